@@ -9,13 +9,13 @@ from django.db import connection
 from django.http import HttpResponse
 
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.connectivity import synapse_counts
 from catmaid.models import UserRole
 
 @requires_user_role(UserRole.Browse)
 def analyze_skeletons(request, project_id=None):
     project_id = int(project_id)
     skids = [int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids[')]
-    s_skids = ",".join(map(str, skids))
     extra = int(request.POST.get('extra', 0))
     adjacents = int(request.POST.get('adjacents', 0))
 
@@ -24,36 +24,33 @@ def analyze_skeletons(request, project_id=None):
 
     cursor = connection.cursor()
 
-    query = '''
-        SELECT tc2.skeleton_id
+    # With extra = 0, just skids are analyzed
+    partners = set()
+    if extra in (1, 3):
+        # Include downstream skeletons
+        partners.update(row[1] for row in synapse_counts(cursor, project_id,
+                pre_skeleton_ids=skids))
+    if extra in (2, 3):
+        # Include upstream skeletons
+        partners.update(row[0] for row in synapse_counts(cursor, project_id,
+                post_skeleton_ids=skids))
+    if 3 == extra:
+        # Also include skeletons linked to the same connectors with the same
+        # relation, e.g. the other postsynaptic partners of a connector.
+        cursor.execute('''
+        SELECT DISTINCT tc2.skeleton_id
         FROM treenode_connector tc1,
              treenode_connector tc2,
-             relation r1,
-             relation r2
+             relation r
         WHERE tc1.skeleton_id IN (%s)
-          AND tc1.relation_id = r1.id
-          AND %s
+          AND tc1.relation_id = r.id
+          AND (r.relation_name = 'presynaptic_to'
+               OR r.relation_name = 'postsynaptic_to')
           AND tc1.connector_id = tc2.connector_id
-          AND tc2.relation_id = r2.id
-          AND %s
-        GROUP BY tc2.skeleton_id'''
-
-    if 0 == extra:
-        # Just skids
-        pass
-    elif 1 == extra:
-        # Include downstream skeletons
-        cursor.execute(query % (s_skids, "r1.relation_name = 'presynaptic_to'", "r2.relation_name = 'postsynaptic_to'"))
-        skids.extend([s[0] for s in cursor.fetchall()])
-    elif 2 == extra:
-        # Include upstream skeletons
-        cursor.execute(query % (s_skids, "r1.relation_name = 'postsynaptic_to'", "r2.relation_name = 'presynaptic_to'"))
-        skids.extend([s[0] for s in cursor.fetchall()])
-    elif 3 == extra:
-        # Include both upstream and downstream skeletons
-        cursor.execute(query % (s_skids, "(r1.relation_name = 'presynaptic_to' OR r1.relation_name = 'postsynaptic_to')", "(r2.relation_name = 'presynaptic_to' OR r2.relation_name = 'postsynaptic_to')"))
-        skids.extend([s[0] for s in cursor.fetchall()])
-
+          AND tc2.relation_id = tc1.relation_id
+        ''' % ",".join(map(str, skids)))
+        partners.update(row[0] for row in cursor.fetchall())
+    skids.extend(partners.difference(skids))
 
     # Obtain neuron names
     cursor.execute('''
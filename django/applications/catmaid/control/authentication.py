@@ -24,6 +24,7 @@ from rest_framework.authtoken.serializers import AuthTokenSerializer
 
 from catmaid.models import Project, UserRole, ClassInstance, \
         ClassInstanceClassInstance
+from catmaid.control import projectcache
 from catmaid.control.common import my_render_to_response
 
 
@@ -109,6 +110,25 @@ def check_user_role(user, project, roles):
     return has_role
 
 
+def get_project(project_id):
+    """Return the project with the passed in ID from the project cache.
+    """
+    project_id = int(project_id)
+    return projectcache.get('projects', project_id,
+            lambda: Project.objects.get(pk=project_id))
+
+
+def cached_check_user_role(user, project_id, roles):
+    """Like check_user_role, but the decision is kept by the project cache for
+    the rest of the current request.
+    """
+    if isinstance(roles, str):
+        roles = [roles]
+    key = (user.id, int(project_id), tuple(roles))
+    return projectcache.get('roles', key,
+            lambda: check_user_role(user, get_project(project_id), roles))
+
+
 def requires_user_role(roles):
     """
     This decorator will return a JSON error response unless the user is logged in
@@ -117,10 +137,9 @@ def requires_user_role(roles):
 
     def decorated_with_requires_user_role(f):
         def inner_decorator(request, roles=roles, *args, **kwargs):
-            p = Project.objects.get(pk=kwargs['project_id'])
             u = request.user
 
-            has_role = check_user_role(u, p, roles)
+            has_role = cached_check_user_role(u, kwargs['project_id'], roles)
 
             if has_role:
                 # The user can execute the function.
@@ -360,7 +379,7 @@ def can_edit_all_or_fail(user, ob_ids, table_name):
             return True
         # If more than one user, check if the request.user can edit them all
         # In other words, check if the set of user_id associated with ob_ids is a subset of the user's domain (the set of user_id that the user can edit)
-        if set(row[0] for row in rows).issubset(user_domain(cursor, user.id)):
+        if set(row[0] for row in rows).issubset(cached_user_domain(cursor, user.id)):
             return True
 
         raise Exception('User %s cannot edit all of the %s unique objects from table %s' % (user.username, len(ob_ids), table_name))
@@ -407,6 +426,13 @@ def user_domain(cursor, user_id):
     domain.add(user_id)
     return domain
 
+def cached_user_domain(cursor, user_id):
+    """Like user_domain, but the domain is kept by the project cache for the
+    rest of the current request.
+    """
+    return set(projectcache.get('domains', user_id,
+            lambda: user_domain(cursor, user_id)))
+
 @requires_user_role([UserRole.Annotate])
 def all_usernames(request, project_id=None):
     """ Return an ordered list of all usernames, each entry a list of id and username. """
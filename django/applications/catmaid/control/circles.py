@@ -10,31 +10,26 @@ from django.http import HttpResponse
 
 from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.connectivity import synapse_counts
 from catmaid.control.skeleton import _neuronnames
 
-def _next_circle(skeleton_set, relations, cursor):
+def _next_circle(project_id, skeleton_set, relations, cursor):
     """ Return a dictionary of skeleton IDs in the skeleton_set vs a dictionary of connected skeletons vs how many connections."""
     pre = relations['presynaptic_to']
     post = relations['postsynaptic_to']
-    cursor.execute('''
-    SELECT tc1.skeleton_id, tc1.relation_id, tc2.skeleton_id
-    FROM treenode_connector tc1,
-         treenode_connector tc2
-    WHERE tc1.skeleton_id in (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.skeleton_id != tc2.skeleton_id
-      AND tc1.relation_id != tc2.relation_id
-      AND (tc1.relation_id = %s OR tc1.relation_id = %s)
-      AND (tc2.relation_id = %s OR tc2.relation_id = %s)
-    ''' % (','.join(map(str, skeleton_set)), pre, post, pre, post))
     connections = defaultdict(partial(defaultdict, partial(defaultdict, int)))
-    for row in cursor.fetchall():
-        connections[row[0]][row[1]][row[2]] += 1
+    for pre_skid, post_skid, confidence, count in synapse_counts(cursor,
+            project_id, pre_skeleton_ids=skeleton_set, exclude_self=True):
+        connections[pre_skid][pre][post_skid] += count
+    for pre_skid, post_skid, confidence, count in synapse_counts(cursor,
+            project_id, post_skeleton_ids=skeleton_set, exclude_self=True):
+        connections[post_skid][post][pre_skid] += count
     return connections
 
 def _relations(cursor, project_id):
-    cursor.execute("SELECT relation_name, id FROM relation WHERE project_id = %s AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')" % int(project_id))
-    return dict(cursor.fetchall())
+    return get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'), cursor)
 
 def _clean_mins(request, cursor, project_id):
     min_pre  = int(request.POST.get('min_pre',  -1))
@@ -76,7 +71,7 @@ def circles_of_hell(request, project_id=None):
 
     while n_circles > 0 and current_circle:
         n_circles -= 1
-        connections = _next_circle(current_circle, relations, cursor)
+        connections = _next_circle(project_id, current_circle, relations, cursor)
         next_circle = set(skID for c in connections.itervalues() \
                           for relationID, cs in c.iteritems() \
                           for skID, count in cs.iteritems() if count >= mins[relationID])
@@ -104,22 +99,19 @@ def find_directed_paths(request, project_id=None):
     relations = _relations(cursor, project_id)
 
     def next_level(skids, rel1, rel2):
-        cursor.execute('''
-        SELECT tc1.skeleton_id, tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2
-        WHERE tc1.skeleton_id in (%s)
-          AND tc1.connector_id = tc2.connector_id
-          AND tc1.skeleton_id != tc2.skeleton_id
-          AND tc1.relation_id = %s
-          AND tc2.relation_id = %s
-        GROUP BY tc1.skeleton_id, tc2.skeleton_id
-        HAVING count(*) >= %s
-        ''' % (','.join(str(skid) for skid in skids),
-               rel1,
-               rel2,
-               min))
-        return cursor.fetchall()
+        # Synapse counts of skids onto their partners if rel1 is presynaptic,
+        # of partners onto skids otherwise.
+        if rel1 == pre:
+            counts = synapse_counts(cursor, project_id, pre_skeleton_ids=skids,
+                    exclude_self=True)
+        else:
+            counts = ((b, a, confidence, count) for a, b, confidence, count
+                      in synapse_counts(cursor, project_id,
+                          post_skeleton_ids=skids, exclude_self=True))
+        pairs = defaultdict(int)
+        for skid, partner, confidence, count in counts:
+            pairs[(skid, partner)] += count
+        return [pair for pair, count in pairs.iteritems() if count >= min]
 
 
     # bidirectional search
@@ -0,0 +1,284 @@
+"""Export of tracing data as typed columns.
+
+Treenodes, connectors, connector links, tags and reviews of a set of skeletons
+or of a whole project are exported as tables. Each table is stored as a NumPy
+.npz archive with one array per column, which can be loaded without parsing
+(e.g. pandas.DataFrame(dict(numpy.load('treenodes.npz')))). Rows are read from
+a server-side cursor in large batches and converted to record arrays without
+creating model instances, exported tables are written batch by batch. Times are stored as datetime64 values in
+microseconds, missing parents as -1.
+"""
+import os
+import shutil
+import tempfile
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+
+import numpy as np
+
+from django.db import connection, transaction
+from django.http import StreamingHttpResponse
+
+from catmaid.models import UserRole
+from catmaid.control.authentication import requires_user_role
+
+# Number of rows read from the database at once
+BATCH_SIZE = 50000
+
+TIME = 'M8[us]'
+
+
+def _time(column):
+    return '(EXTRACT(EPOCH FROM %s) * 1000000)::bigint' % column
+
+
+# For each table its columns and a query with the placeholders "filter" for
+# the condition on skeletons or the project, "connectors" for the condition
+# on connectors.
+TABLES = OrderedDict((
+    ('treenodes', ((
+        ('id', 'i8'), ('parent_id', 'i8'), ('skeleton_id', 'i8'),
+        ('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('radius', 'f4'),
+        ('confidence', 'i2'), ('user_id', 'i4'), ('editor_id', 'i4'),
+        ('creation_time', TIME), ('edition_time', TIME),
+    ), '''
+        SELECT t.id, COALESCE(t.parent_id, -1), t.skeleton_id, t.location_x,
+               t.location_y, t.location_z, t.radius, t.confidence, t.user_id,
+               t.editor_id, %s, %s
+        FROM treenode t
+        WHERE {filter}
+    ''' % (_time('t.creation_time'), _time('t.edition_time')), 't')),
+    ('connectors', ((
+        ('id', 'i8'), ('x', 'f4'), ('y', 'f4'), ('z', 'f4'),
+        ('confidence', 'i2'), ('user_id', 'i4'), ('editor_id', 'i4'),
+        ('creation_time', TIME), ('edition_time', TIME),
+    ), '''
+        SELECT c.id, c.location_x, c.location_y, c.location_z, c.confidence,
+               c.user_id, c.editor_id, %s, %s
+        FROM connector c
+        WHERE {connectors}
+    ''' % (_time('c.creation_time'), _time('c.edition_time')), 'c')),
+    ('links', ((
+        ('id', 'i8'), ('treenode_id', 'i8'), ('connector_id', 'i8'),
+        ('skeleton_id', 'i8'), ('relation_id', 'i8'), ('relation', 'U'),
+        ('confidence', 'i2'), ('user_id', 'i4'), ('creation_time', TIME),
+    ), '''
+        SELECT tc.id, tc.treenode_id, tc.connector_id, tc.skeleton_id,
+               tc.relation_id, r.relation_name, tc.confidence, tc.user_id, %s
+        FROM treenode_connector tc
+        JOIN relation r ON r.id = tc.relation_id
+        WHERE {filter}
+    ''' % _time('tc.creation_time'), 'tc')),
+    ('tags', ((
+        ('treenode_id', 'i8'), ('skeleton_id', 'i8'), ('tag', 'U'),
+        ('user_id', 'i4'), ('creation_time', TIME),
+    ), '''
+        SELECT t.id, t.skeleton_id, ci.name, tci.user_id, %s
+        FROM treenode t
+        JOIN treenode_class_instance tci ON tci.treenode_id = t.id
+        JOIN relation r ON r.id = tci.relation_id
+        JOIN class_instance ci ON ci.id = tci.class_instance_id
+        WHERE {filter}
+          AND r.relation_name = 'labeled_as'
+    ''' % _time('tci.creation_time'), 't')),
+    ('reviews', ((
+        ('id', 'i8'), ('treenode_id', 'i8'), ('skeleton_id', 'i8'),
+        ('reviewer_id', 'i4'), ('review_time', TIME),
+    ), '''
+        SELECT rv.id, rv.treenode_id, rv.skeleton_id, rv.reviewer_id, %s
+        FROM review rv
+        WHERE {filter}
+    ''' % _time('rv.review_time'), 'rv')),
+))
+
+
+def named_cursor(name, itersize=BATCH_SIZE):
+    """Return a server-side cursor of the default database connection, which
+    has to be used in a transaction.
+    """
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(name=name)
+    cursor.itersize = itersize
+    return cursor
+
+
+def _record_dtype(columns):
+    return [(name, 'O' if dtype == 'U' else
+            'i8' if dtype == TIME else dtype) for name, dtype in columns]
+
+
+def _iter_batches(cursor, columns, batch_size):
+    record_dtype = _record_dtype(columns)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield np.array(rows, dtype=record_dtype)
+
+
+def read_columns(cursor, columns, batch_size=BATCH_SIZE):
+    """Read all rows of an executed query into an OrderedDict of column names
+    and arrays of the passed in types. String columns have the type 'U' and
+    get the width of their longest value.
+    """
+    batches = list(_iter_batches(cursor, columns, batch_size))
+    records = np.concatenate(batches) if batches else \
+            np.empty(0, dtype=_record_dtype(columns))
+
+    table = OrderedDict()
+    for name, dtype in columns:
+        column = records[name]
+        if dtype == 'U':
+            column = np.array(column.tolist(), dtype=np.unicode_)
+        elif dtype == TIME:
+            column = column.view(TIME)
+        table[name] = np.ascontiguousarray(column)
+    return table
+
+
+def write_columns(cursor, columns, output, batch_size=BATCH_SIZE):
+    """Write all rows of an executed query as .npz archive with one array per
+    column to <output>, a path or a file. Each batch of rows is appended to a
+    temporary file per column, so that only one batch is held in memory. The
+    arrays have the same types as those of read_columns().
+    """
+    column_files = [tempfile.TemporaryFile() for c in columns]
+    widths = [1] * len(columns)
+    num_rows = 0
+    try:
+        for records in _iter_batches(cursor, columns, batch_size):
+            num_rows += len(records)
+            for i, (name, dtype) in enumerate(columns):
+                if dtype == 'U':
+                    # Batches are stored as arrays of their own width
+                    column = np.array(records[name].tolist(), dtype=np.unicode_)
+                    widths[i] = max(widths[i], column.dtype.itemsize // 4)
+                    np.lib.format.write_array(column_files[i], column)
+                else:
+                    column_files[i].write(
+                            np.ascontiguousarray(records[name]).tobytes())
+
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED, True) as npz:
+            for i, (name, dtype) in enumerate(columns):
+                column_file = column_files[i]
+                column_file.seek(0)
+                dtype = np.dtype((np.unicode_, widths[i]) if dtype == 'U'
+                        else dtype)
+                with tempfile.NamedTemporaryFile() as npy:
+                    np.lib.format.write_array_header_1_0(npy, {
+                        'descr': np.lib.format.dtype_to_descr(dtype),
+                        'fortran_order': False,
+                        'shape': (num_rows,),
+                    })
+                    if dtype.kind == 'U':
+                        written = 0
+                        while written < num_rows:
+                            column = np.lib.format.read_array(column_file)
+                            npy.write(column.astype(dtype).tobytes())
+                            written += len(column)
+                    else:
+                        shutil.copyfileobj(column_file, npy)
+                    npy.flush()
+                    npz.write(npy.name, '%s.npy' % name)
+    finally:
+        for column_file in column_files:
+            column_file.close()
+
+
+def _table_queries(project_id, skeleton_ids=None, tables=None):
+    """Yield the name, columns, query and parameters of each table. Rows are
+    limited to the passed in project, also if skeletons are passed in.
+    """
+    params = {'project_id': int(project_id)}
+    if skeleton_ids is not None:
+        params['skeleton_ids'] = [int(s) for s in skeleton_ids]
+    for name in (tables or TABLES.keys()):
+        columns, query, alias = TABLES[name]
+        condition = '%s.project_id = %%(project_id)s' % alias
+        connectors = 'c.project_id = %(project_id)s'
+        if skeleton_ids is not None:
+            condition += ' AND %s.skeleton_id = ANY(%%(skeleton_ids)s)' % alias
+            connectors += ''' AND c.id IN (SELECT tc.connector_id
+                    FROM treenode_connector tc
+                    WHERE tc.project_id = %(project_id)s
+                      AND tc.skeleton_id = ANY(%(skeleton_ids)s))'''
+        yield name, columns, query.format(filter=condition,
+                connectors=connectors), params
+
+
+@contextmanager
+def _snapshot():
+    """Run the enclosed block in a REPEATABLE READ transaction, so that all
+    tables are read from the same snapshot and links, tags and reviews refer
+    to the same treenodes and connectors. If used within an existing
+    transaction, its isolation level is used.
+    """
+    in_transaction = connection.in_atomic_block
+    with transaction.atomic():
+        if not in_transaction:
+            connection.cursor().execute(
+                    'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        yield
+
+
+def read_tables(project_id, skeleton_ids=None, tables=None):
+    """Return an OrderedDict of table names and columns for the passed in
+    skeletons or, if <skeleton_ids> is None, for the whole project.
+    """
+    result = OrderedDict()
+    with _snapshot():
+        for name, columns, query, params in _table_queries(project_id,
+                skeleton_ids, tables):
+            cursor = named_cursor('columnar_export_%s' % name)
+            cursor.execute(query, params)
+            result[name] = read_columns(cursor, columns)
+            cursor.close()
+    return result
+
+
+def write_tables(project_id, output, skeleton_ids=None, tables=None):
+    """Write each table as <table>.npz to the passed in directory or, if
+    <output> is a zipfile.ZipFile, into the archive. Tables are written while
+    they are read.
+    """
+    with _snapshot():
+        for name, columns, query, params in _table_queries(project_id,
+                skeleton_ids, tables):
+            filename = '%s.npz' % name
+            cursor = named_cursor('columnar_export_%s' % name)
+            cursor.execute(query, params)
+            if isinstance(output, zipfile.ZipFile):
+                with tempfile.NamedTemporaryFile() as npz:
+                    write_columns(cursor, columns, npz)
+                    npz.flush()
+                    output.write(npz.name, filename)
+            else:
+                write_columns(cursor, columns, os.path.join(output, filename))
+            cursor.close()
+
+
+@transaction.non_atomic_requests
+@requires_user_role(UserRole.Browse)
+def export_columnar(request, project_id=None):
+    """Export the treenodes, connectors, connector links, tags and reviews of
+    the skeletons passed as skeleton_ids[] as zip archive of .npz files, one
+    per table. The request isn't wrapped in a transaction, which lets all
+    tables be read from one snapshot.
+    """
+    skeleton_ids = [int(v) for k, v in request.POST.iteritems()
+            if k.startswith('skeleton_ids[')]
+    if not skeleton_ids:
+        raise ValueError("No skeleton IDs provided")
+
+    # Tables are stored without compression, which keeps the export fast
+    archive = tempfile.TemporaryFile()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED, True) as zf:
+        write_tables(project_id, zf, skeleton_ids)
+    archive.seek(0)
+
+    response = StreamingHttpResponse(iter(partial(archive.read, 65536), ''),
+            content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="skeletons.zip"'
+    return response
@@ -4,6 +4,11 @@ import json
 
 from collections import defaultdict
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from django.conf import settings
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
@@ -13,6 +18,7 @@ from catmaid.fields import Double3D
 from catmaid.models import Log, NeuronSearch, CELL_BODY_CHOICES, \
         SORT_ORDERS_DICT, User, Relation, Class, ClassInstance, \
         ClassInstanceClassInstance
+from catmaid.control import projectcache
 
 
 def get_catmaid_version(request):
@@ -94,6 +100,38 @@ def json_error_response(message):
                         content_type='application/json')
 
 
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+
+
+def wants_msgpack(request):
+    """ Return whether a request asks for a msgpack response, either with a
+    "format" parameter or with its Accept header. An explicitly requested
+    format raises an error if msgpack isn't available, the Accept header falls
+    back to JSON.
+    """
+    format = request.GET.get('format', request.POST.get('format'))
+    if format == 'msgpack':
+        if not msgpack:
+            raise ValueError("The msgpack format isn't available on this server")
+        return True
+    elif format:
+        return False
+    return msgpack is not None and \
+            MSGPACK_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', '')
+
+
+def compact_response(data, use_msgpack=False):
+    """ Return <data> as compact JSON or, if <use_msgpack> is true, as msgpack.
+    To keep the response small, msgpack encodes floats with single precision.
+    Unlike JSON, msgpack keeps integer dictionary keys as integers.
+    """
+    if use_msgpack:
+        return HttpResponse(msgpack.packb(data, use_single_float=True),
+                content_type=MSGPACK_CONTENT_TYPE)
+    # Default separators have spaces in them, they aren't needed
+    return HttpResponse(json.dumps(data, separators=(',', ':')))
+
+
 def order_neurons(neurons, order_by=None):
     column, reverse = 'name', False
     if order_by and (order_by in SORT_ORDERS_DICT):
@@ -210,45 +248,44 @@ def cursor_fetch_dictionary(cursor):
             for row in cursor.fetchall()
             ]
 
+def _fetch_name_to_id_map(model, name_field, project_id, cursor):
+    if cursor:
+        cursor.execute("SELECT %s, id FROM %s WHERE project_id = %%s" % \
+                (name_field, model._meta.db_table), (int(project_id),))
+        return dict(cursor.fetchall())
+    else:
+        query = model.objects.filter(project=project_id)
+        return dict(query.values_list(name_field, "id"))
+
+def _filter_name_to_id_map(name_map, name_constraints):
+    if name_constraints:
+        return {name: name_map[name] for name in name_constraints
+                if name in name_map}
+    return dict(name_map)
+
 def get_relation_to_id_map(project_id, name_constraints=None, cursor=None):
     """
     Return a mapping of relation names to relation IDs. If a list of names is
     provided, only relations with those names will be included. If a cursor is
-    provided, this cursor will be used.
+    provided, this cursor will be used. The full mapping of a project is cached
+    in the project cache.
     """
-    if cursor:
-        query = "SELECT relation_name, id  FROM relation WHERE project_id = %s"
-        params = [int(project_id)]
-        if name_constraints:
-            query += " AND (%s)" % ' OR '.join(('relation_name = %s',) * len(name_constraints))
-            params += (name_constraints)
-        cursor.execute(query, params)
-        return dict(cursor.fetchall())
-    else:
-        query = Relation.objects.filter(project=project_id)
-        if name_constraints:
-            query = query.filter(relation_name__in=name_constraints)
-        return {rname: ID for rname, ID in query.values_list("relation_name", "id")}
+    relation_map = projectcache.get('relations', int(project_id),
+            lambda: _fetch_name_to_id_map(Relation, 'relation_name',
+                project_id, cursor))
+    return _filter_name_to_id_map(relation_map, name_constraints)
 
 def get_class_to_id_map(project_id, name_constraints=None, cursor=None):
     """
     Return a mapping of class names to relation IDs. If a list of names is
     provided, only classes with those names will be included. If a cursor is
-    provided, this cursor will be used.
+    provided, this cursor will be used. The full mapping of a project is cached
+    in the project cache.
     """
-    if cursor:
-        query = "SELECT class_name, id  FROM class WHERE project_id = %s"
-        params = [int(project_id)]
-        if name_constraints:
-            query += " AND (%s)" % ' OR '.join(('class_name = %s',) * len(name_constraints))
-            params += (name_constraints)
-        cursor.execute(query, params)
-        return dict(cursor.fetchall())
-    else:
-        query = Class.objects.filter(project=project_id)
-        if name_constraints:
-            query = query.filter(class_name__in=name_constraints)
-        return {cname: ID for cname, ID in query.values_list("class_name", "id")}
+    class_map = projectcache.get('classes', int(project_id),
+            lambda: _fetch_name_to_id_map(Class, 'class_name', project_id,
+                cursor))
+    return _filter_name_to_id_map(class_map, name_constraints)
 
 def urljoin(a, b):
     """ Joins to URL parts a and b while making sure this
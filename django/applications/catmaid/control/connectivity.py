@@ -0,0 +1,94 @@
+"""Synapse counts between skeletons.
+
+The skeleton_connectivity table stores for every pair of pre- and postsynaptic
+skeletons the number of synapses between them, split by confidence (the lower
+confidence of both connector links). It is maintained by triggers on
+treenode_connector and can be rebuilt with the
+catmaid_rebuild_skeleton_connectivity management command. If the
+SKELETON_CONNECTIVITY_TABLE setting is False, synapses are counted by joining
+treenode_connector with itself instead.
+"""
+from django.conf import settings
+
+from catmaid.control.common import get_relation_to_id_map
+
+
+def synapse_counts(cursor, project_id, pre_skeleton_ids=None,
+        post_skeleton_ids=None, exclude_self=False):
+    """Return a list of (pre skeleton ID, post skeleton ID, confidence, count)
+    tuples for all synapses made by any of the presynaptic skeletons onto any
+    of the postsynaptic skeletons. If one of both lists is None, synapses with
+    any partner are counted. Synapses of skeletons onto themselves are left out
+    if exclude_self is True.
+    """
+    if pre_skeleton_ids is None and post_skeleton_ids is None:
+        raise ValueError("Need pre- or postsynaptic skeleton IDs")
+
+    params = {}
+    constraints = []
+    if pre_skeleton_ids is not None:
+        params['pre'] = [int(skid) for skid in pre_skeleton_ids]
+        constraints.append('%(pre_column)s = ANY(%%(pre)s)')
+    if post_skeleton_ids is not None:
+        params['post'] = [int(skid) for skid in post_skeleton_ids]
+        constraints.append('%(post_column)s = ANY(%%(post)s)')
+    if exclude_self:
+        constraints.append('%(pre_column)s != %(post_column)s')
+
+    if getattr(settings, 'SKELETON_CONNECTIVITY_TABLE', True):
+        columns = {'pre_column': 'pre_skeleton_id',
+                   'post_column': 'post_skeleton_id'}
+        query = '''
+            SELECT pre_skeleton_id, post_skeleton_id, confidence, SUM(count)
+            FROM skeleton_connectivity
+            WHERE %s
+            GROUP BY pre_skeleton_id, post_skeleton_id, confidence
+            HAVING SUM(count) > 0
+        '''
+    else:
+        relations = get_relation_to_id_map(project_id,
+                ('presynaptic_to', 'postsynaptic_to'), cursor)
+        params['pre_relation'] = relations['presynaptic_to']
+        params['post_relation'] = relations['postsynaptic_to']
+        columns = {'pre_column': 't1.skeleton_id',
+                   'post_column': 't2.skeleton_id'}
+        query = '''
+            SELECT t1.skeleton_id, t2.skeleton_id,
+                   LEAST(t1.confidence, t2.confidence), count(*)
+            FROM treenode_connector t1
+            JOIN treenode_connector t2 ON t1.connector_id = t2.connector_id
+            WHERE t1.relation_id = %%(pre_relation)s
+              AND t2.relation_id = %%(post_relation)s
+              AND %s
+            GROUP BY 1, 2, 3
+        '''
+
+    where = ' AND '.join(c % columns for c in constraints)
+    cursor.execute(query % where, params)
+    return [(pre, post, confidence, int(count))
+            for pre, post, confidence, count in cursor.fetchall()]
+
+
+def rebuild_skeleton_connectivity(cursor, project_id):
+    """Replace all skeleton_connectivity rows of a project with counts
+    computed from treenode_connector.
+    """
+    # Block concurrent connector link edits until the rebuild is committed
+    cursor.execute('LOCK TABLE treenode_connector IN SHARE MODE')
+    cursor.execute('DELETE FROM skeleton_connectivity WHERE project_id = %s',
+            (project_id,))
+    cursor.execute('''
+        INSERT INTO skeleton_connectivity (project_id, pre_skeleton_id,
+            post_skeleton_id, confidence, count)
+        SELECT t1.project_id, t1.skeleton_id, t2.skeleton_id,
+               LEAST(t1.confidence, t2.confidence), count(*)
+        FROM treenode_connector t1
+        JOIN relation r1 ON r1.id = t1.relation_id
+        JOIN treenode_connector t2 ON t2.connector_id = t1.connector_id
+        JOIN relation r2 ON r2.id = t2.relation_id
+        WHERE t1.project_id = %s
+          AND r1.relation_name = 'presynaptic_to'
+          AND r2.relation_name = 'postsynaptic_to'
+        GROUP BY 1, 2, 3, 4
+    ''', (project_id,))
+    return cursor.rowcount
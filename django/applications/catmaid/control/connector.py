@@ -5,13 +5,13 @@ from itertools import imap
 from datetime import datetime, timedelta
 
 from django.db import connection
-from django.db.models import Count
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
 
 from catmaid.fields import Double3D
 from catmaid.models import Project, Stack, ProjectStack, Connector, \
-        ConnectorClassInstance, Treenode, TreenodeConnector, UserRole
+        ConnectorClassInstance, TreenodeConnector, UserRole
+from catmaid.control import nodecache
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
 from catmaid.control.common import cursor_fetch_dictionary, \
         get_relation_to_id_map
@@ -222,13 +222,12 @@ def list_connector(request, project_id=None):
         connector_ids = map(lambda con: con['connector_id'], connectors)
 
         response_on_error = 'Failed to find counts of treenodes in skeletons.'
-        skel_tn_count = Treenode.objects.filter(skeleton__in=connected_skeletons)\
-        .values('skeleton').annotate(treenode_count=Count('skeleton'))
-        # .values to group by skeleton_id. See http://tinyurl.com/dj-values-annotate
-
-        skeleton_to_treenode_count = {}
-        for s in skel_tn_count:
-            skeleton_to_treenode_count[s['skeleton']] = s['treenode_count']
+        cursor.execute('''
+            SELECT skeleton_id, num_nodes
+            FROM skeleton_summary
+            WHERE skeleton_id = ANY(%s)
+            ''', (list(set(connected_skeletons)),))
+        skeleton_to_treenode_count = dict(cursor.fetchall())
 
         # Rather than do a LEFT OUTER JOIN to also include the connectors
         # with no partners, just do another query to find the connectors
@@ -487,6 +486,8 @@ def create_connector(request, project_id=None):
         confidence=parsed_confidence)
     new_connector.save()
 
+    nodecache.invalidate_nodes(project_id, connector_ids=[new_connector.id])
+
     return HttpResponse(json.dumps({'connector_id': new_connector.id}))
 
 
@@ -494,6 +495,7 @@ def create_connector(request, project_id=None):
 def delete_connector(request, project_id=None):
     connector_id = int(request.POST.get("connector_id", 0))
     can_edit_or_fail(request.user, connector_id, 'connector')
+    nodecache.invalidate_nodes(project_id, connector_ids=[connector_id])
     Connector.objects.filter(id=connector_id).delete()
     return HttpResponse(json.dumps({
         'message': 'Removed connector and class_instances',
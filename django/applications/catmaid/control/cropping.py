@@ -1,4 +1,5 @@
 import json
+import numpy as np
 
 from django.conf import settings
 from django.http import HttpResponse
@@ -7,18 +8,17 @@ from django.contrib.auth.decorators import login_required
 
 from catmaid.models import Stack, Project, ProjectStack, Message, User
 from catmaid.control.common import id_generator, json_error_response
+from catmaid.control.tilefetch import TileFetcher, TileCache
+from catmaid.control.tiffwriter import TiffWriter
 
-import urllib2 as urllib
 import os.path
 import glob
+from copy import copy
+from cStringIO import StringIO
 from time import time
 from math import cos, sin, radians
 
-# The libuuid import is a workaround for a bug with GraphicsMagick
-# which expects the library to be loaded already. Therefore, it
-# has to be loaded before pgmagick.
-from pgmagick import Blob, Image, ImageList, Geometry, ChannelType, \
-        CompositeOperator as co
+from PIL import Image
 
 from celery.task import task
 
@@ -29,6 +29,9 @@ file_extension = "tiff"
 # The path were cropped files get stored in
 crop_output_path = os.path.join(settings.MEDIA_ROOT,
     settings.MEDIA_CROPPING_SUBDIRECTORY)
+# Tiles are fetched concurrently and cached for all crop jobs of a process
+tile_fetcher = TileFetcher(settings.CROPPING_TILE_FETCH_THREADS,
+    TileCache(settings.CROPPING_TILE_CACHE_SIZE))
 
 class CropJob:
     """ A small container class to keep information about the cropping
@@ -67,6 +70,8 @@ class CropJob:
             output_path = os.path.join(crop_output_path, file_name)
         self.single_channel = single_channel
         self.output_path = output_path
+        # Translations of the stacks relative to the project, by stack ID
+        self.translations = {}
         # State that extra initialization is needed
         self.needs_initialization = True
 
@@ -94,6 +99,17 @@ class CropJob:
         # Initialization is done
         self.needs_initialization = False
 
+    def get_translation(self, stack):
+        """ Returns the translation of a stack relative to the project. It is
+        queried only once, copies of a job share the result.
+        """
+        translation = self.translations.get(stack.id)
+        if translation is None:
+            translation = ProjectStack.objects.get(
+                    project_id=self.project_id, stack_id=stack.id).translation
+            self.translations[stack.id] = translation
+        return translation
+
     def get_tile_path(self, stack, tile_coords):
         """ This method returns the path of a tile from a specific stack on a
         particular coordinate. It needs initialization where it will be replaced
@@ -153,12 +169,6 @@ class CropJob:
         raise StandardError("Tile source %s is currently not supported " \
                 "by cropping module" % stack.tile_source_type)
 
-class ImageRetrievalError(IOError):
-    def __init__(self, path, error):
-        IOError.__init__(self, "Couldn't access %s" % (path))
-        self.path = path
-        self.error = error
-
 class ImagePart:
     """ A part of a 2D image where height and width are not necessarily
     of the same size. Provides readout of the defined sub-area of the image.
@@ -179,32 +189,37 @@ class ImagePart:
             raise ValueError( "An image part must have an area, hence no " \
                     "extent should be zero!" )
 
-    def get_image( self ):
-        # Open the image
-        try:
-            img_file = urllib.urlopen( self.path )
-            img_data = img_file.read()
-            bytes_read = len(img_data)
-        except urllib.HTTPError as e:
-            raise ImageRetrievalError(self.path, "Error code: %s" % e.code)
-        except urllib.URLError as e:
-            raise ImageRetrievalError(self.path, e.reason)
-
-        blob = Blob( img_data )
-        image = Image( blob )
-        # Check if the whole image should be used and cropped if necessary.
-        src_width = image.size().width()
-        src_height = image.size().height()
-        if self.width != src_width or self.height != src_height:
-            box = Geometry( self.width, self.height, self.x_min_src, self.y_min_src )
-            image.crop( box )
+    def get_image( self, img_data=None, single_channel=False ):
+        """ Returns the image part as NumPy array of shape (height, width,
+        channels). It has three (RGB) channels or, if single_channel is set,
+        only the red one. If the tile data isn't passed in, it is fetched from
+        the tile source.
+        """
+        if img_data is None:
+            img_data = tile_fetcher.fetch( self.path )
+        bytes_read = len(img_data)
+
+        image = Image.open( StringIO(img_data) )
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        src_width, src_height = image.size
+        pixels = np.asarray(image)
+        if pixels.ndim == 2:
+            pixels = pixels.reshape(pixels.shape + (1,))
+        # Use only the requested part, slicing clips it to the tile bounds
+        pixels = pixels[self.y_min_src:self.y_min_src + self.height,
+                        self.x_min_src:self.x_min_src + self.width]
+        if single_channel:
+            pixels = pixels[:, :, :1]
+        elif pixels.shape[2] == 1:
+            pixels = np.repeat(pixels, 3, axis=2)
 
         # Estimates the size in Bytes of this image part by scaling the number
         # of Bytes read with the ratio between the needed part of the image and
         # its actual size.
         self.estimated_size = bytes_read * abs(float(self.width * self.height) /
                                                float(src_width * src_height))
-        return image
+        return pixels
 
 def to_x_index( x, job, enforce_bounds=True ):
     """ Converts a real world position to a x pixel position.
@@ -233,26 +248,18 @@ def to_z_index( z, job, enforce_bounds=True ):
         section = min(max(section, 0.0), job.ref_stack.dimension.z - 1.0)
     return int( section )
 
-def addMetaData( path, job, result ):
-    """ Use this method to add meta data to the image. Due to a bug in
-    exiv2, its python wrapper pyexiv2 is of no use to us. This bug
-    (http://dev.exiv2.org/issues/762) hinders us to work on multi-page
-    TIFF files. Instead, we use a separate tool called exiftool to write
-    meta data. Currently, there seems no better solution than this. If the
-    tool is not found, no meta data is produced and no error is raised.
+def get_resolution( job ):
+    """ Returns the resolution of the cropped images in pixel per nanometer.
+    The stack info available is nm/px and refers to a zoom-level of zero.
     """
-    # Add resolution information in pixel per nanometer. The stack info
-    # available is nm/px and refers to a zoom-level of zero.
     res_x_scaled = job.ref_stack.resolution.x * 2**job.zoom_level
     res_y_scaled = job.ref_stack.resolution.y * 2**job.zoom_level
-    res_x_nm_px = 1.0 / res_x_scaled
-    res_y_nm_px = 1.0 / res_y_scaled
-    res_args = "-EXIF:XResolution={0} -EXIF:YResolution={1} -EXIF:" \
-            "ResolutionUnit=None".format( str(res_x_nm_px), str(res_y_nm_px) )
-
-    # ImageJ specific meta data to allow easy embedding of units and
-    # display options.
-    n_images = len( result )
+    return (1.0 / res_x_scaled, 1.0 / res_y_scaled)
+
+def get_imagej_description( job, n_images ):
+    """ Returns ImageJ specific meta data, which is stored as TIFF image
+    description, to allow easy embedding of units and display options.
+    """
     ij_version= "1.45p"
     unit = "nm"
     newline = "\n"
@@ -267,140 +274,124 @@ def addMetaData( path, job, result ):
                     "modulo the channel count is not zero" )
         n_slices = n_images / n_channels
         ij_data += "images={1}{0}channels={2}{0}slices={3}{0}hyperstack=true{0}mode=color{0}".format( newline, str(n_images), str(n_channels), str(n_slices) )
-    ij_args = "-EXIF:ImageDescription=\"{0}\"".format( ij_data )
-
-    # Information about the software used
-    sw_args = "-EXIF:Software=\"Created with CATMAID and GraphicsMagic, " \
-            "processed with exiftool.\""
-    # Build up the final tag changing arguments for each slice
-    tag_args = "{0} {1} {2}".format( res_args, ij_args, sw_args )
-    per_slice_tag_args = []
-    for i in range(0, n_images):
-        # the string EXIF gets replaced for every image with IFD<N>
-        slice_args = tag_args.replace( "EXIF", "IFD" + str(i) )
-        per_slice_tag_args.append( slice_args  )
-    final_tag_args = " ".join( per_slice_tag_args )
-    # Create the final call and execute
-    call = "exiftool -overwrite_original {0} {1}".format( final_tag_args, path )
-    os.system( call )
-
-    # Re-save the image with GraphicsMagick, otherwise ImageJ won't read the
-    # images directly.
-    images = ImageList()
-    images.readImages( path )
-    images.writeImages( path )
+    return ij_data
+
+def to_pil_image( image ):
+    """ Returns a PIL image of a single slice, as returned by
+    extract_substack.
+    """
+    if image.shape[2] == 1:
+        image = image[:, :, 0]
+    return Image.fromarray( image )
+
+def write_image( image, path ):
+    """ Writes a single slice, as returned by extract_substack, to the
+    passed in path. The file format is defined by the file extension.
+    """
+    to_pil_image( image ).save( path )
+
+def encode_image( image, format="TIFF" ):
+    """ Returns the data of a single slice, as returned by extract_substack,
+    encoded in the passed in file format.
+    """
+    data = StringIO()
+    to_pil_image( image ).save( data, format )
+    return data.getvalue()
 
 def extract_substack( job ):
     """ Extracts a sub-stack as specified in the passed job while respecting
-    rotation requests. A list of pgmagick images is returned -- one for each
-    slice, starting on top.
+    rotation requests. An iterator over NumPy arrays of shape (height, width,
+    channels) is returned -- one for each slice and stack, starting on top.
+    Slices are created when they are requested, so that only one of them has
+    to be kept in memory at a time.
     """
 
     # Make sure tile source getters have been initialized on the job
     if job.needs_initialization:
         job.initialize()
 
-    # Treat rotation requests special
-    if abs(job.rotation_cw) < 0.00001:
-        # No rotation, create the sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
-    elif abs(job.rotation_cw - 90.0) < 0.00001:
-        # 90 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(270.0)
-    elif abs(job.rotation_cw - 180.0) < 0.00001:
-        # 180 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(180.0)
-    elif abs(job.rotation_cw - 270.0) < 0.00001:
-        # 270 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(90.0)
-    else:
-        # Some methods do counter-clockwise rotation
-        rotation_ccw = 360.0 - job.rotation_cw
-        # There is rotation requested. First, backup the cropping
-        # coordinates and manipulate the job to create a cropped
-        # stack of the bounding box of the rotated box.
-        real_x_min = job.x_min
-        real_x_max = job.x_max
-        real_y_min = job.y_min
-        real_y_max = job.y_max
-        # Rotate bounding box counter-clockwise around center.
-        center = [0.5 * (job.x_max + job.x_min),
-            0.5 * (job.y_max + job.y_min)]
-        rot_p1 = rotate2d(rotation_ccw,
-            [real_x_min, real_y_min], center)
-        rot_p2 = rotate2d(rotation_ccw,
-            [real_x_min, real_y_max], center)
-        rot_p3 = rotate2d(rotation_ccw,
-            [real_x_max, real_y_max], center)
-        rot_p4 = rotate2d(rotation_ccw,
-            [real_x_max, real_y_min], center)
-        # Find new (larger) bounding box of rotated ROI and write
-        # them into the job
-        job.x_min = min([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
-        job.y_min = min([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
-        job.x_max = max([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
-        job.y_max = max([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
-        # Create the enlarged sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
-
-        # Next, rotate the whole result stack counterclockwise to have the
-        # actual ROI axis aligned.
-        for img in cropped_stack:
-            img.rotate(rotation_ccw)
-
-        # Last, do a second crop to remove the not needed parts. The region
-        # to crop is defined by the relative original crop-box coordinates to
-        # to the rotated bounding box.
-        rot_bb_p1 = rotate2d(rotation_ccw,
-            [job.x_min, job.y_min], center)
-        rot_bb_p2 = rotate2d(rotation_ccw,
-            [job.x_min, job.y_max], center)
-        rot_bb_p3 = rotate2d(rotation_ccw,
-            [job.x_max, job.y_max], center)
-        rot_bb_p4 = rotate2d(rotation_ccw,
-            [job.x_max, job.y_min], center)
-        # Get bounding box minimum coordinates in world space
-        bb_x_min = min([rot_bb_p1[0], rot_bb_p2[0], rot_bb_p3[0], rot_bb_p4[0]])
-        bb_y_min = min([rot_bb_p1[1], rot_bb_p2[1], rot_bb_p3[1], rot_bb_p4[1]])
-        # Create relative final crop coordinates
-        crop_p1 = [abs(real_x_min - bb_x_min), abs(real_y_min - bb_y_min)]
-        crop_p2 = [abs(real_x_min - bb_x_min), abs(real_y_max - bb_y_min)]
-        crop_p3 = [abs(real_x_max - bb_x_min), abs(real_y_min - bb_y_min)]
-        crop_p4 = [abs(real_x_max - bb_x_min), abs(real_y_max - bb_y_min)]
-        crop_x_min = min([crop_p1[0], crop_p2[0], crop_p3[0], crop_p4[0]])
-        crop_y_min = min([crop_p1[1], crop_p2[1], crop_p3[1], crop_p4[1]])
-        crop_x_max = max([crop_p1[0], crop_p2[0], crop_p3[0], crop_p4[0]])
-        crop_y_max = max([crop_p1[1], crop_p2[1], crop_p3[1], crop_p4[1]])
-        crop_x_min_px = to_x_index(crop_x_min, job, False)
-        crop_y_min_px = to_y_index(crop_y_min, job, False)
-        crop_x_max_px = to_x_index(crop_x_max, job, False)
-        crop_y_max_px = to_y_index(crop_y_max, job, False)
-        crop_width_px = crop_x_max_px - crop_x_min_px
-        crop_height_px = crop_y_max_px - crop_y_min_px
-        # Crop all images (Geometry: width, height, xOffset, yOffset)
-        crop_geometry = Geometry(crop_width_px, crop_height_px,
-            crop_x_min_px, crop_y_min_px)
-        for img in cropped_stack:
-            img.crop(crop_geometry)
-
-        # Reset the original job parameters
-        job.x_min = real_x_min
-        job.x_max = real_x_max
-        job.y_min = real_y_min
-        job.y_max = real_y_max
-
-    return cropped_stack
+    # Treat rotation requests special: right angles need only a simple
+    # rotation of the sub-stack (np.rot90 rotates counter-clockwise).
+    for k, angle in enumerate( (0.0, 90.0, 180.0, 270.0) ):
+        if abs(job.rotation_cw - angle) < 0.00001:
+            return (np.rot90(img, k) for img in
+                    extract_substack_no_rotation( job ))
+
+    # For other angles, the bounding box of the rotated ROI is extracted by a
+    # copy of the job, which is then resampled in a rotated frame to have the
+    # actual ROI axis aligned.
+    bb_job = copy(job)
+    # Rotate bounding box counter-clockwise around center.
+    rotation_ccw = 360.0 - job.rotation_cw
+    center = [0.5 * (job.x_max + job.x_min),
+        0.5 * (job.y_max + job.y_min)]
+    rot_p1 = rotate2d(rotation_ccw,
+        [job.x_min, job.y_min], center)
+    rot_p2 = rotate2d(rotation_ccw,
+        [job.x_min, job.y_max], center)
+    rot_p3 = rotate2d(rotation_ccw,
+        [job.x_max, job.y_max], center)
+    rot_p4 = rotate2d(rotation_ccw,
+        [job.x_max, job.y_min], center)
+    # Find new (larger) bounding box of rotated ROI and write
+    # them into the job copy
+    bb_job.x_min = min([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
+    bb_job.y_min = min([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
+    bb_job.x_max = max([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
+    bb_job.y_max = max([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
+
+    # The size of the ROI in pixels
+    width = to_x_index(job.x_max, job, False) - to_x_index(job.x_min, job, False)
+    height = to_y_index(job.y_max, job, False) - to_y_index(job.y_min, job, False)
+
+    return rotate_slices(extract_substack_no_rotation( bb_job ),
+            job.rotation_cw, width, height)
+
+def rotate_slices( slices, rotation_cw, width, height ):
+    """ Rotates each of the passed in slices counter-clockwise by rotation_cw
+    degrees around its center and returns the centered width x height pixels
+    of it. Pixel values are interpolated bilinearly, pixels that are mapped
+    outside of a slice are black.
+    """
+    angle = radians(rotation_cw)
+    # Sampling positions are the same for all slices of the same size
+    samplings = {}
+    for img in slices:
+        src_height, src_width = img.shape[:2]
+        sampling = samplings.get((src_height, src_width))
+        if sampling is None:
+            # Map each target pixel to its position in the source slice
+            v, u = np.mgrid[0:height, 0:width].astype(np.float64)
+            du = u - 0.5 * (width - 1)
+            dv = v - 0.5 * (height - 1)
+            x = 0.5 * (src_width - 1) + du * cos(angle) - dv * sin(angle)
+            y = 0.5 * (src_height - 1) + du * sin(angle) + dv * cos(angle)
+            x0 = np.floor(x)
+            y0 = np.floor(y)
+            wx = (x - x0).astype(np.float32)[:, :, np.newaxis]
+            wy = (y - y0).astype(np.float32)[:, :, np.newaxis]
+            # Indices into the source slice with a black border of one pixel,
+            # positions further outside are moved onto this border.
+            x0 = np.clip(x0.astype(np.intp) + 1, 0, src_width + 1)
+            y0 = np.clip(y0.astype(np.intp) + 1, 0, src_height + 1)
+            x1 = np.clip(x0 + 1, 0, src_width + 1)
+            y1 = np.clip(y0 + 1, 0, src_height + 1)
+            sampling = samplings[(src_height, src_width)] = \
+                    (x0, y0, x1, y1, wx, wy)
+
+        x0, y0, x1, y1, wx, wy = sampling
+        padded = np.zeros((src_height + 2, src_width + 2, img.shape[2]),
+                dtype=np.float32)
+        padded[1:-1, 1:-1] = img
+        top = padded[y0, x0] * (1 - wx) + padded[y0, x1] * wx
+        bottom = padded[y1, x0] * (1 - wx) + padded[y1, x1] * wx
+        rotated = top * (1 - wy) + bottom * wy
+        yield np.rint(rotated).astype(img.dtype)
 
 def extract_substack_no_rotation( job ):
     """ Extracts a sub-stack as specified in the passed job without respecting
-    rotation requests. A list of pgmagick images is returned -- one for each
-    slice, starting on top.
+    rotation requests. An iterator over NumPy arrays is returned -- one for
+    each slice and stack, starting on top.
     """
 
     # The actual bounding boxes used for creating the images of each stack
@@ -410,8 +401,7 @@ def extract_substack_no_rotation( job ):
     s_to_bb = {}
     for stack in job.stacks:
         # Retrieve translation relative to current project
-        translation = ProjectStack.objects.get(
-                project_id=job.project_id, stack_id=stack.id).translation
+        translation = job.get_translation(stack)
         x_min_t = job.x_min - translation.x
         x_max_t = job.x_max - translation.x
         y_min_t = job.y_min - translation.y
@@ -462,14 +452,18 @@ def extract_substack_no_rotation( job ):
 
     # Each stack to export is treated as a separate channel. The order
     # of the exported dimensions is XYCZ. This means all the channels of
-    # one slice are exported, then the next slice follows, etc.
-    cropped_stack = []
-    # Accumulator for estimated result size
-    estimated_total_size = 0
-    # Iterate over all slices
+    # one slice are exported, then the next slice follows, etc. The image
+    # parts of all slices and channels are collected first, so that their
+    # tiles can be fetched concurrently.
+    channel_slices = []
     for nz in range(n_slices):
         for stack in job.stacks:
             bb = s_to_bb[stack.id]
+            # Slices without an area don't produce an image. No tiles are
+            # requested for them, which keeps the fetched tiles in sync with
+            # the image parts of the remaining slices.
+            if bb.width <= 0 or bb.height <= 0:
+                continue
             # Shortcut for tile width and height
             tile_width = stack.tile_width
             tile_height = stack.tile_height
@@ -516,47 +510,45 @@ def extract_substack_no_rotation( job ):
                     y_dst += cur_px_y_max - cur_px_y_min
                 # Update x component of destination position
                 x_dst += cur_px_x_max - cur_px_x_min
+            channel_slices.append( (bb, image_parts) )
 
-            # Write out the image parts and make sure the maximum allowed file
-            # size isn't exceeded.
-            cropped_slice = None
-            for ip in image_parts:
-                # Get (correctly cropped) image
-                image = ip.get_image()
-
-                # Estimate total file size and abort if this exceeds the
-                # maximum allowed file size.
-                estimated_total_size = estimated_total_size + ip.estimated_size
-                if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
-                    raise ValueError("The estimated size of the requested image "
-                                     "region is larger than the maximum allowed "
-                                     "file size: %0.2f > %s Bytes" % \
-                                     (estimated_total_size,
-                                      settings.GENERATED_FILES_MAXIMUM_SIZE))
-
-                # It is unfortunately not possible to create proper composite
-                # images based on a canvas image newly created like this:
-                # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
-                # Therefore, this workaround is used.
-                if not cropped_slice:
-                    cropped_slice = Image(image)
-                    cropped_slice.backgroundColor("black")
-                    cropped_slice.erase()
-                    # The '!' makes sure the aspect ration is ignored
-                    cropped_slice.scale('%sx%s!' % (bb.width, bb.height))
-                # Draw the image onto result image
-                cropped_slice.composite( image, ip.x_dst, ip.y_dst, co.OverCompositeOp )
-                # Delete tile image - it's not needed anymore
-                del image
-
-            if cropped_slice:
-                # Optionally, use only a single channel
-                if job.single_channel:
-                    cropped_slice.channel( ChannelType.RedChannel )
-                # Add the image to the cropped stack
-                cropped_stack.append( cropped_slice )
-
-    return cropped_stack
+    tiles = tile_fetcher.fetch_all(ip.path for bb, image_parts in channel_slices
+            for ip in image_parts)
+
+    # Number of channels of each result image
+    n_channels = 1 if job.single_channel else 3
+    # Accumulator for estimated result size
+    estimated_total_size = 0
+    for bb, image_parts in channel_slices:
+        if not image_parts:
+            continue
+        # Assemble the image parts in a black image. Write out the image parts
+        # and make sure the maximum allowed file size isn't exceeded.
+        cropped_slice = np.zeros((bb.height, bb.width, n_channels),
+                dtype=np.uint8)
+        for ip in image_parts:
+            # Get (correctly cropped) image
+            image = ip.get_image( next(tiles), job.single_channel )
+
+            # Estimate total file size and abort if this exceeds the
+            # maximum allowed file size.
+            estimated_total_size = estimated_total_size + ip.estimated_size
+            if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+                raise ValueError("The estimated size of the requested image "
+                                 "region is larger than the maximum allowed "
+                                 "file size: %0.2f > %s Bytes" % \
+                                 (estimated_total_size,
+                                  settings.GENERATED_FILES_MAXIMUM_SIZE))
+
+            # Draw the image onto result image, parts outside of it are
+            # clipped.
+            height = min(image.shape[0], bb.height - ip.y_dst)
+            width = min(image.shape[1], bb.width - ip.x_dst)
+            if height > 0 and width > 0:
+                cropped_slice[ip.y_dst:ip.y_dst + height,
+                              ip.x_dst:ip.x_dst + width] = image[:height, :width]
+
+        yield cropped_slice
 
 def rotate2d(degrees, point, origin):
     """ A rotation function that rotates a point counter-clockwise around
@@ -577,23 +569,20 @@ def process_crop_job(job, create_message=True):
     """ This method does the actual cropping. It controls the data extraction
     and the creation of the sub-stack. It can be executed as Celery task.
     """
+    writer = None
     try:
-        # Create the sub-stack
-        cropped_stack = extract_substack( job )
-
-        # Create tho output image
-        outputImage = ImageList()
-        for img in cropped_stack:
-            outputImage.append( img )
+        # Write the sub-stack page by page to the output file
+        for img in extract_substack( job ):
+            if writer is None:
+                writer = TiffWriter( job.output_path, get_resolution( job ),
+                        "Created with CATMAID" )
+            writer.write_page( img )
 
-        # Save the resulting micro_stack to a temporary location
         no_error_occured = True
         error_message = ""
         # Only produce an image if parts of stacks are within the output
-        if len( cropped_stack ) > 0:
-            outputImage.writeImages( job.output_path )
-            # Add some meta data to the image
-            addMetaData( job.output_path, job, cropped_stack )
+        if writer:
+            writer.close( get_imagej_description( job, writer.num_pages ) )
         else:
             no_error_occured = False
             error_message = "A region outside the stack has been selected. " \
@@ -601,6 +590,8 @@ def process_crop_job(job, create_message=True):
     except (IOError, OSError, ValueError), e:
         no_error_occured = False
         error_message = str(e)
+        if writer:
+            writer.close()
         # Delete the file if parts of it have been written already
         if os.path.exists( job.output_path ):
             os.remove( job.output_path )
@@ -16,6 +16,7 @@ from rest_framework.decorators import api_view
 from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.connectivity import synapse_counts
 from catmaid.control.tree_util import simplify
 
 def basic_graph(project_id, skeleton_ids):
@@ -27,22 +28,10 @@ def basic_graph(project_id, skeleton_ids):
 
     cursor = connection.cursor()
 
-    relations = get_relation_to_id_map(project_id, ('presynaptic_to', 'postsynaptic_to'), cursor)
-    preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
-
-    cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence)
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t2.relation_id = %s
-    ''' % (','.join(map(str, skeleton_ids)), preID, postID))
-
     edges = defaultdict(partial(defaultdict, newSynapseCounts))
-    for row in cursor.fetchall():
-        edges[row[0]][row[1]][row[2] - 1] += 1
+    for pre, post, confidence, count in synapse_counts(cursor, project_id,
+            pre_skeleton_ids=skeleton_ids):
+        edges[pre][post][confidence - 1] += count
 
     return {'edges': tuple((pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems())}
 
@@ -0,0 +1,258 @@
+"""A write-ahead journal for label tiles of HDF5 stacks.
+
+Writing a label tile directly to the HDF5 file of a stack requires opening the
+file for writing, which serializes concurrent label painting on file access.
+Instead, label tiles are appended to a journal file next to the HDF5 file and
+copied to the HDF5 file later by a single writer, which coalesces all pending
+tiles by HDF5 chunk. Readers apply pending tiles of the journal to the data
+read from the HDF5 file, so that written labels are visible immediately. They
+have to read the pending tiles before the HDF5 file: tiles that are flushed in
+between are then found in the file.
+
+The journal <path>.journal is renamed to <path>.journal.flushing while its
+tiles are written to the HDF5 file, new tiles are added to a new journal in
+the meantime. All journal access is guarded with file locks. The HDF5 file is
+locked exclusively while it is written and shared by readers, its
+modification time is updated after each flush, so that readers reopen it.
+
+A queued flush is marked with the file <path>.journal.scheduled, which is
+removed when the flush starts. Writers and readers that find pending tiles
+queue a flush if there is no marker or if it is older than a timeout, in
+which case the queued flush is taken to be lost.
+"""
+import os
+import time
+import fcntl
+import errno
+import struct
+from collections import defaultdict
+from contextlib import closing, contextmanager
+
+import h5py
+import numpy as np
+
+# Scale, x, y, z, width and height of a tile, followed by its pixels
+RECORD_HEADER = struct.Struct('<6i')
+
+# The chunk size used for datasets that aren't chunked
+DEFAULT_CHUNK_SIZE = (256, 256)
+
+
+def journal_path(path):
+    return path + '.journal'
+
+def flushing_path(path):
+    return path + '.journal.flushing'
+
+def scheduled_path(path):
+    return path + '.journal.scheduled'
+
+def dataset_path(scale):
+    return '/labels/scale/' + str(int(scale)) + '/data'
+
+
+def append(path, scale, x, y, z, labels):
+    """Add a tile of labels (a 2D uint8 array) for the HDF5 file at <path> to
+    its journal.
+    """
+    labels = np.ascontiguousarray(labels, dtype=np.uint8)
+    height, width = labels.shape
+    record = RECORD_HEADER.pack(int(scale), x, y, z, width, height) + \
+            labels.tobytes()
+    target = journal_path(path)
+    while True:
+        fd = os.open(target, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # The journal could have been renamed for flushing while waiting
+            # for the lock, in which case a new one is needed.
+            try:
+                current = os.stat(target)
+            except OSError:
+                continue
+            if current.st_ino != os.fstat(fd).st_ino:
+                continue
+            os.write(fd, record)
+            return
+        finally:
+            os.close(fd)
+
+
+def claim_flush(path, timeout):
+    """Return True if a flush of the journal of the HDF5 file at <path> has to
+    be queued by the caller, because none has been queued within the last
+    <timeout> seconds.
+    """
+    target = scheduled_path(path)
+    try:
+        os.close(os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        return True
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    try:
+        if time.time() - os.path.getmtime(target) < timeout:
+            return False
+        os.utime(target, None)
+        return True
+    except OSError as e:
+        # The marker has been removed by a starting flush in the meantime
+        if e.errno == errno.ENOENT:
+            return claim_flush(path, timeout)
+        raise
+
+
+@contextmanager
+def _file_lock(path, operation):
+    fd = os.open(path + '.journal.write', os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, operation)
+        yield
+    finally:
+        os.close(fd)
+
+
+def reading(path):
+    """Return a context manager that keeps flushes from writing to the HDF5
+    file at <path> while the enclosed block reads from it.
+    """
+    return _file_lock(path, fcntl.LOCK_SH)
+
+
+def _read_records(target):
+    """Return a list of (scale, x, y, z, labels) tuples of all complete
+    records of a journal file.
+    """
+    try:
+        with open(target, 'rb') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            data = f.read()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+    records = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        scale, x, y, z, width, height = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        size = width * height
+        if offset + size > len(data):
+            break
+        labels = np.frombuffer(data, dtype=np.uint8, count=size,
+                offset=offset).reshape((height, width))
+        records.append((scale, x, y, z, labels))
+        offset += size
+    return records
+
+
+def pending_records(path):
+    """Return all tiles that haven't been written to the HDF5 file at <path>
+    yet, oldest first.
+    """
+    # The current journal is read first. If it is renamed for flushing in the
+    # meantime, its records are found again in the flushing journal.
+    current = _read_records(journal_path(path))
+    return _read_records(flushing_path(path)) + current
+
+
+def apply_pending(records, scale, x, y, z, data):
+    """Copy the tiles of scale <scale> and section <z> in <records>, a result
+    of pending_records(), that overlap the 2D array <data>, which starts at
+    <x>, <y>, into it.
+    """
+    for r_scale, r_x, r_y, r_z, labels in records:
+        if r_scale != int(scale) or r_z != z:
+            continue
+        _copy_overlap(labels, r_x, r_y, data, x, y)
+    return data
+
+
+def _copy_overlap(src, src_x, src_y, dst, dst_x, dst_y):
+    x0 = max(src_x, dst_x)
+    y0 = max(src_y, dst_y)
+    x1 = min(src_x + src.shape[1], dst_x + dst.shape[1])
+    y1 = min(src_y + src.shape[0], dst_y + dst.shape[0])
+    if x1 > x0 and y1 > y0:
+        dst[y0 - dst_y:y1 - dst_y, x0 - dst_x:x1 - dst_x] = \
+                src[y0 - src_y:y1 - src_y, x0 - src_x:x1 - src_x]
+
+
+def flush(path):
+    """Write all pending tiles of the journal of the HDF5 file at <path> to
+    it. Tiles are grouped by the chunks of the label datasets, each chunk is
+    read and written only once. Returns the number of written tiles or None
+    if another process is flushing the journal already.
+    """
+    lock_fd = os.open(path + '.journal.lock', os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+
+        # Tiles that are added from now on need another flush
+        try:
+            os.remove(scheduled_path(path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        num_records = 0
+        while True:
+            # A journal left over by an interrupted flush is written first
+            if not os.path.exists(flushing_path(path)):
+                try:
+                    os.rename(journal_path(path), flushing_path(path))
+                except OSError as e:
+                    if e.errno == errno.ENOENT:
+                        return num_records
+                    raise
+
+            # Wait for writers that still append to the renamed journal
+            with open(flushing_path(path), 'rb') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            records = _read_records(flushing_path(path))
+
+            if records:
+                with _file_lock(path, fcntl.LOCK_EX):
+                    with closing(h5py.File(path, 'a')) as hfile:
+                        _write_records(hfile, records)
+                    # Readers reopen files whose modification time changed
+                    os.utime(path, None)
+            os.remove(flushing_path(path))
+            num_records += len(records)
+    finally:
+        os.close(lock_fd)
+
+
+def _write_records(hfile, records):
+    # Split records by the chunks they touch, keeping their order
+    chunks = defaultdict(list)
+    for scale, x, y, z, labels in records:
+        if dataset_path(scale) not in hfile:
+            continue
+        dataset = hfile[dataset_path(scale)]
+        chunk_height, chunk_width = (dataset.chunks or DEFAULT_CHUNK_SIZE)[:2]
+        height, width = labels.shape
+        for cy in range(y // chunk_height, (y + height - 1) // chunk_height + 1):
+            for cx in range(x // chunk_width, (x + width - 1) // chunk_width + 1):
+                chunks[(scale, z, cy, cx)].append((x, y, labels))
+
+    for (scale, z, cy, cx), parts in chunks.iteritems():
+        dataset = hfile[dataset_path(scale)]
+        chunk_height, chunk_width = (dataset.chunks or DEFAULT_CHUNK_SIZE)[:2]
+        y0 = cy * chunk_height
+        x0 = cx * chunk_width
+        y1 = min(y0 + chunk_height, dataset.shape[0])
+        x1 = min(x0 + chunk_width, dataset.shape[1])
+        if y1 <= y0 or x1 <= x0:
+            continue
+        block = dataset[y0:y1, x0:x1, z]
+        for x, y, labels in parts:
+            _copy_overlap(labels, x, y, block, x0, y0)
+        dataset[y0:y1, x0:x1, z] = block
@@ -5,6 +5,7 @@ from django.core.exceptions import ObjectDoesNotExist
 
 from catmaid.models import UserRole, Project, Relation, Treenode, Connector, \
         TreenodeConnector, ClassInstance
+from catmaid.control import nodecache
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
 
 @requires_user_role(UserRole.Annotate)
@@ -69,6 +70,8 @@ def create_link(request, project_id=None):
         connector=to_connector  # connector_id = to_id
     ).save()
 
+    nodecache.invalidate_nodes(project_id, connector_ids=[to_id])
+
     result['message'] = 'success'
     return HttpResponse(json.dumps(result), content_type='application/json')
 
@@ -90,6 +93,7 @@ def delete_link(request, project_id=None):
     # and the user_id not matching or not being superuser.
     can_edit_or_fail(request.user, links[0].id, 'treenode_connector')
 
+    nodecache.invalidate_nodes(project_id, connector_ids=[connector_id])
     links[0].delete()
     return HttpResponse(json.dumps({'result': 'Removed treenode to connector link'}))
 
@@ -5,13 +5,14 @@ from itertools import izip
 
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
-from django.db import connection
+from django.db import connection, transaction
 
 from rest_framework.decorators import api_view
 
 from catmaid.models import UserRole, Project, Class, ClassInstance, \
         ClassInstanceClassInstance, Relation, ReviewerWhitelist
-from catmaid.control.authentication import requires_user_role, can_edit_or_fail
+from catmaid.control.authentication import requires_user_role, \
+        cached_user_domain
 from catmaid.control.common import defaultdict, get_relation_to_id_map, \
         get_class_to_id_map
 
@@ -22,10 +23,9 @@ def create_basic_annotated_entity_query(project, params, relations, classes,
 
     annotated_with = relations['annotated_with']
 
-    # One list of annotation sets for requested annotations and one for those
-    # of which subannotations should be included
-    annotation_sets = set()
-    annotation_sets_to_expand = set()
+    # Map each requested annotation set to whether its sub-annotations should
+    # be included. A set that is requested both ways is expanded.
+    annotation_sets = {}
 
     # Get name, annotator and time constraints, if available
     name = params.get('name', "").strip()
@@ -38,10 +38,10 @@ def create_basic_annotated_entity_query(project, params, relations, classes,
     for key in params:
         if key.startswith('annotated_with'):
             annotation_set = frozenset(int(a) for a in params[key].split(','))
-            annotation_sets.add(annotation_set)
+            annotation_sets.setdefault(annotation_set, False)
         elif key.startswith('sub_annotated_with'):
             annotation_set = frozenset(int(a) for a in params[key].split(','))
-            annotation_sets_to_expand.add(annotation_set)
+            annotation_sets[annotation_set] = True
 
     # Construct a dictionary that contains all the filters needed for the
     # current query.
@@ -54,106 +54,76 @@ def create_basic_annotated_entity_query(project, params, relations, classes,
     if name:
         filters['name__iregex'] = name
 
-    # Add annotator and time constraints, if available
+    # Annotator and time constraints apply to the annotation link of the first
+    # annotation set or, without annotation sets, to any annotation link.
+    link_conditions = []
+    link_params = []
     if annotator_ids:
-        if len(annotator_ids) == 1:
-            filters['cici_via_a__user'] = next(iter(annotator_ids))
-        else:
-            filters['cici_via_a__user__in'] = annotator_ids
-        filters['cici_via_a__relation_id'] = annotated_with
+        link_conditions.append('cici.user_id = ANY(%s)')
+        link_params.append(list(annotator_ids))
     if start_date:
-        filters['cici_via_a__creation_time__gte'] = start_date
+        link_conditions.append('cici.creation_time >= %s')
+        link_params.append(start_date)
     if end_date:
-        filters['cici_via_a__creation_time__lte'] = end_date
-
-    # Map annotation sets to their expanded sub-annotations
-    sub_annotation_ids = get_sub_annotation_ids(project, annotation_sets_to_expand,
-            relations, classes)
-
-    # Collect all annotations and their sub-annotation IDs (if requested) in a
-    # set each. For the actual query each set is connected with AND while
-    # for everything within one set OR is used.
-    annotation_id_sets = []
-    for annotation_set in annotation_sets:
-        current_annotation_ids = set(annotation_set)
-        # Add sub annotations, if requested
-        sa_ids = sub_annotation_ids.get(annotation_set)
-        if sa_ids and len(sa_ids):
-            current_annotation_ids.update(sa_ids)
-        annotation_id_sets.append(current_annotation_ids)
-
-    # Due to Django's QuerySet syntax, we have to add the first
-    # annotation ID set constraint to the first filter we add.
-    if annotation_id_sets:
-        first_id_set = annotation_id_sets.pop()
-        filters['cici_via_a__relation_id'] = annotated_with
-        # Use IN (OR) for a single annotation and its sub-annotations
-        filters['cici_via_a__class_instance_b_id__in'] = first_id_set
-
-    # Create basic filter, possibly containing *one* annotation ID set
+        link_conditions.append('cici.creation_time <= %s')
+        link_params.append(end_date)
+
+    if not annotation_sets:
+        if annotator_ids:
+            filters['cici_via_a__user__in'] = annotator_ids
+            filters['cici_via_a__relation_id'] = annotated_with
+        if start_date:
+            filters['cici_via_a__creation_time__gte'] = start_date
+        if end_date:
+            filters['cici_via_a__creation_time__lte'] = end_date
+
+    # Create basic filter
     entities = ClassInstance.objects.filter(**filters)
 
-    # Add remaining filters for annotation constraints, if any
-    for annotation_id_set in annotation_id_sets:
-        entities = entities.filter(
-            cici_via_a__relation_id=annotated_with,
-            cici_via_a__class_instance_b_id__in=annotation_id_set)
+    # Every annotation set is tested with its own sub-query, which makes sets
+    # AND-combined, while everything within one set is OR-combined.
+    # Sub-annotations are looked up in the annotation closure table.
+    for i, (annotation_set, expand) in enumerate(annotation_sets.iteritems()):
+        annotation_ids = list(annotation_set)
+        condition = '''
+            EXISTS (SELECT 1 FROM class_instance_class_instance cici
+                    WHERE cici.class_instance_a = class_instance.id
+                      AND cici.relation_id = %s
+                      AND (cici.class_instance_b = ANY(%s)'''
+        condition_params = [annotated_with, annotation_ids]
+        if expand:
+            condition += '''
+                      OR cici.class_instance_b IN (
+                          SELECT ac.descendant_id FROM annotation_closure ac
+                          WHERE ac.ancestor_id = ANY(%s))'''
+            condition_params.append(annotation_ids)
+        condition += ')'
+        if 0 == i and link_conditions:
+            condition += ' AND ' + ' AND '.join(link_conditions)
+            condition_params.extend(link_params)
+        condition += ')'
+        entities = entities.extra(where=[condition], params=condition_params)
 
     # Create final query. Without any restriction, the result set will contain
     # all instances of the given set of allowed classes.
     return entities
 
-def get_sub_annotation_ids(project_id, annotation_sets, relations, classes):
-    """ Sub-annotations are annotations that are annotated with an annotation
-    from the annotation_set passed. Additionally, transivitely annotated
-    annotations are returned as well. Note that all entries annotation_sets
-    must be frozenset instances, they need to be hashable.
+def rebuild_annotation_closure(cursor, project_id):
+    """Replace all annotation closure rows of a project with the transitive
+    closure of its annotation hierarchy. Returns the number of rows created.
     """
-    if not annotation_sets:
-        return {}
-
-    aaa_tuples = ClassInstanceClassInstance.objects.filter(
-            project_id=project_id,
-            class_instance_a__class_column=classes['annotation'],
-            class_instance_b__class_column=classes['annotation'],
-            relation_id = relations['annotated_with']).values_list(
-                    'class_instance_b', 'class_instance_a')
-
-    # A set wrapper to keep a set in a dictionary
-    class set_wrapper:
-        def __init__(self):
-            self.data = set()
-
-    # Create a dictionary of all annotations annotating a set of annotations
-    aaa = {}
-    for aa in aaa_tuples:
-        sa_set = aaa.get(aa[0])
-        if sa_set is None:
-            sa_set = set_wrapper()
-            aaa[aa[0]] = sa_set
-        sa_set.data.add(aa[1])
-
-    # Collect all sub-annotations by following the annotation hierarchy for
-    # every annotation in the annotation set passed.
-    sa_ids = {}
-    for annotation_set in annotation_sets:
-        # Start with an empty result set for each requested annotation set
-        ls = set()
-        for a in annotation_set:
-            working_set = set([a])
-            while working_set:
-                parent_id = working_set.pop()
-                # Try to get the sub-annotations for this parent
-                child_ids = aaa.get(parent_id) or set_wrapper()
-                for child_id in child_ids.data:
-                    if child_id not in sa_ids:
-                        # Add all children as sub annotations
-                        ls.add(child_id)
-                        working_set.add(child_id)
-        # Store the result list for this ID
-        sa_ids[annotation_set] = list(ls)
-
-    return sa_ids
+    # Block concurrent annotation edits until the rebuild is committed
+    cursor.execute('LOCK TABLE class_instance_class_instance IN SHARE MODE')
+    cursor.execute('DELETE FROM annotation_closure WHERE project_id = %s',
+            (project_id,))
+    cursor.execute('''
+        SELECT rebuild_annotation_closure(ARRAY(
+            SELECT DISTINCT ancestor_id FROM annotation_annotation_link
+            WHERE project_id = %s))
+    ''', (project_id,))
+    cursor.execute('SELECT count(*) FROM annotation_closure WHERE project_id = %s',
+            (project_id,))
+    return cursor.fetchone()[0]
 
 def create_annotated_entity_list(project, entities_qs, relations, annotations=True):
     """ Executes the expected class instance queryset in <entities> and expands
@@ -282,6 +252,14 @@ def query_annotated_classinstances(request, project_id = None):
         description: The maximum number result elements.
         type: integer
         paramType: form
+      - name: after_id
+        description: Instead of range_start, return the elements after the one with this ID (see "next").
+        type: integer
+        paramType: form
+      - name: after_name
+        description: The name of the element passed as after_id, needed if sorted by name.
+        type: string
+        paramType: form
     models:
       annotated_entity:
         id: annotated_entity
@@ -313,7 +291,10 @@ def query_annotated_classinstances(request, project_id = None):
             required: true
         totalRecords:
             type: integer
-            required: true
+            description: The number of all result elements, not returned for after_id requests.
+        next:
+            type: object
+            description: The after_id and after_name parameters of the next page if range_length elements were returned.
     """
     p = get_object_or_404(Project, pk = project_id)
 
@@ -337,7 +318,26 @@ def query_annotated_classinstances(request, project_id = None):
     sort_dir = request.POST.get('sort_dir', 'asc')
     if sort_dir not in ('asc', 'desc'):
         raise ValueError("Only 'asc' and 'desc' are allowed for the 'sort-dir' parameter")
-    query = query.order_by(sort_by if sort_dir == 'asc' else ('-' + sort_by))
+    # The ID makes the order stable, which is needed for paging
+    order = [sort_by, 'id'] if sort_by != 'id' else ['id']
+    query = query.order_by(*(order if sort_dir == 'asc' else
+            ['-' + o for o in order]))
+
+    # Continue after the last element of a previous page, without counting
+    # and skipping all elements before it.
+    after_id = request.POST.get('after_id', None)
+    if after_id:
+        after_id = int(after_id)
+        if sort_by == 'id':
+            query = query.filter(**{'id__gt' if sort_dir == 'asc' else
+                    'id__lt': after_id})
+        elif sort_by == 'name':
+            query = query.extra(where=['(class_instance.name, class_instance.id) %s (%%s, %%s)' %
+                    ('>' if sort_dir == 'asc' else '<')],
+                    params=[request.POST.get('after_name', ''), after_id])
+        else:
+            raise ValueError("Only results sorted by 'id' or 'name' can be "
+                             "continued after an element")
 
     # Make sure we get a distinct result, which otherwise might not be the case
     # due to the joins made.
@@ -351,33 +351,44 @@ def query_annotated_classinstances(request, project_id = None):
     range_start = request.POST.get('range_start', None)
     range_length = request.POST.get('range_length', None)
     with_annotations = request.POST.get('with_annotations', 'false') == 'true'
-    if range_start and range_length:
+    result = {}
+    paged = bool(range_length and (after_id or range_start))
+    if after_id and range_length:
+        range_length = int(range_length)
+        entities = create_annotated_entity_list(p, query[:range_length],
+                relations, with_annotations)
+    elif range_start and range_length:
         range_start = int(range_start)
         range_length = int(range_length)
-        num_records = query.count()
+        result['totalRecords'] = query.count()
         entities = create_annotated_entity_list(p,
                 query[range_start:range_start + range_length],
                 relations, with_annotations)
     else:
         entities = create_annotated_entity_list(p, query, relations,
                 with_annotations)
-        num_records = len(entities)
+        result['totalRecords'] = len(entities)
 
-    return HttpResponse(json.dumps({
-      'entities': entities,
-      'totalRecords': num_records,
-    }))
+    result['entities'] = entities
+    if paged and entities and len(entities) == range_length:
+        result['next'] = {
+            'after_id': entities[-1]['id'],
+            'after_name': entities[-1]['name'],
+        }
+
+    return HttpResponse(json.dumps(result))
 
 def _update_neuron_annotations(project_id, user, neuron_id, annotation_map):
     """ Ensure that the neuron is annotated_with only the annotations given.
     These annotations are expected to come as dictornary of annotation name
     versus annotator ID.
     """
-    annotated_with = Relation.objects.get(project_id=project_id,
-            relation_name='annotated_with')
+    cursor = connection.cursor()
+    annotated_with = get_relation_to_id_map(project_id, ('annotated_with',),
+            cursor)['annotated_with']
 
     qs = ClassInstanceClassInstance.objects.filter(
-            class_instance_a__id=neuron_id, relation=annotated_with)
+            class_instance_a__id=neuron_id, relation_id=annotated_with)
     qs = qs.select_related('class_instance_b').values_list(
             'class_instance_b__name', 'class_instance_b__id')
 
@@ -390,40 +401,19 @@ def _update_neuron_annotations(project_id, user, neuron_id, annotation_map):
     _annotate_entities(project_id, [neuron_id], missing)
 
     to_delete = existing - update
-    to_delete_ids = tuple(aid for name, aid in existing_annotations.iteritems() \
-        if name in to_delete)
-
-    ClassInstanceClassInstance.objects.filter(project=project_id,
-            class_instance_a_id=neuron_id, relation=annotated_with,
-            class_instance_b_id__in=to_delete_ids).delete()
-
-    for aid in to_delete_ids:
-        delete_annotation_if_unused(project_id, aid, annotated_with)
+    to_delete_ids = [aid for name, aid in existing_annotations.iteritems() \
+        if name in to_delete]
 
+    if to_delete_ids:
+        cursor.execute('''
+            DELETE FROM class_instance_class_instance
+            WHERE project_id = %s
+              AND relation_id = %s
+              AND class_instance_a = %s
+              AND class_instance_b = ANY(%s)
+        ''', (project_id, annotated_with, neuron_id, to_delete_ids))
 
-def delete_annotation_if_unused(project, annotation, relation):
-    """ Delete the given annotation instance if it is not used anymore.
-    Returns a tuple where the first element states if
-    """
-    num_annotation_links = ClassInstanceClassInstance.objects.filter(
-        project=project, class_instance_b=annotation, relation=relation).count()
-
-    if num_annotation_links:
-        return False, num_annotation_links
-    else:
-        # See if the annotation is annotated itself
-        meta_annotation_links = ClassInstanceClassInstance.objects.filter(
-            project=project, class_instance_a=annotation, relation=relation)
-        meta_annotation_ids = [cici.class_instance_b_id for cici in meta_annotation_links]
-
-        # Delete annotation
-        ClassInstance.objects.filter(project=project, id=annotation).delete()
-
-        # Delete also meta annotation instances, if they exist
-        for ma in meta_annotation_ids:
-            delete_annotation_if_unused(project, ma, relation)
-
-        return True, 0
+        _delete_unused_annotations(project_id, to_delete_ids, annotated_with)
 
 def _annotate_entities(project_id, entity_ids, annotation_map):
     """ Annotate the entities with the given <entity_ids> with the given
@@ -431,14 +421,19 @@ def _annotate_entities(project_id, entity_ids, annotation_map):
     annotation name versus annotator ID. A listof all annotation class
     instances that have been used is returned. Annotation names can contain the
     counting pattern {nX} with X being a number. This will add an incrementing
-    number starting from X for each entity.
+    number starting from X for each entity. Missing annotations and links are
+    created with one statement each, regardless of the number of entities and
+    annotations.
     """
-    r = Relation.objects.get(project_id = project_id,
-            relation_name = 'annotated_with')
-
-    annotation_class = Class.objects.get(project_id = project_id,
-                                         class_name = 'annotation')
-    annotation_objects = {}
+    cursor = connection.cursor()
+    annotated_with = get_relation_to_id_map(project_id, ('annotated_with',),
+            cursor)['annotated_with']
+    annotation_class = get_class_to_id_map(project_id, ('annotation',),
+            cursor)['annotation']
+
+    # Map each annotation name to its annotator and the entities it should be
+    # linked to.
+    annotation_links = {}
     # Create a regular expression to find allowed patterns. The first group is
     # the whole {nX} part, while the second group is X only.
     counting_pattern = re.compile(r"(\{n(\d+)\})")
@@ -467,27 +462,74 @@ def _annotate_entities(project_id, entity_ids, annotation_map):
             # No matches, so use same annotation for all entities
             expanded_annotations = {annotation: entity_ids}
 
-        # Make sure the annotation's class instance exists.
         for a, a_entity_ids in expanded_annotations.iteritems():
-            ci, created = ClassInstance.objects.get_or_create(
-                    project_id=project_id, name=a,
-                    class_column=annotation_class,
-                    defaults={'user_id': annotator_id})
-
-            newly_annotated = set()
-            # Annotate each of the entities. Don't allow duplicates.
-            for entity_id in a_entity_ids:
-                cici, created = ClassInstanceClassInstance.objects.get_or_create(
-                        project_id=project_id, relation=r,
-                        class_instance_a__id=entity_id, class_instance_b=ci,
-                        defaults={'class_instance_a_id': entity_id,
-                                'user_id': annotator_id})
-                if created:
-                    newly_annotated.add(entity_id)
-            # Remember which entities got newly annotated
-            annotation_objects[ci] = newly_annotated
-
-    return annotation_objects
+            linked_ids = annotation_links.setdefault(a,
+                    (annotator_id, set()))[1]
+            linked_ids.update(int(eid) for eid in a_entity_ids)
+
+    if not annotation_links:
+        return {}
+
+    # Annotation names are passed as literals in a query that has parameters
+    # itself, which is why percent signs have to be escaped.
+    names = ','.join(cursor.mogrify('(%s,%s)', (name, user_id))
+            for name, (user_id, _) in annotation_links.iteritems())
+    names = names.replace('%', '%%')
+
+    with transaction.atomic():
+        # Make sure all annotation class instances exist.
+        cursor.execute('''
+            INSERT INTO class_instance (user_id, creation_time, edition_time,
+                project_id, class_id, name)
+            SELECT DISTINCT ON (v.name) v.user_id, now(), now(), %s, %s, v.name
+            FROM (VALUES {values}) v(name, user_id)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM class_instance ci
+                WHERE ci.project_id = %s
+                  AND ci.class_id = %s
+                  AND ci.name = v.name)
+        '''.format(values=names),
+            (project_id, annotation_class, project_id, annotation_class))
+
+        cursor.execute('''
+            SELECT DISTINCT ON (name) name, id
+            FROM class_instance
+            WHERE project_id = %s
+              AND class_id = %s
+              AND name = ANY(%s)
+            ORDER BY name, id
+        ''', (project_id, annotation_class, annotation_links.keys()))
+        annotation_ids = dict(cursor.fetchall())
+
+        # Link all entities to their annotations, existing links are kept.
+        # Newly linked entities are returned.
+        values = ','.join(cursor.mogrify('(%s,%s,%s)',
+                (eid, annotation_ids[name], user_id))
+                for name, (user_id, linked_ids) in annotation_links.iteritems()
+                for eid in linked_ids)
+        newly_annotated = defaultdict(set)
+        if values:
+            cursor.execute('''
+                INSERT INTO class_instance_class_instance (user_id,
+                    creation_time, edition_time, project_id, relation_id,
+                    class_instance_a, class_instance_b)
+                SELECT v.user_id, now(), now(), %s, %s, v.entity_id,
+                       v.annotation_id
+                FROM (VALUES {values}) v(entity_id, annotation_id, user_id)
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM class_instance_class_instance cici
+                    WHERE cici.project_id = %s
+                      AND cici.relation_id = %s
+                      AND cici.class_instance_a = v.entity_id
+                      AND cici.class_instance_b = v.annotation_id)
+                RETURNING class_instance_b, class_instance_a
+            '''.format(values=values),
+                (project_id, annotated_with, project_id, annotated_with))
+            for annotation_id, entity_id in cursor.fetchall():
+                newly_annotated[annotation_id].add(entity_id)
+
+    annotations = ClassInstance.objects.filter(id__in=annotation_ids.values())
+    return {a: newly_annotated[a.id] for a in annotations}
 
 @requires_user_role(UserRole.Annotate)
 def annotate_entities(request, project_id = None):
@@ -513,22 +555,27 @@ def annotate_entities(request, project_id = None):
                         'cici_via_b__class_instance_a', 'id'))
         entity_ids += [skid_to_eid[skid] for skid in skeleton_ids]
 
-    # Annotate enties
-    annotation_map = {a: request.user.id for a in annotations}
-    annotation_objs = _annotate_entities(project_id, entity_ids, annotation_map)
-    # Annotate annotations
-    if meta_annotations:
-        annotation_ids = [a.id for a in annotation_objs.keys()]
-        meta_annotation_map = {ma: request.user.id for ma in meta_annotations}
-        meta_annotation_objs = _annotate_entities(project_id, annotation_ids,
-                meta_annotation_map)
-        # Update used annotation objects set
-        for ma, me in meta_annotation_objs.items():
-            entities = annotation_objs.get(ma)
-            if entities:
-                entities.update(me)
-            else:
-                annotation_objs[ma] = me
+    with transaction.atomic():
+        # Annotate enties
+        annotation_map = {a: request.user.id for a in annotations}
+        annotation_objs = _annotate_entities(project_id, entity_ids,
+                annotation_map)
+        # Annotate annotations
+        if meta_annotations:
+            annotation_ids = [a.id for a in annotation_objs.keys()]
+            meta_annotation_map = {ma: request.user.id for ma in meta_annotations}
+            meta_annotation_objs = _annotate_entities(project_id,
+                    annotation_ids, meta_annotation_map)
+        else:
+            meta_annotation_objs = {}
+
+    # Update used annotation objects set
+    for ma, me in meta_annotation_objs.items():
+        entities = annotation_objs.get(ma)
+        if entities:
+            entities.update(me)
+        else:
+            annotation_objs[ma] = me
 
     result = {
         'message': 'success',
@@ -540,7 +587,7 @@ def annotate_entities(request, project_id = None):
 
 @requires_user_role(UserRole.Annotate)
 def remove_annotations(request, project_id=None):
-    """ Removes an annotation from one or more entities.
+    """ Removes one or more annotations from one or more entities.
     """
     annotation_ids = [int(v) for k,v in request.POST.iteritems()
             if k.startswith('annotation_ids[')]
@@ -553,19 +600,12 @@ def remove_annotations(request, project_id=None):
     if not entity_ids:
         raise ValueError("No entity IDs provided")
 
-    # Remove individual annotations
-    deleted_annotations = []
-    num_left_annotations = {}
-    for annotation_id in annotation_ids:
-        cicis_to_delete, missed_cicis, deleted, num_left = _remove_annotation(
-                request.user, project_id, entity_ids, annotation_id)
-        # Keep track of results
-        num_left_annotations[str(annotation_id)] = num_left
-        for cici in cicis_to_delete:
-            deleted_annotations.append(cici.id)
+    deleted_links, missed_links, deleted, num_left = _remove_annotations(
+            request.user, project_id, entity_ids, annotation_ids)
+    num_left_annotations = {str(a): n for a, n in num_left.iteritems()}
 
     return HttpResponse(json.dumps({
-        'deleted_annotations': deleted_annotations,
+        'deleted_annotations': deleted_links,
         'left_uses': num_left_annotations
     }), content_type='application/json')
 
@@ -577,19 +617,23 @@ def remove_annotation(request, project_id=None, annotation_id=None):
     entity_ids = [int(v) for k,v in request.POST.iteritems()
             if k.startswith('entity_ids[')]
 
-    cicis_to_delete, missed_cicis, deleted, num_left = _remove_annotation(
-            request.user, project_id, entity_ids, annotation_id)
+    annotation_id = int(annotation_id)
+    deleted_links, missed_links, deleted_annotations, num_left = \
+            _remove_annotations(request.user, project_id, entity_ids,
+                    [annotation_id])
+    deleted = annotation_id in deleted_annotations
+    num_left = num_left[annotation_id]
 
-    if len(cicis_to_delete) > 1:
-        message = "Removed annotation from %s entities." % len(cicis_to_delete)
-    elif len(cicis_to_delete) == 1:
+    if len(deleted_links) > 1:
+        message = "Removed annotation from %s entities." % len(deleted_links)
+    elif len(deleted_links) == 1:
         message = "Removed annotation from one entity."
     else:
         message = "No annotation removed."
 
-    if missed_cicis:
+    if missed_links:
         message += " Couldn't de-annotate %s entities, due to the lack of " \
-                "permissions." % len(missed_cicis)
+                "permissions." % len(missed_links)
 
     if deleted:
         message += " Also removed annotation instance, because it isn't used " \
@@ -603,49 +647,103 @@ def remove_annotation(request, project_id=None, annotation_id=None):
         'left_uses': num_left
     }), content_type='application/json')
 
-def _remove_annotation(user, project_id, entity_ids, annotation_id):
-    """Remove an annotation made by a certain user in a given project on a set
-    of entities (usually neurons and annotations). Returned is a 4-tuple which
-    holds the deleted annotation links, the list of links that couldn't be
-    deleted due to lack of permission, if the annotation itself was removed
-    (because it wasn't used anymore) and how many uses of this annotation are
-    left.
+def _remove_annotations(user, project_id, entity_ids, annotation_ids):
+    """Remove the links of all passed in annotations from all passed in
+    entities (usually neurons and annotations), as far as the user has
+    permission to. Annotations that aren't used anymore are removed as well,
+    regardless of their owner. Returned is a 4-tuple which holds the IDs of
+    the deleted annotation links, the IDs of the links that couldn't be
+    deleted due to lack of permission, the IDs of the removed annotations and
+    a dictionary with the number of uses left of each annotation.
     """
-    p = get_object_or_404(Project, pk=project_id)
-    relations = dict(Relation.objects.filter(
-        project_id=project_id).values_list('relation_name', 'id'))
-
-    # Get CICI instance representing the link
-    cici_n_a = ClassInstanceClassInstance.objects.filter(project=p,
-            relation_id=relations['annotated_with'],
-            class_instance_a__id__in=entity_ids,
-            class_instance_b__id=annotation_id)
-    # Make sure the current user has permissions to remove the annotation.
-    missed_cicis = []
-    cicis_to_delete = []
-    for cici in cici_n_a:
-        try:
-            can_edit_or_fail(user, cici.id, 'class_instance_class_instance')
-            cicis_to_delete.append(cici)
-        except Exception:
-            # Remember links for which permissions are missing
-            missed_cicis.append(cici)
-
-    # Remove link between entity and annotation for all links on which the user
-    # the necessary permissions has.
-    if cicis_to_delete:
-        ClassInstanceClassInstance.objects \
-                .filter(id__in=[cici.id for cici in cicis_to_delete]) \
-                .delete()
-
-    # Remove the annotation class instance, regardless of the owner, if there
-    # are no more links to it
-    annotated_with = Relation.objects.get(project_id=project_id,
-            relation_name='annotated_with')
-    deleted, num_left = delete_annotation_if_unused(project_id, annotation_id,
-                                                    annotated_with)
-
-    return cicis_to_delete, missed_cicis, deleted, num_left
+    cursor = connection.cursor()
+    annotated_with = get_relation_to_id_map(project_id, ('annotated_with',),
+            cursor)['annotated_with']
+    annotation_ids = [int(a) for a in annotation_ids]
+
+    with transaction.atomic():
+        cursor.execute('''
+            SELECT id, user_id
+            FROM class_instance_class_instance
+            WHERE project_id = %s
+              AND relation_id = %s
+              AND class_instance_a = ANY(%s)
+              AND class_instance_b = ANY(%s)
+        ''', (project_id, annotated_with, [int(e) for e in entity_ids],
+                annotation_ids))
+        links = cursor.fetchall()
+
+        # Make sure the current user has permissions to remove the links.
+        if user.is_superuser:
+            domain = None
+        else:
+            domain = cached_user_domain(cursor, user.id)
+        deleted_links = []
+        missed_links = []
+        for link_id, owner_id in links:
+            if domain is None or owner_id in domain:
+                deleted_links.append(link_id)
+            else:
+                missed_links.append(link_id)
+
+        if deleted_links:
+            cursor.execute('''
+                DELETE FROM class_instance_class_instance WHERE id = ANY(%s)
+            ''', (deleted_links,))
+
+        deleted_annotations = _delete_unused_annotations(project_id,
+                annotation_ids, annotated_with)
+
+        cursor.execute('''
+            SELECT class_instance_b, count(*)
+            FROM class_instance_class_instance
+            WHERE project_id = %s
+              AND relation_id = %s
+              AND class_instance_b = ANY(%s)
+            GROUP BY class_instance_b
+        ''', (project_id, annotated_with, annotation_ids))
+        num_left = dict.fromkeys(annotation_ids, 0)
+        num_left.update(cursor.fetchall())
+
+    return deleted_links, missed_links, deleted_annotations, num_left
+
+def _delete_unused_annotations(project_id, annotation_ids, annotated_with):
+    """Delete all passed in annotations that aren't used anymore, along with
+    their meta annotations that aren't used anymore after that. Returns the
+    IDs of all deleted annotations.
+    """
+    cursor = connection.cursor()
+    deleted = set()
+    annotation_ids = set(annotation_ids)
+    while annotation_ids:
+        cursor.execute('''
+            SELECT ci.id
+            FROM class_instance ci
+            WHERE ci.id = ANY(%s)
+              AND ci.project_id = %s
+              AND NOT EXISTS (
+                SELECT 1 FROM class_instance_class_instance cici
+                WHERE cici.class_instance_b = ci.id
+                  AND cici.relation_id = %s)
+        ''', (list(annotation_ids), project_id, annotated_with))
+        unused = [row[0] for row in cursor.fetchall()]
+        if not unused:
+            break
+
+        # Meta annotations have to be checked once their links are removed
+        cursor.execute('''
+            SELECT DISTINCT class_instance_b
+            FROM class_instance_class_instance
+            WHERE class_instance_a = ANY(%s)
+              AND relation_id = %s
+        ''', (unused, annotated_with))
+        meta_annotation_ids = set(row[0] for row in cursor.fetchall())
+
+        ClassInstance.objects.filter(id__in=unused).delete()
+        deleted.update(unused)
+        annotation_ids = meta_annotation_ids - deleted
+
+    return deleted
 
 def create_annotation_query(project_id, param_dict):
 
@@ -914,18 +1012,21 @@ def list_annotations(request, project_id=None):
         classes = get_class_to_id_map(project_id, ('annotation',), cursor)
         relations = get_relation_to_id_map(project_id, ('annotated_with',), cursor)
 
+        # Only distinct pairs of annotation and user IDs are collected before
+        # names are added. Clients that only need annotation names should use
+        # the paged name search (search/names) instead.
         cursor.execute('''
-            SELECT DISTINCT ci.name, ci.id, u.id, u.username
-            FROM class_instance ci
-            LEFT OUTER JOIN class_instance_class_instance cici
-                         ON (ci.id = cici.class_instance_b)
-            LEFT OUTER JOIN auth_user u
-                         ON (cici.user_id = u.id)
-            WHERE (ci.class_id = %s AND cici.relation_id = %s
-              AND ci.project_id = %s AND cici.project_id = %s);
+            SELECT ci.name, ci.id, u.id, u.username
+            FROM (
+                SELECT DISTINCT class_instance_b, user_id
+                FROM class_instance_class_instance
+                WHERE project_id = %s AND relation_id = %s
+            ) cici
+            JOIN class_instance ci ON ci.id = cici.class_instance_b
+            JOIN auth_user u ON u.id = cici.user_id
+            WHERE ci.class_id = %s
                        ''',
-            (classes['annotation'], relations['annotated_with'], project_id,
-                project_id))
+            (project_id, relations['annotated_with'], classes['annotation']))
         annotation_tuples = cursor.fetchall()
     else:
         annotation_query = create_annotation_query(project_id, request.POST)
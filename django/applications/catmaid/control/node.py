@@ -10,11 +10,14 @@ from django.http import HttpResponse
 
 from rest_framework.decorators import api_view
 
-from catmaid.models import UserRole, Treenode, Connector, \
+from catmaid.models import UserRole, Treenode, \
         ClassInstanceClassInstance, Review
 from catmaid.control.authentication import requires_user_role, \
-        can_edit_all_or_fail, user_domain
-from catmaid.control.common import get_relation_to_id_map
+        can_edit_all_or_fail, cached_user_domain
+from catmaid.control import nodecache
+from catmaid.control.spatial import nearest_treenodes
+from catmaid.control.common import get_relation_to_id_map, \
+        compact_response, wants_msgpack
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -49,10 +52,13 @@ def node_list_tuples(request, project_id=None, provider=None):
     params['project_id'] = project_id
     includeLabels = (request.POST.get('labels', None) == 'true')
 
-    provider = get_treenodes_postgis
+    provider_name = request.POST.get('provider', settings.NODE_LIST_PROVIDER)
+    provider = node_list_providers.get(provider_name)
+    if not provider:
+        raise ValueError("Unknown node list provider: %s" % provider_name)
 
     return node_list_tuples_query(request.user, params, project_id, atnid,
-                                  includeLabels, provider)
+                                  includeLabels, provider, wants_msgpack(request))
 
 
 def get_treenodes_classic(cursor, params):
@@ -158,23 +164,249 @@ def get_treenodes_postgis(cursor, params):
     return cursor.fetchall()
 
 
-def node_list_tuples_query(user, params, project_id, atnid, includeLabels, tn_provider):
-    try:
-        cursor = connection.cursor()
+def get_node_list_postgis_json(cursor, params, relation_map, atnid,
+        include_labels, domain):
+    """ Answers the complete node query with a single statement. The spatial
+    filter is the same as the one of get_treenodes_postgis, but connectors,
+    missing treenodes and labels are collected in the same statement and the
+    final JSON response is built by Postgres. If <domain> is None, all nodes
+    are editable, otherwise only the ones owned by a user in <domain>.
+    """
+    params = dict(params)
+    params['halfzdiff'] = abs(params['z2'] - params['z1']) * 0.5
+    params['halfz'] = params['z1'] + (params['z2'] - params['z1']) * 0.5
+    params['atnid'] = atnid
+    params['include_labels'] = include_labels
+    params['all_editable'] = domain is None
+    params['domain'] = list(domain or ())
+    params['presynaptic_to'] = relation_map['presynaptic_to']
+    params['postsynaptic_to'] = relation_map['postsynaptic_to']
+    params['labeled_as'] = relation_map['labeled_as']
+
+    # Values are formatted as text and concatenated, because JSON arrays of
+    # mixed types can't be created with the JSON functions of Postgres 9.3.
+    # Strings (label names) are escaped with array_to_json. Booleans are cast
+    # explicitly, because their output format would otherwise be 't' and 'f'.
+    cursor.execute('''
+    WITH edge_rows AS (
+        SELECT t1.id AS t1_id, t2.id AS t2_id
+        FROM
+          treenode t1,
+          treenode t2,
+          (SELECT te.id
+             FROM treenode_edge te
+             WHERE te.edge &&& 'LINESTRINGZ(%(left)s %(bottom)s %(z2)s,
+                                           %(right)s %(top)s %(z1)s)'
+               AND ST_3DDWithin(te.edge, ST_MakePolygon(ST_GeomFromText(
+                'LINESTRING(%(left)s %(top)s %(halfz)s, %(right)s %(top)s %(halfz)s,
+                            %(right)s %(bottom)s %(halfz)s, %(left)s %(bottom)s %(halfz)s,
+                            %(left)s %(top)s %(halfz)s)')), %(halfzdiff)s)
+          ) edges(edge_child_id)
+        WHERE
+              t1.project_id = %(project_id)s
+          AND (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
+               OR (t1.parent_id IS NULL AND t1.id = t2.id))
+          AND edge_child_id = t1.id
+        LIMIT %(limit)s
+    ), edge_nodes AS (
+        SELECT t1_id AS id FROM edge_rows
+        UNION
+        SELECT t2_id FROM edge_rows
+    ), visible_connectors AS (
+        SELECT c.id
+        FROM connector c
+        WHERE c.project_id = %(project_id)s
+          AND c.location_z >= %(z1)s
+          AND c.location_z <  %(z2)s
+          AND c.location_x >= %(left)s
+          AND c.location_x <  %(right)s
+          AND c.location_y >= %(top)s
+          AND c.location_y <  %(bottom)s
+    ), links AS (
+        SELECT tc.connector_id, tc.relation_id, tc.treenode_id, tc.confidence
+        FROM treenode_connector tc
+        JOIN edge_nodes n ON tc.treenode_id = n.id
+        UNION
+        SELECT tc.connector_id, tc.relation_id, tc.treenode_id, tc.confidence
+        FROM treenode_connector tc
+        JOIN visible_connectors vc ON tc.connector_id = vc.id
+    ), connector_ids AS (
+        SELECT connector_id AS id FROM links
+        UNION
+        SELECT id FROM visible_connectors
+    ), treenode_ids AS (
+        SELECT id FROM edge_nodes
+        UNION
+        SELECT treenode_id FROM links
+        UNION
+        SELECT %(atnid)s
+    ), treenodes AS (
+        SELECT t.*
+        FROM treenode t
+        JOIN treenode_ids ti ON t.id = ti.id
+    ), labels AS (
+        SELECT t.id, ci.name
+        FROM treenodes t
+        JOIN treenode_class_instance tci ON tci.treenode_id = t.id
+        JOIN class_instance ci ON ci.id = tci.class_instance_id
+        WHERE %(include_labels)s
+          AND tci.relation_id = %(labeled_as)s
+          AND t.location_z >= %(z1)s
+          AND t.location_z <  %(z2)s
+          AND t.location_x >= %(left)s
+          AND t.location_x <  %(right)s
+          AND t.location_y >= %(top)s
+          AND t.location_y <  %(bottom)s
+        UNION ALL
+        SELECT c.id, ci.name
+        FROM connector c
+        JOIN connector_ids ON c.id = connector_ids.id
+        JOIN connector_class_instance cci ON cci.connector_id = c.id
+        JOIN class_instance ci ON ci.id = cci.class_instance_id
+        WHERE %(include_labels)s
+          AND cci.relation_id = %(labeled_as)s
+          AND c.location_z >= %(z1)s
+          AND c.location_z <  %(z2)s
+    )
+    SELECT '[' ||
+      (SELECT COALESCE('[' || string_agg('[' ||
+              t.id || ',' ||
+              COALESCE(t.parent_id::text, 'null') || ',' ||
+              t.location_x || ',' ||
+              t.location_y || ',' ||
+              t.location_z || ',' ||
+              t.confidence || ',' ||
+              t.radius || ',' ||
+              t.skeleton_id || ',' ||
+              (%(all_editable)s OR t.user_id = ANY(%(domain)s))::text || ']',
+          ',') || ']', '[]')
+       FROM treenodes t) || ',' ||
+      (SELECT COALESCE('[' || string_agg('[' ||
+              c.id || ',' ||
+              c.location_x || ',' ||
+              c.location_y || ',' ||
+              c.location_z || ',' ||
+              c.confidence || ',' ||
+              COALESCE(r.pre, '[]') || ',' ||
+              COALESCE(r.post, '[]') || ',' ||
+              COALESCE(r.other, '[]') || ',' ||
+              (%(all_editable)s OR c.user_id = ANY(%(domain)s))::text || ']',
+          ',') || ']', '[]')
+       FROM connector c
+       JOIN connector_ids ON c.id = connector_ids.id
+       LEFT JOIN (
+         SELECT l.connector_id,
+           '[' || string_agg(CASE WHEN l.relation_id = %(presynaptic_to)s
+               THEN '[' || l.treenode_id || ',' || l.confidence || ']' END,
+               ',') || ']' AS pre,
+           '[' || string_agg(CASE WHEN l.relation_id = %(postsynaptic_to)s
+               THEN '[' || l.treenode_id || ',' || l.confidence || ']' END,
+               ',') || ']' AS post,
+           '[' || string_agg(CASE WHEN l.relation_id <> %(presynaptic_to)s
+                                   AND l.relation_id <> %(postsynaptic_to)s
+               THEN '[' || l.treenode_id || ',' || l.confidence || ']' END,
+               ',') || ']' AS other
+         FROM links l
+         GROUP BY l.connector_id
+       ) r ON r.connector_id = c.id) || ',' ||
+      (SELECT COALESCE('{' || string_agg('"' || l.id || '":' || l.names, ',') || '}', '{}')
+       FROM (SELECT id, array_to_json(array_agg(name))::text AS names
+             FROM labels
+             GROUP BY id) l) || ',' ||
+      ((SELECT count(*) FROM edge_rows) = %(limit)s)::text ||
+    ']'
+    ''', params)
 
-        cursor.execute('''
-        SELECT relation_name, id FROM relation WHERE project_id=%s
-        ''' % project_id)
-        relation_map = dict(cursor.fetchall())
+    return cursor.fetchone()[0]
 
-        response_on_error = 'Failed to query treenodes'
 
-        is_superuser = user.is_superuser
-        user_id = user.id
+def node_list_tuples_query(user, params, project_id, atnid, includeLabels,
+        tn_provider, use_msgpack=False):
+    cursor = connection.cursor()
 
-        # Set of other user_id for which the request user has editing rights on.
-        # For a superuser, the domain is all users, and implicit.
-        domain = None if is_superuser else user_domain(cursor, user_id)
+    relation_map = get_relation_to_id_map(project_id, cursor=cursor)
+
+    is_superuser = user.is_superuser
+    user_id = user.id
+
+    # Set of other user_id for which the request user has editing rights on.
+    # For a superuser, the domain is all users, and implicit.
+    domain = None if is_superuser else cached_user_domain(cursor, user_id)
+
+    if tn_provider is get_node_list_postgis_json:
+        try:
+            node_list = tn_provider(cursor, params, relation_map, atnid,
+                    includeLabels, domain)
+        except Exception as e:
+            raise Exception('Failed to query node list:' + str(e))
+        # The response is already encoded by the database
+        if use_msgpack:
+            node_list = json.loads(node_list)
+            node_list[2] = dict((int(k), v) for k, v in node_list[2].iteritems())
+            return compact_response(node_list, True)
+        return HttpResponse(node_list)
+
+    node_list = None
+    if tn_provider is get_treenodes_postgis and nodecache.get_node_list_cache():
+        def fetch_cell(cell_params):
+            treenodes, connectors, labels, limit_reached = _node_list_tuples(
+                    cursor, cell_params, relation_map, -1, True, tn_provider,
+                    visible_labels_only=False)
+            return treenodes, connectors, dict(labels), limit_reached
+        node_list = nodecache.get_node_list(project_id, params, includeLabels,
+                fetch_cell)
+        if node_list is not None and -1 != atnid and \
+                atnid not in set(row[0] for row in node_list[0]):
+            # If atnid is a connector, it won't be found in treenode table
+            node_list[0].extend(_fetch_treenode_rows(cursor, [atnid]))
+
+    if node_list is None:
+        node_list = _node_list_tuples(cursor, params, relation_map, atnid,
+                includeLabels, tn_provider)
+
+    treenodes, connectors, labels, limit_reached = node_list
+
+    def can_edit(owner_id):
+        return is_superuser or owner_id == user_id or owner_id in domain
+
+    # Replace the owner of each node with the edit permission of the user
+    treenodes = [row[0:8] + (can_edit(row[8]),) for row in treenodes]
+    connectors = [c[0:8] + (can_edit(c[8]),) for c in connectors]
+
+    return compact_response((treenodes, connectors, dict(labels), limit_reached),
+            use_msgpack)
+
+
+def _fetch_treenode_rows(cursor, treenode_ids):
+    """Return the node list columns of the passed in treenodes, with the
+    owner's user ID as last column.
+    """
+    id_list = ','.join('({0})'.format(int(tnid)) for tnid in treenode_ids)
+    cursor.execute('''
+    SELECT id,
+        parent_id,
+        location_x,
+        location_y,
+        location_z,
+        confidence,
+        radius,
+        skeleton_id,
+        user_id
+    FROM treenode, (VALUES %s) missingnodes(mnid)
+    WHERE id = mnid''' % id_list)
+    return cursor.fetchall()
+
+
+def _node_list_tuples(cursor, params, relation_map, atnid, includeLabels,
+        tn_provider, visible_labels_only=True):
+    """Return treenodes, connectors and labels in the bounding box defined by
+    <params>, along with a flag that tells whether the node limit was reached.
+    Instead of edit permissions, the last column of treenode and connector rows
+    is the ID of their owner. If <visible_labels_only> is false, labels of all
+    returned nodes are included, not only of those in the bounding box.
+    """
+    try:
+        response_on_error = 'Failed to query treenodes'
 
         # Above, notice that the join is done for:
         # 1. A parent-child or child-parent pair (where the first one is in section z)
@@ -194,12 +426,11 @@ def node_list_tuples_query(user, params, project_id, atnid, includeLabels, tn_pr
             t1id = row[0]
             if t1id not in treenode_ids:
                 treenode_ids.add(t1id)
-                treenodes.append(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
+                treenodes.append(row[0:9])
             t2id = row[9]
             if t2id not in treenode_ids:
                 treenode_ids.add(t2id)
-                treenodes.append(row[9:17] + (is_superuser or row[17] == user_id or row[17] in domain,))
-
+                treenodes.append(row[9:18])
 
         # Find connectors related to treenodes in the field of view
         # Connectors found attached to treenodes
@@ -306,7 +537,7 @@ def node_list_tuples_query(user, params, project_id, atnid, includeLabels, tn_pr
                     [kv for kv in  pre[cid].iteritems()],
                     [kv for kv in post[cid].iteritems()],
                     [kv for kv in other[cid].iteritems()],
-                    is_superuser or c[8] == user_id or c[8] in domain)
+                    c[8])
 
 
         # Fetch missing treenodes. These are related to connectors
@@ -316,24 +547,10 @@ def node_list_tuples_query(user, params, project_id, atnid, includeLabels, tn_pr
         # below.
 
         if missing_treenode_ids:
-            missing_id_list = ','.join('({0})'.format(mnid) for mnid in missing_treenode_ids)
             response_on_error = 'Failed to query treenodes from connectors'
-            cursor.execute('''
-            SELECT id,
-                parent_id,
-                location_x,
-                location_y,
-                location_z,
-                confidence,
-                radius,
-                skeleton_id,
-                user_id
-            FROM treenode, (VALUES %s) missingnodes(mnid)
-            WHERE id = mnid''' % missing_id_list)
-
-            for row in cursor.fetchall():
+            for row in _fetch_treenode_rows(cursor, missing_treenode_ids):
                 treenodes.append(row)
-                treenode_ids.add(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
+                treenode_ids.add(row[0])
 
         labels = defaultdict(list)
         if includeLabels:
@@ -342,7 +559,8 @@ def node_list_tuples_query(user, params, project_id, atnid, includeLabels, tn_pr
             bottom, right, z2 = params['bottom'], params['right'], params['z2']
 
             def is_visible(r):
-                return r[2] >= left and r[2] < right and \
+                return not visible_labels_only or \
+                    r[2] >= left and r[2] < right and \
                     r[3] >= top and r[3] < bottom and \
                     r[4] >= z1 and r[4] < z2
 
@@ -361,7 +579,8 @@ def node_list_tuples_query(user, params, project_id, atnid, includeLabels, tn_pr
                     labels[row[0]].append(row[1])
 
             # Collect connectors visible in the current section
-            visible = ','.join('({0})'.format(row[0]) for row in connectors if row[3] >= z1 and row[3] < z2)
+            visible = ','.join('({0})'.format(row[0]) for row in connectors
+                    if not visible_labels_only or row[3] >= z1 and row[3] < z2)
             if visible:
                 cursor.execute('''
                 SELECT cnid, class_instance.name
@@ -374,12 +593,21 @@ def node_list_tuples_query(user, params, project_id, atnid, includeLabels, tn_pr
                 for row in cursor.fetchall():
                     labels[row[0]].append(row[1])
 
-        return HttpResponse(json.dumps((treenodes, connectors, labels, n_retrieved_nodes == params['limit']), separators=(',', ':'))) # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
+        return treenodes, connectors, labels, n_retrieved_nodes == params['limit']
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
 
+# Node list providers that can be selected with the NODE_LIST_PROVIDER setting
+# or the "provider" parameter of a node list request.
+node_list_providers = {
+    'classic': get_treenodes_classic,
+    'postgis': get_treenodes_postgis,
+    'postgis_json': get_node_list_postgis_json,
+}
+
+
 @requires_user_role(UserRole.Annotate)
 def update_location_reviewer(request, project_id=None, node_id=None):
     """ Updates the reviewer id and review time of a node """
@@ -430,46 +658,92 @@ def most_recent_treenode(request, project_id=None):
     }))
 
 
-def _update(Kind, table, nodes, now, user):
+def _update(table, nodes, now, user):
+    """Move all passed in nodes of a table, each given as a sequence of ID, X,
+    Y and Z, with a single UPDATE statement. Raises an Exception if the user
+    can't edit any of them.
+    """
     if not nodes:
         return
-    # 0: id
-    # 1: X
-    # 2: Y
-    # 3: Z
-    can_edit_all_or_fail(user, (node[0] for node in nodes.itervalues()), table)
-    for node in nodes.itervalues():
-        Kind.objects.filter(id=int(node[0])).update(
-            editor=user,
-            edition_time=now,
-            location_x=float(node[1]),
-            location_y=float(node[2]),
-            location_z=float(node[3]))
+    can_edit_all_or_fail(user, (node[0] for node in nodes), table)
+    cursor = connection.cursor()
+    values = ','.join(cursor.mogrify('(%s,%s,%s,%s)', (int(node[0]),
+            float(node[1]), float(node[2]), float(node[3]))) for node in nodes)
+    cursor.execute('''
+        UPDATE {table} n
+        SET editor_id = %s, edition_time = %s,
+            location_x = v.x, location_y = v.y, location_z = v.z
+        FROM (VALUES {values}) v(id, x, y, z)
+        WHERE n.id = v.id
+    '''.format(table=table, values=values), (user.id, now))
+
+
+def _update_child_edges(treenode_ids):
+    """Rebuild the edges of the children of the passed in treenodes that
+    weren't moved themselves. The edges of moved treenodes are written by the
+    row trigger on treenode, which doesn't update the edges of children.
+    """
+    if not treenode_ids:
+        return
+    cursor = connection.cursor()
+    cursor.execute('''
+        UPDATE treenode_edge te
+        SET edge = ST_MakeLine(
+            ST_MakePoint(t.location_x, t.location_y, t.location_z),
+            ST_MakePoint(p.location_x, p.location_y, p.location_z))
+        FROM treenode t
+        JOIN treenode p ON p.id = t.parent_id
+        WHERE te.id = t.id
+          AND t.parent_id = ANY(%(ids)s)
+          AND NOT t.id = ANY(%(ids)s)
+    ''', {'ids': [int(i) for i in treenode_ids]})
 
 
 @requires_user_role(UserRole.Annotate)
 def node_update(request, project_id=None):
-    N = len(request.POST)
-    if 0 != N % 4:
-        raise Exception("Incorrect number of posted items for node_update.")
-
-    pattern = re.compile('^[tc]\[(\d+)\]\[(\d+)\]$')
-
-    nodes = {'t': {}, 'c': {}}
-    for key, value in request.POST.iteritems():
-        i, j = pattern.match(key).groups()
-        i = int(i)
-        j = int(j)
-        node = nodes[key[0]].get(i)
-        if not node:
-            nodes[key[0]][i] = node = {}
-        node[j] = value
+    """Move treenodes and connectors. The new locations can either be passed as
+    JSON encoded lists "treenodes" and "connectors" of [id, x, y, z] arrays or
+    with one parameter t[i][j] or c[i][j] per value, where i is the node index
+    and j is 0 for the ID and 1-3 for X, Y and Z. All nodes of a type are
+    updated with a single statement.
+    """
+    nodes = {'t': [], 'c': []}
+    if 'treenodes' in request.POST or 'connectors' in request.POST:
+        nodes['t'] = json.loads(request.POST.get('treenodes', '[]'))
+        nodes['c'] = json.loads(request.POST.get('connectors', '[]'))
+    else:
+        N = len(request.POST)
+        if 0 != N % 4:
+            raise Exception("Incorrect number of posted items for node_update.")
+
+        pattern = re.compile('^[tc]\[(\d+)\]\[(\d+)\]$')
+
+        indexed_nodes = {'t': {}, 'c': {}}
+        for key, value in request.POST.iteritems():
+            i, j = pattern.match(key).groups()
+            node = indexed_nodes[key[0]].setdefault(int(i), {})
+            node[int(j)] = value
+        for t in ('t', 'c'):
+            nodes[t] = [node for i, node in sorted(indexed_nodes[t].iteritems())]
+
+    for node in nodes['t'] + nodes['c']:
+        if 4 != len(node):
+            raise ValueError("Nodes have to be specified as id, x, y and z")
+
+    # Cached cells of both the old and the new node locations have to be
+    # evicted.
+    treenode_ids = [node[0] for node in nodes['t']]
+    connector_ids = [node[0] for node in nodes['c']]
+    nodecache.invalidate_nodes(project_id, treenode_ids, connector_ids)
 
     now = datetime.now()
-    _update(Treenode, 'treenode', nodes['t'], now, request.user)
-    _update(Connector, 'connector', nodes['c'], now, request.user)
+    _update('treenode', nodes['t'], now, request.user)
+    _update_child_edges(treenode_ids)
+    _update('connector', nodes['c'], now, request.user)
+
+    nodecache.invalidate_nodes(project_id, treenode_ids, connector_ids)
 
-    num_updated_nodes = len(nodes['t'].keys()) + len(nodes['c'].keys())
+    num_updated_nodes = len(nodes['t']) + len(nodes['c'])
     return HttpResponse(json.dumps({'updated': num_updated_nodes}))
 
 
@@ -512,37 +786,20 @@ def node_nearest(request, project_id=None):
             for neur_skel_relation in neuron_skeletons:
                 skeletons.append(neur_skel_relation.class_instance_a_id)
 
-        # Get all treenodes connected to skeletons
+        # Find the closest treenode of all skeletons in the database
         response_on_error = 'Finding the treenodes failed.'
-        treenodes = Treenode.objects.filter(project=project_id, skeleton__in=skeletons)
-
-        def getNearestTreenode(x, y, z, treenodes):
-            minDistance = -1
-            nearestTreenode = None
-            for tn in treenodes:
-                xdiff = x - tn.location_x
-                ydiff = y - tn.location_y
-                zdiff = z - tn.location_z
-                distanceSquared = xdiff ** 2 + ydiff ** 2 + zdiff ** 2
-                if distanceSquared < minDistance or minDistance < 0:
-                    nearestTreenode = tn
-                    minDistance = distanceSquared
-            return nearestTreenode
-
-        nearestTreenode = getNearestTreenode(
-            params['x'],
-            params['y'],
-            params['z'],
-            treenodes)
-        if nearestTreenode is None:
+        nearest = nearest_treenodes(project_id, params['x'], params['y'],
+                params['z'], 1, skeletons)
+        if not nearest:
             raise Exception('No treenodes were found for skeletons in %s' % skeletons)
+        treenode_id, x, y, z, skeleton_id, distance = nearest[0]
 
         return HttpResponse(json.dumps({
-            'treenode_id': nearestTreenode.id,
-            'x': int(nearestTreenode.location_x),
-            'y': int(nearestTreenode.location_y),
-            'z': int(nearestTreenode.location_z),
-            'skeleton_id': nearestTreenode.skeleton_id}))
+            'treenode_id': treenode_id,
+            'x': int(x),
+            'y': int(y),
+            'z': int(z),
+            'skeleton_id': skeleton_id}))
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
@@ -0,0 +1,395 @@
+"""A spatial cache for the node query of the tracing overlay.
+
+Every project is partitioned into a regular grid of cells, whose size is
+defined by the NODE_LIST_CACHE_CELL_SIZE setting. The node query result of a
+single cell is cached and a view query is answered by combining the cells it
+overlaps and reducing the result with the spatial filter of the node query
+(see _reduce_to_view). The cells fetched for a view are extended by half of the
+view's depth in X and Y, because the node query also returns edges within
+this distance of the view's center plane that don't enter the view. Treenode,
+connector, link and label writes evict the cells they touch. Edits that affect
+large parts of a project (e.g. splits and joins) evict all cells of the
+project at once by advancing its cache generation.
+
+The cache is only used if NODE_LIST_CACHE names a cache from CACHES. This
+cache has to be shared by all server processes (e.g. memcached), otherwise an
+edit handled by one process can't evict cells cached by another one.
+"""
+import math
+import threading
+import time
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.signals import request_finished
+
+
+# If more cells than this would be evicted at once, the whole project is
+# invalidated instead.
+MAX_EVICTED_CELLS = 1024
+
+# Maps cache aliases to caches
+_caches = {}
+
+# Keys evicted during the current request. Since requests are wrapped in a
+# transaction, concurrent readers could re-populate an evicted cell with data
+# from before the commit. These keys are therefore evicted a second time once
+# the request is finished.
+_evicted = threading.local()
+
+
+def get_node_list_cache():
+    """Return the cache configured by NODE_LIST_CACHE or None if the node list
+    cache is disabled.
+    """
+    alias = getattr(settings, 'NODE_LIST_CACHE', None)
+    if not alias:
+        return None
+    cache = _caches.get(alias)
+    if cache is None:
+        cache = _caches[alias] = get_cache(alias)
+    return cache
+
+
+def _generation_key(project_id):
+    return 'catmaid-node-list-generation-%s' % project_id
+
+
+def _cell_key(project_id, generation, cell):
+    return 'catmaid-node-list-%s-%s-%s-%s-%s' % ((project_id, generation) + cell)
+
+
+def _get_generation(cache, project_id):
+    key = _generation_key(project_id)
+    generation = cache.get(key)
+    if generation is None:
+        # The generation could have been evicted from the cache. Starting at
+        # the current time makes sure no cells of a former generation are
+        # picked up again.
+        cache.add(key, int(time.time() * 1000), None)
+        generation = cache.get(key)
+    return generation
+
+
+def _axis_range(lower, upper, size):
+    return xrange(int(math.floor(lower / size)), int(math.floor(upper / size)) + 1)
+
+
+def cells_in_box(left, top, z1, right, bottom, z2):
+    """Return a list of (i, j, k) indices of all cells intersecting the passed
+    in bounding box.
+    """
+    sx, sy, sz = settings.NODE_LIST_CACHE_CELL_SIZE
+    return [(i, j, k)
+            for i in _axis_range(left, right, sx)
+            for j in _axis_range(top, bottom, sy)
+            for k in _axis_range(z1, z2, sz)]
+
+
+def cell_bounds(cell):
+    """Return the bounding box of a cell in the parameter format used by the
+    node query.
+    """
+    sx, sy, sz = settings.NODE_LIST_CACHE_CELL_SIZE
+    i, j, k = cell
+    return {
+        'left': i * sx,
+        'right': (i + 1) * sx,
+        'top': j * sy,
+        'bottom': (j + 1) * sy,
+        'z1': k * sz,
+        'z2': (k + 1) * sz,
+    }
+
+
+def get_node_list(project_id, params, include_labels, fetch_cell):
+    """Answer a node query from the cache. The <fetch_cell> function is called
+    with a node query parameter dictionary for every cell that isn't cached,
+    yet. It is expected to return a tuple of treenode rows, connector rows,
+    labels and a limit flag like the node query does, with user IDs instead of
+    edit permissions and labels for all returned nodes.
+
+    Returns None if the query can't be answered from the cache, because it
+    covers too many cells or too many nodes.
+    """
+    cache = get_node_list_cache()
+    margin = abs(params['z2'] - params['z1']) * 0.5
+    cells = cells_in_box(params['left'] - margin, params['top'] - margin,
+            params['z1'], params['right'] + margin, params['bottom'] + margin,
+            params['z2'])
+    if len(cells) > settings.NODE_LIST_CACHE_MAX_CELLS:
+        return None
+
+    generation = _get_generation(cache, project_id)
+    keys = dict((_cell_key(project_id, generation, cell), cell) for cell in cells)
+    cached = cache.get_many(keys.keys())
+
+    cell_data = []
+    for key, cell in keys.iteritems():
+        data = cached.get(key)
+        if data is None:
+            cell_params = cell_bounds(cell)
+            cell_params['project_id'] = project_id
+            cell_params['limit'] = params['limit']
+            data = fetch_cell(cell_params)
+            # A cell with more nodes than the limit allows can't be
+            # represented completely.
+            if data[3]:
+                return None
+            cache.set(key, data, settings.NODE_LIST_CACHE_TIMEOUT)
+        cell_data.append(data)
+
+    return _reduce_to_view(cell_data, params, include_labels)
+
+
+def _distance_sq(a, b, left, top, right, bottom, z):
+    """Return the squared distance between the segment from <a> to <b> and the
+    rectangle [left, right] x [top, bottom] in the plane at <z>.
+    """
+    direction = [b[i] - a[i] for i in range(3)]
+    # Between these parameters along the segment, each coordinate is either
+    # inside or on one side of the rectangle and the squared distance is a
+    # quadratic function of the parameter.
+    ts = [0.0, 1.0]
+    for i, bounds in ((0, (left, right)), (1, (top, bottom))):
+        if direction[i]:
+            ts.extend((bound - a[i]) / direction[i] for bound in bounds)
+    ts = sorted(t for t in ts if 0.0 <= t <= 1.0)
+
+    best = None
+    for t0, t1 in zip(ts, ts[1:]):
+        tm = (t0 + t1) * 0.5
+        # Each active term of the squared distance is (c + d * t)^2
+        terms = [(a[2] - z, direction[2])]
+        for i, lower, upper in ((0, left, right), (1, top, bottom)):
+            value = a[i] + direction[i] * tm
+            if value < lower:
+                terms.append((lower - a[i], -direction[i]))
+            elif value > upper:
+                terms.append((a[i] - upper, direction[i]))
+        dd = sum(d * d for c, d in terms)
+        t = -sum(c * d for c, d in terms) / dd if dd else t0
+        t = min(max(t, t0), t1)
+        distance = sum((c + d * t) ** 2 for c, d in terms)
+        if best is None or distance < best:
+            best = distance
+    return best
+
+
+def _reduce_to_view(cell_data, params, include_labels):
+    """Combine the node query results of multiple cells and keep only what the
+    node query would return for the bounding box in <params>. Like the spatial
+    filter of get_treenodes_postgis, an edge is kept if its bounding box
+    intersects the view and it is not farther than half of the view's depth
+    away from the rectangle that cuts the view in half in Z.
+    """
+    left, top, z1 = params['left'], params['top'], params['z1']
+    right, bottom, z2 = params['right'], params['bottom'], params['z2']
+    halfzdiff = abs(z2 - z1) * 0.5
+    halfz = z1 + (z2 - z1) * 0.5
+
+    treenodes = {}
+    connectors = {}
+    labels = {}
+    for cell_treenodes, cell_connectors, cell_labels, _ in cell_data:
+        for row in cell_treenodes:
+            treenodes[row[0]] = row
+        for c in cell_connectors:
+            # Connectors outside of a cell only come with the links to the
+            # cell's treenodes, merge them.
+            merged = connectors.get(c[0])
+            if merged:
+                for i in (5, 6, 7):
+                    merged[i].update(c[i])
+            else:
+                connectors[c[0]] = [c[0], c[1], c[2], c[3], c[4],
+                        dict(c[5]), dict(c[6]), dict(c[7]), c[8]]
+        labels.update(cell_labels)
+
+    def is_visible(x, y, z):
+        return left <= x < right and top <= y < bottom and z1 <= z < z2
+
+    def intersects(a, b):
+        return min(a[2], b[2]) <= right and max(a[2], b[2]) >= left and \
+               min(a[3], b[3]) <= bottom and max(a[3], b[3]) >= top and \
+               min(a[4], b[4]) <= z2 and max(a[4], b[4]) >= z1 and \
+               _distance_sq(a[2:5], b[2:5], left, top, right, bottom,
+                       halfz) <= halfzdiff * halfzdiff
+
+    children = defaultdict(list)
+    for row in treenodes.itervalues():
+        if row[1]:
+            children[row[1]].append(row[0])
+
+    # Like the node query, include the child node of every edge intersecting
+    # the view, along with its parent and its children.
+    treenode_ids = set()
+    n_retrieved_nodes = 0
+    for row in treenodes.itervalues():
+        parent = treenodes.get(row[1]) if row[1] else row
+        if parent is None or not intersects(row, parent):
+            continue
+        node_children = children[row[0]]
+        treenode_ids.add(row[0])
+        treenode_ids.add(parent[0])
+        treenode_ids.update(node_children)
+        n_retrieved_nodes += 1 + len(node_children)
+        if n_retrieved_nodes >= params['limit']:
+            # Let the database decide which nodes are returned
+            return None
+
+    result_connectors = []
+    missing_treenode_ids = set()
+    for c in connectors.itervalues():
+        relations = c[5:8]
+        if not is_visible(c[1], c[2], c[3]):
+            # Connectors outside the view are only returned with their links
+            # to the returned treenodes.
+            relations = [dict((tnid, confidence) for tnid, confidence
+                    in r.iteritems() if tnid in treenode_ids) for r in relations]
+            if not any(relations):
+                continue
+        for r in relations:
+            missing_treenode_ids.update(tnid for tnid in r if tnid not in treenode_ids)
+        result_connectors.append((c[0], c[1], c[2], c[3], c[4],
+                relations[0].items(), relations[1].items(),
+                relations[2].items(), c[8]))
+
+    treenode_ids.update(missing_treenode_ids)
+    result_treenodes = [treenodes[tnid] for tnid in treenode_ids
+            if tnid in treenodes]
+
+    result_labels = {}
+    if include_labels:
+        for row in result_treenodes:
+            if row[0] in labels and is_visible(row[2], row[3], row[4]):
+                result_labels[row[0]] = labels[row[0]]
+        for c in result_connectors:
+            if c[0] in labels and z1 <= c[3] < z2:
+                result_labels[c[0]] = labels[c[0]]
+
+    return (result_treenodes, result_connectors, result_labels, False)
+
+
+def _remember_eviction(keys=(), project_id=None):
+    if not hasattr(_evicted, 'keys'):
+        _evicted.keys = set()
+        _evicted.projects = set()
+    _evicted.keys.update(keys)
+    if project_id is not None:
+        _evicted.projects.add(project_id)
+
+
+def _evict(project_id, cells):
+    if not cells:
+        return
+    if len(cells) > MAX_EVICTED_CELLS:
+        invalidate_project(project_id)
+        return
+    cache = get_node_list_cache()
+    generation = _get_generation(cache, project_id)
+    keys = [_cell_key(project_id, generation, cell) for cell in cells]
+    cache.delete_many(keys)
+    _remember_eviction(keys)
+
+
+def invalidate_project(project_id):
+    """Evict all cached cells of a project by advancing its generation.
+    """
+    cache = get_node_list_cache()
+    if cache is None:
+        return
+    try:
+        cache.incr(_generation_key(project_id))
+    except ValueError:
+        # No generation is cached, a new one will be created on next access
+        pass
+    _remember_eviction(project_id=project_id)
+
+
+def invalidate_segments(project_id, segments):
+    """Evict all cells intersecting the bounding box of any of the passed in
+    segments. Each segment is expected to be a tuple of six coordinates, start
+    point followed by end point.
+    """
+    if get_node_list_cache() is None:
+        return
+    cells = set()
+    for x1, y1, z1, x2, y2, z2 in segments:
+        cells.update(cells_in_box(min(x1, x2), min(y1, y2), min(z1, z2),
+                max(x1, x2), max(y1, y2), max(z1, z2)))
+        if len(cells) > MAX_EVICTED_CELLS:
+            break
+    _evict(project_id, cells)
+
+
+def invalidate_nodes(project_id, treenode_ids=(), connector_ids=(), cursor=None):
+    """Evict all cells that contain the passed in treenodes or connectors or
+    any of their edges and links. For node moves this has to be called both
+    before and after the update.
+    """
+    if get_node_list_cache() is None:
+        return
+    treenode_ids = [int(tnid) for tnid in treenode_ids]
+    connector_ids = [int(cid) for cid in connector_ids]
+    if not treenode_ids and not connector_ids:
+        return
+
+    if not cursor:
+        from django.db import connection
+        cursor = connection.cursor()
+    # Edges need all cells along them to be evicted, while for links between
+    # treenodes and connectors only cells of the end points are affected.
+    cursor.execute('''
+        SELECT TRUE, t.location_x, t.location_y, t.location_z,
+               p.location_x, p.location_y, p.location_z
+        FROM treenode t
+        JOIN treenode p ON p.id = COALESCE(t.parent_id, t.id)
+        WHERE t.id = ANY(%(treenodes)s) OR t.parent_id = ANY(%(treenodes)s)
+        UNION ALL
+        SELECT FALSE, t.location_x, t.location_y, t.location_z,
+               c.location_x, c.location_y, c.location_z
+        FROM treenode_connector tc
+        JOIN treenode t ON t.id = tc.treenode_id
+        JOIN connector c ON c.id = tc.connector_id
+        WHERE tc.treenode_id = ANY(%(treenodes)s)
+           OR tc.connector_id = ANY(%(connectors)s)
+        UNION ALL
+        SELECT FALSE, c.location_x, c.location_y, c.location_z,
+               c.location_x, c.location_y, c.location_z
+        FROM connector c
+        WHERE c.id = ANY(%(connectors)s)
+    ''', {'treenodes': treenode_ids, 'connectors': connector_ids})
+
+    segments = []
+    for row in cursor.fetchall():
+        if row[0]:
+            segments.append(row[1:])
+        else:
+            segments.append(row[1:4] + row[1:4])
+            segments.append(row[4:7] + row[4:7])
+    invalidate_segments(project_id, segments)
+
+
+def _evict_again(sender, **kwargs):
+    """Repeat all evictions of the finished request, now that its transaction
+    is committed.
+    """
+    keys = getattr(_evicted, 'keys', None)
+    projects = getattr(_evicted, 'projects', None)
+    if not keys and not projects:
+        return
+    _evicted.keys = set()
+    _evicted.projects = set()
+    cache = get_node_list_cache()
+    if keys:
+        cache.delete_many(list(keys))
+    for project_id in projects:
+        try:
+            cache.incr(_generation_key(project_id))
+        except ValueError:
+            pass
+
+request_finished.connect(_evict_again)
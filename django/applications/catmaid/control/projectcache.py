@@ -0,0 +1,136 @@
+"""A cache for data that most requests need, but that rarely changes: the
+relation and class ID maps of projects, project objects, user role decisions
+and user domains.
+
+Relation and class maps and projects are kept per process. Each project has a
+version in the database, which is changed by triggers on every edit of the
+project, its relations or its classes, also by other processes. Cached values
+are only used as long as their project has the version they were created for.
+Role decisions and user domains are only kept for the duration of a request,
+changes of permissions and groups are therefore seen by the next request.
+
+During a request all values are additionally kept for the whole request, so
+that a request sees consistent values. Saving or deleting the underlying
+models evicts these through signals.
+"""
+import threading
+
+from django.contrib.auth.models import User, Group
+from django.core.signals import request_started, request_finished
+from django.db import connection
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from guardian.models import UserObjectPermission, GroupObjectPermission
+
+from catmaid.models import Project, Relation, Class
+
+
+# Namespaces of values that are cached by project ID across requests
+VERSIONED_NAMESPACES = ('relations', 'classes', 'projects')
+
+# Maps (namespace, project ID) to a tuple of project version and value
+_cache = {}
+_lock = threading.Lock()
+
+# Values used by the current request
+_request = threading.local()
+
+
+def get_version(project_id):
+    """Return the current version of a project or None if it has none.
+    """
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT version FROM project_cache_version WHERE project_id = %s
+    ''', (project_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get(namespace, key, compute):
+    """Return the cached value for <key> in <namespace>. If there is none, the
+    <compute> function is called to create it. Keys of versioned namespaces
+    are project IDs.
+    """
+    cache_key = (namespace, key)
+    request_values = getattr(_request, 'values', None)
+    if request_values is not None and cache_key in request_values:
+        return request_values[cache_key]
+
+    if namespace in VERSIONED_NAMESPACES:
+        # The version is read before the value is computed, a value that is
+        # newer than its version is only computed again.
+        version = get_version(key)
+        entry = _cache.get(cache_key)
+        if entry and entry[0] == version:
+            value = entry[1]
+        else:
+            value = compute()
+            with _lock:
+                _cache[cache_key] = (version, value)
+    else:
+        value = compute()
+
+    if request_values is not None:
+        request_values[cache_key] = value
+    return value
+
+
+def invalidate(namespace, key=None):
+    """Evict a single entry or, if no key is given, all entries of a
+    namespace.
+    """
+    with _lock:
+        if key is None:
+            for cache_key in [k for k in _cache if k[0] == namespace]:
+                del _cache[cache_key]
+        else:
+            _cache.pop((namespace, key), None)
+    request_values = getattr(_request, 'values', None)
+    if request_values is not None:
+        if key is None:
+            for cache_key in [k for k in request_values if k[0] == namespace]:
+                del request_values[cache_key]
+        else:
+            request_values.pop((namespace, key), None)
+
+
+def _start_request(sender, **kwargs):
+    _request.values = {}
+
+
+def _finish_request(sender, **kwargs):
+    _request.values = None
+
+request_started.connect(_start_request)
+request_finished.connect(_finish_request)
+
+
+def _on_relation_change(sender, instance, **kwargs):
+    invalidate('relations', instance.project_id)
+
+def _on_class_change(sender, instance, **kwargs):
+    invalidate('classes', instance.project_id)
+
+def _on_project_change(sender, instance, **kwargs):
+    invalidate('projects', instance.id)
+    invalidate('roles')
+
+def _on_user_change(sender, **kwargs):
+    invalidate('roles')
+    invalidate('domains')
+
+def _on_permission_change(sender, **kwargs):
+    invalidate('roles')
+
+for signal in (post_save, post_delete):
+    signal.connect(_on_relation_change, sender=Relation)
+    signal.connect(_on_class_change, sender=Class)
+    signal.connect(_on_project_change, sender=Project)
+    signal.connect(_on_user_change, sender=User)
+    signal.connect(_on_user_change, sender=Group)
+    signal.connect(_on_permission_change, sender=UserObjectPermission)
+    signal.connect(_on_permission_change, sender=GroupObjectPermission)
+m2m_changed.connect(_on_user_change, sender=User.groups.through)
+m2m_changed.connect(_on_permission_change, sender=User.user_permissions.through)
+m2m_changed.connect(_on_permission_change, sender=Group.permissions.through)
@@ -64,10 +64,9 @@ def get_review_count(skeleton_ids):
     # Count nodes that have been reviewed by each user in each partner skeleton
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM review
+    SELECT skeleton_id, reviewer_id, num_reviewed_nodes
+    FROM skeleton_review_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY reviewer_id, skeleton_id
     ''' % ",".join(map(str, skeleton_ids)))
     # Build dictionary
     reviews = defaultdict(lambda: defaultdict(int))
@@ -97,15 +96,36 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
 
     skids_string = ','.join(map(str, skeleton_ids))
 
-    # Count nodes of each skeleton
+    # Count nodes and reviewed nodes of each skeleton
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
+    SELECT skeleton_id, num_nodes, num_reviewed_nodes
+    FROM skeleton_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
+      AND num_nodes > 0
     ''' % skids_string)
     for row in cursor.fetchall():
-        skeletons[row[0]] = [row[1], 0]
+        skeletons[row[0]] = [row[1], row[2]]
+
+    if not (whitelist_id or user_ids or excluding_user_ids):
+        # The union review is part of the skeleton summary
+        return skeletons
+
+    for status in skeletons.itervalues():
+        status[1] = 0
+
+    if user_ids and 1 == len(user_ids):
+        # The nodes reviewed by a single user are summarized per skeleton as
+        # well
+        cursor.execute('''
+        SELECT skeleton_id, num_reviewed_nodes
+        FROM skeleton_review_summary
+        WHERE skeleton_id IN (%s)
+          AND reviewer_id = %s
+        ''' % (skids_string, int(user_ids[0])))
+        for skid, num_reviewed_nodes in cursor.fetchall():
+            if skid in skeletons:
+                skeletons[skid][1] = num_reviewed_nodes
+        return skeletons
 
     query_joins = ""
     # Optionally, add a filter
@@ -122,15 +142,11 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
         # per skeleton.
         user_filter = " AND r.reviewer_id IN (%s)" % \
             ",".join(map(str, user_ids))
-    elif excluding_user_ids:
+    else:
         # Count number of nodes reviewed by all users excluding the
         # specified ones, per skeleton.
         user_filter = " AND r.reviewer_id NOT IN (%s)" % \
             ",".join(map(str, excluding_user_ids))
-    else:
-        # Count total number of reviewed nodes per skeleton, regardless
-        # of reviewer.
-        user_filter = ""
 
     cursor.execute('''
     SELECT skeleton_id, count(*)
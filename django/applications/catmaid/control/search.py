@@ -1,10 +1,28 @@
 import json
 
+from django.db import connection
 from django.http import HttpResponse
 
+from rest_framework.decorators import api_view
+
 from catmaid.models import UserRole, ClassInstance, TreenodeClassInstance
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.common import get_relation_to_id_map, \
+        get_class_to_id_map
+
+# Default and maximum number of results of a single page of a name search
+NAME_SEARCH_PAGE_SIZE = 1000
+NAME_SEARCH_MAX_PAGE_SIZE = 10000
+
+
+def substring_pattern(substring):
+    """Return an ILIKE pattern matching all strings that contain <substring>.
+    Such patterns can be answered with the trigram index on class instance
+    names.
+    """
+    escaped = substring.replace('\\', '\\\\').replace('%', '\\%') \
+            .replace('_', '\\_')
+    return '%' + escaped + '%'
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -31,8 +49,9 @@ def search(request, project_id=None):
     # 1. Query ClassInstance objects, where the name contains the search string.
     # This retrieves neurons, skeletons and groups by name.
     row_query = ClassInstance.objects.values('id', 'name', 'class_column__class_name').filter(
-        name__icontains=search_string,
-        project=project_id).order_by('class_column__class_name', 'name')
+        project=project_id).extra(where=['class_instance.name ILIKE %s'],
+        params=[substring_pattern(search_string)]).order_by(
+        'class_column__class_name', 'name', 'id')
     rows = list(row_query)
     for row in rows:
         ids.add(row['id'])
@@ -87,3 +106,95 @@ def search(request, project_id=None):
 
     return HttpResponse(json.dumps(rows))
 
+
+
+@api_view(['GET'])
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def search_names(request, project_id=None):
+    """Find class instances like annotations and neurons by name, one page at
+    a time.
+
+    Results are sorted by name and ID. To get the next page, the "next" object
+    of a response is passed along with the original parameters. Name
+    constraints are answered with a trigram index.
+    ---
+    parameters:
+      - name: name
+        description: A part of the name of result elements, case insensitive.
+        type: string
+        paramType: query
+      - name: types
+        description: Allowed class names of result elements. Defaults to 'annotation' and 'neuron'.
+        type: string
+        paramType: query
+        allowMultiple: true
+      - name: limit
+        description: The maximum number of result elements, at most 10000.
+        type: integer
+        defaultValue: 1000
+        paramType: query
+      - name: after_name
+        description: The name of the last result element of the previous page.
+        type: string
+        paramType: query
+      - name: after_id
+        description: The ID of the last result element of the previous page.
+        type: integer
+        paramType: query
+    type:
+      entities:
+        type: array
+        description: A list of [id, name, class name] lists.
+        required: true
+      next:
+        type: object
+        description: The after_name and after_id parameters of the next page or null for the last page.
+        required: true
+    """
+    name = request.GET.get('name', '')
+    types = request.GET.getlist('types') or ('annotation', 'neuron')
+    limit = min(int(request.GET.get('limit', NAME_SEARCH_PAGE_SIZE)),
+            NAME_SEARCH_MAX_PAGE_SIZE)
+    if limit < 1:
+        raise ValueError("The limit has to be positive")
+
+    cursor = connection.cursor()
+    classes = get_class_to_id_map(project_id, types, cursor)
+    params = {
+        'project_id': int(project_id),
+        'class_ids': [classes[t] for t in types if t in classes],
+        'limit': limit + 1,
+    }
+
+    conditions = []
+    if name:
+        conditions.append('AND ci.name ILIKE %(name)s')
+        params['name'] = substring_pattern(name)
+    if 'after_id' in request.GET:
+        conditions.append('AND (ci.name, ci.id) > (%(after_name)s, %(after_id)s)')
+        params['after_name'] = request.GET.get('after_name', '')
+        params['after_id'] = int(request.GET['after_id'])
+
+    # One more row than requested is fetched to know whether there is another
+    # page.
+    cursor.execute('''
+        SELECT ci.id, ci.name, c.class_name
+        FROM class_instance ci
+        JOIN class c ON c.id = ci.class_id
+        WHERE ci.project_id = %(project_id)s
+          AND ci.class_id = ANY(%(class_ids)s)
+          {conditions}
+        ORDER BY ci.name, ci.id
+        LIMIT %(limit)s
+    '''.format(conditions='\n          '.join(conditions)), params)
+    entities = cursor.fetchall()
+
+    next_page = None
+    if len(entities) > limit:
+        entities = entities[:limit]
+        next_page = {'after_name': entities[-1][1], 'after_id': entities[-1][0]}
+
+    return HttpResponse(json.dumps({
+        'entities': entities,
+        'next': next_page,
+    }), content_type='application/json')
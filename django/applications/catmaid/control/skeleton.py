@@ -22,15 +22,17 @@ from catmaid.models import Project, UserRole, Class, ClassInstance, Review, \
 from catmaid.objects import Skeleton, SkeletonGroup, \
         compartmentalize_skeletongroup_by_edgecount, \
         compartmentalize_skeletongroup_by_confidence
+from catmaid.control import nodecache, topologycache
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_or_fail
 from catmaid.control.common import insert_into_log, get_class_to_id_map, \
         get_relation_to_id_map, _create_relation
+from catmaid.control.connectivity import synapse_counts
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.neuron_annotations import create_annotation_query, \
         _annotate_entities, _update_neuron_annotations
 from catmaid.control.review import get_treenodes_to_reviews, get_review_status
-from catmaid.control.tree_util import find_root, reroot, edge_count_to_root
+from catmaid.control.tree_util import find_root
 
 
 def get_skeleton_permissions(request, project_id, skeleton_id):
@@ -98,59 +100,42 @@ def open_leaves(request, project_id=None, skeleton_id=None):
       required: true
     """
     tnid = int(request.POST['treenode_id'])
-    cursor = connection.cursor()
-
-    cursor.execute("SELECT id FROM relation WHERE project_id=%s AND relation_name='labeled_as'" % int(project_id))
-    labeled_as = cursor.fetchone()[0]
-
-    # Select all nodes and their tags
-    cursor.execute('''
-    SELECT t.id, t.parent_id, t.location_x, t.location_y, t.location_z, t.creation_time, ci.name
-    FROM treenode t LEFT OUTER JOIN (treenode_class_instance tci INNER JOIN class_instance ci ON tci.class_instance_id = ci.id AND tci.relation_id = %s) ON t.id = tci.treenode_id
-    WHERE t.skeleton_id = %s
-    ''' % (labeled_as, int(skeleton_id)))
-
-    # Some entries repeated, when a node has more than one tag
-    # Create a graph with edges from parent to child, and accumulate parents
-    tree = nx.DiGraph()
-    for row in cursor.fetchall():
-        nodeID = row[0]
-        if row[1]:
-            # It is ok to add edges that already exist: DiGraph doesn't keep duplicates
-            tree.add_edge(row[1], nodeID)
-        else:
-            tree.add_node(nodeID)
-        tree.node[nodeID]['loc'] = (row[2], row[3], row[4])
-        tree.node[nodeID]['ct'] = row[5]
-        if row[6]:
-            props = tree.node[nodeID]
-            tags = props.get('tags')
-            if tags:
-                tags.append(row[6])
-            else:
-                props['tags'] = [row[6]]
+    topology = topologycache.get(skeleton_id)
+    arbor = topology.arbor
 
-    if tnid not in tree:
+    if tnid not in arbor:
         raise Exception("Could not find %s in skeleton %s" % (tnid, int(skeleton_id)))
 
-    reroot(tree, tnid)
-    distances = edge_count_to_root(tree, root_node=tnid)
+    # End nodes are all nodes with at most one neighbor, which includes the
+    # root and the query node itself.
+    distances = topology.path_edge_counts(tnid)
+    n_neighbors = arbor.n_children() + (arbor.parents != -1)
+    end_nodes = arbor.node_ids[n_neighbors <= 1].tolist()
 
     # Iterate end nodes to find which are open.
-    nearest = []
     end_tags = ['uncertain continuation', 'not a branch', 'soma',
             '^(?i)(really|uncertain|anterior|posterior)?\s?ends?$']
     end_regex = re.compile('(?:' + ')|(?:'.join(end_tags) + ')')
+    open_ends = [node_id for node_id in end_nodes
+            if not any(end_regex.match(s) for s in topology.tags.get(node_id, ()))]
+    if not open_ends:
+        return HttpResponse(json.dumps([]))
 
-    for nodeID, out_degree in tree.out_degree_iter():
-        if 0 == out_degree or nodeID == tnid and 1 == out_degree:
-            # Found an end node
-            props = tree.node[nodeID]
-            # Check if not tagged with a tag containing 'end'
-            if not 'tags' in props or not any(end_regex.match(s) for s in props['tags']):
-                # Found an open end
-                d = distances[nodeID]
-                nearest.append([nodeID, props['loc'], d, props['ct']])
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT id, location_x, location_y, location_z, creation_time
+        FROM treenode
+        WHERE id = ANY(%s)
+    ''', (open_ends,))
+    nodes = dict((row[0], row[1:]) for row in cursor.fetchall())
+
+    nearest = []
+    for node_id in open_ends:
+        if node_id in nodes:
+            x, y, z, creation_time = nodes[node_id]
+            # Distances are counted in nodes, including the query node
+            d = int(distances[arbor.index(node_id)]) + 1
+            nearest.append([node_id, (x, y, z), d, creation_time])
 
     return HttpResponse(json.dumps(nearest, cls=DjangoJSONEncoder))
 
@@ -203,62 +188,35 @@ def find_labels(request, project_id=None, skeleton_id=None):
       required: trueist open leaf nodes in a skeleton.
     """
     tnid = int(request.POST['treenode_id'])
-    label_regex = str(request.POST['label_regex'])
-    cursor = connection.cursor()
-
-    cursor.execute("SELECT id FROM relation WHERE project_id=%s AND relation_name='labeled_as'" % int(project_id))
-    labeled_as = cursor.fetchone()[0]
-
-    # Select all nodes in the skeleton and any matching labels
-    cursor.execute('''
-            SELECT
-                t.id,
-                t.parent_id,
-                t.location_x,
-                t.location_y,
-                t.location_z,
-                ci.name
-            FROM treenode t
-            LEFT OUTER JOIN (
-                treenode_class_instance tci
-                INNER JOIN class_instance ci
-                  ON (tci.class_instance_id = ci.id AND tci.relation_id = %s AND ci.name ~ %s))
-              ON t.id = tci.treenode_id
-            WHERE t.skeleton_id = %s
-            ''', (labeled_as, label_regex, int(skeleton_id)))
-
-    # Some entries repeated, when a node has more than one matching label
-    # Create a graph with edges from parent to child, and accumulate parents
-    tree = nx.DiGraph()
-    for row in cursor.fetchall():
-        nodeID = row[0]
-        if row[1]:
-            # It is ok to add edges that already exist: DiGraph doesn't keep duplicates
-            tree.add_edge(row[1], nodeID)
-        else:
-            tree.add_node(nodeID)
-        tree.node[nodeID]['loc'] = (row[2], row[3], row[4])
-        if row[5]:
-            props = tree.node[nodeID]
-            tags = props.get('tags')
-            if tags:
-                tags.append(row[5])
-            else:
-                props['tags'] = [row[5]]
+    label_regex = re.compile(str(request.POST['label_regex']))
+    topology = topologycache.get(skeleton_id)
+    arbor = topology.arbor
 
-    if tnid not in tree:
+    if tnid not in arbor:
         raise Exception("Could not find %s in skeleton %s" % (tnid, int(skeleton_id)))
 
-    reroot(tree, tnid)
-    distances = edge_count_to_root(tree, root_node=tnid)
+    # Find all nodes with matching labels
+    matches = {}
+    for node_id, tags in topology.tags.iteritems():
+        matching_tags = [t for t in tags if label_regex.search(t)]
+        if matching_tags:
+            matches[node_id] = matching_tags
+    if not matches:
+        return HttpResponse(json.dumps([]))
 
-    nearest = []
+    distances = topology.path_edge_counts(tnid)
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT id, location_x, location_y, location_z
+        FROM treenode
+        WHERE id = ANY(%s)
+    ''', (list(matches),))
 
-    for nodeID, props in tree.nodes_iter(data=True):
-        if 'tags' in props:
-            # Found a node with a matching label
-            d = distances[nodeID]
-            nearest.append([nodeID, props['loc'], d, props['tags']])
+    nearest = []
+    for row in cursor.fetchall():
+        # Distances are counted in nodes, including the query node
+        d = int(distances[arbor.index(row[0])]) + 1
+        nearest.append([row[0], row[1:4], d, matches[row[0]]])
 
     nearest.sort(key=lambda n: n[2])
 
@@ -499,7 +457,7 @@ def split_skeleton(request, project_id=None):
     cursor = connection.cursor()
 
     # Check if the treenode is root!
-    if not treenode.parent:
+    if not treenode.parent_id:
         return HttpResponse(json.dumps({'error': 'Can\'t split at the root node: it doesn\'t have a parent.'}))
 
     # Check if annotations are valid
@@ -519,33 +477,31 @@ def split_skeleton(request, project_id=None):
     # Make sure the user has permissions to edit
     can_edit_class_instance_or_fail(request.user, neuron.id, 'neuron')
 
-    # Retrieve the id, parent_id of all nodes in the skeleton. Also
-    # pre-emptively lock all treenodes and connectors in the skeleton to prevent
-    # race conditions resulting in inconsistent skeleton IDs from, e.g., node
-    # creation or update.
+    # Collect the IDs of the split node and all nodes downstream of it in a
+    # temporary table by following parent_id in the database, which avoids
+    # loading the whole skeleton. Treenodes and connector links of these nodes
+    # are pre-emptively locked to prevent race conditions resulting in
+    # inconsistent skeleton IDs from, e.g., node creation or update.
     cursor.execute('''
-        SELECT 1 FROM treenode_connector tc WHERE tc.skeleton_id = %s
+        CREATE TEMPORARY TABLE split_treenode (id bigint PRIMARY KEY)
+        ON COMMIT DROP;
+        WITH RECURSIVE downstream (id) AS (
+            SELECT %(treenode_id)s::bigint
+            UNION ALL
+            SELECT t.id FROM treenode t
+            JOIN downstream d ON t.parent_id = d.id
+        )
+        INSERT INTO split_treenode (id) SELECT id FROM downstream;
+        ANALYZE split_treenode;
+        SELECT 1 FROM treenode_connector tc
+        JOIN split_treenode s ON s.id = tc.treenode_id
         ORDER BY tc.id
         FOR NO KEY UPDATE OF tc;
-        SELECT t.id, t.parent_id FROM treenode t WHERE t.skeleton_id = %s
+        SELECT 1 FROM treenode t
+        JOIN split_treenode s ON s.id = t.id
         ORDER BY t.id
-        FOR NO KEY UPDATE OF t
-        ''', (skeleton_id, skeleton_id)) # no need to sanitize
-    # build the networkx graph from it
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        graph.add_node( row[0] )
-        if row[1]:
-            # edge from parent_id to id
-            graph.add_edge( row[1], row[0] )
-    # find downstream nodes starting from target treenode_id
-    # and generate the list of IDs to change, starting at treenode_id (inclusive)
-    change_list = nx.bfs_tree(graph, treenode_id).nodes()
-    if not change_list:
-        # When splitting an end node, the bfs_tree doesn't return any nodes,
-        # which is surprising, because when the splitted tree has 2 or more nodes
-        # the node at which the split is made is included in the list.
-        change_list.append(treenode_id)
+        FOR NO KEY UPDATE OF t;
+    ''', {'treenode_id': treenode_id})
     # create a new skeleton
     new_skeleton = ClassInstance()
     new_skeleton.name = 'Skeleton'
@@ -573,29 +529,40 @@ def split_skeleton(request, project_id=None):
     cici.user = skeleton.user # The same user that owned the skeleton to split
     cici.project_id = project_id
     cici.save()
-    # update skeleton_id of list in treenode table
-    # This creates a lazy QuerySet that, upon calling update, returns a new QuerySet
-    # that is then executed. It does NOT create an update SQL query for every treenode.
-    tns = Treenode.objects.filter(id__in=change_list).update(skeleton=new_skeleton)
-    # update the skeleton_id value of the treenode_connector table
-    tc = TreenodeConnector.objects.filter(
-        relation__relation_name__endswith = 'synaptic_to',
-        treenode__in=change_list,
-    ).update(skeleton=new_skeleton)
-    # setting new root treenode's parent to null
-    Treenode.objects.filter(id=treenode_id).update(parent=None, editor=request.user)
+    # Move the downstream nodes, their synaptic connector links and their
+    # reviews to the new skeleton and make the split node its root.
+    cursor.execute('''
+        UPDATE treenode t SET skeleton_id = %(skeleton_id)s
+        FROM split_treenode s
+        WHERE t.id = s.id;
+        UPDATE treenode_connector tc SET skeleton_id = %(skeleton_id)s
+        FROM split_treenode s, relation r
+        WHERE tc.treenode_id = s.id
+          AND r.id = tc.relation_id
+          AND r.relation_name LIKE '%%synaptic_to';
+        UPDATE review rv SET skeleton_id = %(skeleton_id)s
+        FROM split_treenode s
+        WHERE rv.treenode_id = s.id;
+        UPDATE treenode SET parent_id = NULL, editor_id = %(user_id)s
+        WHERE id = %(treenode_id)s;
+        DROP TABLE split_treenode;
+    ''', {
+        'skeleton_id': new_skeleton.id,
+        'user_id': request.user.id,
+        'treenode_id': treenode_id,
+    })
 
     # Update annotations of existing neuron to have only over set
     _update_neuron_annotations(project_id, request.user, neuron.id,
             upstream_annotation_map)
 
-    # Update all reviews of the treenodes that are moved to a new neuron to
-    # refer to the new skeleton.
-    Review.objects.filter(treenode_id__in=change_list).update(skeleton=new_skeleton)
-
     # Update annotations of under skeleton
     _annotate_entities(project_id, [new_neuron.id], downstream_annotation_map)
 
+    # Skeleton IDs of many cached nodes changed
+    nodecache.invalidate_project(project_id)
+    topologycache.invalidate(skeleton_id)
+
     # Log the location of the node at which the split was done
     location = (treenode.location_x, treenode.location_y, treenode.location_z)
     insert_into_log(project_id, request.user.id, "split_skeleton", location,
@@ -707,7 +674,7 @@ def skeleton_ancestry(request, project_id=None):
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
-def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_of_id, cursor):
+def _connected_skeletons(project_id, skeleton_ids, op, upstream, cursor):
     def newSynapseCounts():
         return [0, 0, 0, 0, 0]
 
@@ -721,20 +688,18 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
         return Partner()
     partners = defaultdict(newPartner)
 
-    # Obtain the synapses made by all skeleton_ids considering the desired direction of the synapse, as specified by relation_id_1 and relation_id_2:
-    cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence)
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t2.relation_id = %s
-    ''' % (','.join(map(str, skeleton_ids)), int(relation_id_1), int(relation_id_2)))
+    # Obtain the synapses made by all skeleton_ids considering the desired
+    # direction of the synapse: onto skeleton_ids if upstream partners are
+    # requested, from skeleton_ids otherwise.
+    if upstream:
+        counts = ((srcID, partnerID, confidence, count) for partnerID, srcID, confidence, count
+                  in synapse_counts(cursor, project_id, post_skeleton_ids=skeleton_ids))
+    else:
+        counts = synapse_counts(cursor, project_id, pre_skeleton_ids=skeleton_ids)
 
     # Sum the number of synapses
-    for srcID, partnerID, confidence in cursor.fetchall():
-        partners[partnerID].skids[srcID][confidence - 1] += 1
+    for srcID, partnerID, confidence, count in counts:
+        partners[partnerID].skids[srcID][confidence - 1] += count
 
     # There may not be any synapses
     if not partners:
@@ -755,11 +720,10 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
 
     # Count nodes of each partner skeleton
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode,
+    SELECT skeleton_id, num_nodes
+    FROM skeleton_summary,
          (VALUES (%s)) skeletons(skid)
     WHERE skeleton_id = skid
-    GROUP BY skeleton_id
     ''' % skids_string) # no need to sanitize
     for row in cursor.fetchall():
         partners[row[0]].num_nodes = row[1]
@@ -778,20 +742,9 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
 def _skeleton_info_raw(project_id, skeletons, op):
     cursor = connection.cursor()
 
-    # Obtain the IDs of the 'presynaptic_to', 'postsynaptic_to' and 'model_of' relations
-    cursor.execute('''
-    SELECT relation_name,
-           id
-    FROM relation
-    WHERE project_id=%s
-      AND (relation_name='presynaptic_to'
-        OR relation_name='postsynaptic_to'
-        OR relation_name='model_of')''' % project_id)
-    relation_ids = dict(cursor.fetchall())
-
     # Obtain partner skeletons and their info
-    incoming, incoming_reviewers = _connected_skeletons(skeletons, op, relation_ids['postsynaptic_to'], relation_ids['presynaptic_to'], relation_ids['model_of'], cursor)
-    outgoing, outgoing_reviewers = _connected_skeletons(skeletons, op, relation_ids['presynaptic_to'], relation_ids['postsynaptic_to'], relation_ids['model_of'], cursor)
+    incoming, incoming_reviewers = _connected_skeletons(project_id, skeletons, op, True, cursor)
+    outgoing, outgoing_reviewers = _connected_skeletons(project_id, skeletons, op, False, cursor)
 
     def prepare(partners):
         for partnerID in partners.keys():
@@ -937,33 +890,18 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids):
     synapse counts.
     """
     cursor = connection.cursor()
-    relation_map = get_relation_to_id_map(project_id)
-    post_rel_id = relation_map['postsynaptic_to']
-    pre_rel_id = relation_map['presynaptic_to']
 
     # Obtain all synapses made between row skeletons and column skeletons.
-    cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t2.skeleton_id IN (%s)
-      AND t1.connector_id = t2.connector_id
-      AND t1.relation_id = %s
-      AND t2.relation_id = %s
-    ''' % (','.join(map(str, row_skeleton_ids)),
-           ','.join(map(str, col_skeleton_ids)),
-           pre_rel_id, post_rel_id))
+    counts = synapse_counts(cursor, project_id, row_skeleton_ids, col_skeleton_ids)
 
     # Build a sparse connectivity representation. For all skeletons requested
     # map a dictionary of partner skeletons and the number of synapses
     # connecting to each partner.
     outgoing = defaultdict(dict)
-    for r in cursor.fetchall():
-        source, target = r[0], r[1]
+    for source, target, confidence, n in counts:
         mapping = outgoing[source]
         count = mapping.get(target, 0)
-        mapping[target] = count + 1
+        mapping[target] = count + n
 
     return outgoing
 
@@ -1112,6 +1050,8 @@ def _reroot_skeleton(treenode_id, project_id):
                 WHERE treenode.id = v.id
                 ''' % ','.join(['(%s,%s,%s)' % node for node in new_parents]))
 
+        nodecache.invalidate_project(project_id)
+
         return rootnode
 
     except Exception as e:
@@ -1269,6 +1209,8 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         response_on_error = 'Could not update parent of treenode with ID %s' % to_treenode_id
         Treenode.objects.filter(id=to_treenode_id).update(parent=from_treenode_id, editor=user)
 
+        nodecache.invalidate_project(project_id)
+
         # Update linked annotations of neuron
         response_on_error = 'Could not update annotations of neuron ' \
                 'with ID %s' % from_neuron['neuronid']
@@ -1390,6 +1332,8 @@ def _import_skeleton(request, project_id, arborescence, neuron_id=None, name=Non
         WHERE treenode.id = v.id AND treenode.skeleton_id = %s
         """ % (treenode_values, new_skeleton.id)) # Include skeleton ID for index performance.
 
+    nodecache.invalidate_project(project_id)
+
     # Log import.
     insert_into_log(project_id, request.user.id, 'create_neuron',
                     new_location, 'Create neuron %d and skeleton '
@@ -1663,12 +1607,9 @@ def _list_skeletons(project_id, created_by=None, reviewed_by=None, from_date=Non
     if nodecount_gt > 0:
         params.append(nodecount_gt)
         query = '''
-            SELECT sub.skeleton_id
-            FROM (
-                SELECT t.skeleton_id AS skeleton_id, COUNT(*) AS count
-                FROM (%s) q JOIN treenode t ON q.skeleton_id = t.skeleton_id
-                GROUP BY t.skeleton_id
-            ) AS sub WHERE sub.count > %%s
+            SELECT q.skeleton_id
+            FROM (%s) q JOIN skeleton_summary s ON q.skeleton_id = s.skeleton_id
+            WHERE s.num_nodes > %%s
         ''' % query
 
     cursor = connection.cursor()
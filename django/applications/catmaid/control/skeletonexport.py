@@ -1,14 +1,16 @@
 import json
-import networkx as nx
-from itertools import imap
+import tempfile
+import zipfile
+import numpy as np
+from itertools import imap, groupby
+from operator import itemgetter
 from functools import partial
 from collections import defaultdict
-from math import sqrt
 from datetime import datetime
 
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import connection
-from django.http import HttpResponse
+from django.db import connection, transaction
+from django.http import HttpResponse, StreamingHttpResponse
 
 from rest_framework.decorators import api_view
 
@@ -16,11 +18,14 @@ from catmaid.models import UserRole, ClassInstance, Treenode, \
         TreenodeClassInstance, ConnectorClassInstance, Review
 from catmaid.control import export_NeuroML_Level3
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.common import get_relation_to_id_map, \
+        compact_response, wants_msgpack, MSGPACK_CONTENT_TYPE
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
+from catmaid.control.spatial import skeletons_within_distance
+from catmaid.control.columnarexport import named_cursor
 
-from tree_util import edge_count_to_root, partition
+from tree_util import CompactArbor
 try:
     from exportneuroml import neuroml_single_cell, neuroml_network
 except ImportError:
@@ -42,28 +47,59 @@ def get_treenodes_qs(project_id=None, skeleton_id=None, with_labels=True):
     return treenode_qs, labels_qs, labelconnector_qs
 
 
-def get_swc_string(treenodes_qs):
-    all_rows = []
-    for tn in treenodes_qs:
-        swc_row = [tn.id]
-        swc_row.append(0)
-        swc_row.append(tn.location_x)
-        swc_row.append(tn.location_y)
-        swc_row.append(tn.location_z)
-        swc_row.append(max(tn.radius, 0))
-        swc_row.append(-1 if tn.parent_id is None else tn.parent_id)
-        all_rows.append(swc_row)
-    result = ""
-    for row in all_rows:
-        result += " ".join(map(str, row)) + "\n"
-    return result
+# Number of treenode rows that are formatted as SWC at once
+SWC_BATCH_SIZE = 10000
 
-def export_skeleton_response(request, project_id=None, skeleton_id=None, format=None):
-    treenode_qs, labels_qs, labelconnector_qs = get_treenodes_qs(project_id, skeleton_id)
+SWC_QUERY = '''
+    SELECT skeleton_id, id, location_x, location_y, location_z,
+           greatest(radius, 0), COALESCE(parent_id, -1)
+    FROM treenode
+    WHERE project_id = %s AND skeleton_id = ANY(%s)
+'''
+
+
+def _swc_lines(rows):
+    return ''.join('%s 0 %s %s %s %s %s\n' % row[1:] for row in rows)
+
+
+def iter_swc(project_id, skeleton_id):
+    """ Yield the SWC representation of a skeleton in blocks of lines, which
+    are formatted from raw treenode rows.
+    """
+    cursor = connection.cursor()
+    cursor.execute(SWC_QUERY, (int(project_id), [int(skeleton_id)]))
+    while True:
+        rows = cursor.fetchmany(SWC_BATCH_SIZE)
+        if not rows:
+            break
+        yield _swc_lines(rows)
+
+
+def write_swc_archive(project_id, skeleton_ids, output):
+    """ Write one SWC file per skeleton, named <skeleton ID>.swc, to a zip
+    archive. Nodes of all skeletons are read with a single query through a
+    server-side cursor. Returns the IDs of the written skeletons.
+    """
+    written = []
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive, \
+            transaction.atomic():
+        cursor = named_cursor('swc_archive', SWC_BATCH_SIZE)
+        cursor.execute(SWC_QUERY + ' ORDER BY skeleton_id',
+                (int(project_id), [int(s) for s in skeleton_ids]))
+        for skeleton_id, rows in groupby(cursor, itemgetter(0)):
+            archive.writestr('%s.swc' % skeleton_id, _swc_lines(rows))
+            written.append(skeleton_id)
+        cursor.close()
+    return written
 
+
+def export_skeleton_response(request, project_id=None, skeleton_id=None, format=None):
     if format == 'swc':
-        return HttpResponse(get_swc_string(treenode_qs), content_type='text/plain')
-    elif format == 'json':
+        return StreamingHttpResponse(iter_swc(project_id, skeleton_id),
+                content_type='text/plain')
+
+    treenode_qs, labels_qs, labelconnector_qs = get_treenodes_qs(project_id, skeleton_id)
+    if format == 'json':
         return HttpResponse(get_json_string(treenode_qs), content_type='application/json')
     else:
         raise Exception, "Unknown format ('%s') in export_skeleton_response" % (format,)
@@ -74,7 +110,8 @@ def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors
     """
         Performance-critical function. Do not edit unless to improve performance.
 
-        Returns, in JSON, [[nodes], [connectors], {nodeID: [tags]}], with connectors and tags being empty when 0 == with_connectors and 0 == with_tags, respectively
+        Returns, in JSON, [[nodes], [connectors], {nodeID: [tags]}], with connectors and tags being empty when 0 == with_connectors and 0 == with_tags, respectively.
+        With a "format=msgpack" parameter or a matching Accept header, the same structure is returned as msgpack.
     """
 
     # Sanitize
@@ -105,9 +142,7 @@ def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors
     tags = defaultdict(list)
 
     if 0 != with_connectors or 0 != with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
+        relations = get_relation_to_id_map(project_id, cursor=cursor)
 
     if 0 != with_connectors:
         # Fetch all connectors with their partner treenode IDs
@@ -141,7 +176,137 @@ def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors
         for row in cursor.fetchall():
             tags[row[0]].append(row[1])
 
-    return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
+    return compact_response((nodes, connectors, dict(tags)), wants_msgpack(request))
+
+
+# The number of skeletons fetched with a single set of queries when streaming
+# multiple compact skeletons.
+COMPACT_SKELETONS_BATCH_SIZE = 100
+
+
+@requires_user_role(UserRole.Browse)
+def compact_skeletons(request, project_id=None):
+    """
+    Like compact_skeleton, but for all skeletons in the skeleton_ids POST
+    array. Nodes, connectors and tags are fetched with one query each for
+    a batch of skeletons and the response is streamed skeleton by skeleton:
+
+    {"missing": [skeleton_id, ...],
+     "skeletons": {skeleton_id: [[nodes], [connectors], {tag: [nodes]}], ...}}
+
+    IDs that don't belong to a skeleton are listed in "missing". With_connectors and
+    with_tags default to 1, msgpack can be requested like for compact_skeleton.
+    """
+    project_id = int(project_id)
+    # Every skeleton is written only once, repeated IDs would otherwise break
+    # the entry count of the msgpack map.
+    skeleton_ids = list(set(int(v) for k,v in request.POST.iteritems()
+            if k.startswith('skeleton_ids[')))
+    with_connectors = int(request.POST.get('with_connectors', 1))
+    with_tags = int(request.POST.get('with_tags', 1))
+    use_msgpack = wants_msgpack(request)
+
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT ci.id FROM class_instance ci
+        JOIN class c ON c.id = ci.class_id
+        WHERE ci.project_id = %s AND ci.id = ANY(%s)
+          AND c.class_name = 'skeleton'
+    ''', (project_id, skeleton_ids))
+    existing = set(row[0] for row in cursor.fetchall())
+    found = [skid for skid in skeleton_ids if skid in existing]
+    missing = [skid for skid in skeleton_ids if skid not in existing]
+
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to', 'labeled_as'), cursor)
+
+    # Skeletons are only fetched while the response is consumed. Errors can't
+    # be reported after streaming started, which is why the input is checked
+    # above.
+    skeletons = _iter_compact_skeletons(found, relations, with_connectors,
+            with_tags)
+
+    if use_msgpack:
+        import msgpack
+        def stream():
+            packer = msgpack.Packer(use_single_float=True)
+            yield packer.pack_map_header(2)
+            yield packer.pack('missing')
+            yield packer.pack(missing)
+            yield packer.pack('skeletons')
+            yield packer.pack_map_header(len(found))
+            for skid, skeleton in skeletons:
+                yield packer.pack(skid)
+                yield packer.pack(skeleton)
+        return StreamingHttpResponse(stream(), content_type=MSGPACK_CONTENT_TYPE)
+
+    def stream():
+        yield '{"missing":%s,"skeletons":{' % json.dumps(missing)
+        separator = ''
+        for skid, skeleton in skeletons:
+            yield '%s"%s":%s' % (separator, skid,
+                    json.dumps(skeleton, separators=(',', ':')))
+            separator = ','
+        yield '}}'
+    return StreamingHttpResponse(stream(), content_type='application/json')
+
+
+def _iter_compact_skeletons(skeleton_ids, relations, with_connectors, with_tags):
+    """ Yield a (skeleton_id, (nodes, connectors, tags)) tuple in the format of
+    compact_skeleton for each passed in skeleton. Skeletons are queried in
+    batches of COMPACT_SKELETONS_BATCH_SIZE to keep memory usage bounded.
+    """
+    cursor = connection.cursor()
+    pre = relations['presynaptic_to']
+    post = relations['postsynaptic_to']
+
+    for i in xrange(0, len(skeleton_ids), COMPACT_SKELETONS_BATCH_SIZE):
+        batch = skeleton_ids[i:i + COMPACT_SKELETONS_BATCH_SIZE]
+
+        nodes = defaultdict(list)
+        cursor.execute('''
+            SELECT skeleton_id, id, parent_id, user_id,
+                   location_x, location_y, location_z,
+                   radius, confidence
+            FROM treenode
+            WHERE skeleton_id = ANY(%s)
+        ''', (batch,))
+        for row in cursor.fetchall():
+            nodes[row[0]].append(row[1:])
+
+        connectors = defaultdict(list)
+        if 0 != with_connectors:
+            cursor.execute('''
+                SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                       tc.relation_id, c.location_x, c.location_y, c.location_z
+                FROM treenode_connector tc,
+                     connector c
+                WHERE tc.skeleton_id = ANY(%s)
+                  AND tc.connector_id = c.id
+                  AND (tc.relation_id = %s OR tc.relation_id = %s)
+            ''', (batch, pre, post))
+            for row in cursor.fetchall():
+                connectors[row[0]].append((row[1], row[2],
+                        1 if row[3] == post else 0, row[4], row[5], row[6]))
+
+        tags = defaultdict(partial(defaultdict, list))
+        if 0 != with_tags:
+            cursor.execute('''
+                SELECT t.skeleton_id, c.name, tci.treenode_id
+                FROM treenode t,
+                     treenode_class_instance tci,
+                     class_instance c
+                WHERE t.skeleton_id = ANY(%s)
+                  AND t.id = tci.treenode_id
+                  AND tci.relation_id = %s
+                  AND c.id = tci.class_instance_id
+            ''', (batch, relations['labeled_as']))
+            for row in cursor.fetchall():
+                tags[row[0]][row[1]].append(row[2])
+
+        for skid in batch:
+            yield skid, (nodes.get(skid, ()), connectors.get(skid, ()),
+                    dict(tags.get(skid, {})))
 
 
 @requires_user_role(UserRole.Browse)
@@ -151,6 +316,7 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
     Returns, in JSON, [[nodes], [connections], {nodeID: [tags]}],
     with connections being empty when 0 == with_connectors,
     and the dict of node tags being empty 0 == with_tags, respectively.
+    Like compact_skeleton, it can return msgpack instead of JSON.
 
     The difference between this function and the compact_skeleton function is that
     the connections contain the whole chain from the skeleton of interest to the
@@ -165,7 +331,11 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
     and finally the two relations: first for the given skeleton_id and then for the other skeleton.
     The relation_id is 0 for pre and 1 for post.
     """
+    return compact_response(_compact_arbor(project_id, skeleton_id, with_nodes,
+            with_connectors, with_tags), wants_msgpack(request))
 
+
+def _compact_arbor(project_id, skeleton_id, with_nodes, with_connectors, with_tags):
     # Sanitize
     project_id = int(project_id)
     skeleton_id = int(skeleton_id)
@@ -197,9 +367,7 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
             # Otherwise returns an empty list of nodes
 
     if 0 != with_connectors or 0 != with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
+        relations = get_relation_to_id_map(project_id, cursor=cursor)
 
     if 0 != with_connectors:
         # Fetch all inputs and outputs
@@ -243,26 +411,30 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
         for row in cursor.fetchall():
             tags[row[0]].append(row[1])
 
-    return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
+    return nodes, connectors, dict(tags)
 
 
-@requires_user_role([UserRole.Browse])
-def treenode_time_bins(request, project_id=None, skeleton_id=None):
-    """ Return a map of time bins (minutes) vs. list of nodes. """
+def _treenode_time_bins(skeleton_id):
     minutes = defaultdict(list)
     epoch = datetime.utcfromtimestamp(0)
 
     for row in Treenode.objects.filter(skeleton_id=int(skeleton_id)).values_list('id', 'creation_time'):
         minutes[int((row[1] - epoch).total_seconds() / 60)].append(row[0])
 
-    return HttpResponse(json.dumps(minutes, separators=(',', ':')))
+    return dict(minutes)
+
+
+@requires_user_role([UserRole.Browse])
+def treenode_time_bins(request, project_id=None, skeleton_id=None):
+    """ Return a map of time bins (minutes) vs. list of nodes. """
+    return HttpResponse(json.dumps(_treenode_time_bins(skeleton_id), separators=(',', ':')))
 
 
 @requires_user_role([UserRole.Browse])
 def compact_arbor_with_minutes(request, project_id=None, skeleton_id=None, with_nodes=None, with_connectors=None, with_tags=None):
-    r = compact_arbor(request, project_id=project_id, skeleton_id=skeleton_id, with_nodes=with_nodes, with_connectors=with_connectors, with_tags=with_tags)
-    r.content = "%s, %s]" % (r.content[:-1], treenode_time_bins(request, project_id=project_id, skeleton_id=skeleton_id).content)
-    return r
+    arbor = _compact_arbor(project_id, skeleton_id, with_nodes, with_connectors, with_tags)
+    return compact_response(arbor + (_treenode_time_bins(skeleton_id),),
+            wants_msgpack(request))
 
 
 # DEPRECATED. Will be removed.
@@ -403,105 +575,98 @@ def _measure_skeletons(skeleton_ids):
     WHERE skeleton_id IN (%s)
     ''' % skids_string)
 
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
+    rows = cursor.fetchall()
+    skeletons = {}
+    if not rows:
+        return skeletons
+
+    # All skeletons are measured together, with one array entry per node
+    node_ids = np.fromiter((row[0] for row in rows), np.int64, len(rows))
+    parent_ids = np.fromiter((row[1] or -1 for row in rows), np.int64, len(rows))
+    skeleton_ids = np.fromiter((row[2] for row in rows), np.int64, len(rows))
+    xyz = np.array([row[3:6] for row in rows], dtype=np.float64)
+    n = len(node_ids)
+    index = np.arange(n)
+
+    # Index of each node's parent, root nodes are their own parent
+    order = np.argsort(node_ids)
+    has_parent = parent_ids != -1
+    parents = index.copy()
+    parents[has_parent] = order[np.searchsorted(node_ids, parent_ids[has_parent],
+            sorter=order)]
+    children = parents[has_parent]
+
+    # Distance of each node to its parent, zero for root nodes
+    distances = np.sqrt(np.sum((xyz - xyz[parents]) ** 2, axis=1))
+
+    # Count end nodes and branch nodes. Root nodes with one child are end
+    # nodes, root nodes with two children are in the middle of a skeleton.
+    n_children = np.bincount(children, minlength=n)
+    is_root = ~has_parent
+    is_end = np.where(is_root, n_children == 1, n_children == 0)
+    is_branch = n_children > np.where(is_root, 2, 1)
+
+    # Compute weighted position for slab nodes only (root, branch and end
+    # nodes do not move): the average of parent and children, weighted by the
+    # distance to them.
+    weighted_sum = np.empty_like(xyz)
+    for dim in xrange(3):
+        weighted_sum[:, dim] = np.bincount(children,
+                weights=(xyz[:, dim] * distances)[has_parent], minlength=n) + \
+                xyz[parents, dim] * distances
+    sum_distances = np.bincount(children, weights=distances[has_parent],
+            minlength=n) + distances
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average = np.where(sum_distances[:, np.newaxis] != 0,
+                weighted_sum / sum_distances[:, np.newaxis], 0)
+    is_slab = ~(is_end | is_branch)
+    smoothed = xyz.copy()
+    smoothed[is_slab] = xyz[is_slab] * 0.4 + average[is_slab] * 0.6
+    smooth_distances = np.sqrt(np.sum((smoothed - smoothed[parents]) ** 2, axis=1))
+
+    # The principal branch is the path from the end node farthest away (in
+    # edges) from the root to the root. Path sums to the root are computed by
+    # pointer jumping. Of multiple equally deep end nodes, the one with the
+    # longest smoothed path is used.
+    depth = has_parent.astype(np.int64)
+    smooth_path = smooth_distances.copy()
+    jump = parents.copy()
+    while (jump != jump[jump]).any():
+        depth += depth[jump]
+        smooth_path += smooth_path[jump]
+        jump = jump[jump]
+
+    # Map skeleton IDs to consecutive indices to aggregate per skeleton
+    skids, skeleton_index = np.unique(skeleton_ids, return_inverse=True)
+    n_skeletons = len(skids)
+    raw_cable = np.bincount(skeleton_index, weights=distances, minlength=n_skeletons)
+    smooth_cable = np.bincount(skeleton_index, weights=smooth_distances,
+            minlength=n_skeletons)
+    n_nodes = np.bincount(skeleton_index, minlength=n_skeletons)
+    n_ends = np.bincount(skeleton_index[is_end], minlength=n_skeletons)
+    n_branch = np.bincount(skeleton_index[is_branch], minlength=n_skeletons)
+
+    leaves = np.flatnonzero(n_children == 0)
+    leaves = leaves[np.lexsort((smooth_path[leaves], depth[leaves],
+            skeleton_index[leaves]))]
+    # The last leaf of each skeleton is the end of its principal branch
+    last = np.append(skeleton_index[leaves][1:] != skeleton_index[leaves][:-1], True)
+    principal_branch_cable = np.zeros(n_skeletons)
+    principal_branch_cable[skeleton_index[leaves[last]]] = smooth_path[leaves[last]]
 
     class Skeleton():
-        def __init__(self):
-            self.nodes = {}
-            self.raw_cable = 0
-            self.smooth_cable = 0
-            self.principal_branch_cable = 0
-            self.n_ends = 0
-            self.n_branch = 0
+        def __init__(self, i):
+            self.n_nodes = int(n_nodes[i])
+            self.raw_cable = float(raw_cable[i])
+            self.smooth_cable = float(smooth_cable[i])
+            self.principal_branch_cable = float(principal_branch_cable[i])
+            self.n_ends = int(n_ends[i])
+            self.n_branch = int(n_branch[i])
             self.n_pre = 0
             self.n_post = 0
 
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in skeletons.itervalues():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.iteritems():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.itervalues())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.iteritems():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
+    for i, skid in enumerate(skids):
+        skeletons[int(skid)] = Skeleton(i)
 
     # Count inputs
     cursor.execute('''
@@ -543,7 +708,7 @@ def _measure_skeletons(skeleton_ids):
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
     return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()]))
 
 
@@ -703,6 +868,25 @@ def skeleton_swc(*args, **kwargs):
     return export_skeleton_response(*args, **kwargs)
 
 
+@requires_user_role(UserRole.Browse)
+def skeletons_swc(request, project_id=None):
+    """ Export the skeletons passed as skeleton_ids[] as zip archive with one
+    SWC file per skeleton.
+    """
+    skeleton_ids = [int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids[')]
+    if not skeleton_ids:
+        raise ValueError("No skeleton IDs provided")
+
+    archive = tempfile.TemporaryFile()
+    write_swc_archive(project_id, skeleton_ids, archive)
+    archive.seek(0)
+
+    response = StreamingHttpResponse(iter(partial(archive.read, 65536), ''),
+            content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="skeletons-swc.zip"'
+    return response
+
+
 def _export_review_skeleton(project_id=None, skeleton_id=None,
                             subarbor_node_id=None):
     """ Returns a list of segments for the requested skeleton. Each segment
@@ -731,65 +915,34 @@ def _export_review_skeleton(project_id=None, skeleton_id=None,
     # Get all reviews for the requested skeleton
     reviews = get_treenodes_to_reviews_with_time(skeleton_ids=[skeleton_id])
 
-    # Add each treenode to a networkx graph and attach reviewer information to
-    # it.
-    g = nx.DiGraph()
+    # Keep reviewer information for each treenode and represent the skeleton
+    # as an arbor.
+    nodes = {}
     reviewed = set()
     for t in treenodes:
         # While at it, send the reviewer IDs, which is useful to iterate fwd
         # to the first unreviewed node in the segment.
-        g.add_node(t[0], {'id': t[0],
-                          'x': t[2],
-                          'y': t[3],
-                          'z': t[4],
-                          'rids': reviews[t[0]],
-                          'sup': [[o, l] for [o, l] in zip(t[5], t[6]) if o is not None]})
+        nodes[t[0]] = {'id': t[0],
+                       'x': t[2],
+                       'y': t[3],
+                       'z': t[4],
+                       'rids': reviews[t[0]],
+                       'sup': [[o, l] for [o, l] in zip(t[5], t[6]) if o is not None]}
         if reviews[t[0]]:
             reviewed.add(t[0])
-        if t[1]: # if parent
-            g.add_edge(t[1], t[0]) # edge from parent to child
-        else:
-            root_id = t[0]
+    arbor = CompactArbor([t[0] for t in treenodes], [t[1] for t in treenodes])
 
-    if subarbor_node_id and subarbor_node_id != root_id:
+    if subarbor_node_id and subarbor_node_id != arbor.root:
         # Make sure the subarbor node ID (if any) is part of this skeleton
-        if subarbor_node_id not in g:
+        if subarbor_node_id not in arbor:
             raise ValueError("Supplied subarbor node ID (%s) is not part of "
                              "provided skeleton (%s)" % (subarbor_node_id, skeleton_id))
-
-        # Remove connection to parent
-        parent = g.predecessors(subarbor_node_id)[0]
-        g.remove_edge(parent, subarbor_node_id)
-        # Remove all nodes that are upstream from the subarbor node
-        to_delete = set()
-        to_lookat = [root_id]
-        while to_lookat:
-            n = to_lookat.pop()
-            to_lookat.extend(g.successors(n))
-            to_delete.add(n)
-        g.remove_nodes_from(to_delete)
-        # Replace root id with sub-arbor ID
-        root_id=subarbor_node_id
+        # Only keep the subarbor node and all nodes downstream of it
+        arbor = arbor.subarbor(subarbor_node_id)
 
     # Create all sequences, as long as possible and always from end towards root
-    distances = edge_count_to_root(g, root_node=root_id) # distance in number of edges from root
-    seen = set()
-    sequences = []
-    # Iterate end nodes sorted from highest to lowest distance to root
-    endNodeIDs = (nID for nID in g.nodes() if 0 == len(g.successors(nID)))
-    for nodeID in sorted(endNodeIDs, key=distances.get, reverse=True):
-        sequence = [g.node[nodeID]]
-        parents = g.predecessors(nodeID)
-        while parents:
-            parentID = parents[0]
-            sequence.append(g.node[parentID])
-            if parentID in seen:
-                break
-            seen.add(parentID)
-            parents = g.predecessors(parentID)
-
-        if len(sequence) > 1:
-            sequences.append(sequence)
+    sequences = [[nodes[node_id] for node_id in sequence]
+                 for sequence in arbor.partition()]
 
     # Calculate status
 
@@ -964,47 +1117,24 @@ def within_spatial_distance(request, project_id=None):
     if 0 == distance:
         return HttpResponse(json.dumps({"skeletons": []}))
     size_mode = int(request.POST.get("size_mode", 0))
-    having = ""
-
+    min_nodes, max_nodes = None, None
     if 0 == size_mode:
-        having = "HAVING count(*) > 1"
+        min_nodes = 2
     elif 1 == size_mode:
-        having = "HAVING count(*) = 1"
+        max_nodes = 1
     # else, no constraint
 
     cursor = connection.cursor()
     cursor.execute('SELECT location_x, location_y, location_z FROM treenode WHERE id=%s' % tnid)
     pos = cursor.fetchone()
 
+    # The skeletons closest to the treenode first
     limit = 100
-    x0 = pos[0] - distance
-    x1 = pos[0] + distance
-    y0 = pos[1] - distance
-    y1 = pos[1] + distance
-    z0 = pos[2] - distance
-    z1 = pos[2] + distance
-
-    # Cheap emulation of the distance
-    cursor.execute('''
-SELECT skeleton_id, count(*)
-FROM treenode
-WHERE project_id = %s
-  AND location_x > %s
-  AND location_x < %s
-  AND location_y > %s
-  AND location_y < %s
-  AND location_z > %s
-  AND location_z < %s
-GROUP BY skeleton_id
-%s
-LIMIT %s
-''' % (project_id, x0, x1, y0, y1, z0, z1, having, limit))
-
-
-    skeletons = tuple(row[0] for row in cursor.fetchall())
+    skeletons = tuple(row[0] for row in skeletons_within_distance(project_id,
+            pos[0], pos[1], pos[2], distance, limit, min_nodes, max_nodes))
 
     return HttpResponse(json.dumps({"skeletons": skeletons,
-                                    "reached_limit": 100 == len(skeletons)}))
+                                    "reached_limit": limit == len(skeletons)}))
 
 @requires_user_role(UserRole.Browse)
 def partners_by_connector(request, project_id=None):
@@ -1041,11 +1171,10 @@ WHERE tc1.project_id = %s
         # Filter by size: only those with more than one treenode or with exactly one
         cursor.execute('''
 SELECT skeleton_id
-FROM treenode
-WHERE skeleton_id IN (%s)
-GROUP BY skeleton_id
-HAVING count(*) %s 1
-''' % (",".join(str(row[0]) for row in cursor.fetchall()), ">" if 0 == size_mode else "="))
+FROM skeleton_summary
+WHERE skeleton_id = ANY(%%s)
+  AND num_nodes %s 1
+''' % (">" if 0 == size_mode else "="), ([row[0] for row in cursor.fetchall()],))
 
     return HttpResponse(json.dumps(tuple(row[0] for row in cursor.fetchall())))
 
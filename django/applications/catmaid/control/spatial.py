@@ -0,0 +1,310 @@
+"""Nearest neighbour and radius queries on treenodes, connectors and skeletons.
+
+Nearest neighbours of a point are found in two steps: the PostGIS KNN operator
+<-> walks the 2D GiST index of treenode edges (or connector locations) in
+order of distance in X and Y, which yields k nodes close to the point. The
+largest 3D distance of these candidates is an upper bound of the distance of
+the k nearest nodes, which are then selected with an index supported radius
+query and ranked by their exact 3D distance. For treenodes, this radius query
+uses the n-d index of edges, which bounds it in Z, too. Candidates can be close
+in X and Y, but far away in Z, and a 2D radius query would then cover large
+parts of all sections.
+
+Queries restricted to a set of skeletons don't use the KNN operator. They read
+all nodes of these skeletons from the skeleton index and rank them, which is
+linear in the size of the skeletons.
+"""
+import json
+
+from django.db import connection
+from django.http import HttpResponse
+
+from rest_framework.decorators import api_view
+
+from catmaid.models import UserRole
+from catmaid.control.authentication import requires_user_role
+
+# The maximum number of nodes or skeletons a single query returns
+MAX_RESULTS = 1000
+
+
+def _distance(table):
+    return '''sqrt(power(%(table)s.location_x - %%(x)s, 2) +
+                   power(%(table)s.location_y - %%(y)s, 2) +
+                   power(%(table)s.location_z - %%(z)s, 2))''' % {'table': table}
+
+
+def nearest_treenodes(project_id, x, y, z, k=1, skeleton_ids=None):
+    """Return a list of (treenode ID, x, y, z, skeleton ID, distance) tuples of
+    the <k> treenodes closest to the point <x>, <y>, <z>, nearest first. If
+    <skeleton_ids> are given, only treenodes of these skeletons are
+    considered.
+    """
+    params = {'project_id': int(project_id), 'x': x, 'y': y, 'z': z, 'k': k}
+    cursor = connection.cursor()
+
+    if skeleton_ids is not None:
+        params['skeleton_ids'] = list(skeleton_ids)
+        cursor.execute('''
+            SELECT t.id, t.location_x, t.location_y, t.location_z,
+                   t.skeleton_id, %s AS distance
+            FROM treenode t
+            WHERE t.project_id = %%(project_id)s
+              AND t.skeleton_id = ANY(%%(skeleton_ids)s)
+            ORDER BY distance, t.id
+            LIMIT %%(k)s
+        ''' % _distance('t'), params)
+        return cursor.fetchall()
+
+    # The edge of a treenode starts at the treenode, its distance in X and Y
+    # is therefore never smaller than the one of its edge.
+    cursor.execute('''
+        SELECT %s AS distance
+        FROM (SELECT te.id
+              FROM treenode_edge te
+              WHERE te.project_id = %%(project_id)s
+              ORDER BY te.edge <-> ST_MakePoint(%%(x)s, %%(y)s)
+              LIMIT %%(k)s) candidates
+        JOIN treenode t ON t.id = candidates.id
+        ORDER BY distance
+    ''' % _distance('t'), params)
+    distances = [row[0] for row in cursor.fetchall()]
+
+    # The n-th closest candidate bounds the distance of the n nearest nodes.
+    # Radius queries start with the closest candidate and double the number of
+    # candidates within the radius until k nodes are found, which avoids the
+    # radius of the farthest candidate where nearer ones suffice.
+    n = 1
+    while distances:
+        n = min(n, len(distances))
+        params['radius'] = distances[n - 1]
+        cursor.execute('''
+            SELECT * FROM (
+                SELECT t.id, t.location_x, t.location_y, t.location_z,
+                       t.skeleton_id, %s AS distance
+                FROM treenode_edge te
+                JOIN treenode t ON t.id = te.id
+                WHERE te.project_id = %%(project_id)s
+                  AND te.edge &&& ST_MakeLine(
+                      ST_MakePoint(%%(x)s - %%(radius)s, %%(y)s - %%(radius)s,
+                                   %%(z)s - %%(radius)s),
+                      ST_MakePoint(%%(x)s + %%(radius)s, %%(y)s + %%(radius)s,
+                                   %%(z)s + %%(radius)s))
+                  AND ST_3DDWithin(te.edge,
+                      ST_MakePoint(%%(x)s, %%(y)s, %%(z)s), %%(radius)s)
+            ) nodes
+            WHERE distance <= %%(radius)s
+            ORDER BY distance, id
+            LIMIT %%(k)s
+        ''' % _distance('t'), params)
+        nodes = cursor.fetchall()
+        if len(nodes) >= k or n == len(distances):
+            return nodes
+        n *= 2
+    return []
+
+
+def nearest_connectors(project_id, x, y, z, k=1, skeleton_ids=None):
+    """Return a list of (connector ID, x, y, z, distance) tuples of the <k>
+    connectors closest to the point <x>, <y>, <z>, nearest first. If
+    <skeleton_ids> are given, only connectors linked to these skeletons are
+    considered.
+    """
+    params = {'project_id': int(project_id), 'x': x, 'y': y, 'z': z, 'k': k}
+    cursor = connection.cursor()
+
+    if skeleton_ids is not None:
+        params['skeleton_ids'] = list(skeleton_ids)
+        cursor.execute('''
+            SELECT c.id, c.location_x, c.location_y, c.location_z,
+                   %s AS distance
+            FROM connector c
+            WHERE c.id IN (SELECT tc.connector_id
+                           FROM treenode_connector tc
+                           WHERE tc.project_id = %%(project_id)s
+                             AND tc.skeleton_id = ANY(%%(skeleton_ids)s))
+            ORDER BY distance, c.id
+            LIMIT %%(k)s
+        ''' % _distance('c'), params)
+        return cursor.fetchall()
+
+    # Both queries have to use the indexed expression ST_MakePoint(location_x,
+    # location_y) to be supported by the connector location index.
+    cursor.execute('''
+        SELECT max(%s)
+        FROM (SELECT c.location_x, c.location_y, c.location_z
+              FROM connector c
+              WHERE c.project_id = %%(project_id)s
+              ORDER BY ST_MakePoint(c.location_x, c.location_y) <->
+                       ST_MakePoint(%%(x)s, %%(y)s)
+              LIMIT %%(k)s) c
+    ''' % _distance('c'), params)
+    params['radius'] = cursor.fetchone()[0]
+    if params['radius'] is None:
+        return []
+
+    cursor.execute('''
+        SELECT * FROM (
+            SELECT c.id, c.location_x, c.location_y, c.location_z,
+                   %s AS distance
+            FROM connector c
+            WHERE c.project_id = %%(project_id)s
+              AND ST_DWithin(ST_MakePoint(c.location_x, c.location_y),
+                             ST_MakePoint(%%(x)s, %%(y)s), %%(radius)s)
+        ) nodes
+        WHERE distance <= %%(radius)s
+        ORDER BY distance, id
+        LIMIT %%(k)s
+    ''' % _distance('c'), params)
+    return cursor.fetchall()
+
+
+def skeletons_within_distance(project_id, x, y, z, radius, limit=MAX_RESULTS,
+        min_nodes=None, max_nodes=None):
+    """Return a list of (skeleton ID, distance) tuples of all skeletons with
+    cable closer than <radius> to the point <x>, <y>, <z>, ranked by their
+    distance to it. At most <limit> skeletons are returned. Skeletons can be
+    constrained by their number of nodes.
+    """
+    params = {'project_id': int(project_id), 'x': x, 'y': y, 'z': z,
+            'radius': radius, 'limit': limit, 'min_nodes': min_nodes,
+            'max_nodes': max_nodes}
+
+    size_filter = ''
+    if min_nodes is not None or max_nodes is not None:
+        size_filter = 'JOIN skeleton_summary s ON s.skeleton_id = t.skeleton_id'
+        if min_nodes is not None:
+            size_filter += ' AND s.num_nodes >= %(min_nodes)s'
+        if max_nodes is not None:
+            size_filter += ' AND s.num_nodes <= %(max_nodes)s'
+
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT t.skeleton_id,
+               min(ST_3DDistance(te.edge, ST_MakePoint(%%(x)s, %%(y)s, %%(z)s)))
+                   AS distance
+        FROM treenode_edge te
+        JOIN treenode t ON t.id = te.id
+        %s
+        WHERE te.project_id = %%(project_id)s
+          AND te.edge &&& ST_MakeLine(
+              ST_MakePoint(%%(x)s - %%(radius)s, %%(y)s - %%(radius)s,
+                           %%(z)s - %%(radius)s),
+              ST_MakePoint(%%(x)s + %%(radius)s, %%(y)s + %%(radius)s,
+                           %%(z)s + %%(radius)s))
+          AND ST_3DDWithin(te.edge, ST_MakePoint(%%(x)s, %%(y)s, %%(z)s),
+                           %%(radius)s)
+        GROUP BY t.skeleton_id
+        ORDER BY distance, t.skeleton_id
+        LIMIT %%(limit)s
+    ''' % size_filter, params)
+    return cursor.fetchall()
+
+
+def _get_point(params):
+    try:
+        return tuple(float(params[c]) for c in ('x', 'y', 'z'))
+    except KeyError as e:
+        raise ValueError("Coordinate parameter %s missing." % e.args[0])
+
+
+def _get_skeleton_ids(params):
+    skeleton_ids = [int(v) for k in params.keys()
+            if k.startswith('skeleton_ids[') for v in params.getlist(k)]
+    return skeleton_ids or None
+
+
+@api_view(['GET', 'POST'])
+@requires_user_role([UserRole.Browse])
+def nearest_nodes(request, project_id=None):
+    """Find the treenodes or connectors closest to a point.
+
+    Nodes are ranked by their Euclidean distance to the point, nearest first.
+    ---
+    parameters:
+        - name: x
+          description: X coordinate of the point
+          required: true
+          type: number
+        - name: y
+          description: Y coordinate of the point
+          required: true
+          type: number
+        - name: z
+          description: Z coordinate of the point
+          required: true
+          type: number
+        - name: k
+          description: Number of nodes to return (default 1)
+          type: integer
+        - name: type
+          description: Either "treenode" (default) or "connector"
+          type: string
+        - name: skeleton_ids[]
+          description: Only consider nodes of (or linked to) these skeletons
+          type: array
+          items:
+            type: integer
+    type:
+      - type: array
+        items:
+          type: number
+        required: true
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    x, y, z = _get_point(params)
+    k = min(int(params.get('k', 1)), MAX_RESULTS)
+    skeleton_ids = _get_skeleton_ids(params)
+    node_type = params.get('type', 'treenode')
+
+    if 'treenode' == node_type:
+        nodes = nearest_treenodes(project_id, x, y, z, k, skeleton_ids)
+    elif 'connector' == node_type:
+        nodes = nearest_connectors(project_id, x, y, z, k, skeleton_ids)
+    else:
+        raise ValueError("Type has to be either treenode or connector")
+
+    return HttpResponse(json.dumps(nodes))
+
+
+@api_view(['GET', 'POST'])
+@requires_user_role([UserRole.Browse])
+def skeletons_within(request, project_id=None):
+    """Find all skeletons with cable within a radius around a point.
+
+    Returns a list of skeleton ID and distance tuples, nearest first.
+    ---
+    parameters:
+        - name: x
+          description: X coordinate of the point
+          required: true
+          type: number
+        - name: y
+          description: Y coordinate of the point
+          required: true
+          type: number
+        - name: z
+          description: Z coordinate of the point
+          required: true
+          type: number
+        - name: radius
+          description: The maximum distance of a skeleton to the point
+          required: true
+          type: number
+        - name: limit
+          description: Maximum number of skeletons to return
+          type: integer
+    type:
+      - type: array
+        items:
+          type: number
+        required: true
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    x, y, z = _get_point(params)
+    radius = float(params.get('radius', 0))
+    limit = min(int(params.get('limit', MAX_RESULTS)), MAX_RESULTS)
+
+    skeletons = skeletons_within_distance(project_id, x, y, z, radius, limit)
+
+    return HttpResponse(json.dumps(skeletons))
@@ -3,7 +3,6 @@ from numpy import array, float32
 from numpy.linalg import norm
 import networkx as nx
 from collections import namedtuple
-from scipy.sparse.csgraph import dijkstra
 
 from catmaid.control.common import get_relation_to_id_map
 from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
@@ -23,52 +22,43 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
         connector_ids: list of connector IDs.
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
+        h_list: list of bandwidths, all of which are computed in a single
+        traversal of the tree.
     """
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
+    nodeList, offsets, neighbors, weights = treeAdjacency( Gwud )
+    id2index = {node: i for i,node in enumerate(nodeList)}
+    synIndices = np.unique([id2index[node] for node in synNodes])
+
+    densities = treeKernelDensities(offsets, neighbors, weights, synIndices, h_list)
 
     SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups = {}
 
-    for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-
+    for h, densityField in zip(h_list, densities):
         targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
-        densityField = {}            # densityField stores the height of the hill to be climbed
         for startNode in synNodes:
-            if startNode not in targLoc:
-                currNode = startNode
-                allOnPath = []
-
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-
-                while True:
-                    allOnPath.append(currNode)
+            currNode = id2index[startNode]
+            allOnPath = []
 
-                    #Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
+            while currNode not in targLoc:
+                allOnPath.append(currNode)
 
-                    for nn in Gwud.neighbors( currNode ):
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
+                # Climb to the neighbor with the highest density
+                prevNode = currNode
+                for nn in neighbors[offsets[prevNode]:offsets[prevNode+1]]:
+                    if densityField[nn] > densityField[currNode]:
+                        currNode = nn
 
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
+                if currNode == prevNode:
+                    targLoc[currNode] = currNode
+                    break
 
-                    if currNode == prevNode:
-                        break
+            target = targLoc[currNode]
+            for node in allOnPath:
+                targLoc[node] = target
 
-                for node in allOnPath:
-                    targLoc[node] = currNode
-
-        uniqueTargs = set(targLoc[node] for node in synNodes)
+        uniqueTargs = set(nodeList[targLoc[id2index[node]]] for node in synNodes)
 
         loc2group = {}
 
@@ -78,25 +68,111 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
             synapseGroups[h][ind] = SynapseGroup([], [], [], val)
 
         for ind, node in enumerate(synNodes):
-            gi = loc2group[targLoc[node]]
+            gi = loc2group[nodeList[targLoc[id2index[node]]]]
             synapseGroups[h][ gi ].node_ids.append( node )
             synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
             synapseGroups[h][ gi ].relations.append( relations[ind] )
 
     return synapseGroups
 
-def distanceMatrix( G, synNodes ):
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat = {}
-    nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
-
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
-
-    return dmat, {node: i for i,node in enumerate(nodeList)}
+def treeAdjacency( G ):
+    """ Given an undirected nx graph, return its node list and its adjacency
+    in compressed form: the neighbors of the node at index i are
+    neighbors[offsets[i]:offsets[i+1]], the lengths of the respective edges
+    are found at the same positions in weights. Edges without weight have
+    length 1. """
+    nodeList = G.nodes()
+    id2index = {node: i for i,node in enumerate(nodeList)}
+    offsets = np.zeros(len(nodeList) + 1, dtype=np.int64)
+    neighbors = []
+    weights = []
+    for i, node in enumerate(nodeList):
+        for nn, props in G[node].iteritems():
+            neighbors.append(id2index[nn])
+            weights.append(props.get('weight', 1))
+        offsets[i+1] = len(neighbors)
+    return nodeList, offsets, np.array(neighbors, dtype=np.int64), \
+            np.array(weights, dtype=np.float64)
+
+# Kernel contributions are ignored if their sum over all synapses is below this
+# value for every node, which is half of the float64 machine epsilon.
+KERNEL_TOLERANCE = np.finfo(np.float64).eps / 2
+
+def kernelRadius( h, n_sources ):
+    """ Return the distance beyond which the contributions of n_sources
+    Gaussian kernels of bandwidth h sum up to less than KERNEL_TOLERANCE:
+    n_sources * exp(-r^2 / h^2) < KERNEL_TOLERANCE. """
+    return h * np.sqrt(np.log(n_sources / KERNEL_TOLERANCE))
+
+def treeKernelDensities( offsets, neighbors, weights, sources, h_list ):
+    """ Compute the density field sum(exp(-d(s, v)^2 / h^2)) over all sources s
+    for every node v of a tree and for every bandwidth h in h_list. Returns a
+    matrix with one row per bandwidth and one column per node.
+
+    Instead of computing the distance of all sources to all nodes, paths are
+    walked outwards from all sources at once, edge by edge, until they are
+    longer than the kernel radius of the largest bandwidth. Since the graph is
+    a tree, a walk never has to return to the node it came from and every node
+    is reached at most once per source. The cost is therefore linear in the
+    number of nodes within the kernel radius of each source.
+
+    The ignored contributions sum up to less than KERNEL_TOLERANCE at any node.
+    Sources have a density of at least 1 and hill climbing only moves to nodes
+    of higher density, where the result therefore equals the full sum up to
+    float64 rounding. Far away from all sources, where the density is about
+    KERNEL_TOLERANCE or less, it is 0 instead. """
+    n = len(offsets) - 1
+    densities = np.zeros((len(h_list), n))
+    if 0 == len(sources) or 0 == n:
+        return densities
+
+    scales = -1.0 / np.square(np.array(h_list, dtype=np.float64))
+    radius = kernelRadius(np.max(h_list), len(sources))
+    degrees = np.diff(offsets)
+
+    # The current front of all walks: node, node visited before and distance
+    # from the source.
+    nodes = np.asarray(sources, dtype=np.int64)
+    prev = np.repeat(-1, len(nodes))
+    dist = np.zeros(len(nodes))
+
+    # Visited nodes and their distances are buffered and summed up once the
+    # buffer is about as large as the tree.
+    visited, distances, n_buffered = [], [], 0
+
+    def flush():
+        at = np.concatenate(visited)
+        d2 = np.square(np.concatenate(distances))
+        for i, scale in enumerate(scales):
+            densities[i] += np.bincount(at, weights=np.exp(d2 * scale), minlength=n)
+        del visited[:]
+        del distances[:]
+
+    while len(nodes):
+        visited.append(nodes)
+        distances.append(dist)
+        n_buffered += len(nodes)
+        if n_buffered >= n:
+            flush()
+            n_buffered = 0
+
+        # Advance every walk along all edges of its current node
+        counts = degrees[nodes]
+        walk = np.repeat(np.arange(len(nodes)), counts)
+        first = np.cumsum(counts) - counts
+        edges = np.repeat(offsets[nodes] - first, counts) + np.arange(len(walk))
+        following = neighbors[edges]
+        following_dist = dist[walk] + weights[edges]
+        keep = (following != prev[walk]) & (following_dist <= radius)
+
+        prev = nodes[walk[keep]]
+        nodes = following[keep]
+        dist = following_dist[keep]
+
+    if visited:
+        flush()
+
+    return densities
 
 def countTargets( skeleton_id ):
     nTargets = {}
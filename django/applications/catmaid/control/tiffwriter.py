@@ -0,0 +1,165 @@
+"""A minimal writer for uncompressed multi-page TIFF files.
+
+Pages are written one at a time, so that a stack of images doesn't need to be
+kept in memory as a whole. Gray scale and RGB pages with 8 or 16 bit per sample
+are supported. The image description (e.g. ImageJ meta data) is written when
+the file is closed, because it often depends on the number of pages.
+"""
+import struct
+from fractions import Fraction
+
+import numpy as np
+
+# TIFF field types
+ASCII = 2
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+
+# TIFF tags
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC_INTERPRETATION = 262
+IMAGE_DESCRIPTION = 270
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+X_RESOLUTION = 282
+Y_RESOLUTION = 283
+PLANAR_CONFIGURATION = 284
+RESOLUTION_UNIT = 296
+SOFTWARE = 305
+
+MAX_OFFSET = 2**32 - 1
+
+
+def _pack_values(field_type, values):
+    if field_type == ASCII:
+        return values + b'\x00'
+    elif field_type == SHORT:
+        return struct.pack('<%sH' % len(values), *values)
+    elif field_type == LONG:
+        return struct.pack('<%sI' % len(values), *values)
+    elif field_type == RATIONAL:
+        return b''.join(struct.pack('<II', f.numerator, f.denominator)
+                for f in values)
+    raise ValueError("Unsupported TIFF field type: %s" % field_type)
+
+
+def _rational(value):
+    return Fraction(value).limit_denominator(MAX_OFFSET)
+
+
+class TiffWriter(object):
+    """Writes a little endian multi-page TIFF file to <path>. The optional
+    resolution is a tuple of pixels per unit in X and Y, which is stored
+    without unit.
+    """
+    def __init__(self, path, resolution=None, software=None):
+        self.file = open(path, 'wb')
+        self.resolution = resolution
+        self.software = software
+        self.num_pages = 0
+        # Position of the pointer to the next IFD that is written
+        self.next_ifd_pointer = 4
+        # Position of the image description entry of the first page
+        self.description_entry = None
+        self.file.write(b'II*\x00\x00\x00\x00\x00')
+
+    def write_page(self, data):
+        """Append a page with the pixels of a NumPy array of shape (height,
+        width) or (height, width, samples), with one or three samples.
+        """
+        data = np.asarray(data)
+        if data.ndim == 2:
+            data = data.reshape(data.shape + (1,))
+        height, width, samples = data.shape
+        if samples not in (1, 3):
+            raise ValueError("Only gray scale and RGB pages are supported")
+        if data.dtype not in (np.uint8, np.uint16):
+            raise ValueError("Only 8 and 16 bit pages are supported")
+        pixels = np.ascontiguousarray(data,
+                dtype=data.dtype.newbyteorder('<')).tobytes()
+
+        strip_offset = self._tell()
+        self.file.write(pixels)
+
+        bits = data.dtype.itemsize * 8
+        entries = [
+            (IMAGE_WIDTH, LONG, [width]),
+            (IMAGE_LENGTH, LONG, [height]),
+            (BITS_PER_SAMPLE, SHORT, [bits] * samples),
+            (COMPRESSION, SHORT, [1]),
+            (PHOTOMETRIC_INTERPRETATION, SHORT, [1 if samples == 1 else 2]),
+            (STRIP_OFFSETS, LONG, [strip_offset]),
+            (SAMPLES_PER_PIXEL, SHORT, [samples]),
+            (ROWS_PER_STRIP, LONG, [height]),
+            (STRIP_BYTE_COUNTS, LONG, [len(pixels)]),
+            (PLANAR_CONFIGURATION, SHORT, [1]),
+        ]
+        if self.num_pages == 0:
+            # A placeholder, which is replaced when the file is closed
+            entries.append((IMAGE_DESCRIPTION, ASCII, b''))
+        if self.resolution:
+            entries.append((X_RESOLUTION, RATIONAL, [_rational(self.resolution[0])]))
+            entries.append((Y_RESOLUTION, RATIONAL, [_rational(self.resolution[1])]))
+            entries.append((RESOLUTION_UNIT, SHORT, [1]))
+        if self.software:
+            entries.append((SOFTWARE, ASCII, self.software.encode('ascii')))
+        self._write_ifd(sorted(entries, key=lambda e: e[0]))
+        self.num_pages += 1
+
+    def close(self, description=None):
+        """Write the image description of the first page and close the
+        file.
+        """
+        if description and self.description_entry:
+            description = description.encode('ascii') + b'\x00'
+            offset = self._tell()
+            self.file.write(description)
+            self.file.seek(self.description_entry + 4)
+            self.file.write(struct.pack('<II', len(description), offset))
+        self.file.close()
+
+    def _tell(self):
+        # All offsets have to be word aligned
+        offset = self.file.tell()
+        if offset % 2:
+            self.file.write(b'\x00')
+            offset += 1
+        if offset > MAX_OFFSET:
+            raise ValueError("TIFF files can't be larger than 4 GB")
+        return offset
+
+    def _write_ifd(self, entries):
+        ifd_offset = self._tell()
+        # Values that don't fit into an entry follow the IFD
+        external_offset = ifd_offset + 2 + 12 * len(entries) + 4
+        ifd = [struct.pack('<H', len(entries))]
+        external = []
+        for tag, field_type, values in entries:
+            packed = _pack_values(field_type, values)
+            if tag == IMAGE_DESCRIPTION:
+                self.description_entry = ifd_offset + 2 + 12 * len(ifd[1:])
+            count = len(packed) if field_type == ASCII else len(values)
+            if len(packed) <= 4:
+                value = packed.ljust(4, b'\x00')
+            else:
+                value = struct.pack('<I', external_offset)
+                if len(packed) % 2:
+                    packed += b'\x00'
+                external.append(packed)
+                external_offset += len(packed)
+            ifd.append(struct.pack('<HHI', tag, field_type, count) + value)
+        ifd.append(struct.pack('<I', 0))
+        self.file.write(b''.join(ifd + external))
+
+        # Link the new IFD to the previous one
+        end = self.file.tell()
+        self.file.seek(self.next_ifd_pointer)
+        self.file.write(struct.pack('<I', ifd_offset))
+        self.file.seek(end)
+        self.next_ifd_pointer = ifd_offset + 2 + 12 * len(entries)
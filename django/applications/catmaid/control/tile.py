@@ -1,11 +1,19 @@
 import os
 import cStringIO
-from contextlib import closing
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from math import log
 import h5py
 import numpy as np
 import base64
 from django.conf import settings
 
+from catmaid.control import labeljournal
+from catmaid.control.tilefetch import TileCache
+
+from celery.task import task
+
 try:
     from PIL import Image
 except:
@@ -13,6 +21,142 @@ except:
 
 from django.http import HttpResponse
 
+# HDF5 stacks are stored in one file per project, stack and base name. Image
+# data of section z is stored in the 2D dataset /<scale>/<z>/data, where
+# <scale> is int(scale) of the request. The catmaid_create_hdf5_pyramid
+# management command adds a scale pyramid in /pyramid/<zoom level>/<z>/data,
+# with chunks aligned to the tile size. If present, tiles are read from it.
+PYRAMID_GROUP = 'pyramid'
+
+# Open HDF5 files, mapped from their path to an OpenFile. Opening files and
+# parsing their meta data is much more expensive than reading a tile from
+# them. The lock guards the mapping, each file has its own lock for reading.
+_open_files = OrderedDict()
+_open_files_lock = threading.Lock()
+
+# Optional cache of encoded tiles
+_tile_cache = TileCache(settings.HDF5_TILE_CACHE_SIZE) \
+        if settings.HDF5_TILE_CACHE_SIZE > 0 else None
+
+def get_hdf5_path(project_id, stack_id, basename):
+    return os.path.join(settings.HDF5_STORAGE_PATH,
+            '{0}_{1}_{2}.hdf'.format(project_id, stack_id, basename))
+
+class OpenFile(object):
+    """ A read-only HDF5 file handle, which is used by one thread at a time.
+    """
+    def __init__(self, path, mtime):
+        self.mtime = mtime
+        self.hfile = h5py.File(path, 'r')
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def close(self):
+        # Wait for the thread that is reading from the file
+        with self.lock:
+            self.hfile.close()
+            self.closed = True
+
+@contextmanager
+def open_hdf5_file(path, mtime):
+    """ Provides a read-only handle of the HDF5 file at <path> from the cache
+    of open files to the enclosed block, which has exclusive use of it. Files
+    that have been modified since they were opened are opened again. At most
+    HDF5_FILE_HANDLE_CACHE_SIZE files are kept open.
+    """
+    while True:
+        stale = []
+        try:
+            with _open_files_lock:
+                entry = _open_files.pop(path, None)
+                if entry and entry.mtime != mtime:
+                    stale.append(entry)
+                    entry = None
+                if not entry:
+                    entry = OpenFile(path, mtime)
+                _open_files[path] = entry
+                while len(_open_files) > max(1,
+                        settings.HDF5_FILE_HANDLE_CACHE_SIZE):
+                    stale.append(_open_files.popitem(last=False)[1])
+            with entry.lock:
+                # The file could have been evicted by another thread before
+                # the lock was acquired, in which case it is opened again.
+                if not entry.closed:
+                    yield entry.hfile
+                    return
+        finally:
+            # Evicted files are closed once other threads are done with them
+            for evicted in stale:
+                evicted.close()
+
+def close_hdf5_file(path):
+    """ Closes the cached handle of the HDF5 file at <path>, if any. HDF5
+    doesn't allow to open a file for writing while it is open for reading in
+    the same process.
+    """
+    with _open_files_lock:
+        entry = _open_files.pop(path, None)
+    if entry:
+        entry.close()
+
+def read_tile(hfile, scale, x, y, z, width, height):
+    """ Returns the tile at pixel position <x>, <y> of section <z> in the
+    passed in scale as 2D NumPy array, or None if the file has no data for it.
+    Tiles are read from the scale pyramid if the file has one. Scales that are
+    not available are sampled from the closest finer one. Tiles that extend
+    beyond the image are padded with zeros.
+    """
+    zoom_level = max(0, int(round(-log(scale, 2)))) if scale > 0 else 0
+    if PYRAMID_GROUP in hfile:
+        levels = hfile[PYRAMID_GROUP]
+        available = [int(l) for l in levels.keys() if int(l) <= zoom_level]
+        if not available:
+            return None
+        source_level = max(available)
+        scales = levels[str(source_level)]
+    else:
+        # Files without pyramid can only fall back to full resolution data
+        scale_key = str(int(scale))
+        if scale_key in hfile:
+            source_level = zoom_level
+            scales = hfile[scale_key]
+        elif '1' in hfile:
+            source_level = 0
+            scales = hfile['1']
+        else:
+            return None
+
+    z_key = str(z)
+    if z_key not in scales:
+        return None
+    image_data = scales[z_key]['data']
+
+    # Read every n-th pixel if the tile is sampled from a finer level
+    step = 2**(zoom_level - source_level)
+    data = image_data[y * step:(y + height) * step:step,
+                      x * step:(x + width) * step:step]
+    if data.shape != (height, width):
+        padded = np.zeros((height, width), dtype=data.dtype)
+        padded[:data.shape[0], :data.shape[1]] = data
+        data = padded
+    return data
+
+def get_content_type(file_extension):
+    return 'image/jpeg' if file_extension in ('jpg', 'jpeg') else 'image/png'
+
+def encode_tile(data, file_extension):
+    """ Returns the passed in 2D NumPy array as JPEG or PNG image.
+    """
+    if data.dtype != np.uint8:
+        data = data.astype(np.uint8)
+    pil_image = Image.fromarray(data)
+    buf = cStringIO.StringIO()
+    if get_content_type(file_extension) == 'image/jpeg':
+        pil_image.save(buf, 'JPEG')
+    else:
+        pil_image.save(buf, 'PNG')
+    return buf.getvalue()
+
 def get_tile(request, project_id=None, stack_id=None):
 
     scale = float(request.GET.get('scale', '0'))
@@ -27,40 +171,65 @@ def get_tile(request, project_id=None, stack_id=None):
     basename = request.GET.get('basename', 'raw')
 
     # need to know the stack name
-    fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}_{2}.hdf'.format( project_id, stack_id, basename ) )
-
-    if not os.path.exists( fpath ):
-        data=np.zeros( (height, width) )
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-        # return HttpResponse(json.dumps({'error': 'HDF5 file does not exists: {0}'.format(fpath)}))
-
-    with closing(h5py.File(fpath, 'r')) as hfile:
-        #import math
-        #zoomlevel = math.log(int(scale), 2)
-        hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
-        if not str(int(scale)) in hfile['/'].keys():
-            data=np.zeros( (height, width) )
-            pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-            response = HttpResponse(content_type="image/png")
-            pilImage.save(response, "PNG")
-            return response            
-            # return HttpResponse(json.dumps({'error': 'HDF5 file does not contain scale: {0}'.format(str(int(scale)))}))
-        image_data=hfile[hdfpath]
-        data=image_data[y:y+height,x:x+width]
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-
-    return response
+    # Labels (type=labels) are read from the file put_tile writes to
+    labels = request.GET.get('type') == 'labels'
+    if labels:
+        fpath = get_labels_path(project_id, stack_id)
+    else:
+        fpath = get_hdf5_path(project_id, stack_id, basename)
+    try:
+        mtime = os.path.getmtime(fpath)
+    except OSError:
+        mtime = None
 
-def put_tile(request, project_id=None, stack_id=None):
-    """ Store labels to HDF5 """
-    #print >> sys.stderr, 'put tile', request.POST
+    key = (fpath, mtime, scale, x, y, z, width, height, file_extension)
+    # Labels can change without changing the file, they are not cached
+    tile = _tile_cache.get(key) if _tile_cache and not labels else None
+    if tile is None:
+        data = None
+        if labels and mtime is not None:
+            data = read_labels(fpath, scale, x, y, z, width, height)
+        elif mtime is not None:
+            with open_hdf5_file(fpath, mtime) as hfile:
+                data = read_tile(hfile, scale, x, y, z, width, height)
+        if data is None:
+            # A blank tile, if there is no data for the requested tile
+            data = np.zeros((height, width), dtype=np.uint8)
+        tile = encode_tile(data, file_extension)
+        if _tile_cache and not labels:
+            _tile_cache.add(key, tile)
+
+    return HttpResponse(tile, content_type=get_content_type(file_extension))
+
+def get_labels_path(project_id, stack_id):
+    return os.path.join(settings.HDF5_STORAGE_PATH,
+            '{0}_{1}.hdf'.format(project_id, stack_id))
 
+def read_labels(path, scale, x, y, z, width, height):
+    """ Returns the labels of the passed in region, including those that have
+    been stored, but aren't written to the HDF5 file yet.
+    """
+    # Pending labels are read before the file and its modification time. If
+    # they are flushed in the meantime, the file is opened again and has them.
+    pending = labeljournal.pending_records(path)
+    if pending:
+        schedule_flush(path)
+    with labeljournal.reading(path), \
+            open_hdf5_file(path, os.path.getmtime(path)) as hfile:
+        hdfpath = labeljournal.dataset_path(scale)
+        if hdfpath not in hfile:
+            return None
+        data = hfile[hdfpath][y:y+height, x:x+width, z]
+    labels = np.zeros((height, width), dtype=np.uint8)
+    labels[:data.shape[0], :data.shape[1]] = data
+    return labeljournal.apply_pending(pending, scale, x, y, z, labels)
+
+def put_tile(request, project_id=None, stack_id=None):
+    """ Store labels to HDF5. Labels are added to the journal of the HDF5
+    file, which is written to the file by a Celery task. Label tiles returned
+    by get_tile include them immediately. Without a running Celery worker,
+    labels stay in the journal.
+    """
     scale = float(request.POST.get('scale', '0'))
     height = int(request.POST.get('height', '0'))
     width = int(request.POST.get('width', '0'))
@@ -71,14 +240,50 @@ def put_tile(request, project_id=None, stack_id=None):
     row = request.POST.get('row', 'x')
     image = request.POST.get('image', 'x')
 
-    fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}.hdf'.format( project_id, stack_id ) )
-    #print >> sys.stderr, 'fpath', fpath
+    fpath = get_labels_path(project_id, stack_id)
+    # Make sure the labels can be written, before they are accepted
+    with labeljournal.reading(fpath), \
+            open_hdf5_file(fpath, os.path.getmtime(fpath)) as hfile:
+        hdfpath = labeljournal.dataset_path(scale)
+        if hdfpath not in hfile:
+            raise ValueError("The HDF5 file has no labels for scale %s" % scale)
+        shape = hfile[hdfpath].shape
+
+    image_from_canvas = np.asarray( Image.open( cStringIO.StringIO(base64.decodestring(image)) ) )
+    if image_from_canvas.ndim == 3:
+        image_from_canvas = image_from_canvas[:,:,0]
+    # Like writing to the HDF5 file directly, labels outside of it are ignored
+    labels = image_from_canvas[:max(0, min(height, shape[0] - y)),
+                               :max(0, min(width, shape[1] - x))]
 
-    with closing(h5py.File(fpath, 'a')) as hfile:
-        hdfpath = '/labels/scale/' + str(int(scale)) + '/data'
-        #print >> sys.stderr, 'storage', x,y,z,height,width,hdfpath
-        #print >> sys.stderr, 'image', base64.decodestring(image)
-        image_from_canvas = np.asarray( Image.open( cStringIO.StringIO(base64.decodestring(image)) ) )
-        hfile[hdfpath][y:y+height,x:x+width,z] = image_from_canvas[:,:,0]
+    labeljournal.append(fpath, scale, x, y, z, labels)
+    schedule_flush(fpath)
 
     return HttpResponse("Image pushed to HDF5.", content_type="plain/text")
+
+def schedule_flush(path):
+    """ Queues a flush of the label journal of the passed in HDF5 file, unless
+    one has been queued already and isn't overdue. The journal is written
+    after a short delay, so that tiles of multiple requests are written
+    together.
+    """
+    if labeljournal.claim_flush(path, settings.HDF5_LABEL_FLUSH_TIMEOUT):
+        flush_label_journal.apply_async((path,),
+                countdown=settings.HDF5_LABEL_FLUSH_DELAY)
+
+@task()
+def flush_label_journal(path):
+    """ Writes the label journal of the passed in HDF5 file to it. If another
+    process is writing it already or if writing fails, this is tried again
+    later.
+    """
+    close_hdf5_file(path)
+    try:
+        num_tiles = labeljournal.flush(path)
+    except (IOError, OSError) as e:
+        raise flush_label_journal.retry(args=(path,), exc=e,
+                countdown=settings.HDF5_LABEL_FLUSH_DELAY)
+    if num_tiles is None:
+        flush_label_journal.apply_async((path,),
+                countdown=settings.HDF5_LABEL_FLUSH_DELAY)
+    return num_tiles
@@ -0,0 +1,159 @@
+"""Concurrent retrieval of image tiles, e.g. for the cropping tool.
+
+A TileFetcher downloads tiles with a pool of threads, each of which keeps one
+persistent (keep-alive) connection per tile host. Downloaded tiles can be kept
+in a TileCache, a size limited LRU cache that is shared by all jobs of a
+process, so that overlapping jobs don't need to fetch the same tiles again.
+"""
+import socket
+import threading
+import httplib
+import urllib2
+
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+from urlparse import urlsplit, urljoin
+
+
+class ImageRetrievalError(IOError):
+    def __init__(self, path, error):
+        IOError.__init__(self, "Couldn't access %s" % (path))
+        self.path = path
+        self.error = error
+
+
+class TileCache(object):
+    """A thread-safe LRU cache of encoded tile data, which holds at most
+    <max_size> bytes.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            data = self.tiles.pop(path, None)
+            if data is not None:
+                # Mark the tile as most recently used
+                self.tiles[path] = data
+            return data
+
+    def add(self, path, data):
+        if len(data) > self.max_size:
+            return
+        with self.lock:
+            old_data = self.tiles.pop(path, None)
+            if old_data is not None:
+                self.size -= len(old_data)
+            self.tiles[path] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted_data = self.tiles.popitem(last=False)
+                self.size -= len(evicted_data)
+
+
+class TileFetcher(object):
+    """Fetches tiles from HTTP(S) URLs with a pool of <num_threads> threads,
+    other URLs (e.g. file://) are opened with urllib2. The thread pool is
+    created on first use, which allows to create a fetcher in a process that
+    is forked later on (e.g. a Celery worker).
+    """
+    max_redirects = 5
+
+    def __init__(self, num_threads, cache=None, timeout=60):
+        self.num_threads = max(1, int(num_threads))
+        self.cache = cache
+        self.timeout = timeout
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.local = threading.local()
+
+    def fetch(self, path):
+        """Return the data of the tile at <path>."""
+        if self.cache:
+            data = self.cache.get(path)
+            if data is not None:
+                return data
+        data = self._fetch(path, 0)
+        if self.cache:
+            self.cache.add(path, data)
+        return data
+
+    def fetch_all(self, paths):
+        """Return an iterator over the data of all tiles in <paths>, in the
+        same order. Tiles are fetched concurrently, but at most a few tiles per
+        thread ahead of the consumer. If a tile can't be retrieved, the error is
+        raised when its data is requested.
+        """
+        pool = self._get_pool()
+        window = 4 * self.num_threads
+        pending = deque()
+        for path in paths:
+            pending.append(pool.apply_async(self.fetch, (path,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _get_pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.num_threads)
+            return self.pool
+
+    def _fetch(self, path, num_redirects):
+        url = urlsplit(path)
+        if url.scheme not in ('http', 'https'):
+            try:
+                return urllib2.urlopen(path, timeout=self.timeout).read()
+            except urllib2.HTTPError as e:
+                raise ImageRetrievalError(path, "Error code: %s" % e.code)
+            except urllib2.URLError as e:
+                raise ImageRetrievalError(path, e.reason)
+
+        target = url.path or '/'
+        if url.query:
+            target += '?' + url.query
+        try:
+            status, location, data = self._get(url.scheme, url.netloc, target)
+        except (httplib.HTTPException, socket.error) as e:
+            raise ImageRetrievalError(path, str(e))
+
+        if status in (301, 302, 303, 307) and location and \
+                num_redirects < self.max_redirects:
+            return self._fetch(urljoin(path, location), num_redirects + 1)
+        if status != 200:
+            raise ImageRetrievalError(path, "Error code: %s" % status)
+        return data
+
+    def _get(self, scheme, host, target):
+        """Send a GET request over this thread's connection to <host> and
+        return status, location header and body of the response. A connection
+        that has been closed by the server in the meantime is reopened once.
+        """
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        key = (scheme, host)
+        for attempt in (0, 1):
+            connection = connections.get(key)
+            if connection is None:
+                if scheme == 'https':
+                    connection = httplib.HTTPSConnection(host, timeout=self.timeout)
+                else:
+                    connection = httplib.HTTPConnection(host, timeout=self.timeout)
+                connections[key] = connection
+            try:
+                connection.request('GET', target)
+                response = connection.getresponse()
+                # The response has to be read completely before the connection
+                # can be used for the next request.
+                data = response.read()
+                return response.status, response.getheader('location'), data
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                del connections[key]
+                if attempt:
+                    raise
@@ -0,0 +1,171 @@
+"""A per process cache of the topology of skeletons.
+
+For every cached skeleton a CompactArbor with its parent array and the tags
+of its nodes are kept. Entries are validated on every access against the
+version of the skeleton, its number of edits and the time of its latest edit,
+which database triggers keep up to date in the skeleton_summary table. Edits
+handled by other processes are therefore seen immediately. Creating or
+deleting a node patches the cached entry of its skeleton, if the edit count
+shows that no other edit happened in the meantime, instead of loading the
+skeleton again.
+
+At most SKELETON_TOPOLOGY_CACHE_SIZE skeletons are kept, the least recently
+used ones are evicted first. With a value of 0, nothing is cached.
+"""
+import copy
+import threading
+
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import connection
+
+from catmaid.control.tree_util import CompactArbor
+
+
+# Maps skeleton IDs to SkeletonTopology instances, least recently used first
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+class SkeletonTopology(object):
+    """The arbor and tags of a skeleton at a particular version. Instances
+    are shared between threads and must not be modified: patches create new
+    instances.
+    """
+    def __init__(self, version, arbor, tags):
+        self.version = version
+        self.arbor = arbor
+        # Maps node IDs to a list of tag names, only for tagged nodes
+        self.tags = tags
+        self._depths = None
+
+    def depths(self):
+        if self._depths is None:
+            self._depths = self.arbor.depths()
+        return self._depths
+
+    def path_edge_counts(self, node_id):
+        """Return an array with the number of edges between the passed in node
+        and each node of the arbor, in the order of arbor.node_ids.
+        """
+        return self.arbor.path_edge_counts(node_id, self.depths())
+
+
+def get_version(cursor, skeleton_id):
+    """Return a tuple of the number of edits of a skeleton and the time of its
+    latest edit or None if the skeleton has no summary.
+    """
+    cursor.execute('''
+        SELECT num_edits, last_edition_time
+        FROM skeleton_summary WHERE skeleton_id = %s
+    ''', (skeleton_id,))
+    return cursor.fetchone()
+
+
+def _load(cursor, skeleton_id, version):
+    cursor.execute('''
+        SELECT id, parent_id FROM treenode WHERE skeleton_id = %s
+    ''', (skeleton_id,))
+    rows = cursor.fetchall()
+    arbor = CompactArbor([row[0] for row in rows], [row[1] for row in rows])
+
+    cursor.execute('''
+        SELECT tci.treenode_id, ci.name
+        FROM treenode t
+        JOIN treenode_class_instance tci ON tci.treenode_id = t.id
+        JOIN relation r ON r.id = tci.relation_id
+        JOIN class_instance ci ON ci.id = tci.class_instance_id
+        WHERE t.skeleton_id = %s
+          AND r.relation_name = 'labeled_as'
+    ''', (skeleton_id,))
+    tags = defaultdict(list)
+    for node_id, name in cursor.fetchall():
+        tags[node_id].append(name)
+
+    return SkeletonTopology(version, arbor, dict(tags))
+
+
+def _store(skeleton_id, topology):
+    max_size = getattr(settings, 'SKELETON_TOPOLOGY_CACHE_SIZE', 64)
+    if max_size <= 0:
+        return
+    with _lock:
+        _cache.pop(skeleton_id, None)
+        _cache[skeleton_id] = topology
+        while len(_cache) > max_size:
+            _cache.popitem(last=False)
+
+
+def get(skeleton_id):
+    """Return the SkeletonTopology of a skeleton, which is loaded from the
+    database unless an entry of its current version is cached.
+    """
+    skeleton_id = int(skeleton_id)
+    cursor = connection.cursor()
+    # The version is read before the nodes, so that concurrent edits can only
+    # make the loaded topology newer than its version, never older.
+    version = get_version(cursor, skeleton_id)
+    with _lock:
+        topology = _cache.get(skeleton_id)
+        if topology and topology.version == version:
+            del _cache[skeleton_id]
+            _cache[skeleton_id] = topology
+            return topology
+
+    topology = _load(cursor, skeleton_id, version)
+    if version is not None:
+        _store(skeleton_id, topology)
+    return topology
+
+
+def _patch(skeleton_id, num_edits, update):
+    """Apply <update> to a copy of the cached arbor of a skeleton, if it was
+    edited exactly <num_edits> times since it has been cached. Otherwise the
+    entry is evicted.
+    """
+    skeleton_id = int(skeleton_id)
+    with _lock:
+        topology = _cache.get(skeleton_id)
+    if not topology:
+        return
+    version = get_version(connection.cursor(), skeleton_id)
+    if version is None or version[0] != topology.version[0] + num_edits:
+        invalidate(skeleton_id)
+        return
+    # The update replaces arrays of the arbor instead of modifying them, a
+    # shallow copy is therefore enough.
+    arbor = copy.copy(topology.arbor)
+    tags = dict(topology.tags)
+    try:
+        update(arbor, tags)
+    except KeyError:
+        # The cached arbor doesn't match the edit
+        invalidate(skeleton_id)
+        return
+    _store(skeleton_id, SkeletonTopology(version, arbor, tags))
+
+
+def add_node(skeleton_id, node_id, parent_id, num_edits=1):
+    """Add a new, untagged node to the cached topology of its skeleton. This
+    has to be called after the node has been created.
+    """
+    def update(arbor, tags):
+        arbor.add_node(node_id, parent_id)
+    _patch(skeleton_id, num_edits, update)
+
+
+def remove_node(skeleton_id, node_id, num_edits):
+    """Remove a node from the cached topology of its skeleton, its children
+    are linked to its parent. This has to be called after the node has been
+    deleted, <num_edits> is the number of changed nodes and tags.
+    """
+    def update(arbor, tags):
+        arbor.remove_node(node_id)
+        tags.pop(node_id, None)
+    _patch(skeleton_id, num_edits, update)
+
+
+def invalidate(skeleton_id):
+    with _lock:
+        _cache.pop(int(skeleton_id), None)
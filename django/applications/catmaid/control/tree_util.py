@@ -1,22 +1,380 @@
 # A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
+# or a CompactArbor. All functions below accept both.
+
+import numpy as np
 
 from operator import itemgetter
 from networkx import Graph, DiGraph
 from collections import defaultdict
 from math import sqrt
 from itertools import izip, islice
+from django.db import connection
 from catmaid.models import Treenode
 
+
+class CompactArbor(object):
+    """ A tree stored in parallel NumPy arrays rather than as a networkx
+    DiGraph, which needs much less memory and allows vectorized traversals.
+    Nodes are addressed by their index: node_ids[i] is the ID of node i,
+    parents[i] is the index of its parent (-1 for the root) and, if available,
+    locations[i] is its (x, y, z) position. The indices of the children of
+    node i are child_indices[child_offsets[i]:child_offsets[i+1]].
+    Methods take and return node IDs, use to_digraph() and from_digraph() to
+    convert from and to networkx. """
+
+    def __init__(self, node_ids, parent_ids, locations=None):
+        """ parent_ids holds the parent ID of each node, None for the root. """
+        self.node_ids = np.asarray(node_ids, dtype=np.int64).reshape(-1)
+        self._order = np.argsort(self.node_ids)
+        parent_ids = np.fromiter((-1 if p is None else p for p in parent_ids),
+                np.int64, len(self.node_ids))
+        has_parent = parent_ids != -1
+        self.parents = np.full(len(self.node_ids), -1, dtype=np.int64)
+        self.parents[has_parent] = self.indices(parent_ids[has_parent])
+        if locations is None:
+            self.locations = None
+        else:
+            self.locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+        self._update_children()
+
+    @classmethod
+    def from_digraph(cls, tree, locations=None):
+        """ Create a CompactArbor from a DiGraph with edges from parent to child.
+        locations: an optional dictionary of node ID vs (x, y, z). """
+        node_ids = tree.nodes()
+        parent_ids = [next(tree.predecessors_iter(node), None) for node in node_ids]
+        if locations is not None:
+            locations = [locations[node] for node in node_ids]
+        return cls(node_ids, parent_ids, locations)
+
+    def to_digraph(self):
+        """ Return a DiGraph with edges from parent to child. """
+        tree = DiGraph()
+        tree.add_nodes_from(self.node_ids.tolist())
+        children = np.flatnonzero(self.parents != -1)
+        tree.add_edges_from(izip(self.node_ids[self.parents[children]].tolist(),
+                                 self.node_ids[children].tolist()))
+        return tree
+
+    def copy(self):
+        arbor = CompactArbor.__new__(CompactArbor)
+        arbor.node_ids = self.node_ids
+        arbor._order = self._order
+        arbor.parents = self.parents.copy()
+        arbor.locations = self.locations
+        arbor._update_children()
+        return arbor
+
+    def _update_children(self):
+        children = np.flatnonzero(self.parents != -1)
+        order = np.argsort(self.parents[children], kind='mergesort')
+        self.child_indices = children[order]
+        counts = np.bincount(self.parents[children], minlength=len(self.node_ids))
+        self.child_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, node_id):
+        i = np.searchsorted(self.node_ids, node_id, sorter=self._order)
+        return i < len(self._order) and self.node_ids[self._order[i]] == node_id
+
+    def indices(self, node_ids):
+        """ Return an array with the index of each of the passed in node IDs.
+        Raises a KeyError if a node isn't part of the arbor. """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if 0 == len(self._order):
+            if node_ids.size:
+                raise KeyError("Node %s is not part of the arbor" % node_ids.flat[0])
+            return node_ids
+        positions = np.searchsorted(self.node_ids, node_ids, sorter=self._order)
+        indices = self._order[np.minimum(positions, len(self._order) - 1)]
+        missing = self.node_ids[indices] != node_ids
+        if missing.any():
+            raise KeyError("Node %s is not part of the arbor" % node_ids[missing].flat[0])
+        return indices
+
+    def index(self, node_id):
+        return int(self.indices([node_id])[0])
+
+    @property
+    def root(self):
+        """ The ID of the first node without a parent. """
+        roots = np.flatnonzero(self.parents == -1)
+        return int(self.node_ids[roots[0]]) if len(roots) else None
+
+    def parent(self, node_id):
+        """ Return the ID of the parent of a node, None for the root. """
+        p = self.parents[self.index(node_id)]
+        return None if -1 == p else int(self.node_ids[p])
+
+    def children(self, node_id):
+        """ Return a list of the IDs of the children of a node. """
+        i = self.index(node_id)
+        return self.node_ids[self.child_indices[
+                self.child_offsets[i]:self.child_offsets[i + 1]]].tolist()
+
+    def n_children(self):
+        """ Return an array with the number of children of each node. """
+        return np.diff(self.child_offsets)
+
+    def _children_of(self, indices):
+        """ Return the indices of all children of the nodes at <indices>. """
+        starts = self.child_offsets[indices]
+        counts = self.child_offsets[indices + 1] - starts
+        total = counts.sum()
+        if 0 == total:
+            return np.empty(0, dtype=np.int64)
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + \
+                np.arange(total)
+        return self.child_indices[offsets]
+
+    def _levels(self, start):
+        """ Yield arrays of node indices, level by level, starting with the
+        node at index <start> and followed by its descendants. """
+        level = np.array([start], dtype=np.int64)
+        while len(level):
+            yield level
+            level = self._children_of(level)
+
+    def _depths(self, start=None):
+        """ Return an array with the number of edges between each node and the
+        node at index <start> (the root by default), -1 for all nodes that
+        aren't downstream of it. """
+        if start is None:
+            start = self.index(self.root)
+        depths = np.full(len(self.node_ids), -1, dtype=np.int64)
+        for depth, level in enumerate(self._levels(start)):
+            depths[level] = depth
+        return depths
+
+    def subarbor(self, node_id):
+        """ Return a new CompactArbor with the passed in node as root and all
+        nodes downstream of it. """
+        start = self.index(node_id)
+        members = np.concatenate(list(self._levels(start)))
+        parents = self.parents[members]
+        parents[0] = -1
+        parent_ids = [None if -1 == p else self.node_ids[p] for p in parents.tolist()]
+        locations = None if self.locations is None else self.locations[members]
+        return CompactArbor(self.node_ids[members], parent_ids, locations)
+
+    def find_root(self):
+        return self.root
+
+    def edge_count_to_root(self, root_node=None):
+        """ Like edge_count_to_root(): return a map of node ID vs number of
+        edges from the root, starting with 1 for the root itself. If
+        <root_node> is given, only nodes downstream of it are included. """
+        start = self.index(root_node if root_node else self.root)
+        distances = {}
+        for count, level in enumerate(self._levels(start), 1):
+            distances.update(dict.fromkeys(self.node_ids[level].tolist(), count))
+        return distances
+
+    def find_common_ancestor(self, nodes, ds=None, root_node=None):
+        """ Like find_common_ancestor(): return the nearest common ancestor of
+        all passed in node IDs and its distance to the root. """
+        if 1 == len(nodes):
+            return nodes[0], 0
+        depths = self._depths()
+        indices = self.indices(list(nodes))
+        # Bring all nodes up to the same depth, then walk up together
+        target = depths[indices].min()
+        for i in xrange(len(indices)):
+            while depths[indices[i]] > target:
+                indices[i] = self.parents[indices[i]]
+        indices = np.unique(indices)
+        while len(indices) > 1:
+            indices = np.unique(self.parents[indices])
+        return int(self.node_ids[indices[0]]), int(depths[indices[0]]) + 1
+
+    def find_common_ancestors(self, node_groups):
+        return (self.find_common_ancestor(nodes) for nodes in node_groups)
+
+    def _path_to_root(self, i):
+        path = [i]
+        p = self.parents[i]
+        while p != -1:
+            path.append(p)
+            p = self.parents[p]
+        return path
+
+    def reroot(self, new_root):
+        """ Reverse in place the direction of the edges from the new_root to
+        root. """
+        path = self._path_to_root(self.index(new_root))
+        if 1 == len(path):
+            # new_root is already the root
+            return
+        path = np.array(path, dtype=np.int64)
+        self.parents[path[1:]] = path[:-1]
+        self.parents[path[0]] = -1
+        self._update_children()
+
+    def partition(self, root_node=None):
+        """ Like partition(): yield sequences of node IDs, each running from an
+        end node to either the root or a branch node. Branch nodes are
+        repeated as ends of all sequences except the longest one that finishes
+        at the root. """
+        if root_node and root_node != self.root:
+            for sequence in self.subarbor(root_node).partition():
+                yield sequence
+            return
+        depths = self._depths()
+        ends = np.flatnonzero((self.n_children() == 0) & (depths != -1))
+        # Iterate end nodes sorted from highest to lowest distance to root
+        ends = ends[np.argsort(-depths[ends], kind='mergesort')]
+        parents = self.parents.tolist()
+        node_ids = self.node_ids.tolist()
+        seen = [False] * len(node_ids)
+        for i in ends.tolist():
+            sequence = [node_ids[i]]
+            p = parents[i]
+            while p != -1:
+                sequence.append(node_ids[p])
+                if seen[p]:
+                    break
+                seen[p] = True
+                p = parents[p]
+            if len(sequence) > 1:
+                yield sequence
+
+    def simplify(self, keepers):
+        """ Like simplify(): return a networkx Graph with only the nodes to
+        keep and the branch points between them.
+        WARNING: will reroot the arbor at the first of the keepers. """
+        keepers = set(keepers)
+        mini = Graph()
+        mini.add_nodes_from(keepers)
+        root = keepers.pop()
+        self.reroot(root)
+        parents = self.parents.tolist()
+        node_ids = self.node_ids.tolist()
+        n_children = self.n_children().tolist()
+        children = defaultdict(int)
+        seen_branch_nodes = set(keepers)
+        paths = []
+        for node in keepers:
+            path = [node]
+            paths.append(path)
+            p = parents[self.index(node)]
+            while p != -1:
+                parent = node_ids[p]
+                if parent in mini:
+                    path.append(parent)
+                    break
+                elif n_children[p] > 1:
+                    children[parent] += 1
+                    path.append(parent)
+                    if parent in seen_branch_nodes:
+                        break
+                    seen_branch_nodes.add(parent)
+                p = parents[p]
+        for path in paths:
+            origin = path[0]
+            for i in xrange(1, len(path) -1):
+                if children[path[i]] > 1:
+                    mini.add_edge(origin, path[i])
+                    origin = path[i]
+            mini.add_edge(origin, path[-1])
+
+        return mini
+
+    def spanning_tree(self, preserve):
+        return spanning_tree(self, preserve)
+
+    def cable_length(self, locations=None):
+        """ Return the total cable length. If no dictionary of node ID vs
+        position is passed in, the arbor's locations are used. """
+        if locations is None:
+            xyz = self.locations
+        else:
+            xyz = np.array([locations[node] for node in self.node_ids.tolist()],
+                    dtype=np.float64)
+        children = np.flatnonzero(self.parents != -1)
+        return float(np.sqrt(np.sum((xyz[children] -
+                xyz[self.parents[children]]) ** 2, axis=1)).sum())
+
+    def depths(self):
+        """ Return an array with the number of edges between each node and the
+        root, computed by pointer jumping instead of walking all levels. """
+        depths = (self.parents != -1).astype(np.int64)
+        jumps = self.parents.copy()
+        active = np.flatnonzero(jumps != -1)
+        while len(active):
+            targets = jumps[active]
+            depths[active] += depths[targets]
+            jumps[active] = jumps[targets]
+            active = active[jumps[active] != -1]
+        return depths
+
+    def path_edge_counts(self, node_id, depths=None):
+        """ Return an array with the number of edges on the path between the
+        passed in node and each node (-1 for nodes not connected to it),
+        without rerooting the arbor. Depths from depths() can be passed in
+        if they are known already. """
+        if depths is None:
+            depths = self.depths()
+        start = self.index(node_id)
+        indices = np.arange(len(self.node_ids))
+        on_path = np.zeros(len(self.node_ids), dtype=bool)
+        on_path[self._path_to_root(start)] = True
+        # Find for every node its nearest ancestor on the path from the start
+        # node to the root, which is its common ancestor with the start node.
+        ancestors = np.where(on_path | (self.parents == -1), indices, self.parents)
+        while True:
+            jumped = ancestors[ancestors]
+            if (jumped == ancestors).all():
+                break
+            ancestors = jumped
+        counts = depths[start] + depths - 2 * depths[ancestors]
+        counts[~on_path[ancestors]] = -1
+        return counts
+
+    def add_node(self, node_id, parent_id):
+        """ Add a node as child of the node <parent_id> (None for a new root).
+        Arrays are replaced rather than modified in place, so that shallow
+        copies of the arbor aren't affected. Locations aren't supported. """
+        parent = -1 if parent_id is None else self.index(parent_id)
+        position = np.searchsorted(self.node_ids, node_id, sorter=self._order)
+        self._order = np.insert(self._order, position, len(self.node_ids))
+        self.node_ids = np.append(self.node_ids, np.int64(node_id))
+        self.parents = np.append(self.parents, np.int64(parent))
+        self.locations = None
+        self._update_children()
+
+    def remove_node(self, node_id):
+        """ Remove a node and link its children to its parent. Like
+        add_node(), arrays are replaced rather than modified in place. """
+        i = self.index(node_id)
+        parents = self.parents.copy()
+        parents[parents == i] = parents[i]
+        parents = np.delete(parents, i)
+        parents[parents > i] -= 1
+        order = self._order[self._order != i]
+        order[order > i] -= 1
+        self.parents = parents
+        self._order = order
+        self.node_ids = np.delete(self.node_ids, i)
+        self.locations = None
+        self._update_children()
+
+
 def find_root(tree):
     """ Search and return the first node that has zero predecessors.
     Will be the root node in directed graphs.
     Avoids one database lookup. """
+    if isinstance(tree, CompactArbor):
+        return tree.root
     for node in tree:
         if not next(tree.predecessors_iter(node), None):
             return node
 
 def edge_count_to_root(tree, root_node=None):
     """ Return a map of nodeID vs number of edges from the first node that lacks predecessors (aka the root). If root_id is None, it will be searched for."""
+    if isinstance(tree, CompactArbor):
+        return tree.edge_count_to_root(root_node)
     distances = {}
     count = 1
     current_level = [root_node if root_node else find_root(tree)]
@@ -37,6 +395,8 @@ def find_common_ancestor(tree, nodes, ds=None, root_node=None):
     Assumes that nodes contains at least 1 node.
     Assumes that all nodes are present in tree.
     Returns a tuple with the ancestor node and its distance to root. """
+    if isinstance(tree, CompactArbor):
+        return tree.find_common_ancestor(nodes)
     if 1 == len(nodes):
         return nodes[0], 0
     distances = ds if ds else edge_count_to_root(tree, root_node=root_node)
@@ -54,11 +414,15 @@ def find_common_ancestor(tree, nodes, ds=None, root_node=None):
     return first, distances[first]
 
 def find_common_ancestors(tree, node_groups):
+    if isinstance(tree, CompactArbor):
+        return tree.find_common_ancestors(node_groups)
     distances = edge_count_to_root(tree)
     return (find_common_ancestor(tree, nodes, ds=distances) for nodes in node_groups)
 
 def reroot(tree, new_root):
     """ Reverse in place the direction of the edges from the new_root to root. """
+    if isinstance(tree, CompactArbor):
+        return tree.reroot(new_root)
     parent = next(tree.predecessors_iter(new_root), None)
     if not parent:
         # new_root is already the root
@@ -75,6 +439,8 @@ def simplify(tree, keepers):
     where only the nodes to keep and the branch points between them are preserved.
     WARNING: will reroot the tree at the first of the keepers.
     WARNING: keepers can't be empty. """
+    if isinstance(tree, CompactArbor):
+        return tree.simplify(keepers)
     # Ensure no repeats
     keepers = set(keepers)
     # Add all keeper nodes to the minified graph
@@ -125,6 +491,11 @@ def partition(tree, root_node=None):
     with branch nodes repeated as ends of all sequences except the longest
     one that finishes at the root.
     Each sequence runs from an end node to either the root or a branch node. """
+    if isinstance(tree, CompactArbor):
+        return tree.partition(root_node)
+    return _partition_digraph(tree, root_node)
+
+def _partition_digraph(tree, root_node=None):
     distances = edge_count_to_root(tree, root_node=root_node) # distance in number of edges from root
     seen = set()
     # Iterate end nodes sorted from highest to lowest distance to root
@@ -152,7 +523,13 @@ def spanning_tree(tree, preserve):
         spanning.add_node(iter(preserve).next())
         return spanning
 
-    if len(tree.successors(find_root(tree))) > 1:
+    if isinstance(tree, CompactArbor):
+        if tree.n_children()[tree.index(tree.root)] > 1:
+            # Reroot a copy at the first end node found
+            end_node = tree.node_ids[np.flatnonzero(tree.n_children() == 0)[0]]
+            tree = tree.copy()
+            tree.reroot(int(end_node))
+    elif len(tree.successors(find_root(tree))) > 1:
         tree = tree.copy()
         # First end node found
         endNode = (node for node in tree if not next(tree.successors_iter(node), None)).next()
@@ -186,6 +563,8 @@ def spanning_tree(tree, preserve):
 def cable_length(tree, locations):
     """ locations: a dictionary of nodeID vs iterable of node position (1d, 2d, 3d, ...)
     Returns the total cable length. """
+    if isinstance(tree, CompactArbor):
+        return tree.cable_length(locations)
     return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in izip(locations[a], locations[b]))) for a,b in tree.edges_iter())
 
 
@@ -223,3 +602,24 @@ def lazy_load_trees(skeleton_ids, node_properties):
     if tree:
         yield (skid, tree)
 
+
+
+def lazy_load_arbors(skeleton_ids):
+    """ Return a lazy collection of pairs of (long, CompactArbor) representing
+    (skeleton_id, arbor), with node locations. Like lazy_load_trees, but
+    without additional node properties. """
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT skeleton_id, id, parent_id, location_x, location_y, location_z
+        FROM treenode
+        WHERE skeleton_id = ANY(%s)
+        ORDER BY skeleton_id
+    ''', (list(skeleton_ids),))
+    rows = cursor.fetchall()
+    start = 0
+    for end in xrange(1, len(rows) + 1):
+        if end == len(rows) or rows[end][0] != rows[start][0]:
+            nodes = rows[start:end]
+            yield rows[start][0], CompactArbor([row[1] for row in nodes],
+                    [row[2] for row in nodes], [row[3:6] for row in nodes])
+            start = end
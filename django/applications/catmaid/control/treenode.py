@@ -2,7 +2,7 @@ import decimal
 import itertools
 import json
 import math
-import networkx as nx
+import numpy as np
 import re
 
 from collections import defaultdict
@@ -13,7 +13,8 @@ from django.http import HttpResponse
 from rest_framework.decorators import api_view
 
 from catmaid.models import UserRole, Treenode, ClassInstance, \
-        TreenodeConnector, Location
+        TreenodeClassInstance, TreenodeConnector, Location
+from catmaid.control import nodecache, topologycache
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_or_fail
 from catmaid.control.common import get_relation_to_id_map, \
@@ -73,6 +74,10 @@ def create_treenode(request, project_id=None):
             params['confidence'], params['useneuron'], params['parent_id'],
             neuron_name=request.POST.get('neuron_name', None))
 
+    nodecache.invalidate_nodes(project_id, [treenode_id])
+    if -1 != params['parent_id']:
+        topologycache.add_node(skeleton_id, treenode_id, params['parent_id'])
+
     return HttpResponse(json.dumps({
         'treenode_id': treenode_id,
         'skeleton_id': skeleton_id
@@ -138,6 +143,8 @@ def insert_treenode(request, project_id=None):
     child.parent_id = treenode_id
     child.save()
 
+    nodecache.invalidate_nodes(project_id, [treenode_id])
+
     return HttpResponse(json.dumps({
         'treenode_id': treenode_id,
         'skeleton_id': skeleton_id
@@ -312,8 +319,11 @@ def update_parent(request, project_id=None, treenode_id=None):
         raise Exception("Child node %s is in skeleton %s but parent node %s is in skeleton %s!", \
                         treenode_id, child.skeleton_id, parent_id, parent.skeleton_id)
 
+    # Evict cached cells of both the old and the new edge
+    nodecache.invalidate_nodes(project_id, [treenode_id])
     child.parent_id = parent_id
     child.save()
+    nodecache.invalidate_nodes(project_id, [treenode_id])
 
     return HttpResponse(json.dumps({'success': True}))
 
@@ -331,6 +341,7 @@ def update_radius(request, project_id=None, treenode_id=None):
         # Update radius only for the treenode
         Treenode.objects.filter(pk=treenode_id).update(editor=request.user,
                                                        radius=radius)
+        nodecache.invalidate_nodes(project_id, [treenode_id])
         return HttpResponse(json.dumps({'success': True}))
 
     cursor.execute('''
@@ -354,6 +365,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        nodecache.invalidate_nodes(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 2 == option:
@@ -372,6 +384,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        nodecache.invalidate_nodes(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 3 == option:
@@ -389,6 +402,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        nodecache.invalidate_nodes(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 4 == option:
@@ -403,6 +417,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        nodecache.invalidate_nodes(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 5 == option:
@@ -412,6 +427,7 @@ def update_radius(request, project_id=None, treenode_id=None):
                 .filter(pk=treenode_id) \
                 .values('skeleton_id')) \
             .update(editor=request.user, radius=radius)
+        nodecache.invalidate_project(project_id)
         return HttpResponse(json.dumps({'success': True}))
 
 
@@ -431,6 +447,9 @@ def delete_treenode(request, project_id=None):
     treenode = Treenode.objects.get(pk=treenode_id)
     parent_id = treenode.parent_id
 
+    # Evict all cached cells that contain the node, its edges or its links
+    nodecache.invalidate_nodes(project_id, [treenode_id])
+
     response_on_error = ''
     deleted_neuron = False
     try:
@@ -482,12 +501,24 @@ def delete_treenode(request, project_id=None):
             # Treenode is not root, it has a parent and perhaps children.
             # Reconnect all the children to the parent.
             response_on_error = 'Could not update parent id of children nodes'
+            children = list(Treenode.objects.filter(parent=treenode) \
+                .values_list('id', flat=True))
             Treenode.objects.filter(parent=treenode) \
                 .update(parent=treenode.parent)
+            # The new edges from the children to the parent could cross
+            # cells that weren't evicted before.
+            nodecache.invalidate_nodes(project_id, children)
 
-        # Remove treenode
+        # Remove treenode. Its tags are deleted along with it, each of them
+        # counts as an edit of the skeleton, just like each relinked child.
         response_on_error = 'Could not delete treenode.'
+        num_tags = TreenodeClassInstance.objects.filter(treenode_id=treenode_id).count()
         Treenode.objects.filter(pk=treenode_id).delete()
+        if parent_id:
+            topologycache.remove_node(treenode.skeleton_id, treenode_id,
+                    len(children) + num_tags + 1)
+        else:
+            topologycache.invalidate(treenode.skeleton_id)
         return HttpResponse(json.dumps({
             'deleted_neuron': deleted_neuron,
             'parent_id': parent_id,
@@ -595,6 +626,7 @@ def update_confidence(request, project_id=None, treenode_id=None):
         rows_affected = Treenode.objects.filter(id=tnid).update(confidence=new_confidence, editor=request.user)
 
     if rows_affected > 0:
+        nodecache.invalidate_nodes(project_id, [tnid])
         location = Location.objects.filter(id=tnid).values_list('location_x',
                 'location_y', 'location_z')[0]
         insert_into_log(project_id, request.user.id, "change_confidence", location, "Changed to %s" % new_confidence)
@@ -608,23 +640,9 @@ def update_confidence(request, project_id=None, treenode_id=None):
 
 
 
-def _skeleton_as_graph(skeleton_id):
-    # Fetch all nodes of the skeleton
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT id, parent_id
-        FROM treenode
-        WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
+def _skeleton_as_arbor(skeleton_id):
+    # The arbor is shared with other requests and must not be modified
+    return topologycache.get(skeleton_id).arbor
 
 
 def _find_first_interesting_node(sequence):
@@ -671,16 +689,16 @@ def find_previous_branchnode_or_root(request, project_id=None, treenode_id=None)
         tnid = int(treenode_id)
         alt = 1 == int(request.POST['alt'])
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = _skeleton_as_arbor(skid)
         # Travel upstream until finding a parent node with more than one child
         # or reaching the root node
         seq = [] # Does not include the starting node tnid
         while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
+            parent = arbor.parent(tnid)
+            if parent:
+                tnid = parent
                 seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
+                if 1 != len(arbor.children(tnid)):
                     break # Found a branch node
             else:
                 break # Found the root node
@@ -698,9 +716,9 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
     try:
         tnid = int(treenode_id)
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = _skeleton_as_arbor(skid)
 
-        children = graph.successors(tnid)
+        children = arbor.children(tnid)
         branches = []
         for child_node_id in children:
             # Travel downstream until finding a child node with more than one
@@ -708,7 +726,7 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
             seq = [child_node_id] # Does not include the starting node tnid
             branch_end = child_node_id
             while True:
-                branchChildren = graph.successors(branch_end)
+                branchChildren = arbor.children(branch_end)
                 if 1 == len(branchChildren):
                     branch_end = branchChildren[0]
                     seq.append(branch_end)
@@ -719,10 +737,11 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
                              _find_first_interesting_node(seq),
                              branch_end])
 
-        # If more than one branch exists, sort based on downstream arbor size.
+        # If more than one branch exists, sort based on downstream arbor size,
+        # measured as number of nodes with children.
         if len(children) > 1:
             branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
+                   key=lambda b: np.count_nonzero(arbor.subarbor(b[0]).n_children()),
                    reverse=True)
 
         # Leaf nodes will have no branches
@@ -1,15 +1,21 @@
 import os.path
-import shutil
 import tarfile
+import time
 import json
 
+from collections import deque
+from copy import copy
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
 from django.conf import settings
 from django.http import HttpResponse
 from django.db.models import Count
 
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, id_generator
-from catmaid.control.cropping import CropJob, extract_substack, ImageRetrievalError
+from catmaid.control.cropping import CropJob, extract_substack, encode_image
+from catmaid.control.tilefetch import ImageRetrievalError
 from catmaid.models import ClassInstanceClassInstance, TreenodeConnector, \
         Message, User, UserRole, Treenode
 
@@ -63,8 +69,11 @@ class TreenodeExporter:
         # The name of entities that are exported
         self.entity_name = "treenode"
 
-        # Output path for this job will be initialized, when needed
+        # The root folder in the archive and the path of the archive will be
+        # initialized, when needed
         self.output_path = None
+        self.archive_path = None
+        self.archive = None
 
         # Cache for neuron and relation folder names
         self.skid_to_neuron_folder = {}
@@ -73,6 +82,9 @@ class TreenodeExporter:
         # Get relation map
         self.relation_map = get_relation_to_id_map(job.project_id)
 
+        # A crop job for the whole stack, which is copied for each node
+        self.crop_template = None
+
         # Store meta data for each node
         self.metadata = {}
 
@@ -85,54 +97,80 @@ class TreenodeExporter:
         msg.action = url
         msg.save()
 
-    def create_basic_output_path(self):
-        """ Will create a random output folder name prefixed with the entity
-        name as well as the actual directory.
+    def create_archive(self):
+        """ Will create a new gzip compressed tar archive with a random name
+        prefixed with the entity name. All files are stored in a folder of the
+        same name in the archive and are added as soon as they are available.
         """
-        # Find non-existing random folder name
+        # Find non-existing random archive name
         while True:
             folder_name = self.entity_name + '_archive_' + id_generator()
-            output_path = os.path.join(treenode_output_path, folder_name)
-            if not os.path.exists(output_path):
+            archive_path = os.path.join(treenode_output_path,
+                    folder_name + '.tar.gz')
+            if not os.path.exists(archive_path):
                 break
-        # Create folder and store path as field
-        os.makedirs(output_path)
-        self.output_path = output_path
+        self.output_path = folder_name
+        self.archive_path = archive_path
+        self.archive = tarfile.open(archive_path, 'w:gz')
+
+    def add_file(self, path, data):
+        """ Adds a file with the passed in data to the archive. Folders don't
+        need to be added explicitly.
+        """
+        info = tarfile.TarInfo(path)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.archive.addfile(info, StringIO(data))
+
+    def close_archive(self):
+        self.archive.close()
 
     def create_path(self, treenode):
-        """ Based on the output path, this function will create a folder
-        structure for a particular skeleton. Things that are supposedly
-        needed multiple times, will be cached. This function will also make
-        sure the path exists and is ready to be written to.
+        """ Based on the output path, this function will create the folder
+        name in the archive for a particular skeleton. Things that are
+        supposedly needed multiple times, will be cached.
         """
         # Get (and create if needed) cache entry for string of neuron id
         treenode_path = self.skid_to_neuron_folder.get(treenode.skeleton_id)
-        if treenode_path:
-            return treenode_path
-        else:
+        if not treenode_path:
             neuron_cici = ClassInstanceClassInstance.objects.get(
                     relation_id=self.relation_map['model_of'],
                     project_id=self.job.project_id,
-                    class_instance_a=treenode.skeleton.id)
+                    class_instance_a=treenode.skeleton_id)
             treenode_path = os.path.join(self.output_path,
                     str(neuron_cici.class_instance_b_id))
-            self.skid_to_neuron_folder[treenode.skeleton.id] = treenode_path
+            self.skid_to_neuron_folder[treenode.skeleton_id] = treenode_path
+        return treenode_path
 
-            # Create path output_path/neuron_id
-            try:
-                os.makedirs(treenode_path)
-                return treenode_path
-            except OSError as e:
-                # Everything is fine if the path exists and is writable
-                if not os.path.exists(treenode_path) or not \
-                        os.access(treenode_path, os.W_OK):
-                    raise e
+    def create_crop_job(self, x, y, z):
+        """ Returns a crop job for the bounding box around the passed in
+        location. All crop jobs are copies of one initialized job, so that
+        they don't need to access the database anymore.
+        """
+        if not self.crop_template:
+            # Create a single file for each section (instead of a mulipage TIFF)
+            self.crop_template = CropJob(self.job.user, self.job.project_id,
+                    self.job.stack_id, 0, 0, 0, 0, 0, 0, 0, 0,
+                    single_channel=True)
+            self.crop_template.initialize()
+            for stack in self.crop_template.stacks:
+                self.crop_template.get_translation(stack)
+        crop_job = copy(self.crop_template)
+        crop_job.x_min = x - self.job.x_radius
+        crop_job.x_max = x + self.job.x_radius
+        crop_job.y_min = y - self.job.y_radius
+        crop_job.y_max = y + self.job.y_radius
+        crop_job.z_min = z - self.job.z_radius
+        crop_job.z_max = z + self.job.z_radius
+        return crop_job
 
     def get_entities_to_export(self):
         """ Returns a list of treenode links. If the job asks only for a
         sample, the first treenode of the first skeleton will be used.
         Otherwise, if no sample should be taken, all treempdes of all
-        skeletons are exported.
+        skeletons are exported. Treenodes are ordered by their location, so
+        that nodes with overlapping bounding boxes are exported close in time
+        and can share cached tiles.
         """
         if self.job.sample:
             try:
@@ -143,34 +181,34 @@ class TreenodeExporter:
                 return []
         else:
             return Treenode.objects.filter(project_id=self.job.project_id,
-                    skeleton_id__in=self.job.skeleton_ids)
+                    skeleton_id__in=self.job.skeleton_ids).order_by(
+                            'location_z', 'location_y', 'location_x')
 
-    def export_single_node(self, treenode):
-        """ Exports a treenode and expects the output path to be existing
-        and writable.
+    def prepare_node(self, treenode):
+        """ Returns the arguments of export_single_node for a treenode. This
+        accesses the database and is therefore called from the thread that
+        iterates the nodes.
         """
-        # Calculate bounding box for current connector
-        x_min = treenode.location_x - self.job.x_radius
-        x_max = treenode.location_x + self.job.x_radius
-        y_min = treenode.location_y - self.job.y_radius
-        y_max = treenode.location_y + self.job.y_radius
-        z_min = treenode.location_z - self.job.z_radius
-        z_max = treenode.location_z + self.job.z_radius
-        rotation_cw = 0
-        zoom_level = 0
-
-        # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
-                self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
-        # Save each file in output path
-        output_path = self.create_path(treenode)
-        for i, img in enumerate(cropped_stack):
+        crop_job = self.create_crop_job(treenode.location_x,
+                treenode.location_y, treenode.location_z)
+        return (self.create_path(treenode), treenode.id, crop_job)
+
+    def export_single_node(self, path, treenode_id, crop_job):
+        """ Returns a list of archive paths and TIFF data of the sections
+        around a treenode. This doesn't access the database and can be called
+        from worker threads.
+        """
+        images = list(extract_substack(crop_job))
+        if len(images) == 1:
             # Save image in output path, named <treenode-id>.tiff
-            image_name = "%s.tiff" % treenode.id
-            treenode_image_path = os.path.join(output_path, image_name)
-            img.write(treenode_image_path)
+            names = ["%s.tiff" % treenode_id]
+        else:
+            # Name images of multiple sections <treenode-id>_<z>.tiff
+            names = ["%s_%s.tiff" % (treenode_id,
+                int(crop_job.z_min + i * crop_job.stacks[0].resolution.z + 0.5))
+                for i in range(len(images))]
+        return [(os.path.join(path, name), encode_image(img))
+                for name, img in zip(names, images)]
 
     def post_process(self, nodes):
         """ Create a meta data file for all the nodes passed (usually all of the
@@ -200,11 +238,11 @@ class TreenodeExporter:
         # parent-id, nr. presynaptic sites, nr. postsynaptic sites, x, y, z
         skid_to_metadata = {}
         for n in nodes:
-            ls = skid_to_metadata.get(n.skeleton.id)
+            ls = skid_to_metadata.get(n.skeleton_id)
             if not ls:
                 ls = []
-                skid_to_metadata[n.skeleton.id] = ls
-            p = n.parent.id if n.parent else 'null'
+                skid_to_metadata[n.skeleton_id] = ls
+            p = n.parent_id if n.parent_id else 'null'
             n_pre = presynaptic_map.get(n.id, 0)
             n_post = postsynaptic_map.get(n.id, 0)
             x = n.location_x
@@ -216,13 +254,12 @@ class TreenodeExporter:
         # Save metdata for each skeleton to files
         for skid, metadata in skid_to_metadata.items():
             path = self.skid_to_neuron_folder.get(skid)
-            with open(os.path.join(path, 'metadata.csv'), 'w') as f:
-                f.write("This CSV file contains meta data for CATMAID skeleton " \
-                        "%s. The columns represent the following data:\n" % skid)
-                f.write("treenode-id, parent-id, # presynaptic sites, " \
-                        "# postsynaptic sites, x, y, z\n")
-                for line in metadata:
-                    f.write("%s\n" % line)
+            lines = ["This CSV file contains meta data for CATMAID skeleton " \
+                    "%s. The columns represent the following data:" % skid,
+                    "treenode-id, parent-id, # presynaptic sites, " \
+                    "# postsynaptic sites, x, y, z"] + metadata
+            self.add_file(os.path.join(path, 'metadata.csv'),
+                    "\n".join(lines) + "\n")
 
 class ConnectorExporter(TreenodeExporter):
     """ Most of the infrastructure can be used for both treenodes and
@@ -234,20 +271,19 @@ class ConnectorExporter(TreenodeExporter):
         self.entity_name = "connector"
 
     def create_path(self, connector_link):
-        """ Based on the output path, this function will create a folder
-        structure for a particular connector. Things that are supposedly
-        needed multiple times, will be cached. This function will also make
-        sure the path exists and is ready to be written to.
+        """ Based on the output path, this function will create the folder
+        name in the archive for a particular connector. Things that are
+        supposedly needed multiple times, will be cached.
         """
         # Get (and create if needed) cache entry for string of neuron id
         if connector_link.skeleton_id not in self.skid_to_neuron_folder:
             neuron_cici = ClassInstanceClassInstance.objects.get(
                     relation_id=self.relation_map['model_of'],
                     project_id=self.job.project_id,
-                    class_instance_a=connector_link.skeleton.id)
-            self.skid_to_neuron_folder[connector_link.skeleton.id] = \
+                    class_instance_a=connector_link.skeleton_id)
+            self.skid_to_neuron_folder[connector_link.skeleton_id] = \
                     str(neuron_cici.class_instance_b_id)
-        neuron_folder = self.skid_to_neuron_folder[connector_link.skeleton.id]
+        neuron_folder = self.skid_to_neuron_folder[connector_link.skeleton_id]
 
         # get (and create if needed) cache entry for string of relation name
         if connector_link.relation_id not in self.relid_to_rel_folder:
@@ -260,25 +296,16 @@ class ConnectorExporter(TreenodeExporter):
             self.relid_to_rel_folder[connector_link.relation_id] = rel_folder
         relation_folder =  self.relid_to_rel_folder[connector_link.relation_id]
 
-        # Create path output_path/neuron_id/relation_name/connector_id
-        connector_path = os.path.join(self.output_path, neuron_folder,
-                relation_folder, str(connector_link.connector.id))
-        try:
-            os.makedirs(connector_path)
-        except OSError as e:
-            # Everything is fine if the path exists and is writable
-            if not os.path.exists(connector_path) or not \
-                    os.access(connector_path, os.W_OK):
-                raise e
-
-        return connector_path
+        # Path output_path/neuron_id/relation_name/connector_id
+        return os.path.join(self.output_path, neuron_folder,
+                relation_folder, str(connector_link.connector_id))
 
     def get_entities_to_export(self):
         """ Returns a list of connector links. If the job asks only for a
         sample, the first pre-synaptic connector of the first skeleton will be
         used. If such a connector doesn't exist, the first one found is used.
         Otherwise, if no sample should be taken, all connectors of all
-        skeletons are exported.
+        skeletons are exported, ordered by their location.
         """
         if self.job.sample:
             # First try to get a pre-synaptic connector, because these are usually
@@ -309,42 +336,36 @@ class ConnectorExporter(TreenodeExporter):
                     relation_id__in=(self.relation_map['presynaptic_to'],
                                         self.relation_map['postsynaptic_to']),
                     skeleton_id__in=self.job.skeleton_ids).select_related(
-                            'connector')
+                            'connector').order_by('connector__location_z',
+                                    'connector__location_y',
+                                    'connector__location_x')
 
         return connector_links
 
-    def export_single_node(self, connector_link):
-        """ Exports a single connector and expects the output path to be existing
-        and writable.
+    def prepare_node(self, connector_link):
+        """ Returns the arguments of export_single_node for a connector link.
+        This accesses the database and is therefore called from the thread
+        that iterates the links.
         """
         connector = connector_link.connector
-
-        # Calculate bounding box for current connector
-        x_min = connector.location_x - self.job.x_radius
-        x_max = connector.location_x + self.job.x_radius
-        y_min = connector.location_y - self.job.y_radius
-        y_max = connector.location_y + self.job.y_radius
-        z_min = connector.location_z - self.job.z_radius
-        z_max = connector.location_z + self.job.z_radius
-        rotation_cw = 0
-        zoom_level = 0
-
-        # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
-                self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
-        # Save each file in output path
-        connector_path = self.create_path(connector_link)
-        for i, img in enumerate(cropped_stack):
+        crop_job = self.create_crop_job(connector.location_x,
+                connector.location_y, connector.location_z)
+        return (self.create_path(connector_link), connector.location_x,
+                connector.location_y, crop_job)
+
+    def export_single_node(self, path, x, y, crop_job):
+        """ Returns a list of archive paths and TIFF data of the sections
+        around a connector. This doesn't access the database and can be called
+        from worker threads.
+        """
+        files = []
+        for i, img in enumerate(extract_substack(crop_job)):
             # Save image in output path, named after the image center's coordinates,
             # rounded to full integers.
-            x = int(connector.location_x + 0.5)
-            y = int(connector.location_y + 0.5)
-            z = int(z_min + i * crop_self.stacks[0].resolution.z  + 0.5)
-            image_name = "%s_%s_%s.tiff" % (x, y, z)
-            connector_image_path = os.path.join(connector_path, image_name)
-            img.write(connector_image_path)
+            z = int(crop_job.z_min + i * crop_job.stacks[0].resolution.z  + 0.5)
+            image_name = "%s_%s_%s.tiff" % (int(x + 0.5), int(y + 0.5), z)
+            files.append((os.path.join(path, image_name), encode_image(img)))
+        return files
 
     def post_process(self, nodes):
         pass
@@ -353,7 +374,9 @@ class ConnectorExporter(TreenodeExporter):
 def process_export_job(exporter):
     """ This method does the actual archive creation. It controls the data
     extraction and the creation of all sub-stacks. It can be executed as Celery
-    task.
+    task. Sub-stacks are created by a pool of NODE_EXPORT_THREADS threads,
+    which share the tile cache of the cropping tool, and are added to the
+    archive as soon as they are done.
     """
     nodes = exporter.get_entities_to_export()
 
@@ -364,50 +387,62 @@ def process_export_job(exporter):
         exporter.create_message("Nothing to export", msg, '#')
         return msg
 
-    # Create a working directoy to create subfolders and images in
-    exporter.create_basic_output_path()
+    # Create the archive all images are written to
+    exporter.create_archive()
+
+    num_threads = max(1, getattr(settings, 'NODE_EXPORT_THREADS', 4))
+    pool = ThreadPool(num_threads)
 
     # Store error codes and URLs for unreachable images for each failed link
     error_urls = {}
+    def add_result(node, result):
+        try:
+            for path, data in result.get():
+                exporter.add_file(path, data)
+        except ImageRetrievalError as e:
+            error_urls[node] = (e.error, e.path)
+
     try:
-        # Export every node
+        # Export every node, but keep only a few results per thread in
+        # memory, until they are written to the archive.
+        pending = deque()
         for node in nodes:
-            try:
-                exporter.export_single_node(node)
-            except ImageRetrievalError as e:
-                error_urls[node] = (e.error, e.path)
+            args = exporter.prepare_node(node)
+            pending.append((node, pool.apply_async(
+                    exporter.export_single_node, args)))
+            if len(pending) >= 2 * num_threads:
+                add_result(*pending.popleft())
+        while pending:
+            add_result(*pending.popleft())
         # Create error log, if needed
         if error_urls:
-            error_path = os.path.join(exporter.output_path, "error_log.txt")
-            with open(error_path, 'w') as f:
-                f.write("The following %ss couldn't be exported. At " \
-                        "least one image URL of each of them couldn't be " \
-                        "reached.\n" % exporter.entity_name)
-                f.write("%s-id http-error-code url\n" % exporter.entity_name)
-                for node, eu in error_urls.items():
-                    f.write("%s %s %s\n" % (node.id, eu[0], eu[1]))
+            lines = ["The following %ss couldn't be exported. At " \
+                    "least one image URL of each of them couldn't be " \
+                    "reached." % exporter.entity_name,
+                    "%s-id http-error-code url" % exporter.entity_name]
+            for node, eu in error_urls.items():
+                lines.append("%s %s %s" % (node.id, eu[0], eu[1]))
+            exporter.add_file(os.path.join(exporter.output_path,
+                    "error_log.txt"), "\n".join(lines) + "\n")
     except IOError as e:
+        exporter.close_archive()
+        os.remove(exporter.archive_path)
         msg = "The export of the data set has been aborted, because an " \
                 "error occured: %s" % str(e)
         exporter.create_message("The %s export failed" % exporter.entity_name,
                 msg, '#')
         return "An error occured during the %s export: %s" % \
                 (exporter.entity_name, str(e))
+    finally:
+        pool.terminate()
+        pool.join()
 
     # Give an exporter the chance to do some postprocessing
     exporter.post_process(nodes)
-
-    # Make working directory an archive
-    tarfile_path = exporter.output_path.rstrip(os.sep) + '.tar.gz'
-    tar = tarfile.open(tarfile_path, 'w:gz')
-    tar.add(exporter.output_path, arcname=os.path.basename(exporter.output_path))
-    tar.close()
-
-    # Delete working directory
-    shutil.rmtree(exporter.output_path)
+    exporter.close_archive()
 
     # Create message
-    tarfile_name = os.path.basename(tarfile_path)
+    tarfile_name = os.path.basename(exporter.archive_path)
     url = os.path.join(settings.CATMAID_URL, settings.MEDIA_URL,
             settings.MEDIA_TREENODE_SUBDIRECTORY, tarfile_name)
     if error_urls:
@@ -0,0 +1,98 @@
+from contextlib import closing
+import os.path
+import h5py
+import numpy as np
+
+from django.core.management.base import BaseCommand, CommandError
+from catmaid.models import Stack
+from catmaid.control.tile import get_hdf5_path, PYRAMID_GROUP
+from optparse import make_option
+
+
+def downsample(data):
+    """Return a copy of a 2D array with half the width and height, each pixel
+    is the mean of four source pixels. Odd sizes are padded at the border.
+    """
+    height, width = data.shape
+    padded = np.pad(data, ((0, height % 2), (0, width % 2)), mode='edge')
+    blocks = padded.astype(np.float32)
+    mean = 0.25 * (blocks[0::2, 0::2] + blocks[1::2, 0::2] +
+                   blocks[0::2, 1::2] + blocks[1::2, 1::2])
+    return np.rint(mean).astype(data.dtype)
+
+
+class Command(BaseCommand):
+    args = '<project_id> <stack_id>'
+    help = 'Add a scale pyramid to the HDF5 file of a stack. The image data ' \
+        'of each zoom level is stored in chunks of the tile size, until a ' \
+        'section fits into a single tile. Full resolution data is read from ' \
+        'the group "1" of the file.'
+    option_list = BaseCommand.option_list + (
+        make_option('--basename',
+            dest='basename',
+            default='raw',
+            help='The base name of the HDF5 file (default: raw)'),
+        make_option('--tile-width',
+            dest='tile_width',
+            type='int',
+            default=None,
+            help='The tile width, defaults to the one of the stack'),
+        make_option('--tile-height',
+            dest='tile_height',
+            type='int',
+            default=None,
+            help='The tile height, defaults to the one of the stack'),
+        make_option('--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Recreate an existing pyramid'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Please specify a project and a stack ID')
+        project_id, stack_id = (int(a) for a in args)
+
+        path = get_hdf5_path(project_id, stack_id, options['basename'])
+        if not os.path.exists(path):
+            raise CommandError('HDF5 file "%s" does not exist' % path)
+
+        tile_width = options['tile_width']
+        tile_height = options['tile_height']
+        if not tile_width or not tile_height:
+            try:
+                stack = Stack.objects.get(pk=stack_id)
+            except Stack.DoesNotExist:
+                raise CommandError('Stack "%s" does not exist' % stack_id)
+            tile_width = tile_width or stack.tile_width
+            tile_height = tile_height or stack.tile_height
+
+        with closing(h5py.File(path, 'a')) as hfile:
+            if PYRAMID_GROUP in hfile:
+                if not options['force']:
+                    raise CommandError('The file has a pyramid already, use ' \
+                            '--force to recreate it')
+                del hfile[PYRAMID_GROUP]
+            if '1' not in hfile:
+                raise CommandError('The file has no full resolution data')
+            source = hfile['1']
+            pyramid = hfile.create_group(PYRAMID_GROUP)
+
+            num_levels = 0
+            for z in sorted(source.keys(), key=int):
+                data = source[z]['data'][...]
+                level = 0
+                while True:
+                    height, width = data.shape
+                    chunks = (min(tile_height, height), min(tile_width, width))
+                    group = pyramid.require_group(str(level)).create_group(z)
+                    group.create_dataset('data', data=data, chunks=chunks)
+                    if width <= tile_width and height <= tile_height:
+                        break
+                    data = downsample(data)
+                    level += 1
+                num_levels = max(num_levels, level + 1)
+
+        self.stdout.write('Created a pyramid with %s zoom levels in %s' % \
+                (num_levels, path))
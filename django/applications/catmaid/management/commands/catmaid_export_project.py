@@ -0,0 +1,410 @@
+import gzip
+import json
+import os
+import shutil
+from cStringIO import StringIO
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from catmaid.models import Project, Relation
+from catmaid.control.columnarexport import named_cursor, write_tables
+
+
+FORMATS = ('csv', 'graphml', 'swc', 'npz')
+
+CHECKPOINT_NAME = 'checkpoint.json'
+
+# CSV headers are the same as those of the former export_all_csv.py script
+CSV_SKELETON_HEADER = '"skeleton ID", "treenode ID", "parent treenode ID", ' \
+        '"x", "y", "z"\n'
+
+CSV_SYNAPSE_HEADER = '"synapse ID", "presynaptic treenode ID", ' \
+        '"presynaptic skeleton ID", "postsynaptic treenode ID", ' \
+        '"postsynaptic skeleton ID"\n'
+
+GRAPHML_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns"
+         xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+         xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">
+<key id="skid" for="node" attr.name="skeleton id" attr.type="long"/>
+<key id="x" for="node" attr.name="x" attr.type="float"/>
+<key id="y" for="node" attr.name="y" attr.type="float"/>
+<key id="z" for="node" attr.name="z" attr.type="float"/>
+<key id="pre_skid" for="edge" attr.name="presynaptic skeleton id" attr.type="long"/>
+<key id="post_skid" for="edge" attr.name="postsynaptic skeleton id" attr.type="long"/>
+<graph id="CNS">
+'''
+
+GRAPHML_FOOTER = '</graph>\n</graphml>\n'
+
+GRAPHML_NODE = '<node id="n%s">\n<data key="skid">%s</data>\n' \
+        '<data key="x">%s</data>\n<data key="y">%s</data>\n' \
+        '<data key="z">%s</data>\n</node>\n'
+
+GRAPHML_EDGE = '<edge id="e%s" directed="false" source="n%s" target="n%s" />\n'
+
+GRAPHML_SYNAPSE = '<edge id="e%s" directed="true" source="n%s" target="n%s">\n' \
+        '<data key="pre_skid">%s</data>\n<data key="post_skid">%s</data>\n' \
+        '</edge>\n'
+
+# Number of rows fetched at once from server-side cursors
+FETCH_SIZE = 10000
+
+
+def _iter_rows(cursor):
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def _compress(text):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(text)
+    return buf.getvalue()
+
+
+def _write_atomically(path, write):
+    """Call <write> with a gzip file that is moved to <path> once it has been
+    written completely.
+    """
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        write(f)
+    os.rename(tmp_path, path)
+
+
+class Exporter(object):
+    """Write the skeletons and synapses of a project in one or more formats.
+
+    Skeletons are split into partitions, which are exported independently of
+    each other, each in its own short transaction, into gzip files in the
+    "parts" folder of the output directory. SWC files are written directly to
+    the "swc" folder. NumPy archives with all nodes, connectors, links, tags and
+    reviews of the exported skeletons are written to the "npz" folder after
+    all partitions are done. Completed partitions are recorded in a checkpoint file,
+    so that an interrupted export can be continued. Once all partitions are
+    done, the parts are concatenated into the final files; concatenated gzip
+    members are valid gzip files.
+    """
+
+    def __init__(self, project_id, output_dir, formats, min_nodes):
+        self.project_id = project_id
+        self.output_dir = output_dir
+        self.formats = formats
+        self.min_nodes = min_nodes
+        self.parts_dir = os.path.join(output_dir, 'parts')
+        self.swc_dir = os.path.join(output_dir, 'swc')
+        self.npz_dir = os.path.join(output_dir, 'npz')
+        self.checkpoint_path = os.path.join(output_dir, CHECKPOINT_NAME)
+
+    def output_path(self, name):
+        return os.path.join(self.output_dir,
+                'project_%s.%s' % (self.project_id, name))
+
+    def part_path(self, name, index):
+        return os.path.join(self.parts_dir, '%s.%05d.gz' % (name, index))
+
+    def get_skeleton_ids(self):
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT skeleton_id FROM skeleton_summary
+            WHERE project_id = %s AND num_nodes >= %s
+            ORDER BY skeleton_id
+        ''', (self.project_id, self.min_nodes))
+        return [row[0] for row in cursor.fetchall()]
+
+    def create_checkpoint(self, num_partitions):
+        skeleton_ids = self.get_skeleton_ids()
+        size = max(1, -(-len(skeleton_ids) // num_partitions))
+        return {
+            'project_id': self.project_id,
+            'formats': list(self.formats),
+            'min_nodes': self.min_nodes,
+            'partitions': [skeleton_ids[i:i + size]
+                    for i in xrange(0, len(skeleton_ids), size)],
+            'done': [],
+            'synapses_done': False,
+            'tables_done': False,
+        }
+
+    def load_checkpoint(self):
+        """Return the checkpoint of an earlier export with the same parameters
+        or None if there is none.
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['project_id'] != self.project_id or \
+                checkpoint['formats'] != list(self.formats) or \
+                checkpoint['min_nodes'] != self.min_nodes:
+            return None
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.rename(tmp_path, self.checkpoint_path)
+
+    def export_partition(self, index, skeleton_ids):
+        """Export the nodes of the passed in skeletons. CSV rows are produced
+        by the database with COPY, GraphML and SWC are written while iterating
+        a server-side cursor over all nodes, ordered by skeleton.
+        """
+        with transaction.atomic():
+            if 'csv' in self.formats:
+                cursor = connection.cursor()
+                query = cursor.mogrify('''
+                    COPY (SELECT skeleton_id, id, parent_id,
+                                 location_x, location_y, location_z
+                          FROM treenode
+                          WHERE skeleton_id = ANY(%s)
+                          ORDER BY skeleton_id, id)
+                    TO STDOUT WITH CSV
+                ''', (skeleton_ids,))
+                _write_atomically(self.part_path('skeletons', index),
+                        lambda f: cursor.copy_expert(query, f))
+
+            if 'graphml' in self.formats or 'swc' in self.formats:
+                cursor = named_cursor('export_partition_%s' % index, FETCH_SIZE)
+                cursor.execute('''
+                    SELECT skeleton_id, id, parent_id, location_x,
+                           location_y, location_z, radius
+                    FROM treenode
+                    WHERE skeleton_id = ANY(%s)
+                    ORDER BY skeleton_id, id
+                ''', (skeleton_ids,))
+                if 'graphml' in self.formats:
+                    _write_atomically(self.part_path('graphml', index),
+                            lambda f: self.write_nodes(cursor, f))
+                else:
+                    self.write_nodes(cursor, None)
+                cursor.close()
+
+    def write_nodes(self, cursor, graphml):
+        swc = None
+        swc_skeleton_id = None
+        try:
+            for skid, node_id, parent_id, x, y, z, radius in _iter_rows(cursor):
+                if graphml:
+                    graphml.write(GRAPHML_NODE % (node_id, skid, x, y, z))
+                    if parent_id:
+                        graphml.write(GRAPHML_EDGE % (node_id, node_id, parent_id))
+                if 'swc' in self.formats:
+                    if skid != swc_skeleton_id:
+                        if swc:
+                            swc.close()
+                        swc_skeleton_id = skid
+                        swc = open(os.path.join(self.swc_dir, '%s.swc' % skid), 'w')
+                    swc.write('%s 0 %s %s %s %s %s\n' % (node_id, x, y, z,
+                            max(radius, 0), -1 if parent_id is None else parent_id))
+        finally:
+            if swc:
+                swc.close()
+
+    def export_synapses(self, skeleton_ids):
+        relations = dict(Relation.objects.filter(project_id=self.project_id,
+                relation_name__in=('presynaptic_to', 'postsynaptic_to'))
+                .values_list('relation_name', 'id'))
+        params = {
+            'project_id': self.project_id,
+            'pre': relations.get('presynaptic_to'),
+            'post': relations.get('postsynaptic_to'),
+            'skeleton_ids': skeleton_ids,
+        }
+        # CSV rows list each side's treenode and skeleton, GraphML edges need
+        # both treenodes before the skeletons.
+        columns = {
+            'csv': 'tc2.id, tc1.treenode_id, tc1.skeleton_id, '
+                   'tc2.treenode_id, tc2.skeleton_id',
+            'graphml': 'tc2.id, tc1.treenode_id, tc2.treenode_id, '
+                       'tc1.skeleton_id, tc2.skeleton_id',
+        }
+        query = '''
+            SELECT {columns}
+            FROM treenode_connector tc1
+            JOIN treenode_connector tc2 ON tc1.connector_id = tc2.connector_id
+            WHERE tc1.project_id = %(project_id)s
+              AND tc1.relation_id = %(pre)s
+              AND tc2.relation_id = %(post)s
+              AND tc1.skeleton_id = ANY(%(skeleton_ids)s)
+        '''
+        with transaction.atomic():
+            if 'csv' in self.formats:
+                cursor = connection.cursor()
+                copy = cursor.mogrify('COPY (%s) TO STDOUT WITH CSV' %
+                        query.format(columns=columns['csv']), params)
+                _write_atomically(self.part_path('synapses', 0),
+                        lambda f: cursor.copy_expert(copy, f))
+            if 'graphml' in self.formats:
+                cursor = named_cursor('export_synapses', FETCH_SIZE)
+                cursor.execute(query.format(columns=columns['graphml']), params)
+                def write(f):
+                    for row in _iter_rows(cursor):
+                        f.write(GRAPHML_SYNAPSE % row)
+                _write_atomically(self.part_path('graphml_synapses', 0), write)
+                cursor.close()
+
+    def export_tables(self, skeleton_ids):
+        """Write treenodes, connectors, links, tags and reviews of the exported
+        skeletons as NumPy archives of typed columns into the "npz" folder.
+        """
+        write_tables(self.project_id, self.npz_dir, skeleton_ids)
+
+    def assemble(self, num_partitions):
+        def concatenate(name, header, parts, footer=None):
+            with open(self.output_path(name), 'wb') as out:
+                out.write(_compress(header))
+                for part in parts:
+                    with open(part, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+                if footer:
+                    out.write(_compress(footer))
+
+        partitions = range(num_partitions)
+        if 'csv' in self.formats:
+            concatenate('skeletons.csv.gz', CSV_SKELETON_HEADER,
+                    [self.part_path('skeletons', i) for i in partitions])
+            concatenate('synapses.csv.gz', CSV_SYNAPSE_HEADER,
+                    [self.part_path('synapses', 0)])
+        if 'graphml' in self.formats:
+            concatenate('graphml.gz', GRAPHML_HEADER,
+                    [self.part_path('graphml', i) for i in partitions] +
+                    [self.part_path('graphml_synapses', 0)], GRAPHML_FOOTER)
+
+
+# The exporter of a worker process, set by _init_worker()
+_worker_exporter = None
+
+
+def _init_worker(exporter):
+    global _worker_exporter
+    _worker_exporter = exporter
+
+
+def _export_partition(args):
+    index, skeleton_ids = args
+    _worker_exporter.export_partition(index, skeleton_ids)
+    return index
+
+
+class Command(BaseCommand):
+    args = '<project_id> <output_dir>'
+    help = 'Export all skeletons of a project with at least --min-nodes ' \
+        'nodes and the synapses between them as CSV, GraphML, one SWC file ' \
+        'per skeleton and/or NumPy archives of typed columns (npz). ' \
+        'Skeletons are exported in partitions by parallel worker processes. ' \
+        'An interrupted export is continued from where it stopped when the ' \
+        'command is called again with the same parameters.'
+    option_list = BaseCommand.option_list + (
+        make_option('--formats',
+            dest='formats',
+            default=','.join(FORMATS),
+            help='Comma separated list of output formats out of %s ' \
+                '(default: all)' % ', '.join(FORMATS)),
+        make_option('--workers',
+            dest='workers',
+            type='int',
+            default=4,
+            help='Number of worker processes (default: 4)'),
+        make_option('--partitions',
+            dest='partitions',
+            type='int',
+            default=None,
+            help='Number of skeleton partitions (default: 8 per worker)'),
+        make_option('--min-nodes',
+            dest='min_nodes',
+            type='int',
+            default=2,
+            help='Only export skeletons with at least this many nodes ' \
+                '(default: 2)'),
+        make_option('--restart',
+            action='store_true',
+            dest='restart',
+            default=False,
+            help='Ignore the checkpoint of an earlier, interrupted export'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Please specify a project ID and an output directory')
+        project_id, output_dir = int(args[0]), args[1]
+        if not Project.objects.filter(pk=project_id).exists():
+            raise CommandError('Project with ID %s does not exist' % project_id)
+
+        formats = [f.strip() for f in options['formats'].split(',') if f.strip()]
+        unknown = set(formats) - set(FORMATS)
+        if unknown or not formats:
+            raise CommandError('Unknown formats: %s' % ', '.join(unknown))
+        formats = [f for f in FORMATS if f in formats]
+        workers = max(1, options['workers'])
+        num_partitions = options['partitions'] or 8 * workers
+
+        exporter = Exporter(project_id, output_dir, formats, options['min_nodes'])
+        for path, required in ((output_dir, True), (exporter.parts_dir, True),
+                (exporter.swc_dir, 'swc' in formats),
+                (exporter.npz_dir, 'npz' in formats)):
+            if required and not os.path.exists(path):
+                os.makedirs(path)
+
+        checkpoint = None if options['restart'] else exporter.load_checkpoint()
+        if checkpoint:
+            self.stdout.write('Continuing export, %s of %s partitions are done' %
+                    (len(checkpoint['done']), len(checkpoint['partitions'])))
+        else:
+            checkpoint = exporter.create_checkpoint(num_partitions)
+            exporter.save_checkpoint(checkpoint)
+
+        partitions = checkpoint['partitions']
+        done = set(checkpoint['done'])
+        todo = [(i, p) for i, p in enumerate(partitions) if i not in done]
+
+        def mark_done(index):
+            checkpoint['done'].append(index)
+            exporter.save_checkpoint(checkpoint)
+            self.stdout.write('Exported partition %s (%s of %s)' % (index,
+                    len(checkpoint['done']), len(partitions)))
+
+        if workers > 1 and len(todo) > 1:
+            # Database connections can't be shared with forked processes, each
+            # worker opens its own.
+            connection.close()
+            pool = Pool(workers, _init_worker, (exporter,))
+            try:
+                for index in pool.imap_unordered(_export_partition, todo):
+                    mark_done(index)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for index, skeleton_ids in todo:
+                exporter.export_partition(index, skeleton_ids)
+                mark_done(index)
+
+        if not checkpoint['synapses_done']:
+            exporter.export_synapses([s for p in partitions for s in p])
+            checkpoint['synapses_done'] = True
+            exporter.save_checkpoint(checkpoint)
+
+        if 'npz' in formats and not checkpoint['tables_done']:
+            exporter.export_tables([s for p in partitions for s in p])
+            checkpoint['tables_done'] = True
+            exporter.save_checkpoint(checkpoint)
+
+        exporter.assemble(len(partitions))
+        shutil.rmtree(exporter.parts_dir)
+        os.remove(exporter.checkpoint_path)
+
+        self.stdout.write('Exported %s skeletons of project %s to %s' % (
+                sum(len(p) for p in partitions), project_id, output_dir))
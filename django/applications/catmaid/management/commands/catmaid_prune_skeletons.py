@@ -4,6 +4,7 @@ import catmaid
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection, transaction
 from catmaid.models import Project
+from catmaid.control import nodecache
 from optparse import make_option
 
 
@@ -52,6 +53,8 @@ class Command(BaseCommand):
                 cursor.execute("SELECT * FROM prune_skeletons(%s, %s)", [project.id, dryrun])
                 results = cursor.fetchone()
                 num_deleted_nodes = results[0]
+                if not dryrun:
+                    nodecache.invalidate_project(project.id)
             except Project.DoesNotExist:
                 raise CommandError('Project "%s" does not exist' % project_id)
 
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from catmaid.models import Project
+from catmaid.control.neuron_annotations import rebuild_annotation_closure
+from optparse import make_option
+
+class DryRunRollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    args = '<project_id>'
+    help = 'Rebuild the annotation closure table, which links annotations ' \
+        'to all their sub-annotations, for the specified projects. If no ' \
+        'project is specified, all projects are rebuilt.'
+    option_list = BaseCommand.option_list + (
+        make_option('--dryrun',
+            action='store_true',
+            dest='dryrun',
+            default=False,
+            help='Don\'t actually apply changes'),
+        )
+
+    def handle(self, *args, **options):
+        dryrun = options['dryrun']
+
+        if dryrun:
+            self.stdout.write('DRY RUN - no changes will be made')
+        else:
+            self.stdout.write('This will make changes to the database')
+
+        if args:
+            project_ids = args
+        else:
+            project_ids = Project.objects.values_list('id', flat=True)
+
+        cursor = connection.cursor()
+
+        try:
+            with transaction.atomic():
+                for project_id in project_ids:
+                    try:
+                        project = Project.objects.get(pk=int(project_id))
+                    except Project.DoesNotExist:
+                        raise CommandError('Project "%s" does not exist' % project_id)
+
+                    num_rows = rebuild_annotation_closure(cursor, project.id)
+                    self.stdout.write('Created annotation closure for ' \
+                            'project "%s" (%s annotation pairs)' % \
+                            (project.id, num_rows))
+
+                if dryrun:
+                    # For a dry run, cancel the transaction by raising an exception
+                    raise DryRunRollback()
+
+                self.stdout.write('Successfully rebuilt annotation closure table')
+
+        except DryRunRollback:
+            self.stdout.write('Dry run completed')
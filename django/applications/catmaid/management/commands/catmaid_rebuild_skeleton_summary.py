@@ -0,0 +1,102 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from catmaid.models import Project
+from optparse import make_option
+
+class DryRunRollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    args = '<project_id>'
+    help = 'Rebuild the skeleton summary tables (node count, cable length ' \
+        'and review counts) for all skeletons in the specified projects. If ' \
+        'no project is specified, all projects are rebuilt.'
+    option_list = BaseCommand.option_list + (
+        make_option('--dryrun',
+            action='store_true',
+            dest='dryrun',
+            default=False,
+            help='Don\'t actually apply changes'),
+        )
+
+    def handle(self, *args, **options):
+        dryrun = options['dryrun']
+
+        if dryrun:
+            self.stdout.write('DRY RUN - no changes will be made')
+        else:
+            self.stdout.write('This will make changes to the database')
+
+        if args:
+            project_ids = args
+        else:
+            project_ids = Project.objects.values_list('id', flat=True)
+
+        cursor = connection.cursor()
+
+        try:
+            with transaction.atomic():
+                # Block concurrent treenode and review edits until the rebuild
+                # is committed.
+                cursor.execute('LOCK TABLE treenode, review IN SHARE MODE')
+
+                for project_id in project_ids:
+                    try:
+                        project = Project.objects.get(pk=int(project_id))
+                    except Project.DoesNotExist:
+                        raise CommandError('Project "%s" does not exist' % project_id)
+
+                    cursor.execute('DELETE FROM skeleton_summary WHERE project_id = %s',
+                                   (project.id,))
+                    cursor.execute('DELETE FROM skeleton_review_summary WHERE project_id = %s',
+                                   (project.id,))
+
+                    cursor.execute('''
+                        INSERT INTO skeleton_summary (skeleton_id, project_id,
+                            num_nodes, cable_length, num_reviewed_nodes)
+                        SELECT COALESCE(n.skeleton_id, r.skeleton_id), %(project_id)s,
+                               COALESCE(n.num_nodes, 0), COALESCE(n.cable_length, 0),
+                               COALESCE(r.num_reviewed_nodes, 0)
+                        FROM (
+                            SELECT t.skeleton_id, count(*) AS num_nodes,
+                                   COALESCE(sum(sqrt(
+                                       power(t.location_x::float8 - p.location_x, 2) +
+                                       power(t.location_y::float8 - p.location_y, 2) +
+                                       power(t.location_z::float8 - p.location_z, 2))), 0)
+                                   AS cable_length
+                            FROM treenode t
+                            LEFT JOIN treenode p ON p.id = t.parent_id
+                            WHERE t.project_id = %(project_id)s
+                            GROUP BY t.skeleton_id
+                        ) n
+                        FULL OUTER JOIN (
+                            SELECT skeleton_id,
+                                   count(DISTINCT treenode_id) AS num_reviewed_nodes
+                            FROM review
+                            WHERE project_id = %(project_id)s
+                            GROUP BY skeleton_id
+                        ) r ON r.skeleton_id = n.skeleton_id''',
+                        {'project_id': project.id})
+                    num_skeletons = cursor.rowcount
+
+                    cursor.execute('''
+                        INSERT INTO skeleton_review_summary (skeleton_id,
+                            reviewer_id, project_id, num_reviewed_nodes)
+                        SELECT skeleton_id, reviewer_id, project_id,
+                               count(DISTINCT treenode_id)
+                        FROM review
+                        WHERE project_id = %s
+                        GROUP BY skeleton_id, reviewer_id, project_id''',
+                        (project.id,))
+
+                    self.stdout.write('Created summaries for project "%s" (%s skeletons)' % \
+                                      (project.id, num_skeletons))
+
+                if dryrun:
+                    # For a dry run, cancel the transaction by raising an exception
+                    raise DryRunRollback()
+
+                self.stdout.write('Successfully rebuilt skeleton summary tables')
+
+        except DryRunRollback:
+            self.stdout.write('Dry run completed')
@@ -98,15 +98,15 @@ QUnit.test('SVG overlay test', function( assert ) {
       function(xhr) {
         // Parse request (see node.py)
         var items = xhr.requestBody.split("&");
-        var pattern = /^[tc]\[(\d+)\]\[(\d+)\]=(\d+)$/;
-
         var nodeIDs = items.reduce(function(nodes, item) {
-          var matches = pattern.exec(item);
-          // If there are matches and the second index of the element is zero,
-          // it means a node is specified (other indices are coordinateS).
-          if (matches && matches[2] === "0") {
-            // For the test there is no need to parse the node ID as int
-            nodes.push(matches[3]);
+          var param = item.split("=");
+          // Both treenodes and connectors are passed as JSON encoded list of
+          // [id, x, y, z] arrays.
+          if (param[0] === "treenodes" || param[0] === "connectors") {
+            JSON.parse(decodeURIComponent(param[1])).forEach(function(node) {
+              // For the test there is no need to parse the node ID as int
+              nodes.push(String(node[0]));
+            });
           }
           return nodes;
         }, []);
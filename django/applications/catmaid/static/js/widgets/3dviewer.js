@@ -1325,27 +1325,20 @@
     if (0 === skeleton_ids.length) return;
 
     var options = this.options;
-    var url1 = django_url + project.id + '/',
-        lean = options.lean_mode ? 0 : 1,
-        url2 = '/' + lean  + '/' + lean + '/compact-skeleton';
-
+    var lean = options.lean_mode ? 0 : 1;
 
     // Register with the neuron name service and fetch the skeleton data
     CATMAID.NeuronNameService.getInstance().registerAll(this, models,
-      fetchSkeletons.bind(this,
+      fetchCompactSkeletons.bind(this,
           skeleton_ids,
-          function(skeleton_id) {
-            return url1 + skeleton_id + url2;
-          },
-          function(skeleton_id) {
-            return {}; // the post
-          },
+          lean,
+          lean,
           (function(skeleton_id, json) {
             var sk = this.space.updateSkeleton(models[skeleton_id], json, options);
             if (sk) sk.show(this.options);
           }).bind(this),
           function(skeleton_id) {
-            // Failed loading: will be handled elsewhere via fnMissing in fetchCompactSkeletons
+            // Failed loading: will be handled elsewhere by fetchCompactSkeletons
           },
           (function() {
             this.updateSkeletonColors(
@@ -1789,8 +1789,8 @@ SkeletonAnnotations.TracingOverlay.prototype.updateNodeCoordinatesInDB = functio
         requestQueue.register(
             django_url + project.id + '/node/update', 'POST',
             {
-              t: update.treenode,
-              c: update.connector
+              treenodes: JSON.stringify(update.treenode),
+              connectors: JSON.stringify(update.connector)
             },
             CATMAID.jsonResponseHandler(resolve, reject));
       } else {
@@ -332,31 +332,32 @@
   };
 
   AnnotationCache.prototype.update = function(callback) {
-    requestQueue.register(django_url + project.id + '/annotations/',
-        'POST', {}, (function (status, data, text) {
-          var e = $.parseJSON(data);
-          if (status !== 200) {
-              alert("The server returned an unexpected status (" +
-                status + ") " + "with error message:\n" + text);
-          } else {
-            if (e.error) {
-              new CATMAID.ErrorDialog(e.error, e.detail).show();
+    var annotation_ids = {};
+    var annotation_names = {};
+    // Annotation names are loaded page by page, each page continues after the
+    // last annotation of the previous one.
+    var loadPage = (function(params) {
+      requestQueue.register(django_url + project.id + '/search/names',
+          'GET', params, CATMAID.jsonResponseHandler((function(json) {
+            json.entities.forEach(function(a) {
+              annotation_ids[a[1]] = a[0];
+              annotation_names[a[0]] = a[1];
+            });
+            if (json.next) {
+              loadPage($.extend({}, params, json.next));
             } else {
-              // Empty cache
-              this.annotation_ids = {};
-              this.annotation_names = {};
-              // Populate cache
-              e.annotations.forEach((function(a) {
-               this.annotation_ids[a.name] = a.id;
-               this.annotation_names[a.id] = a.name;
-              }).bind(this));
+              // Replace cache
+              this.annotation_ids = annotation_ids;
+              this.annotation_names = annotation_names;
               // Call back, if requested
               if (callback) {
                 callback();
               }
             }
-          }
-        }).bind(this));
+          }).bind(this)));
+    }).bind(this);
+
+    loadPage({types: 'annotation', limit: 10000});
   };
 
   /**
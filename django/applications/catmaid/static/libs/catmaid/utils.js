@@ -64,6 +64,72 @@ InstanceRegistry.prototype.getLastInstance = function() {
 	return a[a.length-1];
 };
 
+/** Like fetchSkeletons, but skeletons are loaded in batches with the compact
+ * skeleton batch endpoint. The JSON passed to fnLoadedOne is the same as from
+ * a compact-skeleton request.*/
+var fetchCompactSkeletons = function(skeleton_ids, with_connectors, with_tags, fnLoadedOne, fnFailedLoading, fnDone) {
+  var batchSize = 50,
+      i = 0,
+      missing = [],
+      unloadable = [],
+      finish = function() {
+        $.unblockUI();
+        if (missing.length > 0 && confirm("Skeletons " + missing.join(', ') + " do not exist. Remove them from selections?")) {
+          CATMAID.skeletonListSources.removeSkeletons(missing);
+        }
+        if (unloadable.length > 0) {
+          alert("Could not load skeletons: " + unloadable.join(', '));
+        }
+      },
+      loadBatch = function() {
+        var batch = skeleton_ids.slice(i, i + batchSize);
+        requestQueue.register(django_url + project.id + '/skeletons/compact-skeleton', 'POST',
+            {skeleton_ids: batch,
+             with_connectors: with_connectors,
+             with_tags: with_tags},
+            function(status, text) {
+              try {
+                var json = 200 === status ? $.parseJSON(text) : null;
+                batch.forEach(function(skeleton_id) {
+                  if (json && json.skeletons && json.skeletons[skeleton_id]) {
+                    fnLoadedOne(skeleton_id, json.skeletons[skeleton_id]);
+                  } else {
+                    if (json && json.missing && -1 !== json.missing.indexOf(Number(skeleton_id))) {
+                      missing.push(skeleton_id);
+                    } else {
+                      unloadable.push(skeleton_id);
+                    }
+                    fnFailedLoading(skeleton_id);
+                  }
+                });
+                // Next iteration
+                i += batch.length;
+                $('#counting-loaded-skeletons').text(i + " / " + skeleton_ids.length);
+                if (i < skeleton_ids.length) {
+                  loadBatch();
+                } else {
+                  finish();
+                  fnDone();
+                }
+              } catch (e) {
+                finish();
+                console.log(e, e.stack);
+                CATMAID.msg("ERROR", "Problem loading skeletons " + batch.join(', '));
+              }
+            });
+      };
+  if (skeleton_ids.length > 1) {
+    $.blockUI({message: '<img src="' + STATIC_URL_JS +
+      'images/busy.gif" /> <span>Loading skeletons <div id="counting-loaded-skeletons">0 / ' +
+      skeleton_ids.length + '</span>'});
+  }
+  if (skeleton_ids.length > 0) {
+    loadBatch();
+  } else {
+    fnDone();
+  }
+};
+
 /** Load each skeleton from the skeleton_ids array one by one, invoking the fnLoadedOne
  * with the ID and the corresponding JSON.
  * If some skeletons fail to load (despite existing), the fnFailedLoading will be invoked with the ID.
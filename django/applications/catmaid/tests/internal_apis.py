@@ -2,7 +2,7 @@ from django.test import TestCase
 from django.contrib.auth.models import User
 from catmaid.models import Project, Class, Relation, ClassInstance, \
     ClassInstanceClassInstance
-from catmaid.control.neuron_annotations import delete_annotation_if_unused
+from catmaid.control.neuron_annotations import _delete_unused_annotations
 
 
 class InternalApiTests(TestCase):
@@ -44,32 +44,30 @@ class InternalApiTests(TestCase):
                                                         relation=annotated_with)
 
         # Try to delete annotation B and expect fail, because it is used
-        b_deleted, b_usecount = delete_annotation_if_unused(self.test_project,
-                                                            annotation_b.id,
-                                                            annotated_with)
-        self.assertFalse(b_deleted)
-        self.assertEqual(b_usecount, 1)
+        b_deleted = _delete_unused_annotations(self.test_project.id,
+                                               [annotation_b.id],
+                                               annotated_with.id)
+        self.assertEqual(set(), b_deleted)
         self.assertTrue(ClassInstance.objects.filter(id=annotation_a.id).exists())
         self.assertTrue(ClassInstance.objects.filter(id=annotation_b.id).exists())
         self.assertTrue(ClassInstance.objects.filter(id=annotation_c.id).exists())
 
         # Try to delete annotation C and expect fail, because it is used
-        c_deleted, c_usecount = delete_annotation_if_unused(self.test_project,
-                                                            annotation_c.id,
-                                                            annotated_with)
-        self.assertFalse(c_deleted)
-        self.assertEqual(c_usecount, 1)
+        c_deleted = _delete_unused_annotations(self.test_project.id,
+                                               [annotation_c.id],
+                                               annotated_with.id)
+        self.assertEqual(set(), c_deleted)
         self.assertTrue(ClassInstance.objects.filter(id=annotation_a.id).exists())
         self.assertTrue(ClassInstance.objects.filter(id=annotation_b.id).exists())
         self.assertTrue(ClassInstance.objects.filter(id=annotation_c.id).exists())
 
         # Try to delete annotation A and expect this to succeed, B and C should
         # also be deleted. Since they are not use anymore if A is deleted.
-        a_deleted, a_usecount = delete_annotation_if_unused(self.test_project,
-                                                            annotation_a.id,
-                                                            annotated_with)
-        self.assertTrue(a_deleted)
-        self.assertEqual(a_usecount, 0)
+        a_deleted = _delete_unused_annotations(self.test_project.id,
+                                               [annotation_a.id],
+                                               annotated_with.id)
+        self.assertEqual(set([annotation_a.id, annotation_b.id, annotation_c.id]),
+                         a_deleted)
         self.assertFalse(ClassInstance.objects.filter(id=annotation_a.id).exists())
         self.assertFalse(ClassInstance.objects.filter(id=annotation_b.id).exists())
         self.assertFalse(ClassInstance.objects.filter(id=annotation_c.id).exists())
@@ -0,0 +1,240 @@
+import gzip
+import os
+import shutil
+import tempfile
+from xml.etree import ElementTree
+
+import numpy as np
+
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client
+from django.utils.six import StringIO
+from guardian.shortcuts import assign_perm
+from catmaid.models import Class, ClassInstance, Project, User, Treenode
+from catmaid.models import TreenodeConnector
+from catmaid.management.commands.catmaid_export_project import Exporter, \
+        CSV_SKELETON_HEADER, CSV_SYNAPSE_HEADER
+
+
+class PruneSkeletonsTest(TestCase):
+    """
+    Test CATMAID's prune skeleton  mananagement command.
+    """
+
+    def setUp(self):
+        self.username = "test"
+        self.password = "test"
+        self.user = User.objects.create(username=self.username,
+                                        password=self.password)
+        self.client = Client()
+        self.client.login(username=self.username, password=self.password)
+
+    def test_straight_line_pruning(self):
+        """
+        Test pruning of a straight line. Only the end nodes should remain.
+        """
+        # Create a new neuron and add six nodes to it
+        p = TestProject(self.user)
+        skid = p.create_neuron()
+        root = p.create_node(0, 0, 0, None, skid)
+        n1 = p.create_node(0, 0, 10, root.id, skid)
+        n2 = p.create_node(0, 0, 20, root.id, skid)
+        n3 = p.create_node(0, 0, 30, root.id, skid)
+        n4 = p.create_node(0, 0, 40, root.id, skid)
+        n5 = p.create_node(0, 0, 50, root.id, skid)
+
+        # Call pruning for this project
+        out = StringIO()
+        call_command('catmaid_prune_skeletons', p.project.id, stdout=out)
+        self.assertIn('Deleted 4 nodes in project "%s"' % p.project.id, out.getvalue())
+
+class ExportProjectTestMixin(object):
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        call_command('catmaid_rebuild_skeleton_summary', '3', stdout=StringIO())
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def read(self, name, output_dir=None):
+        path = os.path.join(output_dir or self.output_dir, 'project_3.' + name)
+        with gzip.open(path) as f:
+            return f.read()
+
+
+class ExportProjectTest(ExportProjectTestMixin, TestCase):
+    """
+    Test CATMAID's project export management command.
+    """
+
+    def test_export(self):
+        call_command('catmaid_export_project', '3', self.output_dir,
+                workers=1, partitions=3, formats='csv,graphml,swc,npz',
+                stdout=StringIO())
+
+        skeleton_ids = [s for s in Treenode.objects.filter(project_id=3) \
+                .values_list('skeleton_id', flat=True).distinct() \
+                if Treenode.objects.filter(skeleton_id=s).count() > 1]
+        nodes = Treenode.objects.filter(skeleton_id__in=skeleton_ids)
+
+        lines = self.read('skeletons.csv.gz').splitlines()
+        self.assertEqual(CSV_SKELETON_HEADER, lines[0] + '\n')
+        self.assertEqual(nodes.count() + 1, len(lines))
+        self.assertEqual(set(n.id for n in nodes),
+                set(int(l.split(',')[1]) for l in lines[1:]))
+
+        graphml = self.read('graphml.gz')
+        self.assertTrue(graphml.startswith('<?xml'))
+        self.assertTrue(graphml.endswith('</graphml>\n'))
+        self.assertEqual(nodes.count(), graphml.count('<node '))
+
+        synapses = self.read('synapses.csv.gz').splitlines()
+        self.assertEqual(CSV_SYNAPSE_HEADER, synapses.pop(0) + '\n')
+        pre = TreenodeConnector.objects.filter(project_id=3,
+                skeleton_id__in=skeleton_ids,
+                relation__relation_name='presynaptic_to')
+        post = TreenodeConnector.objects.filter(project_id=3,
+                relation__relation_name='postsynaptic_to')
+        expected = sorted((p.id, l.treenode_id, p.treenode_id, l.skeleton_id,
+                p.skeleton_id) for l in pre
+                for p in post.filter(connector_id=l.connector_id))
+        self.assertEqual(len(expected), len(synapses))
+        self.assertEqual(sorted((int(r[0]), int(r[1]), int(r[3]), int(r[2]),
+                int(r[4])) for r in (l.split(',') for l in synapses)), expected)
+
+        # Synapse edges connect the treenodes on both sides and carry their
+        # skeleton IDs.
+        root = ElementTree.fromstring(graphml)
+        ns = '{http://graphml.graphdrawing.org/xmlns}'
+        edges = []
+        for edge in root.iter(ns + 'edge'):
+            if edge.get('directed') != 'true':
+                continue
+            data = dict((d.get('key'), int(d.text)) for d in edge.iter(ns + 'data'))
+            edges.append((int(edge.get('id')[1:]), int(edge.get('source')[1:]),
+                    int(edge.get('target')[1:]), data['pre_skid'],
+                    data['post_skid']))
+        self.assertEqual(expected, sorted(edges))
+
+        for skeleton_id in skeleton_ids:
+            with open(os.path.join(self.output_dir, 'swc', '%s.swc' % skeleton_id)) as f:
+                rows = [l.split() for l in f.read().splitlines()]
+            self.assertEqual(Treenode.objects.filter(
+                skeleton_id=skeleton_id).count(), len(rows))
+            self.assertEqual(1, sum(1 for r in rows if r[6] == '-1'))
+
+        treenodes = np.load(os.path.join(self.output_dir, 'npz', 'treenodes.npz'))
+        self.assertEqual(sorted(n.id for n in nodes), sorted(treenodes['id']))
+
+        # A finished export leaves no checkpoint behind
+        self.assertFalse(os.path.exists(
+            os.path.join(self.output_dir, 'checkpoint.json')))
+
+    def test_resume(self):
+        out = StringIO()
+        call_command('catmaid_export_project', '3', self.output_dir,
+                workers=1, partitions=3, formats='csv', stdout=out)
+        expected = self.read('skeletons.csv.gz')
+
+        # Mark the first partition of a new export as done and keep its part
+        exporter = Exporter(3, self.output_dir, ['csv'], 2)
+        checkpoint = exporter.create_checkpoint(3)
+        os.makedirs(exporter.parts_dir)
+        exporter.export_partition(0, checkpoint['partitions'][0])
+        checkpoint['done'] = [0]
+        exporter.save_checkpoint(checkpoint)
+
+        out = StringIO()
+        call_command('catmaid_export_project', '3', self.output_dir,
+                workers=1, formats='csv', stdout=out)
+        self.assertIn('1 of %s partitions are done' % len(checkpoint['partitions']),
+                out.getvalue())
+        self.assertEqual(expected, self.read('skeletons.csv.gz'))
+
+
+class ExportProjectWorkersTest(ExportProjectTestMixin, TransactionTestCase):
+    """
+    Test the project export with several worker processes. These open their
+    own database connections and only see committed data.
+    """
+    names = ('skeletons.csv.gz', 'synapses.csv.gz', 'graphml.gz')
+
+    def export(self, output_dir, workers):
+        out = StringIO()
+        call_command('catmaid_export_project', '3', output_dir,
+                workers=workers, partitions=4, formats='csv,graphml,swc',
+                stdout=out)
+        return out.getvalue()
+
+    def test_workers(self):
+        self.export(self.output_dir, 1)
+        parallel_dir = os.path.join(self.output_dir, 'parallel')
+        self.export(parallel_dir, 2)
+
+        # Parts are assembled in partition order, independent of the order in
+        # which workers finished them.
+        for name in self.names:
+            self.assertEqual(self.read(name), self.read(name, parallel_dir))
+        swc_files = sorted(os.listdir(os.path.join(self.output_dir, 'swc')))
+        self.assertEqual(swc_files,
+                sorted(os.listdir(os.path.join(parallel_dir, 'swc'))))
+        for name in swc_files:
+            with open(os.path.join(self.output_dir, 'swc', name)) as f1, \
+                    open(os.path.join(parallel_dir, 'swc', name)) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_resume_workers(self):
+        self.export(self.output_dir, 1)
+        expected = dict((name, self.read(name)) for name in self.names)
+
+        # Mark the second partition of a new export as done and keep its parts
+        exporter = Exporter(3, self.output_dir, ['csv', 'graphml', 'swc'], 2)
+        checkpoint = exporter.create_checkpoint(4)
+        os.makedirs(exporter.parts_dir)
+        exporter.export_partition(1, checkpoint['partitions'][1])
+        checkpoint['done'] = [1]
+        exporter.save_checkpoint(checkpoint)
+        for name in self.names:
+            os.remove(exporter.output_path(name))
+
+        out = self.export(self.output_dir, 2)
+        self.assertIn('1 of 4 partitions are done', out)
+        for index in (0, 2, 3):
+            self.assertIn('Exported partition %s ' % index, out)
+        self.assertNotIn('Exported partition 1 ', out)
+        for name in self.names:
+            self.assertEqual(expected[name], self.read(name))
+        self.assertFalse(os.path.exists(exporter.checkpoint_path))
+
+
+class TestProject():
+    """
+    Create a new project, assign brows and annotate permissions to the test
+    user and create needed classes for testing pruning.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.project = Project.objects.create(title="Skeleton pruning test project")
+        assign_perm('can_browse', self.user, self.project)
+        assign_perm('can_annotate', self.user, self.project)
+
+        self.class_map = {
+            "skeleton": self.create_class("skeleton")
+        }
+
+    def create_class(self, name):
+        return Class.objects.create(class_name="skeleton", user=self.user,
+                project=self.project, description="")
+
+    def create_neuron(self):
+            return ClassInstance.objects.create(user=self.user, name="A skeleton",
+                project=self.project, class_column=self.class_map["skeleton"])
+
+    def create_node(self, x, y, z, parent_id, skeleton_id):
+        return Treenode.objects.create(location_x=x, location_y=y, location_z=z,
+                project=self.project, user=self.user, editor=self.user,
+                parent_id=parent_id, radius=-1, skeleton=skeleton_id)
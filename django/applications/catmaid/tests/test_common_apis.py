@@ -1,23 +1,35 @@
 import re
 import urllib
 import json
+import msgpack
+import zipfile
+import networkx as nx
+import numpy as np
 
 from django.conf import settings
 from django.contrib.auth.models import Permission
+from django.core.management import call_command
 from django.db import connection, transaction
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
-from guardian.shortcuts import assign_perm
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+from guardian.shortcuts import assign_perm, remove_perm
 
 from catmaid.fields import Double3D, Integer3D
-from catmaid.models import Project, Stack, ProjectStack
+from catmaid.models import Project, Stack, ProjectStack, Relation, Class
 from catmaid.models import ClassInstance, Log, Message, TextlabelLocation
 from catmaid.models import Treenode, Connector, TreenodeConnector, User, Review, ReviewerWhitelist
 from catmaid.models import Textlabel, TreenodeClassInstance, ClassInstanceClassInstance
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
+from catmaid.control.connectivity import synapse_counts, \
+        rebuild_skeleton_connectivity
 from catmaid.control.neuron_annotations import _annotate_entities, create_annotation_query
+from catmaid.control.review import get_review_status
+from catmaid.control import nodecache, projectcache, topologycache
+from catmaid.control.skeleton import _import_skeleton
 
 
 class TransactionTests(TransactionTestCase):
@@ -329,7 +341,23 @@ class ViewPageTests(TestCase):
         url = '/%d/skeleton/235/swc' % (self.test_project_id,)
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.compare_swc_data(response.content, swc_output_for_skeleton_235)
+        self.compare_swc_data(''.join(response.streaming_content),
+                swc_output_for_skeleton_235)
+
+    def test_swc_archive(self):
+        self.fake_authentication()
+        url = '/%d/skeletons/swc' % (self.test_project_id,)
+        response = self.client.post(url, {'skeleton_ids[0]': 235,
+                'skeleton_ids[1]': 373})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('application/zip', response['Content-Type'])
+
+        archive = zipfile.ZipFile(StringIO(''.join(response.streaming_content)))
+        self.assertEqual(['235.swc', '373.swc'], archive.namelist())
+        self.compare_swc_data(archive.read('235.swc'), swc_output_for_skeleton_235)
+        swc = archive.read('373.swc')
+        self.assertEqual(Treenode.objects.filter(skeleton_id=373).count(),
+                len(swc.splitlines()))
 
     def test_labels(self):
         self.fake_authentication()
@@ -1914,6 +1942,66 @@ class ViewPageTests(TestCase):
                 {"id":362, "name":"downstream-B", "class_name":"neuron"}]
         self.assertEqual(expected_result, parsed_response)
 
+    def test_search_names(self):
+        self.fake_authentication()
+
+        url = '/%d/search/names' % self.test_project_id
+        response = self.client.get(url, {'name': 'DOWNSTREAM',
+                'types': 'neuron', 'limit': 1})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        expected_result = {
+            'entities': [[374, 'downstream-A', 'neuron']],
+            'next': {'after_name': 'downstream-A', 'after_id': 374},
+        }
+        self.assertEqual(expected_result, parsed_response)
+
+        params = {'name': 'DOWNSTREAM', 'types': 'neuron', 'limit': 1}
+        params.update(parsed_response['next'])
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        expected_result = {
+            'entities': [[362, 'downstream-B', 'neuron']],
+            'next': None,
+        }
+        self.assertEqual(expected_result, parsed_response)
+
+        # Wildcards are matched literally
+        response = self.client.get(url, {'name': '%'})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual({'entities': [], 'next': None}, parsed_response)
+
+    def test_query_targets_pages(self):
+        self.fake_authentication()
+
+        url = '/%d/annotations/query-targets' % self.test_project_id
+        response = self.client.post(url, {'types[0]': 'neuron'})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        all_ids = [e['id'] for e in parsed_response['entities']]
+        self.assertEqual(sorted(all_ids), all_ids)
+        self.assertTrue(len(all_ids) > 2)
+
+        # The first page is requested with an offset, the following ones
+        # continue after the last element of the previous page.
+        response = self.client.post(url, {'types[0]': 'neuron',
+                'range_start': 0, 'range_length': 2})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual(len(all_ids), parsed_response['totalRecords'])
+        paged_ids = [e['id'] for e in parsed_response['entities']]
+        while 'next' in parsed_response:
+            params = {'types[0]': 'neuron', 'range_length': 2}
+            params.update(parsed_response['next'])
+            response = self.client.post(url, params)
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content)
+            self.assertNotIn('totalRecords', parsed_response)
+            paged_ids.extend(e['id'] for e in parsed_response['entities'])
+        self.assertEqual(all_ids, paged_ids)
+
     def test_search_with_nodes_and_duplicate_label(self):
         self.fake_authentication()
 
@@ -2056,11 +2144,50 @@ class ViewPageTests(TestCase):
 
         self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=2405).skeleton_id)
 
+    def test_import_skeleton(self):
+        self.fake_authentication()
+
+        arborescence = nx.DiGraph()
+        locations = {1: (100, 200, 0), 2: (150, 250, 10), 3: (180, 300, 20),
+                4: (120, 260, 20)}
+        for node, (x, y, z) in locations.iteritems():
+            arborescence.add_node(node, x=x, y=y, z=z)
+        arborescence.add_edges_from([(1, 2), (2, 3), (2, 4)])
+
+        class Request(object):
+            user = User.objects.get(username='test2')
+
+        result = _import_skeleton(Request(), self.test_project_id,
+                arborescence, name='imported')
+        skeleton_id = result['skeleton_id']
+        self.assertEqual('imported',
+                ClassInstance.objects.get(id=skeleton_id).name)
+        self.assertEqual(1, ClassInstanceClassInstance.objects.filter(
+                class_instance_a_id=skeleton_id,
+                class_instance_b_id=result['neuron_id'],
+                relation__relation_name='model_of').count())
+
+        ids = dict((n, d['id']) for n, d in arborescence.nodes_iter(data=True))
+        treenodes = Treenode.objects.filter(skeleton_id=skeleton_id)
+        self.assertEqual(4, treenodes.count())
+        for treenode in treenodes:
+            node = [n for n, tnid in ids.iteritems() if tnid == treenode.id][0]
+            predecessors = arborescence.predecessors(node)
+            self.assertEqual(ids[predecessors[0]] if predecessors else None,
+                    treenode.parent_id)
+            self.assertEqual(locations[node], (treenode.location_x,
+                    treenode.location_y, treenode.location_z))
+
     def test_split_skeleton(self):
         self.fake_authentication()
 
         # Test simple split of 3-node skeleton at middle node.
         old_skeleton_id = 2388
+        review_time = "2014-03-17T00:00:00"
+        for treenode_id in (2392, 2396):
+            Review.objects.create(project_id=self.test_project_id, reviewer_id=3,
+                review_time=review_time, skeleton_id=old_skeleton_id,
+                treenode_id=treenode_id)
         response = self.client.post(
             '/%d/skeleton/split' % (self.test_project_id,),
             {'treenode_id': 2394, 'upstream_annotation_map': '{}', 'downstream_annotation_map': '{}'})
@@ -2071,6 +2198,16 @@ class ViewPageTests(TestCase):
         self.assertTreenodeHasProperties(2392, None, old_skeleton_id)
         self.assertTreenodeHasProperties(2394, None, new_skeleton_id)
         self.assertTreenodeHasProperties(2396, 2394, new_skeleton_id)
+        self.assertEqual(User.objects.get(username='test2').id,
+                Treenode.objects.get(id=2394).editor_id)
+
+        # Connector links and reviews of downstream nodes are moved, too
+        self.assertEqual(new_skeleton_id,
+                TreenodeConnector.objects.get(id=2405).skeleton_id)
+        self.assertEqual(old_skeleton_id,
+                Review.objects.get(treenode_id=2392).skeleton_id)
+        self.assertEqual(new_skeleton_id,
+                Review.objects.get(treenode_id=2396).skeleton_id)
 
         # Test error is returned when trying to split root node.
         response = self.client.post(
@@ -2387,6 +2524,56 @@ class ViewPageTests(TestCase):
         self.assertFalse(annotations['C'] in linked_annotation_ids)
 
 
+    def test_bulk_annotations(self):
+        self.fake_authentication()
+        neuron_ids = [2365, 2381]
+        params = {
+            'annotations[0]': 'A',
+            'annotations[1]': 'B',
+            'meta_annotations[0]': 'meta',
+            'entity_ids[0]': neuron_ids[0],
+            'entity_ids[1]': neuron_ids[1],
+        }
+
+        response = self.client.post(
+            '/%d/annotations/add' % (self.test_project_id,), params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        annotations = {a['name']: a for a in parsed_response['annotations']}
+        self.assertItemsEqual(['A', 'B', 'meta'], annotations.keys())
+        self.assertItemsEqual(neuron_ids, annotations['A']['entities'])
+        self.assertItemsEqual(neuron_ids, annotations['B']['entities'])
+        self.assertItemsEqual([annotations['A']['id'], annotations['B']['id']],
+                annotations['meta']['entities'])
+
+        # Annotating again doesn't create new links
+        response = self.client.post(
+            '/%d/annotations/add' % (self.test_project_id,), params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        for a in parsed_response['annotations']:
+            self.assertEqual(annotations[a['name']]['id'], a['id'])
+            self.assertEqual([], a['entities'])
+        self.assertEqual(4, ClassInstanceClassInstance.objects.filter(
+                class_instance_a__in=neuron_ids,
+                class_instance_b__name__in=('A', 'B')).count())
+
+        # Removing all links removes the annotations and the meta annotation,
+        # which isn't used anymore either.
+        response = self.client.post(
+            '/%d/annotations/remove' % (self.test_project_id,), {
+                'entity_ids[0]': neuron_ids[0],
+                'entity_ids[1]': neuron_ids[1],
+                'annotation_ids[0]': annotations['A']['id'],
+                'annotation_ids[1]': annotations['B']['id']})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual(4, len(parsed_response['deleted_annotations']))
+        self.assertEqual({str(annotations['A']['id']): 0,
+                str(annotations['B']['id']): 0}, parsed_response['left_uses'])
+        self.assertFalse(ClassInstance.objects.filter(
+                id__in=[a['id'] for a in annotations.values()]).exists())
+
     def test_read_message_error(self):
         self.fake_authentication()
         message_id = 5050
@@ -2519,6 +2706,56 @@ class ViewPageTests(TestCase):
         parsed_response.sort(key=distsort)
         self.assertEqual(parsed_response, expected_result)
 
+    def test_skeleton_topology_cache(self):
+        self.fake_authentication()
+        skeleton_id = 235
+
+        topology = topologycache.get(skeleton_id)
+        self.assertEqual(28, len(topology.arbor))
+        self.assertIs(topology, topologycache.get(skeleton_id))
+
+        # Created and deleted nodes are patched into the cached topology
+        response = self.client.post('/%d/treenode/create' % self.test_project_id, {
+            'x': 2820,
+            'y': 1400,
+            'z': 0,
+            'confidence': 5,
+            'parent_id': 261,
+            'radius': 2})
+        self.assertEqual(response.status_code, 200)
+        treenode_id = json.loads(response.content)['treenode_id']
+        patched = topologycache.get(skeleton_id)
+        self.assertIsNot(topology, patched)
+        self.assertEqual(topology.version[0] + 1, patched.version[0])
+        self.assertEqual(261, patched.arbor.parent(treenode_id))
+
+        response = self.client.post('/%d/treenode/delete' % self.test_project_id,
+                {'treenode_id': 259})
+        self.assertEqual(response.status_code, 200)
+        topology = topologycache.get(skeleton_id)
+        self.assertNotIn(259, topology.arbor)
+        self.assertEqual(257, topology.arbor.parent(261))
+        self.assertIs(topology, topologycache.get(skeleton_id))
+
+        # Other edits, e.g. tagging, are recognized by the version
+        response = self.client.post(
+                '/%d/label/treenode/%d/update' % (self.test_project_id, 261),
+                {'tags': 'soma', 'delete_existing': 'false'})
+        self.assertEqual(response.status_code, 200)
+        tagged = topologycache.get(skeleton_id)
+        self.assertIsNot(topology, tagged)
+        self.assertEqual(['soma'], tagged.tags[261])
+
+        # The cached topology matches the database
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT id, parent_id FROM treenode WHERE skeleton_id = %s
+        ''', (skeleton_id,))
+        parents = dict(cursor.fetchall())
+        self.assertEqual(sorted(parents), sorted(tagged.arbor.node_ids.tolist()))
+        for node_id, parent_id in parents.iteritems():
+            self.assertEqual(parent_id, tagged.arbor.parent(node_id))
+
     def test_skeleton_find_labels(self):
         self.fake_authentication()
 
@@ -2673,6 +2910,98 @@ class ViewPageTests(TestCase):
                 "skeleton_id": 361}
         self.assertEqual(expected_result, parsed_response)
 
+    def test_spatial_queries(self):
+        self.fake_authentication()
+        point = {'x': 3000, 'y': 5000, 'z': 0}
+
+        def query(url, params):
+            params = dict(point, **params)
+            response = self.client.get('/%d/spatial/%s' % \
+                    (self.test_project_id, url), params)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)
+
+        nodes = query('nearest', {'k': 3})
+        self.assertEqual([2374, 2372, 2370], [n[0] for n in nodes])
+        self.assertEqual([3310, 5190, 0, 2364], nodes[0][1:5])
+        self.assertAlmostEqual(363.593, nodes[0][5], places=3)
+
+        nodes = query('nearest', {'skeleton_ids[0]': 2388})
+        self.assertEqual(1, len(nodes))
+        self.assertEqual(2394, nodes[0][0])
+        self.assertAlmostEqual(1035.857, nodes[0][5], places=3)
+
+        connectors = query('nearest', {'type': 'connector', 'k': 2})
+        self.assertEqual([2400, 432], [c[0] for c in connectors])
+        connectors = query('nearest', {'type': 'connector',
+                'skeleton_ids[0]': 235, 'skeleton_ids[1]': 361})
+        self.assertEqual([432], [c[0] for c in connectors])
+
+        # Nearest nodes match a ranking of all nodes, also for points far
+        # away in Z from the nodes closest in X and Y.
+        all_nodes = Treenode.objects.filter(project_id=self.test_project_id) \
+                .values_list('id', 'location_x', 'location_y', 'location_z')
+        for x, y, z in ((3000, 5000, 0), (3000, 5000, 700), (6000, 3000, -2000)):
+            ranked = sorted(all_nodes, key=lambda n: ((n[1] - x)**2 +
+                    (n[2] - y)**2 + (n[3] - z)**2, n[0]))
+            for k in (1, 3, 10):
+                nodes = query('nearest', {'x': x, 'y': y, 'z': z, 'k': k})
+                self.assertEqual([n[0] for n in ranked[:k]], [n[0] for n in nodes])
+
+        # Distances are measured to the cable of skeletons
+        skeletons = query('skeletons-within', {'radius': 1600})
+        self.assertEqual([2364, 2388, 2411], [s[0] for s in skeletons])
+        self.assertAlmostEqual(97.198, skeletons[0][1], places=3)
+
+    def test_columnar_export(self):
+        self.fake_authentication()
+        skeleton_id = 235
+        response = self.client.post('/%d/skeletons/export/columnar' % \
+                self.test_project_id, {'skeleton_ids[0]': skeleton_id})
+        self.assertEqual(response.status_code, 200)
+
+        archive = zipfile.ZipFile(StringIO(''.join(response.streaming_content)))
+        self.assertEqual(['treenodes.npz', 'connectors.npz', 'links.npz',
+                'tags.npz', 'reviews.npz'], archive.namelist())
+
+        def load(name):
+            return np.load(StringIO(archive.read(name)))
+
+        treenodes = load('treenodes.npz')
+        expected = Treenode.objects.filter(skeleton_id=skeleton_id)
+        self.assertEqual(sorted(expected.values_list('id', flat=True)),
+                sorted(treenodes['id']))
+        for node in expected:
+            i = list(treenodes['id']).index(node.id)
+            self.assertEqual(node.parent_id or -1, treenodes['parent_id'][i])
+            self.assertAlmostEqual(node.location_x, treenodes['x'][i], places=3)
+            self.assertEqual(np.dtype('M8[us]'), treenodes['creation_time'].dtype)
+
+        links = load('links.npz')
+        expected = TreenodeConnector.objects.filter(skeleton_id=skeleton_id)
+        self.assertEqual(sorted(expected.values_list('id', flat=True)),
+                sorted(links['id']))
+        connectors = load('connectors.npz')
+        self.assertEqual(set(links['connector_id']), set(connectors['id']))
+
+        tags = load('tags.npz')
+        expected = TreenodeClassInstance.objects.filter(
+                treenode__skeleton_id=skeleton_id,
+                relation__relation_name='labeled_as')
+        self.assertEqual(sorted(t.class_instance.name for t in expected),
+                sorted(tags['tag']))
+
+        # Skeletons of other projects aren't exported
+        assign_perm('can_browse', User.objects.get(username='test2'),
+                Project.objects.get(pk=5))
+        response = self.client.post('/5/skeletons/export/columnar',
+                {'skeleton_ids[0]': skeleton_id})
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(StringIO(''.join(response.streaming_content)))
+        for name in archive.namelist():
+            self.assertEqual(0, len(load(name)['id' if name != 'tags.npz'
+                    else 'treenode_id']))
+
     def test_node_find_previous_branch(self):
         self.fake_authentication()
         treenode_id = 257
@@ -2910,6 +3239,43 @@ class ViewPageTests(TestCase):
             self.assertEqual(z[i], node.location_z)
             i += 1
 
+    def test_node_update_json(self):
+        self.fake_authentication()
+        treenodes = [[2368, 2990, 5200, 1], [2370, 3060, 4460, 2]]
+        connectors = [[356, 3640, 5060, 5]]
+
+        response = self.client.post(
+                '/%d/node/update' % self.test_project_id, {
+                    'treenodes': json.dumps(treenodes),
+                    'connectors': json.dumps(connectors)})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual({'updated': 3}, parsed_response)
+        for Kind, nodes in ((Treenode, treenodes), (Connector, connectors)):
+            for node_id, x, y, z in nodes:
+                node = Kind.objects.get(id=node_id)
+                self.assertEqual(x, node.location_x)
+                self.assertEqual(y, node.location_y)
+                self.assertEqual(z, node.location_z)
+
+        # The edges of the moved nodes and of their children have to start
+        # and end at the new locations.
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT id, ST_X(ST_StartPoint(edge)), ST_Y(ST_StartPoint(edge)),
+                   ST_Z(ST_StartPoint(edge)), ST_X(ST_EndPoint(edge)),
+                   ST_Y(ST_EndPoint(edge)), ST_Z(ST_EndPoint(edge))
+            FROM treenode_edge
+            WHERE id IN (2368, 2370, 2372)
+            ORDER BY id
+        ''')
+        expected_edges = [
+            (2368, 2990, 5200, 1, 2990, 5200, 1),
+            (2370, 3060, 4460, 2, 2990, 5200, 1),
+            (2372, 2760, 4600, 0, 3060, 4460, 2),
+        ]
+        self.assertEqual(expected_edges, list(cursor.fetchall()))
+
     def test_node_no_update_many_nodes(self):
         self.fake_authentication()
         self.maxDiff = None
@@ -3022,6 +3388,395 @@ class ViewPageTests(TestCase):
         for row in expected_c_result:
             self.assertTrue(row in parsed_response[1])
 
+    def test_node_list_providers_match(self):
+        self.fake_authentication()
+        params = {
+                'z1': 0,
+                'top': 2280,
+                'left': 4430,
+                'right': 12430,
+                'bottom': 5730,
+                'z2': 9,
+                'atnid': 2423,
+                'labels': 'true'}
+
+        def node_list(provider):
+            params['provider'] = provider
+            response = self.client.post('/%d/node/list' % (self.test_project_id,), params)
+            self.assertEqual(response.status_code, 200)
+            treenodes, connectors, labels, limit_reached = json.loads(response.content)
+            # Relations of connectors are unordered
+            connectors = [c[:5] + [sorted(r) for r in c[5:8]] + c[8:] for c in connectors]
+            return sorted(treenodes), sorted(connectors), labels, limit_reached
+
+        self.assertEqual(node_list('postgis'), node_list('postgis_json'))
+
+    def test_node_list_cache_matches(self):
+        self.fake_authentication()
+        views = [
+            {'z1': 0, 'top': 2280, 'left': 4430, 'right': 12430,
+             'bottom': 5730, 'z2': 9},
+            {'z1': 0, 'top': 4625, 'left': 2860, 'right': 12625,
+             'bottom': 8075, 'z2': 9},
+            # A view that ends close to nodes
+            {'z1': -5, 'top': 2000, 'left': 5000, 'right': 6105,
+             'bottom': 2990, 'z2': 5},
+        ]
+
+        def node_list(params):
+            params = dict(params, atnid=-1, labels='true', provider='postgis')
+            response = self.client.post('/%d/node/list' % (self.test_project_id,), params)
+            self.assertEqual(response.status_code, 200)
+            treenodes, connectors, labels, limit_reached = json.loads(response.content)
+            connectors = [c[:5] + [sorted(r) for r in c[5:8]] + c[8:] for c in connectors]
+            return sorted(treenodes), sorted(connectors), labels, limit_reached
+
+        caches = dict(settings.CACHES, node_list_test={
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'node_list_test',
+        })
+        cache_settings = override_settings(CACHES=caches,
+                NODE_LIST_CACHE='node_list_test',
+                NODE_LIST_CACHE_CELL_SIZE=(1000.0, 1000.0, 10.0),
+                NODE_LIST_CACHE_MAX_CELLS=256)
+
+        def assertCacheMatches():
+            expected = [node_list(view) for view in views]
+            with cache_settings:
+                nodecache.get_node_list_cache().clear()
+                # Fill the cache, then answer from it
+                for i in range(2):
+                    self.assertEqual(expected, [node_list(view) for view in views])
+
+        assertCacheMatches()
+
+        # Cells of moved nodes are evicted
+        with cache_settings:
+            response = self.client.post('/%d/node/update' % self.test_project_id, {
+                'treenodes': json.dumps([[285, 6000, 2990, 0], [2394, 5000, 2000, 0]])})
+            self.assertEqual(response.status_code, 200)
+            treenodes = node_list(views[2])[0]
+            self.assertIn(2394, [row[0] for row in treenodes])
+        assertCacheMatches()
+
+    def test_compact_skeleton_msgpack(self):
+        self.fake_authentication()
+        url = '/%d/%d/1/1/compact-skeleton' % (self.test_project_id, 235)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        expected_result = json.loads(response.content)
+
+        response = self.client.get(url, {'format': 'msgpack'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-msgpack')
+        self.assertEqual(expected_result, msgpack.unpackb(response.content))
+
+        response = self.client.get(url, HTTP_ACCEPT='application/x-msgpack')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(expected_result, msgpack.unpackb(response.content))
+
+    def test_measure_skeletons(self):
+        self.fake_authentication()
+        response = self.client.post('/%d/skeletons/measure' % (self.test_project_id,), {
+            'skeleton_ids[0]': 235,
+            'skeleton_ids[1]': 373,
+            'skeleton_ids[2]': 2411,
+            'skeleton_ids[3]': 2433})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = sorted(json.loads(response.content))
+        # Skeleton ID, raw cable, smooth cable, inputs, outputs, nodes, branch
+        # nodes, end nodes and principal branch cable.
+        expected_result = [
+            [235, 11243, 10640, 0, 3, 28, 2, 4, 7391.129118055569],
+            [373, 2345, 2324, 2, 0, 5, 0, 2, 1705.8585462212545],
+            [2411, 1480, 1344, 0, 1, 4, 0, 2, 947.5794160431797],
+            [2433, 0, 0, 0, 0, 1, 0, 0, 0.0],
+        ]
+        self.assertEqual(len(expected_result), len(parsed_response))
+        for expected, row in zip(expected_result, parsed_response):
+            self.assertEqual(expected[:8], row[:8])
+            self.assertAlmostEqual(expected[8], row[8])
+
+    def test_compact_skeletons(self):
+        self.fake_authentication()
+
+        def normalize(skeleton):
+            # Nodes, connectors and tagged nodes are unordered
+            nodes, connectors, tags = skeleton
+            return sorted(nodes), sorted(connectors), \
+                    dict((k, sorted(v)) for k, v in tags.iteritems())
+
+        skeleton_ids = [235, 373, 2411]
+        expected_skeletons = {}
+        for skid in skeleton_ids:
+            response = self.client.get('/%d/%d/1/1/compact-skeleton' % (self.test_project_id, skid))
+            self.assertEqual(response.status_code, 200)
+            expected_skeletons[str(skid)] = normalize(json.loads(response.content))
+
+        response = self.client.post('/%d/skeletons/compact-skeleton' % (self.test_project_id,), {
+            'skeleton_ids[0]': 235,
+            'skeleton_ids[1]': 373,
+            'skeleton_ids[2]': 2411,
+            'skeleton_ids[3]': 99999})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(''.join(response.streaming_content))
+        self.assertEqual([99999], parsed_response['missing'])
+        self.assertEqual(expected_skeletons, dict((skid, normalize(skeleton))
+                for skid, skeleton in parsed_response['skeletons'].iteritems()))
+
+        # Repeated IDs are returned once and IDs of other class instances are
+        # reported as missing, which keeps the msgpack map valid.
+        response = self.client.post('/%d/skeletons/compact-skeleton' % (self.test_project_id,), {
+            'skeleton_ids[0]': 235,
+            'skeleton_ids[1]': 373,
+            'skeleton_ids[2]': 235,
+            'skeleton_ids[3]': 233,
+            'format': 'msgpack'})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = msgpack.unpackb(''.join(response.streaming_content))
+        self.assertEqual([233], parsed_response['missing'])
+        self.assertEqual(
+                dict((int(k), v) for k, v in expected_skeletons.iteritems()
+                    if k in ('235', '373')),
+                dict((skid, normalize(skeleton))
+                    for skid, skeleton in parsed_response['skeletons'].iteritems()))
+
+    def test_skeleton_connectivity_table(self):
+        self.fake_authentication()
+        cursor = connection.cursor()
+
+        def assertTableMatchesJoin():
+            skeleton_ids = Treenode.objects.values_list('skeleton_id', flat=True).distinct()
+            results = []
+            for use_table in (True, False):
+                with self.settings(SKELETON_CONNECTIVITY_TABLE=use_table):
+                    results.append((
+                        sorted(synapse_counts(cursor, self.test_project_id,
+                            pre_skeleton_ids=skeleton_ids)),
+                        sorted(synapse_counts(cursor, self.test_project_id,
+                            post_skeleton_ids=skeleton_ids, exclude_self=True))))
+            self.assertTrue(results[1][0])
+            self.assertEqual(results[1], results[0])
+
+        assertTableMatchesJoin()
+
+        response = self.client.post('/%d/link/create' % self.test_project_id, {
+            'from_id': 237, 'to_id': 432, 'link_type': 'postsynaptic_to'})
+        self.assertEqual(response.status_code, 200)
+        assertTableMatchesJoin()
+
+        response = self.client.post('/%d/skeleton/split' % self.test_project_id, {
+            'treenode_id': 2394,
+            'upstream_annotation_map': '{}',
+            'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        assertTableMatchesJoin()
+
+        response = self.client.post('/%d/link/delete' % self.test_project_id, {
+            'connector_id': 356, 'treenode_id': 377})
+        self.assertEqual(response.status_code, 200)
+        assertTableMatchesJoin()
+
+        cursor.execute('DELETE FROM skeleton_connectivity')
+        rebuild_skeleton_connectivity(cursor, self.test_project_id)
+        assertTableMatchesJoin()
+
+    def test_analyze_skeletons_partners(self):
+        self.fake_authentication()
+        cursor = connection.cursor()
+        skeleton_id = 373
+
+        # Partners are the skeletons linked to the same connectors as before
+        # the skeleton connectivity table was used.
+        query = '''
+            SELECT tc2.skeleton_id
+            FROM treenode_connector tc1,
+                 treenode_connector tc2,
+                 relation r1,
+                 relation r2
+            WHERE tc1.skeleton_id = %s
+              AND tc1.relation_id = r1.id
+              AND r1.relation_name IN %s
+              AND tc1.connector_id = tc2.connector_id
+              AND tc2.relation_id = r2.id
+              AND r2.relation_name IN %s
+        '''
+        pre, post = ('presynaptic_to',), ('postsynaptic_to',)
+        relations = {1: (pre, post), 2: (post, pre), 3: (pre + post, pre + post)}
+        for extra in (0, 1, 2, 3):
+            expected = set([skeleton_id])
+            if extra:
+                cursor.execute(query, (skeleton_id,) + relations[extra])
+                expected.update(row[0] for row in cursor.fetchall())
+            response = self.client.post(
+                    '/%d/skeleton/analytics' % self.test_project_id,
+                    {'skeleton_ids[0]': skeleton_id, 'extra': extra})
+            self.assertEqual(response.status_code, 200)
+            skeleton_ids = [skid for skid, _ in json.loads(response.content)['issues']]
+            self.assertEqual(expected, set(skeleton_ids))
+            self.assertEqual(len(skeleton_ids), len(expected))
+
+    def test_skeleton_summary_table(self):
+        self.fake_authentication()
+        cursor = connection.cursor()
+
+        def assertSummaryMatches():
+            cursor.execute('''
+                SELECT t.skeleton_id, count(*), COALESCE(sum(sqrt(
+                    power(t.location_x::float8 - p.location_x, 2) +
+                    power(t.location_y::float8 - p.location_y, 2) +
+                    power(t.location_z::float8 - p.location_z, 2))), 0),
+                    (SELECT count(DISTINCT r.treenode_id) FROM review r
+                     WHERE r.skeleton_id = t.skeleton_id)
+                FROM treenode t
+                LEFT JOIN treenode p ON p.id = t.parent_id
+                GROUP BY t.skeleton_id
+                ORDER BY t.skeleton_id
+            ''')
+            expected = cursor.fetchall()
+            cursor.execute('''
+                SELECT skeleton_id, num_nodes, cable_length, num_reviewed_nodes
+                FROM skeleton_summary
+                ORDER BY skeleton_id
+            ''')
+            summary = cursor.fetchall()
+            self.assertEqual([(r[0], r[1], r[3]) for r in expected],
+                             [(r[0], r[1], r[3]) for r in summary])
+            for e, s in zip(expected, summary):
+                self.assertAlmostEqual(e[2], s[2], places=3)
+
+            cursor.execute('''
+                SELECT skeleton_id, reviewer_id, count(DISTINCT treenode_id)
+                FROM review
+                GROUP BY skeleton_id, reviewer_id ORDER BY 1, 2
+            ''')
+            expected = cursor.fetchall()
+            cursor.execute('''
+                SELECT skeleton_id, reviewer_id, num_reviewed_nodes
+                FROM skeleton_review_summary ORDER BY 1, 2
+            ''')
+            self.assertEqual(expected, cursor.fetchall())
+
+            # All collected changes have been applied
+            cursor.execute('''
+                SELECT (SELECT count(*) FROM skeleton_summary_delta),
+                       (SELECT count(*) FROM skeleton_review_summary_delta)
+            ''')
+            self.assertEqual((0, 0), cursor.fetchone())
+
+        assertSummaryMatches()
+
+        response = self.client.post('/%d/treenode/create' % self.test_project_id, {
+            'x': 5, 'y': 10, 'z': 15, 'confidence': 5, 'parent_id': 2394, 'radius': 2})
+        self.assertEqual(response.status_code, 200)
+        assertSummaryMatches()
+
+        response = self.client.post('/%d/node/2394/reviewed' % self.test_project_id)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/%d/node/2396/reviewed' % self.test_project_id)
+        self.assertEqual(response.status_code, 200)
+        assertSummaryMatches()
+
+        # A second review of the same node doesn't count as another reviewed
+        # node of the reviewer.
+        skeleton_id = Treenode.objects.get(pk=2394).skeleton_id
+        Review.objects.create(project_id=self.test_project_id,
+                reviewer_id=self.test_user_id, skeleton_id=skeleton_id,
+                treenode_id=2394)
+        assertSummaryMatches()
+        status = get_review_status([skeleton_id], self.test_project_id,
+                user_ids=[self.test_user_id])
+        cursor.execute('''
+            SELECT count(DISTINCT treenode_id) FROM review
+            WHERE skeleton_id = %s AND reviewer_id = %s
+        ''', (skeleton_id, self.test_user_id))
+        self.assertEqual(cursor.fetchone()[0], status[skeleton_id][1])
+        self.assertLessEqual(status[skeleton_id][1], status[skeleton_id][0])
+
+        response = self.client.post('/%d/node/update' % self.test_project_id, {
+            't[0][0]': 2394, 't[0][1]': 6000, 't[0][2]': 3000, 't[0][3]': 0})
+        self.assertEqual(response.status_code, 200)
+        assertSummaryMatches()
+
+        response = self.client.post('/%d/skeleton/split' % self.test_project_id, {
+            'treenode_id': 2394,
+            'upstream_annotation_map': '{}',
+            'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        assertSummaryMatches()
+
+        response = self.client.post('/%d/treenode/delete' % self.test_project_id,
+                {'treenode_id': 349})
+        self.assertEqual(response.status_code, 200)
+        assertSummaryMatches()
+
+        cursor.execute('DELETE FROM skeleton_summary')
+        cursor.execute('DELETE FROM skeleton_review_summary')
+        call_command('catmaid_rebuild_skeleton_summary', str(self.test_project_id),
+                stdout=StringIO())
+        assertSummaryMatches()
+
+        status = get_review_status([235, 373], self.test_project_id)
+        cursor.execute('''
+            SELECT skeleton_id, count(*) FROM treenode
+            WHERE skeleton_id IN (235, 373) GROUP BY skeleton_id''')
+        self.assertEqual(dict(cursor.fetchall()),
+                dict((skid, s[0]) for skid, s in status.iteritems()))
+
+    def test_project_cache(self):
+        self.fake_authentication()
+
+        # Relation maps are cached until the version of their project changes.
+        # This also happens for edits without signals, e.g. by other
+        # processes or with queryset updates.
+        relations = get_relation_to_id_map(self.test_project_id)
+        self.assertIn('labeled_as', relations)
+        version = projectcache.get_version(self.test_project_id)
+        self.assertIsNotNone(version)
+        self.assertEqual(version, projectcache.get_version(self.test_project_id))
+        self.assertIs(relations, projectcache.get('relations',
+                self.test_project_id, lambda: None))
+
+        Relation.objects.filter(project_id=self.test_project_id,
+                relation_name='labeled_as').update(relation_name='tagged_as')
+        self.assertNotEqual(version,
+                projectcache.get_version(self.test_project_id))
+        relations = get_relation_to_id_map(self.test_project_id)
+        self.assertNotIn('labeled_as', relations)
+        self.assertIn('tagged_as', relations)
+        self.assertEqual({'tagged_as': relations['tagged_as']},
+                get_relation_to_id_map(self.test_project_id,
+                    ('tagged_as', 'labeled_as')))
+
+        # Classes of other projects don't affect the version
+        version = projectcache.get_version(self.test_project_id)
+        Class.objects.create(user_id=self.test_user_id, project_id=1,
+                class_name='test', description='')
+        self.assertEqual(version, projectcache.get_version(self.test_project_id))
+        Class.objects.create(user_id=self.test_user_id,
+                project_id=self.test_project_id, class_name='test',
+                description='')
+        self.assertIn('test', get_class_to_id_map(self.test_project_id))
+
+        # Role decisions are evicted if permissions change
+        url = '/%d/node/user-info' % self.test_project_id
+        response = self.client.post(url, {'node_id': 2374})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('permission_error', json.loads(response.content))
+
+        p = Project.objects.get(pk=self.test_project_id)
+        user = User.objects.get(pk=self.test_user_id)
+        remove_perm('can_browse', user, p)
+        remove_perm('can_annotate', user, p)
+        response = self.client.post(url, {'node_id': 2374})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.content)['permission_error'])
+
+        assign_perm('can_browse', user, p)
+        response = self.client.post(url, {'node_id': 2374})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('permission_error', json.loads(response.content))
+
     def test_textlabels_empty(self):
         self.fake_authentication()
         expected_result = {}
@@ -3227,6 +3982,57 @@ class ViewPageTests(TestCase):
         self.assertEqual(aq[0].name, 'myannotation')
         self.assertEqual(aq[1].name, 'pattern 10 test-2-annotation')
 
+    def test_sub_annotation_query(self):
+        self.fake_authentication()
+
+        # Build the hierarchy meta2 > meta1 > annotation > neuron 2365
+        neuron_id = 2365
+        _annotate_entities(self.test_project_id, [neuron_id],
+                {'annotation': self.test_user_id})
+        annotation = ClassInstance.objects.get(project_id=self.test_project_id,
+                name='annotation')
+        _annotate_entities(self.test_project_id, [annotation.id],
+                {'meta1': self.test_user_id})
+        meta1 = ClassInstance.objects.get(project_id=self.test_project_id,
+                name='meta1')
+        _annotate_entities(self.test_project_id, [meta1.id],
+                {'meta2': self.test_user_id})
+        meta2 = ClassInstance.objects.get(project_id=self.test_project_id,
+                name='meta2')
+
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT ancestor_id, descendant_id, depth FROM annotation_closure
+            WHERE project_id = %s ORDER BY depth, ancestor_id
+        ''', (self.test_project_id,))
+        expected_closure = [
+            (meta1.id, annotation.id, 1),
+            (meta2.id, meta1.id, 1),
+            (meta2.id, annotation.id, 2),
+        ]
+        self.assertEqual(sorted(expected_closure), sorted(cursor.fetchall()))
+
+        def query(params):
+            response = self.client.post('/%d/annotations/query-targets' %
+                    self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content)
+            return sorted(e['id'] for e in parsed_response['entities'])
+
+        self.assertEqual([meta1.id], query({'annotated_with0': meta2.id}))
+        self.assertEqual(sorted([neuron_id, annotation.id, meta1.id]),
+                query({'sub_annotated_with0': meta2.id}))
+        self.assertEqual([neuron_id], query({
+                'sub_annotated_with0': meta2.id,
+                'annotated_with1': annotation.id}))
+
+        # Removing a link removes the sub-annotations below it
+        ClassInstanceClassInstance.objects.filter(class_instance_a=meta1.id,
+                class_instance_b=meta2.id).delete()
+        self.assertEqual([], query({'sub_annotated_with0': meta2.id}))
+        self.assertEqual(sorted([neuron_id, annotation.id]),
+                query({'sub_annotated_with0': meta1.id}))
+
     def test_review_status(self):
         self.fake_authentication()
 
@@ -0,0 +1,159 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from catmaid.control import nodecache
+
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'node_list_test': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'node_list_test',
+    },
+}
+
+
+@override_settings(CACHES=CACHES, NODE_LIST_CACHE='node_list_test',
+        NODE_LIST_CACHE_CELL_SIZE=(100.0, 100.0, 10.0),
+        NODE_LIST_CACHE_MAX_CELLS=64, NODE_LIST_CACHE_TIMEOUT=300)
+class NodeListCacheTests(TestCase):
+    """ The cache is filled by a fake node query that returns every edge whose
+    bounding box intersects a cell, which is what the &&& filter of the
+    database query returns before the distance is checked.
+    """
+
+    def setUp(self):
+        nodecache.get_node_list_cache().clear()
+        # Treenode rows: id, parent_id, x, y, z, confidence, radius,
+        # skeleton_id, user_id
+        self.treenodes = [
+            # A chain, of which the last edge leaves the view
+            (1, None, 10.0, 10.0, 5.0, 5, -1, 100, 1),
+            (2, 1, 50.0, 10.0, 5.0, 5, -1, 100, 1),
+            (3, 2, 150.0, 10.0, 5.0, 5, -1, 100, 1),
+            # An edge that passes the lower right corner of the view without
+            # entering it, but within half of the view's depth.
+            (4, None, 98.0, 103.0, 5.0, 5, -1, 101, 1),
+            (5, 4, 103.0, 98.0, 5.0, 5, -1, 101, 1),
+            # An edge whose bounding box intersects the view, but which is
+            # farther away from it than half of the view's depth.
+            (6, None, 95.0, 140.0, 9.0, 5, -1, 102, 1),
+            (7, 6, 140.0, 95.0, 9.0, 5, -1, 102, 1),
+        ]
+        # Connector rows: id, x, y, z, confidence, presynaptic links,
+        # postsynaptic links, other links, user_id
+        self.connectors = [
+            (10, 20.0, 20.0, 5.0, 5, {1: 5}, {}, {}, 1),
+            (11, 300.0, 300.0, 5.0, 5, {}, {3: 5, 7: 5}, {}, 1),
+        ]
+        self.view = {
+            'left': 10.0, 'top': 10.0, 'z1': 0.0,
+            'right': 99.0, 'bottom': 99.0, 'z2': 10.0,
+            'limit': 1000,
+        }
+        self.fetched = []
+
+    def fetch_cell(self, params):
+        self.fetched.append((params['left'], params['top'], params['z1']))
+        nodes = dict((row[0], row) for row in self.treenodes)
+
+        def in_box(x, y, z):
+            return params['left'] <= x <= params['right'] and \
+                   params['top'] <= y <= params['bottom'] and \
+                   params['z1'] <= z <= params['z2']
+
+        treenode_ids = set()
+        for row in self.treenodes:
+            parent = nodes[row[1]] if row[1] else row
+            lower = [min(row[i], parent[i]) for i in (2, 3, 4)]
+            upper = [max(row[i], parent[i]) for i in (2, 3, 4)]
+            if lower[0] <= params['right'] and upper[0] >= params['left'] and \
+                    lower[1] <= params['bottom'] and upper[1] >= params['top'] and \
+                    lower[2] <= params['z2'] and upper[2] >= params['z1']:
+                treenode_ids.add(row[0])
+                treenode_ids.add(parent[0])
+                treenode_ids.update(r[0] for r in self.treenodes if r[1] == row[0])
+
+        connectors = []
+        for c in self.connectors:
+            if in_box(c[1], c[2], c[3]):
+                relations = c[5:8]
+            else:
+                relations = [dict((tnid, confidence) for tnid, confidence
+                        in r.iteritems() if tnid in treenode_ids) for r in c[5:8]]
+                if not any(relations):
+                    continue
+            connectors.append(c[0:5] + tuple(r.items() for r in relations) + c[8:])
+            for r in relations:
+                treenode_ids.update(r)
+
+        treenodes = [row for row in self.treenodes if row[0] in treenode_ids]
+        return treenodes, connectors, {}, False
+
+    def get_node_list(self, view=None):
+        return nodecache.get_node_list(1, view or self.view, False,
+                self.fetch_cell)
+
+    def test_cell_fill(self):
+        node_list = self.get_node_list()
+        self.assertIsNotNone(node_list)
+        # The view is extended by half of its depth in X and Y, which covers
+        # two cells in each dimension.
+        self.assertEqual(8, len(self.fetched))
+
+        del self.fetched[:]
+        self.assertEqual(node_list, self.get_node_list())
+        self.assertEqual([], self.fetched)
+
+    def test_reduce_to_view(self):
+        treenodes, connectors, labels, limit_reached = self.get_node_list()
+        self.assertEqual([1, 2, 3, 4, 5], sorted(row[0] for row in treenodes))
+        self.assertFalse(limit_reached)
+        # Connectors outside of the view only keep links to returned treenodes
+        connectors = dict((c[0], [dict(r) for r in c[5:8]]) for c in connectors)
+        self.assertEqual({
+            10: [{1: 5}, {}, {}],
+            11: [{}, {3: 5}, {}],
+        }, connectors)
+
+    def test_limit(self):
+        view = dict(self.view, limit=3)
+        self.assertIsNone(self.get_node_list(view))
+
+    def test_distance(self):
+        # A segment passing the corner (99, 99) at a distance of sqrt(4.5)
+        self.assertAlmostEqual(4.5, nodecache._distance_sq((98.0, 103.0, 5.0),
+                (103.0, 98.0, 5.0), 0.0, 0.0, 99.0, 99.0, 5.0))
+        # A segment crossing the rectangle
+        self.assertEqual(4.0, nodecache._distance_sq((-10.0, 50.0, 7.0),
+                (200.0, 50.0, 7.0), 0.0, 0.0, 99.0, 99.0, 5.0))
+        # A single point
+        self.assertEqual(9.0 + 16.0, nodecache._distance_sq((102.0, 50.0, 1.0),
+                (102.0, 50.0, 1.0), 0.0, 0.0, 99.0, 99.0, 5.0))
+
+    def test_invalidation(self):
+        self.get_node_list()
+
+        # Only cells intersecting the changed edge are fetched again
+        del self.fetched[:]
+        nodecache.invalidate_segments(1, [(50.0, 10.0, 5.0, 150.0, 10.0, 5.0)])
+        self.get_node_list()
+        self.assertEqual([(0.0, 0.0, 0.0), (100.0, 0.0, 0.0)],
+                sorted(self.fetched))
+
+        # A moved node is seen after the cells of its old and new edges have
+        # been evicted.
+        self.treenodes[5] = (6, None, 50.0, 50.0, 9.0, 5, -1, 102, 1)
+        nodecache.invalidate_segments(1, [(95.0, 140.0, 9.0, 140.0, 95.0, 9.0),
+                (50.0, 50.0, 9.0, 140.0, 95.0, 9.0)])
+        treenodes = self.get_node_list()[0]
+        self.assertEqual([1, 2, 3, 4, 5, 6, 7],
+                sorted(row[0] for row in treenodes))
+
+        # Invalidating the project evicts all cells
+        del self.fetched[:]
+        nodecache.invalidate_project(1)
+        self.get_node_list()
+        self.assertEqual(8, len(self.fetched))
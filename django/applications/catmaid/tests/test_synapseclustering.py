@@ -0,0 +1,112 @@
+import random
+
+import numpy as np
+import networkx as nx
+
+from django.test import TestCase
+
+from catmaid.control.synapseclustering import tree_max_density, \
+        treeAdjacency, treeKernelDensities
+
+
+def dense_max_density(graph, synapse_nodes, connector_ids, h):
+    """ Group synapses by hill climbing on densities that are computed from the
+    distances of all synapse nodes to all nodes, like tree_max_density did
+    before it walked the tree. Returns the densities and a set of (local
+    maximum, connector IDs) tuples. """
+    sources = set(synapse_nodes)
+    lengths = dict((s, nx.single_source_dijkstra_path_length(graph, s))
+            for s in sources)
+    density = dict((node, np.sum([np.exp(-lengths[s][node]**2 / h**2)
+            for s in sources])) for node in graph.nodes())
+
+    groups = {}
+    for node, connector_id in zip(synapse_nodes, connector_ids):
+        current = node
+        while True:
+            previous = current
+            for nn in graph.neighbors(previous):
+                if density[nn] > density[current]:
+                    current = nn
+            if current == previous:
+                break
+        groups.setdefault(current, set()).add(connector_id)
+
+    return density, set((k, frozenset(v)) for k, v in groups.iteritems())
+
+
+class SynapseClusteringTests(TestCase):
+
+    def setUp(self):
+        # A chain of 10 nodes with a side branch of 3 nodes at node 4, edges
+        # are 100 units long.
+        self.graph = nx.Graph()
+        for i in range(1, 10):
+            self.graph.add_edge(i - 1, i, weight=100.0)
+        self.graph.add_edge(4, 10, weight=100.0)
+        self.graph.add_edge(10, 11, weight=100.0)
+        self.graph.add_edge(11, 12, weight=100.0)
+
+    def test_kernel_densities(self):
+        synapse_nodes = [0, 1, 9, 12]
+        h_list = [50.0, 200.0]
+        nodes, offsets, neighbors, weights = treeAdjacency(self.graph)
+        index = dict((n, i) for i, n in enumerate(nodes))
+        densities = treeKernelDensities(offsets, neighbors, weights,
+                [index[n] for n in synapse_nodes], h_list)
+
+        lengths = nx.all_pairs_dijkstra_path_length(self.graph)
+        for h, density in zip(h_list, densities):
+            for node in nodes:
+                expected = sum(np.exp(-lengths[s][node]**2 / h**2)
+                        for s in synapse_nodes)
+                self.assertAlmostEqual(expected, density[index[node]])
+
+    def test_tree_max_density(self):
+        synapse_nodes = [0, 1, 2, 6, 7, 8, 8]
+        connector_ids = [20, 21, 22, 26, 27, 28, 29]
+        relations = [1, 1, 1, 2, 2, 2, 2]
+        groups = tree_max_density(self.graph, synapse_nodes, connector_ids,
+                relations, [150.0, 2000.0])
+
+        narrow = sorted(groups[150.0].values(), key=lambda g: g.local_max)
+        self.assertEqual(2, len(narrow))
+        self.assertEqual(1, narrow[0].local_max)
+        self.assertEqual([20, 21, 22], sorted(narrow[0].connector_ids))
+        self.assertEqual(7, narrow[1].local_max)
+        self.assertEqual([26, 27, 28, 29], sorted(narrow[1].connector_ids))
+
+        wide = groups[2000.0].values()
+        self.assertEqual(1, len(wide))
+        self.assertEqual(connector_ids, sorted(wide[0].connector_ids))
+
+    def test_random_trees(self):
+        # Compare densities and groups with the dense reference on random trees
+        # with random edge lengths.
+        rng = random.Random(42)
+        h_list = [100.0, 400.0, 1500.0]
+        for t in range(20):
+            graph = nx.Graph()
+            for i in range(1, 300):
+                graph.add_edge(rng.randint(0, i - 1), i,
+                        weight=rng.uniform(10.0, 500.0))
+            synapse_nodes = [rng.randint(0, 299) for i in range(40)]
+            connector_ids = range(1000, 1040)
+            relations = [rng.randint(1, 2) for i in range(40)]
+
+            nodes, offsets, neighbors, weights = treeAdjacency(graph)
+            index = dict((n, i) for i, n in enumerate(nodes))
+            densities = treeKernelDensities(offsets, neighbors, weights,
+                    np.unique([index[n] for n in synapse_nodes]), h_list)
+            groups = tree_max_density(graph, synapse_nodes, connector_ids,
+                    relations, h_list)
+
+            for h, density in zip(h_list, densities):
+                expected_density, expected_groups = dense_max_density(graph,
+                        synapse_nodes, connector_ids, h)
+                for node in nodes:
+                    expected = expected_density[node]
+                    self.assertTrue(abs(expected - density[index[node]]) <=
+                            1e-12 * max(1.0, expected))
+                self.assertEqual(expected_groups, set((g.local_max,
+                        frozenset(g.connector_ids)) for g in groups[h].values()))
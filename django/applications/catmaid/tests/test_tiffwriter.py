@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from django.test import TestCase
+from PIL import Image
+
+from catmaid.control.tiffwriter import TiffWriter
+
+
+class TiffWriterTests(TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.output_dir, 'test.tiff')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_multi_page(self):
+        pages = [np.random.randint(0, 256, (13, 17, 3)).astype(np.uint8)
+                 for i in range(3)]
+        writer = TiffWriter(self.path, (0.25, 0.5), 'Created with CATMAID')
+        for page in pages:
+            writer.write_page(page)
+        writer.close('ImageJ=1.45p\nunit=nm\n')
+
+        image = Image.open(self.path)
+        self.assertEqual('ImageJ=1.45p\nunit=nm\n', image.tag[270].rstrip('\x00'))
+        for i, page in enumerate(pages):
+            image.seek(i)
+            self.assertEqual('RGB', image.mode)
+            self.assertTrue((np.asarray(image) == page).all())
+        self.assertRaises(EOFError, image.seek, len(pages))
+
+    def test_gray_scale(self):
+        page = np.arange(11 * 7, dtype=np.uint8).reshape((11, 7, 1))
+        writer = TiffWriter(self.path)
+        writer.write_page(page)
+        writer.close()
+
+        image = Image.open(self.path)
+        self.assertEqual('L', image.mode)
+        self.assertTrue((np.asarray(image) == page[:, :, 0]).all())
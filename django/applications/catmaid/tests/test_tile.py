@@ -0,0 +1,175 @@
+import os
+import base64
+import shutil
+import tempfile
+import threading
+from contextlib import closing
+from cStringIO import StringIO
+
+import h5py
+import mock
+import numpy as np
+from PIL import Image
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.client import Client
+
+from catmaid.control import labeljournal
+from catmaid.control.tile import flush_label_journal, open_hdf5_file
+from catmaid.management.commands.catmaid_create_hdf5_pyramid import downsample
+
+
+class HDF5TileTests(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.hdf5_dir = tempfile.mkdtemp()
+        self.data = np.random.randint(0, 256, (600, 500)).astype(np.uint8)
+        path = os.path.join(self.hdf5_dir, '3_3_raw.hdf')
+        with closing(h5py.File(path, 'w')) as hfile:
+            hfile.create_dataset('1/0/data', data=self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.hdf5_dir)
+
+    def get_tile(self, x, y, scale):
+        response = self.client.get('/3/stack/3/tile', {'x': x, 'y': y, 'z': 0,
+                'width': 256, 'height': 256, 'scale': scale})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('image/png', response['Content-Type'])
+        return np.asarray(Image.open(StringIO(response.content)))
+
+    def test_tiles(self):
+        with self.settings(HDF5_STORAGE_PATH=self.hdf5_dir):
+            # Tiles at the border are padded
+            tile = self.get_tile(256, 256, 1)
+            self.assertTrue((tile[:, :244] == self.data[256:512, 256:]).all())
+            self.assertTrue((tile[:, 244:] == 0).all())
+
+            # Without pyramid, other zoom levels are sampled from full
+            # resolution data.
+            tile = self.get_tile(0, 0, 0.5)
+            sampled = self.data[::2, ::2]
+            self.assertTrue((tile[:, :250] == sampled[:256]).all())
+
+            call_command('catmaid_create_hdf5_pyramid', '3', '3',
+                    tile_width=256, tile_height=256, stdout=StringIO())
+            tile = self.get_tile(0, 0, 0.5)
+            self.assertTrue((tile[:, :250] == downsample(self.data)[:256]).all())
+            tile = self.get_tile(0, 0, 1)
+            self.assertTrue((tile == self.data[:256, :256]).all())
+
+            # Sections without data are blank
+            response = self.client.get('/3/stack/3/tile', {'x': 0, 'y': 0,
+                    'z': 1, 'width': 256, 'height': 256, 'scale': 1})
+            tile = np.asarray(Image.open(StringIO(response.content)))
+            self.assertEqual((256, 256), tile.shape)
+            self.assertTrue((tile == 0).all())
+
+    def test_open_files(self):
+        path = os.path.join(self.hdf5_dir, '3_3_raw.hdf')
+        other_path = os.path.join(self.hdf5_dir, '3_3_other.hdf')
+        with closing(h5py.File(other_path, 'w')) as hfile:
+            hfile.create_dataset('1/0/data', data=self.data[::-1])
+
+        # Only one file is kept open, reading another one evicts it. Reading
+        # doesn't wait until the evicted file isn't used anymore, closing it
+        # afterwards does.
+        read = threading.Event()
+        def read_other():
+            with open_hdf5_file(other_path, os.path.getmtime(other_path)) as f:
+                self.assertTrue((f['1/0/data'][:] == self.data[::-1]).all())
+                read.set()
+
+        with self.settings(HDF5_FILE_HANDLE_CACHE_SIZE=1):
+            with open_hdf5_file(path, os.path.getmtime(path)) as hfile:
+                thread = threading.Thread(target=read_other)
+                thread.start()
+                self.assertTrue(read.wait(10))
+                self.assertTrue(thread.is_alive())
+                self.assertTrue((hfile['1/0/data'][:] == self.data).all())
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+            self.assertFalse(hfile)
+
+    def test_label_journal(self):
+        path = os.path.join(self.hdf5_dir, '3_3.hdf')
+        with closing(h5py.File(path, 'w')) as hfile:
+            hfile.create_dataset(labeljournal.dataset_path(1), shape=(600, 500, 2),
+                    dtype=np.uint8, chunks=(128, 128, 1))
+
+        expected = np.zeros((600, 500), dtype=np.uint8)
+        for i, (x, y) in enumerate(((0, 0), (100, 50), (450, 550))):
+            labels = np.empty((100, 100), dtype=np.uint8)
+            labels.fill(i + 1)
+            labeljournal.append(path, 1, x, y, 1, labels)
+            expected[y:y+100, x:x+100] = labels[:600-y, :500-x]
+
+        # Labels are readable before they are written to the file
+        with self.settings(HDF5_STORAGE_PATH=self.hdf5_dir):
+            response = self.client.get('/3/stack/3/tile', {'x': 0, 'y': 0,
+                    'z': 1, 'width': 256, 'height': 256, 'scale': 1,
+                    'type': 'labels'})
+            tile = np.asarray(Image.open(StringIO(response.content)))
+            self.assertTrue((tile == expected[:256, :256]).all())
+
+        # A flush is queued once, until it starts or is overdue
+        self.assertTrue(labeljournal.claim_flush(path, 60))
+        self.assertFalse(labeljournal.claim_flush(path, 60))
+        scheduled = labeljournal.scheduled_path(path)
+        os.utime(scheduled, (0, 0))
+        self.assertTrue(labeljournal.claim_flush(path, 60))
+
+        mtime = os.path.getmtime(path)
+        self.assertEqual(3, flush_label_journal(path))
+        self.assertEqual([], labeljournal.pending_records(path))
+        self.assertFalse(os.path.exists(scheduled))
+        self.assertTrue(labeljournal.claim_flush(path, 60))
+        # Cached read handles of the file are replaced
+        self.assertNotEqual(mtime, os.path.getmtime(path))
+        with closing(h5py.File(path, 'r')) as hfile:
+            data = hfile[labeljournal.dataset_path(1)]
+            self.assertTrue((data[:, :, 1] == expected).all())
+            self.assertTrue((data[:, :, 0] == 0).all())
+
+    def test_put_tile(self):
+        path = os.path.join(self.hdf5_dir, '3_3.hdf')
+        with closing(h5py.File(path, 'w')) as hfile:
+            hfile.create_dataset(labeljournal.dataset_path(1), shape=(600, 500, 2),
+                    dtype=np.uint8, chunks=(128, 128, 1))
+
+        labels = np.zeros((256, 256), dtype=np.uint8)
+        labels[10:50, 20:80] = 7
+        image = StringIO()
+        Image.fromarray(labels).save(image, 'PNG')
+        expected = np.zeros((600, 500), dtype=np.uint8)
+        expected[50:306, 100:356] = labels
+
+        def get_labels():
+            response = self.client.get('/3/stack/3/tile', {'x': 0, 'y': 0,
+                    'z': 1, 'width': 256, 'height': 256, 'scale': 1,
+                    'type': 'labels'})
+            self.assertEqual(response.status_code, 200)
+            return np.asarray(Image.open(StringIO(response.content)))
+
+        with self.settings(HDF5_STORAGE_PATH=self.hdf5_dir):
+            response = self.client.post('/3/stack/3/put_tile', {'x': 100,
+                    'y': 50, 'z': 1, 'width': 256, 'height': 256, 'scale': 1,
+                    'image': base64.encodestring(image.getvalue())})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(1, len(labeljournal.pending_records(path)))
+            self.assertTrue((get_labels() == expected[:256, :256]).all())
+
+            # Labels that are flushed right after the journal has been read
+            # are found in the file.
+            pending_records = labeljournal.pending_records
+            def read_and_flush(p):
+                records = pending_records(p)
+                self.assertEqual(1, flush_label_journal(p))
+                return records
+            with mock.patch.object(labeljournal, 'pending_records',
+                    read_and_flush):
+                self.assertTrue((get_labels() == expected[:256, :256]).all())
+            self.assertEqual([], labeljournal.pending_records(path))
+            self.assertTrue((get_labels() == expected[:256, :256]).all())
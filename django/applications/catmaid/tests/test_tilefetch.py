@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from catmaid.control.tilefetch import TileFetcher, TileCache, \
+        ImageRetrievalError
+
+
+class TileFetcherTests(TestCase):
+
+    def setUp(self):
+        self.tile_dir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(20):
+            path = os.path.join(self.tile_dir, '%s.jpg' % i)
+            with open(path, 'wb') as f:
+                f.write('tile %s' % i)
+            self.paths.append('file://' + path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tile_dir)
+
+    def test_fetch_all(self):
+        fetcher = TileFetcher(3)
+        paths = self.paths + self.paths[:5]
+        data = list(fetcher.fetch_all(paths))
+        self.assertEqual(['tile %s' % i for i in range(20) + range(5)], data)
+
+    def test_fetch_missing(self):
+        fetcher = TileFetcher(3)
+        tiles = fetcher.fetch_all([self.paths[0], 'file:///nonexistent.jpg'])
+        self.assertEqual('tile 0', next(tiles))
+        self.assertRaises(ImageRetrievalError, next, tiles)
+
+    def test_cache(self):
+        # Room for two tiles
+        cache = TileCache(2 * len('tile 10'))
+        fetcher = TileFetcher(2, cache)
+        self.assertEqual('tile 10', fetcher.fetch(self.paths[10]))
+        self.assertEqual('tile 11', fetcher.fetch(self.paths[11]))
+        self.assertEqual('tile 10', cache.get(self.paths[10]))
+
+        # Cached tiles are returned even if they aren't available anymore.
+        # Tile 11 is the least recently used and gets evicted.
+        os.remove(self.paths[10][len('file://'):])
+        self.assertEqual('tile 10', fetcher.fetch(self.paths[10]))
+        self.assertEqual('tile 12', fetcher.fetch(self.paths[12]))
+        self.assertIsNone(cache.get(self.paths[11]))
+        self.assertEqual(2 * len('tile 10'), cache.size)
@@ -0,0 +1,86 @@
+from django.test import TestCase
+from networkx import DiGraph
+
+from catmaid.control import tree_util
+from catmaid.control.tree_util import CompactArbor
+
+
+class CompactArborTests(TestCase):
+    """ Compare the results of tree_util functions on a CompactArbor with
+    those on an equivalent DiGraph.
+    """
+
+    def setUp(self):
+        # 1 - 2 - 3 - 4
+        #      \
+        #       5 - 6
+        #        \
+        #         7
+        self.node_ids = [1, 2, 3, 4, 5, 6, 7]
+        self.parent_ids = [None, 1, 2, 3, 2, 5, 5]
+        self.locations = {
+            1: (0.0, 0.0, 0.0),
+            2: (1.0, 0.0, 0.0),
+            3: (2.0, 0.0, 0.0),
+            4: (3.0, 0.0, 0.0),
+            5: (1.0, 3.0, 4.0),
+            6: (1.0, 3.0, 5.0),
+            7: (1.0, 4.0, 4.0),
+        }
+
+    def arbor(self):
+        return CompactArbor(self.node_ids, self.parent_ids,
+                [self.locations[n] for n in self.node_ids])
+
+    def digraph(self):
+        tree = DiGraph()
+        tree.add_node(1)
+        for node, parent in zip(self.node_ids, self.parent_ids):
+            if parent:
+                tree.add_edge(parent, node)
+        return tree
+
+    def test_traversal(self):
+        arbor = self.arbor()
+        self.assertEqual(1, arbor.root)
+        self.assertEqual(1, tree_util.find_root(arbor))
+        self.assertEqual(2, arbor.parent(3))
+        self.assertEqual(None, arbor.parent(1))
+        self.assertEqual([3, 5], sorted(arbor.children(2)))
+        self.assertTrue(7 in arbor)
+        self.assertFalse(8 in arbor)
+        self.assertEqual(tree_util.edge_count_to_root(self.digraph()),
+                tree_util.edge_count_to_root(arbor))
+        self.assertEqual((2, 2), tree_util.find_common_ancestor(arbor, [4, 6, 7]))
+        self.assertEqual([5, 6, 7], sorted(arbor.subarbor(5).node_ids.tolist()))
+
+    def test_partition(self):
+        expected = [[4, 3, 2, 1], [6, 5, 2], [7, 5]]
+        partition = sorted(tree_util.partition(self.arbor()), key=len, reverse=True)
+        self.assertEqual(expected[0], partition[0])
+        self.assertEqual(sorted(expected[1:]), sorted(partition[1:]))
+
+    def test_reroot(self):
+        arbor = self.arbor()
+        tree = self.digraph()
+        tree_util.reroot(arbor, 6)
+        tree_util.reroot(tree, 6)
+        self.assertEqual(6, arbor.root)
+        self.assertEqual(sorted(tree.edges()), sorted(arbor.to_digraph().edges()))
+
+    def test_simplify(self):
+        mini = tree_util.simplify(self.arbor(), [4, 6, 7])
+        expected = tree_util.simplify(self.digraph(), [4, 6, 7])
+        self.assertEqual(sorted(map(sorted, expected.edges())),
+                sorted(map(sorted, mini.edges())))
+
+    def test_spanning_tree(self):
+        spanning = tree_util.spanning_tree(self.arbor(), [3, 6])
+        expected = tree_util.spanning_tree(self.digraph(), [3, 6])
+        self.assertEqual(sorted(expected.nodes()), sorted(spanning.nodes()))
+
+    def test_cable_length(self):
+        arbor = self.arbor()
+        expected = tree_util.cable_length(self.digraph(), self.locations)
+        self.assertAlmostEqual(expected, arbor.cable_length())
+        self.assertAlmostEqual(expected, tree_util.cable_length(arbor, self.locations))
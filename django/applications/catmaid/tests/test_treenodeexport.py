@@ -0,0 +1,67 @@
+from django.test import TestCase
+
+from catmaid.control import treenodeexport
+from catmaid.control.tilefetch import ImageRetrievalError
+
+
+class Node(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeExporter(object):
+    """ An exporter that keeps files and messages in memory and fails to
+    retrieve the images of one node.
+    """
+    entity_name = 'treenode'
+    output_path = 'export'
+    archive_path = 'export.tar.gz'
+
+    def __init__(self, nodes, failing_node):
+        self.nodes = nodes
+        self.failing_node = failing_node
+        self.files = {}
+        self.messages = []
+
+    def get_entities_to_export(self):
+        return self.nodes
+
+    def create_archive(self):
+        pass
+
+    def close_archive(self):
+        pass
+
+    def create_message(self, title, message, url):
+        self.messages.append(title)
+
+    def add_file(self, path, data):
+        self.files[path] = data
+
+    def prepare_node(self, node):
+        return (node,)
+
+    def export_single_node(self, node):
+        if node is self.failing_node:
+            raise ImageRetrievalError('http://example.com/0/0_0_0.jpg', 404)
+        return [('export/%s.tiff' % node.id, 'image %s' % node.id)]
+
+    def post_process(self, nodes):
+        pass
+
+
+class TreenodeExportTests(TestCase):
+
+    def test_process_export_job(self):
+        nodes = [Node(i) for i in range(10)]
+        exporter = FakeExporter(nodes, nodes[3])
+        treenodeexport.process_export_job(exporter)
+
+        self.assertEqual(['Export of treenodes finished'], exporter.messages)
+        self.assertEqual(10, len(exporter.files))
+        for node in nodes:
+            if node is not nodes[3]:
+                self.assertEqual('image %s' % node.id,
+                        exporter.files['export/%s.tiff' % node.id])
+        error_log = exporter.files['export/error_log.txt'].splitlines()
+        self.assertEqual('3 404 http://example.com/0/0_0_0.jpg', error_log[-1])
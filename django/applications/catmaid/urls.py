@@ -184,6 +184,13 @@ urlpatterns += patterns('catmaid.control.node',
     (r'^(?P<project_id>\d+)/nodes/find-labels$', 'find_labels'),
 )
 
+# Spatial queries
+UrlParser.explicit_root_paths |= set(['{project_id}/spatial'])
+urlpatterns += patterns('catmaid.control.spatial',
+    (r'^(?P<project_id>\d+)/spatial/nearest$', 'nearest_nodes'),
+    (r'^(?P<project_id>\d+)/spatial/skeletons-within$', 'skeletons_within'),
+)
+
 # Treenode access
 UrlParser.explicit_root_paths |= set(['{project_id}/treenodes'])
 urlpatterns += patterns('catmaid.control.treenode',
@@ -240,10 +247,12 @@ urlpatterns += patterns('catmaid.control.skeleton',
 urlpatterns += patterns('catmaid.control.skeletonexport',
     (r'^(?P<project_id>\d+)/neuroml/neuroml_level3_v181$', 'export_neuroml_level3_v181'),
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/swc$', 'skeleton_swc'),
+    (r'^(?P<project_id>\d+)/skeletons/swc$', 'skeletons_swc'),
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/neuroml$', 'skeletons_neuroml'),
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/json$', 'skeleton_with_metadata'),
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/compact-json$', 'skeleton_for_3d_viewer'),
     (r'^(?P<project_id>\d+)/(?P<skeleton_id>\d+)/(?P<with_connectors>\d)/(?P<with_tags>\d)/compact-skeleton$', 'compact_skeleton'),
+    (r'^(?P<project_id>\d+)/skeletons/compact-skeleton$', 'compact_skeletons'),
     (r'^(?P<project_id>\d+)/(?P<skeleton_id>\d+)/(?P<with_nodes>\d)/(?P<with_connectors>\d)/(?P<with_tags>\d)/compact-arbor$', 'compact_arbor'),
     (r'^(?P<project_id>\d+)/(?P<skeleton_id>\d+)/(?P<with_nodes>\d)/(?P<with_connectors>\d)/(?P<with_tags>\d)/compact-arbor-with-minutes$', 'compact_arbor_with_minutes'),
     (r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/review$', 'export_review_skeleton'),
@@ -254,6 +263,11 @@ urlpatterns += patterns('catmaid.control.skeletonexport',
     (r'^(?P<project_id>\d+)/skeletons/partners-by-connector$', 'partners_by_connector'),
 )
 
+# Columnar export
+urlpatterns += patterns('catmaid.control.columnarexport',
+    (r'^(?P<project_id>\d+)/skeletons/export/columnar$', 'export_columnar'),
+)
+
 # Treenode and Connector image stack archive export
 urlpatterns += patterns('catmaid.control.treenodeexport',
     (r'^(?P<project_id>\d+)/connectorarchive/export$', 'export_connectors'),
@@ -444,6 +458,7 @@ urlpatterns += patterns('catmaid.control',
 
     # Search
     (r'^(?P<project_id>\d+)/search$', 'search.search'),
+    (r'^(?P<project_id>\d+)/search/names$', 'search.search_names'),
 
     # Wiring diagram export
     (r'^(?P<project_id>\d+)/wiringdiagram/json$', 'wiringdiagram.export_wiring_diagram'),
@@ -150,6 +150,39 @@ ROI_AUTO_CREATE_IMAGE = False
 # client.
 NODE_LIST_MAXIMUM_COUNT = 5000
 
+# The default implementation of the spatial query of the tracing overlay:
+# 'postgis' and 'classic' fetch treenodes, connectors and labels in separate
+# queries, 'postgis_json' uses a single query that returns the final JSON
+# response. Node list requests can select an implementation with the
+# "provider" parameter, e.g. for benchmarking.
+NODE_LIST_PROVIDER = 'postgis'
+
+# Spatial queries of the tracing overlay can be answered from a cache that
+# partitions each project into cells of NODE_LIST_CACHE_CELL_SIZE (x, y, z in
+# project space). To enable it, set NODE_LIST_CACHE to the name of a cache in
+# CACHES that is shared by all server processes, e.g. memcached. Cells are
+# evicted on edits, NODE_LIST_CACHE_TIMEOUT (in seconds) bounds the lifetime of
+# a cell in any case. View queries that span more than NODE_LIST_CACHE_MAX_CELLS
+# cells are sent to the database directly.
+NODE_LIST_CACHE = None
+NODE_LIST_CACHE_CELL_SIZE = (4096.0, 4096.0, 200.0)
+NODE_LIST_CACHE_TIMEOUT = 300
+NODE_LIST_CACHE_MAX_CELLS = 64
+
+# Synapse counts between skeletons (e.g. for the connectivity widget) are read
+# from the skeleton_connectivity table, which is kept up to date by database
+# triggers. If this table is suspected to be out of date (e.g. after triggers
+# had been disabled for an import), set this to False to count synapses from
+# the treenode_connector table directly and run the management command
+# catmaid_rebuild_skeleton_connectivity.
+SKELETON_CONNECTIVITY_TABLE = True
+
+# The topology and tags of the SKELETON_TOPOLOGY_CACHE_SIZE most recently used
+# skeletons are cached by each server process (e.g. for finding open leaves).
+# Cached skeletons are validated against their edit count in the database on
+# every use. A value of 0 disables this cache.
+SKELETON_TOPOLOGY_CACHE_SIZE = 64
+
 # Default importer tile width and height
 IMPORTER_DEFAULT_TILE_WIDTH = 256
 IMPORTER_DEFAULT_TILE_HEIGHT = 256
@@ -168,6 +201,33 @@ MEDIA_TREENODE_SUBDIRECTORY = 'treenode_archives'
 # than this. This defaults to 50 Megabyte.
 GENERATED_FILES_MAXIMUM_SIZE = 52428800
 
+# The cropping tool fetches image tiles with CROPPING_TILE_FETCH_THREADS
+# concurrent connections per worker process. Fetched tiles are kept in memory
+# for later crop jobs of the same process, CROPPING_TILE_CACHE_SIZE limits
+# this cache in Bytes (defaults to 128 Megabyte).
+CROPPING_TILE_FETCH_THREADS = 8
+CROPPING_TILE_CACHE_SIZE = 134217728
+
+# The treenode and connector archive export creates the image stacks of
+# NODE_EXPORT_THREADS nodes concurrently per worker process. All of them share
+# the tile fetcher and tile cache of the cropping tool.
+NODE_EXPORT_THREADS = 4
+
+# Tiles of HDF5 stacks are read from files that are kept open by each server
+# process, HDF5_FILE_HANDLE_CACHE_SIZE is the maximum number of open files.
+# Encoded tiles can additionally be cached in memory, up to HDF5_TILE_CACHE_SIZE
+# Bytes per process. This cache is disabled with a size of 0.
+HDF5_FILE_HANDLE_CACHE_SIZE = 16
+HDF5_TILE_CACHE_SIZE = 0
+
+# Label tiles that are stored for HDF5 stacks are collected in a journal, which
+# is written to the HDF5 file by a Celery task HDF5_LABEL_FLUSH_DELAY seconds
+# after the first tile has been added to it. If this task hasn't started after
+# HDF5_LABEL_FLUSH_TIMEOUT seconds, it is queued again by the next request
+# that stores or reads labels.
+HDF5_LABEL_FLUSH_DELAY = 5
+HDF5_LABEL_FLUSH_TIMEOUT = 60
+
 # Specifies if user registration is allowed
 USER_REGISTRATION_ALLOWED = False
 
@@ -179,6 +239,7 @@ NEW_USER_DEFAULT_GROUPS = []
 CELERY_IMPORTS = (
     'catmaid.control.cropping',
     'catmaid.control.roi',
+    'catmaid.control.tile',
     'catmaid.control.treenodeexport',
 )
 
@@ -17,4 +17,5 @@ CREATE DATABASE "$CATMAID_DATABASE" OWNER "$CATMAID_USER";
 
 \connect $CATMAID_DATABASE
 CREATE EXTENSION postgis;
+CREATE EXTENSION pg_trgm;
 EOSQL
@@ -3,16 +3,15 @@
 # [1] load 'export_all.py'
 # [2] project_id = 12
 # [3] export(project_id)
+#
+# Skeletons and synapses are exported as CSV and GraphML by the
+# catmaid_export_project management command into the current directory.
 
-from django.db import transaction
-import export_all_graphml
-import export_all_csv
+from django.core.management import call_command
 import export_all_annotations
 
-@transaction.atomic
 def export(project_id):
     project_id = int(project_id)
-    export_all_graphml.export(project_id, "all." + str(project_id) + ".graphml")
-    export_all_csv.export(project_id, "all")
+    call_command('catmaid_export_project', str(project_id), '.',
+            formats='csv,graphml')
     export_all_annotations.export(project_id, "all", "all")
-
@@ -1,5 +1,4 @@
 import json
-import time
 
 from django.conf import settings
 from django.http import HttpResponse
@@ -11,6 +10,7 @@ from catmaid.control.authentication import *
 from catmaid.control.common import *
 
 from catmaid.control.object import get_annotation_graph
+from catmaid.control.columnarexport import read_tables
 from catmaid.control.skeletonexport import get_treenodes_qs
 from catmaid.control.stack import get_stack_info
 
@@ -25,7 +25,6 @@ from contextlib import closing
 from random import choice
 import os
 import base64, cStringIO
-import time
 import sys
 
 # This file defines constants used to correctly define the metadata for NeuroHDF microcircuit data
@@ -60,111 +59,67 @@ ConnectivityPostsynaptic = {
     'id': 3
 }
 
-def get_skeleton_as_dataarray(project_id=None, skeleton_id=None):
-    # retrieve all treenodes for a given skeleton
+def _seconds(times):
+    return times.astype('M8[s]').astype(np.uint32)
 
-    if skeleton_id is None:
-        qs = Treenode.objects.filter(
-            project=project_id).order_by('id')
-    else:
-        qs = Treenode.objects.filter(
-            skeleton=skeleton_id,
-            project=project_id).order_by('id')
-
-    treenode_count = qs.count()
-    treenode_xyz = np.zeros( (treenode_count, 3), dtype = np.float32 )
-    treenode_parentid = np.zeros( (treenode_count,), dtype = np.uint32 )
-    treenode_id = np.zeros( (treenode_count,), dtype = np.uint32 )
-    treenode_radius = np.zeros( (treenode_count,), dtype = np.int32 )
-    treenode_confidence = np.zeros( (treenode_count,), dtype = np.uint32 )
-    treenode_userid = np.zeros( (treenode_count,), dtype = np.uint32 )
-    treenode_type = np.zeros( (treenode_count,), dtype = np.uint32 )
-    treenode_skeletonid = np.zeros( (treenode_count,), dtype = np.uint32 )
-    treenode_creationtime = np.zeros( (treenode_count,), dtype = np.uint32 )
-    treenode_modificationtime = np.zeros( (treenode_count,), dtype = np.uint32 )
-    
-    treenode_connectivity = np.zeros( (treenode_count, 2), dtype = np.uint32 )
-    treenode_connectivity_type = np.zeros( (treenode_count,), dtype = np.uint32 )
-    treenode_connectivity_skeletonid = np.zeros( (treenode_count,), dtype = np.uint32 )
-
-    row_count = 0
-    parents = 0
-    for i,tn in enumerate(qs):
-        treenode_xyz[i,0] = tn.location.x
-        treenode_xyz[i,1] = tn.location.y
-        treenode_xyz[i,2] = tn.location.z
-        treenode_id[i] = tn.id
-        treenode_radius[i] = tn.radius
-        treenode_confidence[i] = tn.confidence
-        treenode_userid[i] = tn.user_id
-        treenode_skeletonid[i] = tn.skeleton_id
-        treenode_creationtime[i] = int(time.mktime(tn.creation_time.timetuple()))
-        treenode_modificationtime[i] = int(time.mktime(tn.edition_time
-        .timetuple()))
-
-        if not tn.parent_id is None:
-            treenode_parentid[i] = tn.parent_id
-            treenode_type[i] = VerticesTypeSkeletonNode['id']
-
-            # only here save it and increment the row_count
-            treenode_connectivity_type[row_count] = ConnectivityNeurite['id']
-            treenode_connectivity_skeletonid[row_count] = treenode_skeletonid[i]
-            treenode_connectivity[row_count,0] = treenode_id[i]
-            treenode_connectivity[row_count,1] = treenode_parentid[i]
-            row_count += 1
-
-        else:
-            treenode_type[i] = VerticesTypeSkeletonRootNode['id']
-            parents+=1
-
-    # correct for too many rows because of empty root relationship
-    treenode_connectivity = treenode_connectivity[:-parents,:]
-    treenode_connectivity_type = treenode_connectivity_type[:-parents]
-    treenode_connectivity_skeletonid = treenode_connectivity_skeletonid[:-parents]
+def get_skeleton_as_dataarray(project_id=None, skeleton_id=None):
+    # retrieve all treenodes, connectors and their links for a given skeleton
+    skeleton_ids = None if skeleton_id is None else [skeleton_id]
+    tables = read_tables(project_id, skeleton_ids,
+                         ('treenodes', 'connectors', 'links'))
+
+    tn = tables['treenodes']
+    order = np.argsort(tn['id'])
+    tn = dict((name, column[order]) for name, column in tn.iteritems())
+    is_root = tn['parent_id'] == -1
+    has_parent = ~is_root
+
+    treenode_xyz = np.column_stack((tn['x'], tn['y'], tn['z'])).astype(np.float32)
+    treenode_id = tn['id'].astype(np.uint32)
+    treenode_radius = tn['radius'].astype(np.int32)
+    treenode_confidence = tn['confidence'].astype(np.uint32)
+    treenode_userid = tn['user_id'].astype(np.uint32)
+    treenode_type = np.where(is_root, VerticesTypeSkeletonRootNode['id'],
+                             VerticesTypeSkeletonNode['id']).astype(np.uint32)
+    treenode_skeletonid = tn['skeleton_id'].astype(np.uint32)
+    treenode_creationtime = _seconds(tn['creation_time'])
+    treenode_modificationtime = _seconds(tn['edition_time'])
+
+    treenode_connectivity = np.column_stack((tn['id'][has_parent],
+                                             tn['parent_id'][has_parent])).astype(np.uint32)
+    treenode_connectivity_type = np.empty(has_parent.sum(), dtype=np.uint32)
+    treenode_connectivity_type.fill(ConnectivityNeurite['id'])
+    treenode_connectivity_skeletonid = treenode_skeletonid[has_parent]
 
-    if skeleton_id is None:
-        qs_tc = TreenodeConnector.objects.filter(
-            project=project_id,
-            relation__relation_name__endswith = 'synaptic_to',
-        ).select_related('treenode', 'connector', 'relation')
-    else:
-        qs_tc = TreenodeConnector.objects.filter(
-            project=project_id,
-            skeleton=skeleton_id,
-            relation__relation_name__endswith = 'synaptic_to',
-        ).select_related('connector', 'relation__relation_name')
-
-    treenode_connector_connectivity=[]; treenode_connector_connectivity_type=[]
-    cn_type=[]; cn_xyz=[]; cn_id=[]; cn_confidence=[]; cn_userid=[]; cn_radius=[]; cn_skeletonid=[]
-    cn_skeletonid_connector=[]; cn_creationtime=[]; cn_modificationtime=[]
     # because skeletons with a single treenode might have no connectivity
     # (no parent and no synaptic connection), but we still want to recover their skeleton id, we need
     # to store the skeletonid as a property on the vertices too, with default value 0 for connectors
-    found_synapse=False
-    for tc in qs_tc:
-        if tc.relation.relation_name == 'presynaptic_to':
-            treenode_connector_connectivity_type.append( ConnectivityPresynaptic['id'] )
-            found_synapse=True
-        elif tc.relation.relation_name == 'postsynaptic_to':
-            treenode_connector_connectivity_type.append( ConnectivityPostsynaptic['id'] )
-            found_synapse=True
-        else:
-            print >> std.err, "non-synaptic relation found: ", tc.relation.relation_name
-            continue
-        treenode_connector_connectivity.append( [tc.treenode_id,tc.connector_id] ) # !!!
-        # also need other connector node information
-        cn_xyz.append( [tc.connector.location.x, tc.connector.location.y, tc.connector.location.z] )
-        cn_id.append( tc.connector_id )
-        cn_confidence.append( tc.connector.confidence )
-        cn_userid.append( tc.connector.user_id )
-        cn_radius.append( 0 ) # default because no radius for connector
-        cn_skeletonid_connector.append( 0 ) # default skeleton id for connector
-        cn_type.append( VerticesTypeConnectorNode['id'] )
-        cn_skeletonid.append( tc.skeleton_id )
-        cn_creationtime.append( int(time.mktime(tc.connector.creation_time
-        .timetuple())) )
-        cn_modificationtime.append( int(time.mktime(tc.connector.edition_time
-        .timetuple())) )
+    links = tables['links']
+    synaptic = np.in1d(links['relation'], ('presynaptic_to', 'postsynaptic_to'))
+    links = dict((name, column[synaptic]) for name, column in links.iteritems())
+    found_synapse = len(links['id']) > 0
+
+    # Find the connector of each link
+    cn = tables['connectors']
+    cn_order = np.argsort(cn['id'])
+    cn_index = cn_order[np.searchsorted(cn['id'][cn_order], links['connector_id'])]
+    cn = dict((name, column[cn_index]) for name, column in cn.iteritems())
+
+    treenode_connector_connectivity = np.column_stack((links['treenode_id'],
+                                                       links['connector_id']))
+    treenode_connector_connectivity_type = np.where(
+        links['relation'] == 'presynaptic_to', ConnectivityPresynaptic['id'],
+        ConnectivityPostsynaptic['id'])
+    cn_xyz = np.column_stack((cn['x'], cn['y'], cn['z']))
+    cn_id = cn['id']
+    cn_confidence = cn['confidence']
+    cn_userid = cn['user_id']
+    cn_radius = np.zeros(len(cn_id)) # default because no radius for connector
+    cn_skeletonid_connector = np.zeros(len(cn_id)) # default skeleton id for connector
+    cn_type = np.empty(len(cn_id)); cn_type.fill(VerticesTypeConnectorNode['id'])
+    cn_skeletonid = links['skeleton_id']
+    cn_creationtime = _seconds(cn['creation_time'])
+    cn_modificationtime = _seconds(cn['edition_time'])
 
     data = {'vert':{},'conn':{}}
     # check if we have synaptic connectivity at all